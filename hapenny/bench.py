@@ -0,0 +1,80 @@
+# Cycle-count benchmarks for the instruction test benches.
+#
+# sim-cpu.py and sim-chonk.py measure how many cycles each test case takes.
+# This module saves those counts as JSON and compares them against a saved
+# baseline (checked in under bench/), so that a change to the
+# microarchitecture that quietly adds a state to some instruction shows up as
+# a failure rather than as a slightly worse Dhrystone score months later.
+#
+# The test case names include their operands (e.g. "SLLI x1, x2, 31"), so
+# instructions whose timing depends on their operands get one entry each.
+
+import json
+
+
+def case_keys(names):
+    """Turns a list of test case names into unique keys. A few cases share
+    a name (the same instruction with different register contents); later
+    ones get " [2]", " [3]", etc. appended. Pass the names of all cases, not
+    just the ones being run, so the keys don't depend on the filter."""
+    seen = {}
+    keys = []
+    for name in names:
+        n = seen.get(name, 0) + 1
+        seen[name] = n
+        keys.append(name if n == 1 else f"{name} [{n}]")
+    return keys
+
+
+def save(path, core, cycles):
+    "Writes a benchmark: 'cycles' maps case keys to cycle counts."
+    with open(path, "w") as f:
+        json.dump({"core": core, "cycles": cycles}, f, indent = 1)
+        f.write("\n")
+
+
+def load(path):
+    "Reads a benchmark written by 'save', returning (core, cycles)."
+    with open(path) as f:
+        data = json.load(f)
+    return data["core"], data["cycles"]
+
+
+def compare(baseline, cycles):
+    """Compares measured cycle counts against a baseline (both dicts of key
+    -> cycles). Returns (regressions, improvements, new), where the first two
+    are lists of (key, baseline cycles, measured cycles) and 'new' lists keys
+    missing from the baseline. Cases in the baseline that weren't measured
+    are ignored, so filtered runs can be compared too."""
+    regressions = []
+    improvements = []
+    new = []
+    for key, measured in cycles.items():
+        if key not in baseline:
+            new.append(key)
+        elif measured > baseline[key]:
+            regressions.append((key, baseline[key], measured))
+        elif measured < baseline[key]:
+            improvements.append((key, baseline[key], measured))
+    return regressions, improvements, new
+
+
+def check(path, core, cycles):
+    """Compares 'cycles' against the baseline at 'path', printing the
+    differences. Returns True if nothing got slower."""
+    base_core, baseline = load(path)
+    if base_core != core:
+        print(f"bench: baseline {path} is for {base_core}, not {core}")
+        return False
+    regressions, improvements, new = compare(baseline, cycles)
+    for key, old, now in regressions:
+        print(f"bench: REGRESSION {key}: {old} -> {now} cycles")
+    for key, old, now in improvements:
+        print(f"bench: improved {key}: {old} -> {now} cycles")
+    for key in new:
+        print(f"bench: new case {key}: {cycles[key]} cycles")
+    if improvements or new:
+        print(f"bench: update the baseline with --bench {path}")
+    print(f"bench: {len(cycles)} cases, {len(regressions)} regressions, "
+          f"{len(improvements)} improvements")
+    return not regressions
@@ -0,0 +1,691 @@
+# Helpers for scripted iCE40 builds.
+#
+# The board scripts build through Amaranth's platform flow (yosys, then
+# nextpnr-ice40, then icepack), which leaves its logs in the build directory
+# and otherwise only tells us whether it worked. The numbers we actually care
+# about when comparing configurations -- how many logic cells it took and how
+# fast it'll go -- are buried in the nextpnr log. This module runs the flow
+# and digs them out.
+#
+# Fmax also depends a good deal on nextpnr's placement seed, so build can try
+# several seeds against the same synthesized netlist in parallel and keep the
+# fastest result.
+#
+# Given a cache directory, build also skips the tools when it has seen the
+# design before, and skips place and route when only memory contents have
+# changed (see below).
+#
+# The tools are located the way Amaranth always does it, so set YOSYS,
+# NEXTPNR_ICE40 and ICEPACK (e.g. to the yowasp- versions) if they aren't on
+# your PATH.
+
+import contextlib
+import hashlib
+import json
+import os
+import re
+import runpy
+import shutil
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+from amaranth.build.run import LocalBuildProducts
+
+
+class BuildError(Exception):
+    pass
+
+
+class Report:
+    """Resource use and timing from a nextpnr-ice40 log.
+
+    Attributes
+    ----------
+    cells: dict mapping cell type (e.g. "ICESTORM_LC") to (used, available),
+        taken from the final utilisation report in the log.
+    clocks: dict mapping clock net name to (achieved MHz, constrained MHz or
+        None), from the final timing report.
+    seed: the nextpnr seed that produced this result, if build picked it
+        from several.
+    seeds: for a multi-seed build, a dict mapping each seed tried to its
+        Report (None if nextpnr failed outright).
+    """
+    def __init__(self, cells, clocks):
+        self.cells = cells
+        self.clocks = clocks
+        self.seed = None
+        self.seeds = None
+
+    @property
+    def lcs(self):
+        "Logic cells used, or None if the log didn't get as far as placement."
+        return self.cells.get("ICESTORM_LC", (None, None))[0]
+
+    @property
+    def brams(self):
+        "Block RAMs used."
+        return self.cells.get("ICESTORM_RAM", (0, None))[0]
+
+    @property
+    def fmax(self):
+        """Achieved Fmax in MHz of the slowest constrained clock (or of the
+        slowest clock, if none are constrained), or None if the log has no
+        timing report."""
+        constrained = [f for f, target in self.clocks.values()
+                       if target is not None]
+        achieved = constrained or [f for f, _ in self.clocks.values()]
+        return min(achieved) if achieved else None
+
+    @property
+    def timing_met(self):
+        "True if every constrained clock made its target."
+        return all(target is None or f >= target
+                   for f, target in self.clocks.values())
+
+
+_CELL_RE = re.compile(r"^Info:\s+(\w+):\s+(\d+)/\s*(\d+)\s+\d+%", re.M)
+_FMAX_RE = re.compile(
+    r"^Info: Max frequency for clock\s+'([^']+)': ([\d.]+) MHz"
+    r"(?: \((?:PASS|FAIL) at ([\d.]+) MHz\))?",
+    re.M,
+)
+
+
+def parse_nextpnr_log(path):
+    """Reads a nextpnr-ice40 log (the {name}.tim file an Amaranth build
+    leaves behind) into a Report. nextpnr reports utilisation and timing more
+    than once as it goes; the last report wins."""
+    text = Path(path).read_text()
+
+    cells = {}
+    for cell, used, total in _CELL_RE.findall(text):
+        cells[cell] = (int(used), int(total))
+
+    clocks = {}
+    for clock, achieved, target in _FMAX_RE.findall(text):
+        clocks[clock] = (float(achieved), float(target) if target else None)
+
+    return Report(cells, clocks)
+
+
+def build(platform, top, *, build_dir, name = "top", seeds = None,
+          jobs = None, cache = None, do_program = False, **kwargs):
+    """Builds 'top' for 'platform' in 'build_dir', and returns the Report for
+    the result. Extra keyword arguments are passed to platform.build, so
+    toolchain overrides like nextpnr_opts work.
+
+    If 'seeds' is given (a count, or a list of seeds), the netlist is
+    synthesized once and then placed and routed once per seed, 'jobs' at a
+    time (default: all of them). The result with the highest Fmax is kept as
+    {name}.asc/.tim/.bin, and each seed's result is recorded in the report's
+    'seeds' and in {name}.seeds.json. The build fails if no seed meets
+    timing, as the plain build would, unless nextpnr_opts allows that.
+
+    If 'cache' names a directory, results are kept there and reused, keyed by
+    the design, constraints, toolchain options and versions. A design that
+    has been built before gets its old bitstream back without running any
+    tools. A design that differs only in memory contents is synthesized, but
+    not placed or routed: the new contents are written into the old
+    placement's block RAMs.
+
+    Every build also records which block RAMs hold which memories in
+    {name}.brams.json, so that update_memories can change their contents
+    later without running the tools.""" 
+    if seeds is not None and isinstance(seeds, int):
+        seeds = range(1, seeds + 1)
+    seeds = None if seeds is None else list(seeds)
+    plan = platform.build(top, name = name, do_build = False, **kwargs)
+    products = plan.extract(str(build_dir))
+    if cache is None:
+        report = _run_plan(plan, Path(build_dir), name, seeds, jobs)
+    else:
+        report = _run_cached(plan, Path(build_dir), name, seeds, jobs,
+                             Path(cache))
+    if do_program:
+        platform.toolchain_program(products, name)
+    return report
+
+
+def _run_tool(argv, cwd, **kwargs):
+    # Finds tools the way Amaranth's generated build scripts do: an
+    # environment variable named after the tool, or else the tool's name.
+    tool = os.environ.get(argv[0].upper().replace("-", "_"), argv[0])
+    return subprocess.run([tool, *argv[1:]], cwd = cwd, check = True,
+                          **kwargs)
+
+
+def _replace_arg(argv, flag, value):
+    argv = list(argv)
+    argv[argv.index(flag) + 1] = value
+    return argv
+
+
+def _plan_commands(build_dir, name):
+    # The build plan carries its own command lines in machine-readable form,
+    # so rather than re-deriving the nextpnr options for the device, we take
+    # them from there and only change what we need to.
+    plan_json = build_dir / f"build_{name}.json"
+    return json.loads(plan_json.read_text())["commands"]
+
+
+def _run_plan(plan, build_dir, name, seeds, jobs):
+    # Runs an extracted build plan's commands, placing with each of 'seeds'
+    # if given. Either way, we also have nextpnr write out the routed
+    # netlist, which is how we find out where the block RAMs went.
+    synth, pnr, pack = _plan_commands(build_dir, name)
+    _run_tool(synth, build_dir)
+    if seeds is None:
+        _run_tool(pnr + ["--write", f"{name}.routed.json"], build_dir)
+        report = parse_nextpnr_log(build_dir / f"{name}.tim")
+    else:
+        report = _place_seeds(build_dir, name, pnr, seeds, jobs)
+    _run_tool(pack, build_dir)
+    _record_brams(plan, build_dir, name)
+    return report
+
+
+def _place_seeds(build_dir, name, pnr, seeds, jobs):
+    # Failing timing on one seed shouldn't stop the others; we decide whether
+    # the build failed once we've seen them all.
+    allow_fail = "--timing-allow-fail" in pnr
+    if not allow_fail:
+        pnr = pnr + ["--timing-allow-fail"]
+
+    def place(seed):
+        argv = _replace_arg(pnr, "--log", f"{name}.seed{seed}.tim")
+        argv = _replace_arg(argv, "--asc", f"{name}.seed{seed}.asc")
+        argv += ["--write", f"{name}.seed{seed}.routed.json"]
+        try:
+            _run_tool(argv + ["--seed", str(seed)], build_dir)
+        except subprocess.CalledProcessError:
+            return None
+        return parse_nextpnr_log(build_dir / f"{name}.seed{seed}.tim")
+
+    with ThreadPoolExecutor(max_workers = jobs or len(seeds)) as pool:
+        results = dict(zip(seeds, pool.map(place, seeds)))
+
+    with open(build_dir / f"{name}.seeds.json", "w") as f:
+        json.dump({
+            str(seed): None if r is None else {
+                "lcs": r.lcs,
+                "fmax": r.fmax,
+                "timing_met": r.timing_met,
+            }
+            for seed, r in results.items()
+        }, f, indent = 1)
+        f.write("\n")
+
+    placed = [(r.fmax, seed) for seed, r in results.items()
+              if r is not None and r.fmax is not None]
+    if not placed:
+        raise BuildError(f"nextpnr failed for every seed; see {build_dir}")
+    _, best = max(placed)
+    report = results[best]
+    report.seed = best
+    report.seeds = results
+    if not (allow_fail or report.timing_met):
+        raise BuildError(f"no seed met timing; best was seed {best} at "
+                         f"{report.fmax} MHz (see {name}.seeds.json)")
+
+    for ext in ["asc", "tim", "routed.json"]:
+        shutil.copyfile(build_dir / f"{name}.seed{best}.{ext}",
+                        build_dir / f"{name}.{ext}")
+    return report
+
+
+# The build cache.
+#
+# Each build is filed under two keys. The bitstream key covers everything
+# that goes into the tools -- the RTLIL, the constraints, the command lines
+# (which name the device and package), the seeds, and the tool versions -- so
+# a hit there means the bitstream would come out the same. The placement key
+# is the same thing with the memory initialization data blanked out of the
+# RTLIL, so a hit there means the logic and its placement would come out the
+# same, and only the memory contents differ. That's only good enough if all
+# those memories are in block RAM, where we can change them: yosys turns small
+# memories into logic, so the build's record keeps a digest of each of those
+# memories' contents as well, and a change to any of them means a full build.
+#
+# Yosys' src attributes are left out of both, since they record file paths and
+# line numbers in the Python source, which change all the time without
+# affecting the design.
+
+_tool_versions = {}
+
+def _tool_version(tool, flag):
+    if tool not in _tool_versions:
+        result = _run_tool([tool, flag], None, capture_output = True,
+                           text = True)
+        _tool_versions[tool] = (result.stdout + result.stderr).strip()
+    return _tool_versions[tool]
+
+
+_SRC_RE = re.compile(r"^\s*attribute \\src .*\n", re.M)
+_MEMINIT_DATA_RE = re.compile(
+    r"(cell \$meminit(?:_v2)? .*?connect \\DATA )\S+", re.S)
+
+def _cache_keys(plan, name, seeds):
+    """Returns (bitstream key, placement key) for an extracted plan."""
+    rtlil = _SRC_RE.sub("", plan.files[f"{name}.il"])
+    common = hashlib.sha256()
+    for file in sorted(plan.files):
+        # The .il is hashed separately below; the rest of the build scripts
+        # and the debug Verilog are derived from things we already hash.
+        if file.endswith((".il", ".v", ".sh", ".bat")):
+            continue
+        contents = plan.files[file]
+        if isinstance(contents, str):
+            contents = contents.encode()
+        common.update(file.encode() + b"\0" + contents + b"\0")
+    for tool, flag in [("yosys", "-V"), ("nextpnr-ice40", "--version")]:
+        common.update(_tool_version(tool, flag).encode() + b"\0")
+
+    bitstream = common.copy()
+    bitstream.update(rtlil.encode())
+    bitstream.update(repr(seeds).encode())
+
+    placement = common.copy()
+    placement.update(_MEMINIT_DATA_RE.sub(r"\1-", rtlil).encode())
+
+    return bitstream.hexdigest(), placement.hexdigest()
+
+
+def _store(entry, build_dir, files):
+    # Fills a cache entry atomically, so that an interrupted build can't
+    # leave behind an entry with some of its files missing.
+    tmp = entry.with_name(entry.name + ".tmp")
+    shutil.rmtree(tmp, ignore_errors = True)
+    tmp.mkdir(parents = True)
+    for file in files:
+        if (build_dir / file).exists():
+            shutil.copyfile(build_dir / file, tmp / file)
+    shutil.rmtree(entry, ignore_errors = True)
+    tmp.rename(entry)
+
+
+def _run_cached(plan, build_dir, name, seeds, jobs, cache):
+    bitstream_key, placement_key = _cache_keys(plan, name, seeds)
+    bitstream_entry = cache / "bitstream" / bitstream_key
+    placement_entry = cache / "placement" / placement_key
+    products = [f"{name}.asc", f"{name}.bin", f"{name}.tim",
+                f"{name}.seeds.json", f"{name}.brams.json"]
+
+    if bitstream_entry.exists():
+        print(f"build cache: design unchanged, reusing {bitstream_entry}")
+        for file in products:
+            if (bitstream_entry / file).exists():
+                shutil.copyfile(bitstream_entry / file, build_dir / file)
+        return parse_nextpnr_log(build_dir / f"{name}.tim")
+
+    report = None
+    if placement_entry.exists():
+        report = _reuse_placement(plan, placement_entry, build_dir, name)
+
+    if report is None:
+        report = _run_plan(plan, build_dir, name, seeds, jobs)
+        if (build_dir / f"{name}.brams.json").exists():
+            _store(placement_entry, build_dir, products)
+
+    _store(bitstream_entry, build_dir, products)
+    return report
+
+
+def _top_cells(netlist):
+    for module in netlist["modules"].values():
+        if module.get("attributes", {}).get("top"):
+            return module["cells"]
+    # nextpnr's output has only the one module.
+    return next(iter(netlist["modules"].values()))["cells"]
+
+
+def _reuse_placement(plan, entry, build_dir, name):
+    # Writes the design's new memory contents into the cached placement's
+    # bitstream. Returns None (meaning: do a full build) if a memory that
+    # isn't in block RAM has changed, or if the RAMs don't line up with the
+    # cached ones after all, e.g. if yosys optimized differently given the
+    # new contents.
+    for file in [f"{name}.tim", f"{name}.seeds.json", f"{name}.brams.json"]:
+        if (entry / file).exists():
+            shutil.copyfile(entry / file, build_dir / file)
+    record = json.loads((build_dir / f"{name}.brams.json").read_text())
+    asc = (entry / f"{name}.asc").read_text()
+    _, _, pack = _plan_commands(build_dir, name)
+    memories = _rtlil_memories(plan.files[f"{name}.il"], name)
+
+    changed = _changed_logic_memories(record, memories)
+    if changed:
+        print(f"build cache: memories {changed} are in logic and have "
+              f"changed, so not reusing {entry}")
+        return None
+
+    if not record["unmapped"]:
+        # We know where every memory's bits go, so the new contents can be
+        # taken straight from the RTLIL.
+        contents = _bram_contents(record, memories)
+    else:
+        # Some RAMs hold things we can't lay out ourselves, so let yosys do
+        # it and copy the INIT values from the netlist.
+        synth, _, _ = _plan_commands(build_dir, name)
+        _run_tool(synth, build_dir)
+        netlist = json.loads((build_dir / f"{name}.json").read_text())
+        rams = dict(record["rams"])
+        contents = {}
+        for cell_name, cell in _top_cells(netlist).items():
+            if not cell["type"].startswith("SB_RAM40_4K"):
+                continue
+            if cell_name not in rams:
+                return None
+            x, y = rams.pop(cell_name)
+            contents[x, y] = _cell_init(cell)
+        if rams:
+            return None
+
+    print(f"build cache: only memory contents changed, reusing {entry}")
+    (build_dir / f"{name}.asc").write_text(patch_asc_rams(asc, contents))
+    _run_tool(pack, build_dir)
+    return parse_nextpnr_log(build_dir / f"{name}.tim")
+
+
+def _cell_init(cell):
+    return [_param_bits(cell["parameters"].get(f"INIT_{i:X}", "0"))
+            for i in range(16)]
+
+
+def _param_bits(value):
+    # Yosys writes wide parameters to JSON as binary strings, MSB first;
+    # undefined bits come out as x, which the bitstream can't express.
+    if isinstance(value, int):
+        return value
+    return int(value.replace("x", "0").replace("z", "0"), 2)
+
+
+def patch_asc_rams(asc, contents):
+    """Replaces block RAM contents in an IceStorm ASCII bitstream. 'contents'
+    maps the (x, y) tile of each RAM to be changed to a list of sixteen
+    256-bit integers, the same as the RAM's INIT_0 through INIT_F."""
+    lines = asc.split("\n")
+    seen = set()
+    for i, line in enumerate(lines):
+        if line.startswith(".ram_data "):
+            x, y = map(int, line.split()[1:3])
+            if (x, y) in contents:
+                lines[i + 1:i + 17] = [f"{row:064x}"
+                                       for row in contents[x, y]]
+                seen.add((x, y))
+    missing = set(contents) - seen
+    if missing:
+        raise BuildError(f"bitstream has no RAM at {sorted(missing)}")
+    return "\n".join(lines)
+
+
+# Block RAM contents.
+#
+# To change what's in a memory without rebuilding, we need to know which
+# block RAMs yosys used for it, where nextpnr put them, and how its words are
+# laid out in their INIT bits. The first two come from the netlists. For the
+# third, yosys names the RAMs for a memory M as M.0.0, M.0.1, and so on, and
+# runs them all in one of the four SB_RAM40_4K modes: 256x16, 512x8, 1024x4
+# or 2048x2. For a memory W bits wide in a mode w bits wide, RAM k holds data
+# bits (k % (W/w)) * w and up, of the (k // (W/w))'th run of 256x(16/w)
+# words. Within each RAM, each 16-bit row of INIT holds 16/w consecutive
+# words, interleaved in bit-reversed order as described in the iCE40 memory
+# usage guide.
+#
+# That's a lot of reverse engineering to trust, so when we record a build we
+# also check that the layout reproduces the INIT values yosys actually
+# generated. Memories that fail the check, and RAMs that don't belong to a
+# memory from the RTLIL, are recorded as unmapped and can't be updated.
+
+_MEMORY_RE = re.compile(r"^  memory width (\d+) (?:offset \d+ )?size (\d+) "
+                        r"\\(\S+)$", re.M)
+_MEMINIT_RE = re.compile(
+    r"^  cell \$meminit(?:_v2)? \S+\n(.*?)^  end$", re.M | re.S)
+
+
+def _rtlil_memories(rtlil, name):
+    """Finds the memories in the RTLIL of the design called 'name'. Returns a
+    dict mapping each memory's name (as yosys names it after flattening, e.g.
+    "bootmem.U$0") to (width, depth, list of initial words)."""
+    memories = {}
+    # Amaranth names each module after its path in the hierarchy, which is
+    # also what flattening prefixes its contents with.
+    for module in re.split(r"^module ", rtlil, flags = re.M)[1:]:
+        path = module.split("\n", 1)[0].strip().lstrip("\\")
+        prefix = "" if path == name else path[len(name) + 1:] + "."
+        local = {}
+        for width, depth, memid in _MEMORY_RE.findall(module):
+            local[memid] = (int(width), int(depth), [0] * int(depth))
+        for body in _MEMINIT_RE.findall(module):
+            memid = re.search(r'parameter \\MEMID "\\\\(.*)"', body)[1]
+            addr = _rtlil_const(re.search(r"connect \\ADDR (.*)", body)[1])
+            data = _rtlil_const(re.search(r"connect \\DATA (.*)", body)[1])
+            width, depth, words = local[memid]
+            count = int(re.search(r"parameter \\WORDS (\d+)", body)[1])
+            for i in range(count):
+                words[addr + i] = (data >> (i * width)) & ((1 << width) - 1)
+        for memid, memory in local.items():
+            memories[prefix + memid] = memory
+    return memories
+
+
+def _rtlil_const(text):
+    # Constants in RTLIL look like 16'0101...; an empty concatenation ({ })
+    # is what Amaranth writes for a zero-width address.
+    text = text.strip()
+    if text.startswith("{"):
+        return 0
+    _, bits = text.split("'")
+    return int(bits.replace("x", "0").replace("z", "0") or "0", 2)
+
+
+def _bitrev(value, width):
+    return int(f"{value:0{width}b}"[::-1], 2) if width else 0
+
+
+def _bram_init(mode, width, index, words):
+    """Computes INIT_0 through INIT_F for the index'th block RAM of a memory
+    'width' bits wide mapped in 'mode' (0-3, i.e. 256x16 through 2048x2),
+    given the memory's words."""
+    w = 16 >> mode
+    slices = -(-width // w)
+    addr_base = (index // slices) * (256 << mode)
+    bit_base = (index % slices) * w
+    init = 0
+    for p in range(4096):
+        row, col = p >> 4, p & 15
+        addr = (addr_base + (row << mode)
+                + _bitrev(col & ((1 << mode) - 1), mode))
+        bit = bit_base + _bitrev(col >> mode, 4 - mode)
+        if addr < len(words) and bit < width and (words[addr] >> bit) & 1:
+            init |= 1 << p
+    return [(init >> (256 * i)) & ((1 << 256) - 1) for i in range(16)]
+
+
+def _record_brams(plan, build_dir, name):
+    # Writes {name}.brams.json after a build: the tile of every block RAM,
+    # the layout of every memory we can update, the contents of those that
+    # went into logic, and the placement key, so that update_memories can
+    # tell whether the logic has changed since.
+    routed = json.loads((build_dir / f"{name}.routed.json").read_text())
+    rams = {}
+    for cell_name, cell in _top_cells(routed).items():
+        if cell["type"] != "ICESTORM_RAM":
+            continue
+        bel = cell["attributes"].get("NEXTPNR_BEL", "")
+        match = re.fullmatch(r"X(\d+)/Y(\d+)/ram", bel)
+        if not match or not cell_name.endswith("_RAM"):
+            # Not a netlist we understand; leave no record rather than a
+            # wrong one.
+            (build_dir / f"{name}.brams.json").unlink(missing_ok = True)
+            return
+        rams[cell_name[:-len("_RAM")]] = [int(match[1]), int(match[2])]
+
+    netlist = json.loads((build_dir / f"{name}.json").read_text())
+    cells = {cell_name: cell for cell_name, cell in _top_cells(netlist).items()
+             if cell["type"].startswith("SB_RAM40_4K")}
+    rtlil_memories = _rtlil_memories(plan.files[f"{name}.il"], name)
+
+    memories = {}
+    logic_memories = {}
+    unmapped = set(cells)
+    for mem_name, (width, depth, words) in rtlil_memories.items():
+        mem_cells = []
+        while f"{mem_name}.0.{len(mem_cells)}" in cells:
+            mem_cells.append(f"{mem_name}.0.{len(mem_cells)}")
+        if not mem_cells:
+            # Not in block RAM (e.g. turned into logic), so its contents are
+            # part of the placement, though the placement key can't see them.
+            logic_memories[mem_name] = _memory_digest(words)
+            continue
+        modes = {int(cells[c]["parameters"].get("READ_MODE", "0"), 2)
+                 for c in mem_cells}
+        if len(modes) != 1:
+            continue
+        mode = modes.pop()
+        if any(_bram_init(mode, width, i, words) != _cell_init(cells[c])
+               for i, c in enumerate(mem_cells)):
+            continue
+        memories[mem_name] = {
+            "width": width,
+            "depth": depth,
+            "mode": mode,
+            "tiles": [rams[c] for c in mem_cells],
+        }
+        unmapped -= set(mem_cells)
+
+    _, placement_key = _cache_keys(plan, name, None)
+    with open(build_dir / f"{name}.brams.json", "w") as f:
+        json.dump({
+            "placement_key": placement_key,
+            "rams": rams,
+            "memories": memories,
+            "logic_memories": logic_memories,
+            "unmapped": sorted(unmapped),
+        }, f, indent = 1)
+        f.write("\n")
+
+
+def _memory_digest(words):
+    return hashlib.sha256(json.dumps(words).encode()).hexdigest()
+
+
+def _changed_logic_memories(record, memories):
+    # Names the memories (as returned by _rtlil_memories) that the recorded
+    # build put in logic, whose contents have changed since. Ones that have
+    # gone change the placement key anyway.
+    return sorted(
+        mem_name for mem_name, digest in record["logic_memories"].items()
+        if mem_name in memories
+        and _memory_digest(memories[mem_name][2]) != digest
+    )
+
+
+def _bram_contents(record, memories):
+    # Lays out the given memories (as returned by _rtlil_memories) into the
+    # RAMs recorded for them, for patch_asc_rams.
+    contents = {}
+    for mem_name, (width, depth, words) in memories.items():
+        if mem_name not in record["memories"]:
+            continue
+        layout = record["memories"][mem_name]
+        if (width, depth) != (layout["width"], layout["depth"]):
+            raise BuildError(
+                f"memory {mem_name} is now {depth}x{width}, but the "
+                f"bitstream has it as {layout['depth']}x{layout['width']}; "
+                f"a full build is needed")
+        for i, (x, y) in enumerate(layout["tiles"]):
+            contents[x, y] = _bram_init(layout["mode"], width, i, words)
+    return contents
+
+
+def update_memories(platform, top, *, build_dir, name = "top",
+                    do_program = False, **kwargs):
+    """Updates the memory contents of the bitstream in 'build_dir' to match
+    'top', without running yosys or nextpnr. This is for changing firmware:
+    the design is elaborated to find the new contents, which are written into
+    the block RAMs recorded by the last build, and the bitstream is repacked.
+
+    Raises BuildError if the last build left no record, if any memory changed
+    shape, if a memory that isn't in block RAM changed contents, or if
+    anything other than memory contents changed since."""
+    build_dir = Path(build_dir)
+    record_path = build_dir / f"{name}.brams.json"
+    if not record_path.exists():
+        raise BuildError(f"no block RAM record in {build_dir}; "
+                         f"a full build is needed")
+    record = json.loads(record_path.read_text())
+
+    plan = platform.build(top, name = name, do_build = False, **kwargs)
+    memories = _rtlil_memories(plan.files[f"{name}.il"], name)
+    gone = set(record["memories"]) - set(memories)
+    if gone:
+        raise BuildError(f"memories {sorted(gone)} are no longer in the "
+                         f"design; a full build is needed")
+    # Check the shapes first, since that's the more useful message.
+    contents = _bram_contents(record, memories)
+    _, placement_key = _cache_keys(plan, name, None)
+    if placement_key != record["placement_key"]:
+        raise BuildError("the design has changed in more than its memory "
+                         "contents since the last build; a full build is "
+                         "needed")
+    changed = _changed_logic_memories(record, memories)
+    if changed:
+        raise BuildError(f"memories {changed} have changed, but aren't in "
+                         f"block RAM, so can't be updated; a full build is "
+                         f"needed")
+    if record["unmapped"]:
+        raise BuildError(f"can't update RAMs {record['unmapped']}, which "
+                         f"don't hold a memory whose layout we know; a full "
+                         f"build is needed")
+
+    asc = build_dir / f"{name}.asc"
+    asc.write_text(patch_asc_rams(asc.read_text(), contents))
+    _, _, pack = _plan_commands(build_dir, name)
+    _run_tool(pack, build_dir)
+    if do_program:
+        platform.toolchain_program(LocalBuildProducts(str(build_dir)), name)
+    return parse_nextpnr_log(build_dir / f"{name}.tim")
+
+
+def seed_summary(report):
+    """Describes the spread of results from a multi-seed build, one line per
+    seed, fastest first."""
+    lines = []
+    ranked = sorted(report.seeds.items(),
+                    key = lambda i: -1 if i[1] is None or i[1].fmax is None
+                                    else i[1].fmax,
+                    reverse = True)
+    for seed, r in ranked:
+        mark = "*" if seed == report.seed else " "
+        if r is None or r.fmax is None:
+            lines.append(f"{mark} seed {seed:3}: failed")
+        else:
+            met = "" if r.timing_met else " (timing not met)"
+            lines.append(f"{mark} seed {seed:3}: {r.fmax:7.2f} MHz{met}")
+    fmaxes = [r.fmax for r in report.seeds.values()
+              if r is not None and r.fmax is not None]
+    lines.append(f"fmax over {len(fmaxes)} seeds: min {min(fmaxes):.2f}, "
+                 f"median {sorted(fmaxes)[len(fmaxes) // 2]:.2f}, "
+                 f"max {max(fmaxes):.2f} MHz")
+    return "\n".join(lines)
+
+
+def build_script(script, params, *, build_dir, **kwargs):
+    """Builds the design from a board script, the way sweep.py does it.
+
+    The script must define a Test class, which is constructed with 'params'
+    as keyword arguments, and a PLATFORM class to build it for. The script is
+    run without __name__ set to "__main__", so its own build doesn't start.
+    Anything the script prints goes to build.log in the build directory.
+
+    This is a module-level function so that it can be handed to a process
+    pool."""
+    build_dir = Path(build_dir)
+    build_dir.mkdir(parents = True, exist_ok = True)
+    with open(build_dir / "build.log", "w") as log, \
+            contextlib.redirect_stdout(log):
+        board = runpy.run_path(str(script), run_name = "hapenny_build_board")
+        top = board["Test"](**params)
+        return build(board["PLATFORM"](), top, build_dir = build_dir,
+                     **kwargs)
@@ -5,7 +5,7 @@ from amaranth.lib.wiring import *
 from amaranth.lib.enum import *
 from amaranth.lib.coding import Encoder, Decoder
 
-from hapenny import StreamSig, AlwaysReady, treeduce
+from hapenny import StreamSig, AlwaysReady, treeduce, mux, oneof
 
 import logging
 
@@ -24,16 +24,35 @@ class BusCmd(Signature):
         })
 
 class BusPort(Signature):
-    def __init__(self, *, addr, data):
+    """The hapenny bus.
+
+    A command issued with cmd.valid is normally accepted on the cycle it's
+    issued, and a load's data appears on resp on the following cycle.
+
+    Parameters
+    ----------
+    addr (int): number of address bits.
+    data (int): number of data bits.
+    wait_states (bool): if True, cmd also has a ready signal, and a device that
+        needs more time can hold it low to make the requester wait. The
+        requester holds the same command on the bus until ready goes high,
+        which is the cycle the command is accepted; the response still comes
+        on the cycle after that, and is only valid for that one cycle. Devices
+        without this signal are always ready.
+    """
+    def __init__(self, *, addr, data, wait_states = False):
+        cmd = BusCmd(addr=addr, data=data)
         super().__init__({
-            'cmd': Out(AlwaysReady(BusCmd(addr=addr, data=data))),
+            'cmd': Out(StreamSig(cmd) if wait_states else AlwaysReady(cmd)),
             'resp': In(data),
         })
 
-def partial_decode(m, bus, width):
-    assert width >= bus.cmd.payload.addr.shape().width, \
-            "can't use partial_decode to make a bus narrower"
-    port = BusPort(addr = width, data = bus.cmd.payload.data.shape()).flip().create()
+def has_wait_states(bus):
+    "Checks whether a bus port has a cmd.ready signal."
+    return hasattr(bus.cmd, 'ready')
+
+def _forward(m, bus, port):
+    # Connects port, the device side of an adapter, through to bus.
     m.d.comb += [
         bus.cmd.payload.addr.eq(port.cmd.payload.addr),
         bus.cmd.payload.data.eq(port.cmd.payload.data),
@@ -42,23 +61,63 @@ def partial_decode(m, bus, width):
 
         port.resp.eq(bus.resp),
     ]
+    if has_wait_states(bus):
+        m.d.comb += port.cmd.ready.eq(bus.cmd.ready)
+
+def partial_decode(m, bus, width):
+    assert width >= bus.cmd.payload.addr.shape().width, \
+            "can't use partial_decode to make a bus narrower"
+    port = BusPort(addr = width, data = bus.cmd.payload.data.shape(),
+                   wait_states = has_wait_states(bus)).flip().create()
+    _forward(m, bus, port)
     return port
 
 def narrow_addr(m, bus, width):
     assert width <= bus.cmd.payload.addr.shape().width, \
             "can't use narrow_addr to make a bus wider"
-    port = BusPort(addr = width, data = bus.cmd.payload.data.shape()).flip().create()
+    port = BusPort(addr = width, data = bus.cmd.payload.data.shape(),
+                   wait_states = has_wait_states(bus)).flip().create()
+    _forward(m, bus, port)
+    return port
+
+def add_wait_states(m, bus, cycles):
+    """Makes a device that always answers in one cycle answer in cycles + 1
+    instead, by holding off every command for 'cycles' cycles before passing
+    it through. Mostly useful for testing.
+
+    Returns a port with wait states, for connecting to a fabric."""
+    assert not has_wait_states(bus), "device already has wait states"
+    port = BusPort(
+        addr = bus.cmd.payload.addr.shape(),
+        data = bus.cmd.payload.data.shape(),
+        wait_states = True,
+    ).flip().create()
+
+    waited = Signal(range(cycles + 1))
     m.d.comb += [
         bus.cmd.payload.addr.eq(port.cmd.payload.addr),
         bus.cmd.payload.data.eq(port.cmd.payload.data),
         bus.cmd.payload.lanes.eq(port.cmd.payload.lanes),
-        bus.cmd.valid.eq(port.cmd.valid),
+        # Only pass the command through on the cycle we accept it.
+        bus.cmd.valid.eq(port.cmd.valid & port.cmd.ready),
+        port.cmd.ready.eq(waited == cycles),
 
         port.resp.eq(bus.resp),
     ]
+    m.d.sync += waited.eq(mux(
+        port.cmd.valid & ~port.cmd.ready,
+        waited + 1,
+        0,
+    ))
     return port
 
 class SimpleFabric(Elaboratable):
+    """Connects several devices to one requester, selecting between them using
+    the top address bits.
+
+    If any device has wait states, so does the fabric's bus; devices without
+    them are always ready.
+    """
     def __init__(self, devices):
         assert len(devices) > 0
         data_bits = max(p.cmd.payload.data.shape().width for p in devices)
@@ -69,9 +128,11 @@ class SimpleFabric(Elaboratable):
         self.extra_bits = (len(devices) - 1).bit_length()
         self.addr_bits = addr_bits
         self.data_bits = data_bits
+        self.wait_states = any(has_wait_states(d) for d in devices)
 
         self.bus = BusPort(addr = addr_bits + self.extra_bits, data =
-                                 data_bits).flip().create()
+                           data_bits, wait_states = self.wait_states,
+                           ).flip().create()
 
     def elaborate(self, platform):
         m = Module()
@@ -109,4 +170,115 @@ class SimpleFabric(Elaboratable):
 
         m.d.comb += self.bus.resp.eq(treeduce(lambda a, b: a | b, response_data))
 
+        # The bus is ready unless the addressed device says otherwise. (In
+        # particular, nonexistent devices are always ready, so that a wild
+        # access doesn't hang the requester.)
+        if self.wait_states:
+            waiting = [
+                (devid == i) & ~d.cmd.ready
+                for (i, d) in enumerate(self.devices)
+                if has_wait_states(d)
+            ]
+            m.d.comb += self.bus.cmd.ready.eq(
+                ~treeduce(lambda a, b: a | b, waiting)
+            )
+
+        return m
+
+class BusArbiter(Elaboratable):
+    """Shares one device (or a fabric full of them) between several
+    requesters, such as the CPUs of a multi-core SoC.
+
+    Each requester gets a port with wait states, and the device belongs to
+    one of them at a time; the others' commands wait. So the requesters must
+    be able to wait -- a Cpu needs wait_states = True. The device stays with
+    whoever has it until someone else has a command waiting, and then goes to
+    the next one in line, round robin (unless the device itself is holding
+    off a command, which keeps it where it is). A requester that has the
+    device to itself never waits, but one that finds another there waits at
+    least a cycle.
+
+    Who has the device is decided a cycle ahead, so that whether a requester
+    may go doesn't depend on what the others are doing on the same cycle.
+    That would make a long path from every requester's command through every
+    other's ready -- which, for a Cpu, stalls everything.
+
+    The device's response goes to every requester, since each one only looks
+    at it on the cycle after its own command is accepted.
+
+    Parameters
+    ----------
+    device: the bus port to share.
+    count (int): number of requesters.
+
+    Attributes
+    ----------
+    buses (list of port): one per requester, with the device's address and
+        data widths, and wait states.
+    grant (out): the requester that has the device. Devices that care who's
+        asking, like Mailbox, can look at this.
+    """
+    def __init__(self, device, count):
+        assert count > 0
+        self.device = device
+        self.count = count
+        addr_bits = device.cmd.payload.addr.shape().width
+        data_bits = device.cmd.payload.data.shape().width
+        self.buses = [
+            BusPort(addr = addr_bits, data = data_bits,
+                    wait_states = True).flip().create()
+            for _ in range(count)
+        ]
+        self.grant = Signal(range(count))
+
+    def elaborate(self, platform):
+        m = Module()
+
+        valid = Cat(*(b.cmd.valid for b in self.buses))
+        if has_wait_states(self.device):
+            device_ready = self.device.cmd.ready
+        else:
+            device_ready = 1
+
+        # The device goes to the first requester after the current one that
+        # has a command waiting, if any...
+        next_grant = Signal(range(self.count))
+        m.d.comb += next_grant.eq(self.grant)
+        with m.Switch(self.grant):
+            for g in range(self.count):
+                with m.Case(g):
+                    # Lowest priority first, so that later assignments win.
+                    for k in range(self.count - 1, 0, -1):
+                        r = (g + k) % self.count
+                        with m.If(valid[r]):
+                            m.d.comb += next_grant.eq(r)
+        # ...unless the device is holding off the current one's command.
+        m.d.sync += self.grant.eq(mux(
+            self.device.cmd.valid & ~device_ready,
+            self.grant,
+            next_grant,
+        ))
+
+        cmd = self.device.cmd
+        m.d.comb += [
+            cmd.payload.addr.eq(oneof([
+                (self.grant == i, b.cmd.payload.addr)
+                for (i, b) in enumerate(self.buses)
+            ])),
+            cmd.payload.data.eq(oneof([
+                (self.grant == i, b.cmd.payload.data)
+                for (i, b) in enumerate(self.buses)
+            ])),
+            cmd.payload.lanes.eq(oneof([
+                (self.grant == i, b.cmd.payload.lanes)
+                for (i, b) in enumerate(self.buses)
+            ])),
+            cmd.valid.eq(valid.bit_select(self.grant, 1)),
+        ]
+        for (i, b) in enumerate(self.buses):
+            m.d.comb += [
+                b.cmd.ready.eq((self.grant == i) & device_ready),
+                b.resp.eq(self.device.resp),
+            ]
+
         return m
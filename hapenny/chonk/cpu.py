@@ -59,6 +59,9 @@ class Cpu(Component):
         address range, and I/O devices higher, you can set this parameter to
         smaller than addr_width to save some area. If not explicitly
         overridden, this is the same as addr_width.  addr_width.
+    counters (bool): implement the cycle and instret counters.
+    shift_bits_per_cycle (int): how many bits the shifter moves per cycle, one
+        of 1, 2, 4, 8 or 16. See EWBox. Default 1.
 
     Attributes
     ----------
@@ -80,6 +83,7 @@ class Cpu(Component):
                  reset_vector = 0,
                  addr_width = 32,
                  counters = False,
+                 shift_bits_per_cycle = 1,
                  prog_addr_width = None):
         super().__init__()
 
@@ -100,6 +104,7 @@ class Cpu(Component):
             addr_width = addr_width,
             prog_addr_width = self.prog_addr_width,
             counters = counters,
+            shift_bits_per_cycle = shift_bits_per_cycle,
         )
 
     def elaborate(self, platform):
@@ -24,7 +24,8 @@ class EWBox(Component):
     - Loads: write to rd
     - Bxx: perform branch target computation
     - SLT: rewrite rd to set flag
-    - Shifts: shift one more bit and hold this state until done; write rd.
+    - Shifts: shift up to shift_bits_per_cycle more bits and hold this state
+      until done; write rd.
 
     Parameters
     ----------
@@ -42,6 +43,11 @@ class EWBox(Component):
         address range, and I/O devices higher, you can set this parameter to
         smaller than addr_width to save some area. If not explicitly
         overridden, this is the same as addr_width.  addr_width.
+    counters (bool): implement the cycle and instret counters.
+    shift_bits_per_cycle (int): how far the shifter can move bits in one
+        cycle: 1, 2, 4, 8 or 16. Larger values cost more logic but shorten
+        long shifts; a shift by N bits takes 3 + ceil(N / shift_bits_per_cycle)
+        cycles. Default 1.
 
     Attributes
     ----------
@@ -88,8 +94,11 @@ class EWBox(Component):
                  addr_width = 32,
                  prog_addr_width = 32,
                  counters = False,
+                 shift_bits_per_cycle = 1,
                  ):
         super().__init__()
+        assert shift_bits_per_cycle in (1, 2, 4, 8, 16), \
+                f"can't shift {shift_bits_per_cycle} bits per cycle"
         assert reset_vector.bit_length() <= prog_addr_width, \
                 f"reset vector 0x{reset_vector:x} won't fit in PC"
 
@@ -104,6 +113,7 @@ class EWBox(Component):
         self.pc = Signal(prog_addr_width - 2, reset = reset_vector >> 2)
 
         self.counters = counters
+        self.shift_bits_per_cycle = shift_bits_per_cycle
 
     def elaborate(self, platform):
         m = Module()
@@ -257,14 +267,48 @@ class EWBox(Component):
 
         # The Shifter
         #
-        # We use a dead-simple single-bit-per-cycle shifter, and as a result a
-        # shift can take up to 31 additional cycles.
+        # By default we use a dead-simple single-bit-per-cycle shifter, and as a
+        # result a shift can take up to 31 additional cycles. Setting
+        # shift_bits_per_cycle higher replaces it with a small barrel shifter
+        # that moves up to that many bits per cycle.
         #
         # During the shift, the bits being shifted are held in the accumulator.
         # The shift_amt register tracks how many bits are yet to go -- when not
         # shifting, its contents are undefined.
         shift_amt = Signal(5)
 
+        # The accumulator contents after this cycle's step, and the size of the
+        # step.
+        shift_fill = dec.inst[30] & self.accum[-1]
+        shifted = Signal(32)
+        step = self.shift_bits_per_cycle
+        if step == 1:
+            shift_step = 1
+            m.d.comb += shifted.eq(mux(
+                dec.funct3[2] == 0,
+                Cat(0, self.accum[:-1]), # left shift
+                Cat(self.accum[1:], shift_fill), # right shift
+            ))
+        else:
+            # Step by the full amount until fewer bits than that remain.
+            step_bits = step.bit_length() - 1
+            shift_step = Signal(range(step + 1))
+            m.d.comb += [
+                shift_step.eq(mux(
+                    shift_amt[step_bits:] != 0,
+                    step,
+                    shift_amt[:step_bits],
+                )),
+                shifted.eq(mux(
+                    dec.funct3[2] == 0,
+                    # left shift
+                    (self.accum << shift_step)[:32],
+                    # right shift
+                    (Cat(self.accum, shift_fill.replicate(step))
+                        >> shift_step)[:32],
+                )),
+            ]
+
         # Shifts are the only thing we do that can cause a state hold in the
         # S-Box -- we repeat state 2 until the shift is done.
         m.d.comb += self.hold.eq(
@@ -282,7 +326,7 @@ class EWBox(Component):
                     self.rf_resp[:5],
                 ),
                 # Count shift_amt down while in state 2.
-                2: shift_amt - 1,
+                2: shift_amt - shift_step,
                 # Otherwise, do not update the register.
             }, default = shift_amt)),
             # The shifter update rule is in the accumulator mux.
@@ -597,11 +641,7 @@ class EWBox(Component):
                 # Shifts use the accumulator as the shift register.
                 (dec.is_shift, mux(
                     shift_amt != 0,
-                    mux(
-                        dec.funct3[2] == 0, # left shift
-                        Cat(0, self.accum[:-1]),
-                        Cat(self.accum[1:], dec.inst[30] & self.accum[-1]),
-                    ),
+                    shifted,
                     self.accum,
                 )),
                 # Otherwise, trash it.
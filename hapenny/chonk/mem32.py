@@ -10,6 +10,8 @@ from hapenny.bus import BusPort
 
 import hapenny.mem # for stitching together 16-bit primitives
 
+import struct
+
 class BasicMemory(Elaboratable):
     """A dead-simple 32-bit-wide memory with the Hapenny bus interface.
 
@@ -56,8 +58,35 @@ class BasicMemory(Elaboratable):
             init = contents,
         )
 
+        self.depth = depth
         self.read_only = False
 
+    # Simulation backdoor. These go straight to the memory contents without
+    # using the bus or taking any clock cycles, so they're only usable from a
+    # simulator process (via 'yield from'). Addresses are word indices and
+    # wrap at the memory's depth, like the bus does.
+
+    def load(self, contents, offset = 0):
+        "Writes a list of 32-bit words into the memory at 'offset'."
+        for i, word in enumerate(contents):
+            yield self.m[(offset + i) % self.depth].eq(word)
+
+    def load_image(self, image, offset = 0):
+        "Writes a binary image (bytes) into the memory at word 'offset'."
+        image = image + b"\0" * (-len(image) % 4)
+        yield from self.load(
+            struct.unpack("<" + "I" * (len(image) // 4), image),
+            offset,
+        )
+
+    def poke(self, addr, value):
+        "Writes one word."
+        yield self.m[addr % self.depth].eq(value & 0xFFFF_FFFF)
+
+    def peek(self, addr):
+        "Reads one word."
+        return (yield self.m[addr % self.depth])
+
     def elaborate(self, platform):
         m = Module()
 
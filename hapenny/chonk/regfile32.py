@@ -27,6 +27,18 @@ class RegFile(Component):
         self.read_cmd = AlwaysReady(select_bits).flip().create()
         self.write_cmd = AlwaysReady(RegWrite(select_bits)).flip().create()
 
+    # Simulation backdoor. These bypass the ports and poke at the memory
+    # directly, taking no clock cycles, so they're only usable from a
+    # simulator process (via 'yield from') after elaboration.
+
+    def poke(self, reg, value, *, bank = 0):
+        "Sets register 'reg' to 'value'."
+        yield self.mem[bank * 32 + reg].eq(value & 0xFFFF_FFFF)
+
+    def peek(self, reg, *, bank = 0):
+        "Reads register 'reg'."
+        return (yield self.mem[bank * 32 + reg])
+
     def elaborate(self, platform):
         m = Module()
 
@@ -34,7 +46,7 @@ class RegFile(Component):
         contents = [0xDEAD_0000 | n | (b << 8) for n in range(32) for b in range(self.banks)]
         contents[0] = 0
 
-        m.submodules.mem = mem = Memory(
+        m.submodules.mem = self.mem = mem = Memory(
             width = 32,
             depth = nregs,
             name = "regfile",
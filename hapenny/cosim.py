@@ -0,0 +1,394 @@
+# Lockstep co-simulation of the RTL against the functional model.
+#
+# The Cpu's RVFI port produces one record per retired instruction. For each
+# record, we load the register and memory values the CPU actually read into a
+# scratch copy of the model, execute the same instruction, and compare what the
+# model did with what the CPU reported doing.
+#
+# That alone would miss a CPU that reads the wrong value out of a register or
+# memory, or loses a write, so we also keep a shadow of the registers and of
+# memory, updated from what each record wrote, and check what the CPU read
+# against it. The test bench can't poke at the CPU's registers, memory or PC
+# behind our back (through the debug port, say) without telling us: resync
+# forgets everything we knew, and then we learn each register and byte from
+# the first record that reads or writes it.
+#
+# hapenny's RVFI adapter reports memory traffic the way the 16-bit bus sees it:
+# addresses are word-aligned, masks are set two bits at a time for each
+# halfword touched by a load, and write data sits in its byte lanes. The
+# expectations below are phrased in those terms.
+#
+# Compressed instructions are reported as the halfword that was in memory
+# (zero-extended); we expand them the same way the model does to find out
+# which registers they touch.
+#
+# When the CPU takes an interrupt, the next record (the first instruction of
+# the handler) has intr set, and is somewhere other than where the last one
+# said it was going, which is where MRET should go back to.
+#
+# With several harts, records come from each in turn, starting with hart 0
+# after a reset, so we keep track of whose each one is, and where each hart
+# should go next. Each hart has its own registers, as do interrupt handlers
+# with banked_interrupts; memory is shared.
+
+from hapenny.model import Hart, ModelError, expand
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# RVFI payload fields that the checker consumes, in the order they're printed
+# in divergence reports.
+FIELDS = [
+    "order", "insn", "trap", "halt", "intr",
+    "pc_rdata", "pc_wdata",
+    "rs1_addr", "rs1_rdata", "rs2_addr", "rs2_rdata",
+    "rd_addr", "rd_wdata",
+    "mem_addr", "mem_rmask", "mem_wmask", "mem_rdata", "mem_wdata",
+]
+
+
+class Divergence(Exception):
+    """Raised when the CPU's behavior doesn't match the model.
+
+    Attributes
+    ----------
+    record (dict): the RVFI record that failed to check.
+    problems (list of str): everything that didn't match.
+    """
+
+    def __init__(self, record, problems):
+        self.record = record
+        self.problems = problems
+        super().__init__(format_divergence(record, problems))
+
+
+def format_divergence(record, problems):
+    lines = [
+        f"divergence at PC {record['pc_rdata']:08x} "
+        f"(insn {record['insn']:08x}, order {record['order']}):"
+    ]
+    lines += [f"  {p}" for p in problems]
+    lines.append("  RVFI record:")
+    for name in FIELDS:
+        lines.append(f"    {name:10} {record[name]:08x}")
+    return "\n".join(lines)
+
+
+class _RecordBus:
+    """Bus stand-in that serves loads from an RVFI record's mem_rdata and
+    remembers what the model tried to do."""
+
+    def __init__(self, mem_rdata):
+        self.mem_rdata = mem_rdata
+        self.accesses = []
+
+    def read(self, addr, size):
+        self.accesses.append(("r", addr, size, None))
+        value = self.mem_rdata >> (8 * (addr & 3))
+        return value & ((1 << (8 * size)) - 1)
+
+    def write(self, addr, size, value):
+        self.accesses.append(("w", addr, size, value & ((1 << (8 * size)) - 1)))
+
+
+def _uses(insn):
+    "Returns (uses_rs1, uses_rs2, writes_rd) for an instruction word."
+    opcode = insn & 0x7F
+    funct3 = (insn >> 12) & 7
+    if opcode in (0b0110111, 0b0010111, 0b1101111):  # LUI, AUIPC, JAL
+        return (False, False, True)
+    if opcode in (0b1100111, 0b0000011, 0b0010011):  # JALR, loads, ALU imm
+        return (True, False, True)
+    if opcode == 0b0110011:                          # ALU reg
+        return (True, True, True)
+    if opcode in (0b1100011, 0b0100011):             # branches, stores
+        return (True, True, False)
+    if opcode == 0b1110011:                          # CSRs
+        return (funct3 in (0b001, 0b010, 0b011), False, funct3 != 0)
+    return (False, False, False)
+
+
+def _rs2_mask(insn):
+    """Returns the bits of rs2 an instruction depends on. The CPU doesn't
+    read the top half for SB, SH or shifts, and RVFI leaves whatever the last
+    instruction read there."""
+    opcode = insn & 0x7F
+    funct3 = (insn >> 12) & 7
+    if opcode == 0b0100011 and funct3 in (0b000, 0b001):
+        return 0xFFFF
+    if opcode == 0b0110011 and funct3 in (0b001, 0b101) \
+            and (insn >> 25) != 1:
+        return 0x1F
+    return 0xFFFF_FFFF
+
+
+class RvfiChecker:
+    """Checks RVFI records from a Cpu against hapenny.model.
+
+    Parameters
+    ----------
+    addr_width (int): the Cpu's addr_width parameter.
+    prog_addr_width (int): the Cpu's prog_addr_width parameter, if different.
+    muldiv (bool): the Cpu's muldiv parameter.
+    compressed (bool): the Cpu's compressed parameter.
+    interrupts (bool): whether the Cpu has interrupts.
+    banked_interrupts (bool): the Cpu's banked_interrupts parameter.
+    harts (int): the Cpu's harts parameter.
+
+    Memory is assumed to be plain RAM, which only the CPU writes between
+    resyncs.
+
+    Attributes
+    ----------
+    checked (int): number of records checked so far.
+    """
+
+    def __init__(self, *, addr_width = 32, prog_addr_width = None,
+                 muldiv = False, compressed = False, interrupts = False,
+                 banked_interrupts = False, harts = 1):
+        self.muldiv = muldiv
+        self.compressed = compressed
+        self.interrupts = interrupts
+        self.banked_interrupts = banked_interrupts
+        self.addr_mask = (1 << addr_width) - 1
+        self.pc_mask = (1 << (prog_addr_width or addr_width)) - 1
+        self.harts = harts
+        self.checked = 0
+        # The hart the next record comes from, and where each hart should
+        # go next, if we know.
+        self.hart = 0
+        self.expected_pcs = [None] * harts
+        # Where MRET should go, if we've seen an interrupt taken.
+        self.epc = None
+        # What we know is in each register bank (one per hart, or with
+        # banked interrupts, one for handlers too) and in memory, by register
+        # number and byte address. Anything missing is unknown.
+        self.in_handler = False
+        self.regs = [{} for _ in range(max(harts, 2))]
+        self.memory = {}
+
+    @property
+    def expected_pc(self):
+        return self.expected_pcs[self.hart]
+
+    @expected_pc.setter
+    def expected_pc(self, pc):
+        self.expected_pcs[self.hart] = pc
+
+    @property
+    def bank(self):
+        "The register bank the next record's instruction uses."
+        if self.harts > 1:
+            return self.hart
+        return int(self.banked_interrupts and self.in_handler)
+
+    def resync(self, regs = None):
+        """Forgets the expected next PC and everything we knew about the
+        registers and memory; call this when the test bench changes any of
+        them behind the CPU's back. 'regs', if given, maps register numbers
+        to what the bench left in them, in the bank the next record uses.
+        With several harts, the next record must be hart 0's, as it is after
+        a reset."""
+        self.hart = 0
+        self.expected_pcs = [None] * self.harts
+        self.in_handler = False
+        for bank in self.regs:
+            bank.clear()
+        self.regs[self.bank].update(regs or {})
+        self.memory.clear()
+
+    def check(self, record):
+        """Checks one RVFI record (a dict of field name -> int), raising
+        Divergence if it doesn't match the model."""
+        problems = []
+        insn = record["insn"]
+        # The instruction whose fields we check against, which is the
+        # expansion of insn if it's compressed.
+        fields = insn
+        if self.compressed and insn & 3 != 3:
+            fields = expand(insn & 0xFFFF)
+            if fields is None:
+                problems.append(f"CPU retired illegal compressed "
+                                f"instruction {insn:04x}")
+                raise Divergence(record, problems)
+        uses_rs1, uses_rs2, writes_rd = _uses(fields)
+        rs1 = (fields >> 15) & 0x1F
+        rs2 = (fields >> 20) & 0x1F
+        rd = (fields >> 7) & 0x1F
+
+        if record["halt"] or record["trap"]:
+            problems.append("CPU flagged the record as halt/trap "
+                            "(inconsistent register or memory halves)")
+
+        pc = record["pc_rdata"]
+        if record["intr"]:
+            if not self.interrupts:
+                problems.append("CPU took an interrupt but has none")
+            self.epc = self.expected_pc
+            self.in_handler = True
+        elif self.expected_pc is not None and pc != self.expected_pc:
+            problems.append(f"PC should be {self.expected_pc:08x}, "
+                            f"CPU executed {pc:08x}")
+
+        # Seed a scratch hart with the values the CPU read.
+        bus = _RecordBus(record["mem_rdata"])
+        hart = Hart(bus, reset_vector = pc, timing = None, counters = False,
+                    muldiv = self.muldiv, compressed = self.compressed,
+                    interrupt_vector = 0 if self.interrupts else None,
+                    hartid = self.hart)
+        # If we don't know where MRET should go (because we haven't seen the
+        # interrupt taken since a resync), take the CPU's word for it.
+        hart.epc = (self.epc if self.epc is not None
+                    else record["pc_wdata"])
+        regs = self.regs[self.bank]
+        if uses_rs1:
+            if record["rs1_addr"] != rs1:
+                problems.append(f"rs1_addr should be x{rs1}, "
+                                f"CPU read x{record['rs1_addr']}")
+            problems += self._check_read(regs, rs1, record["rs1_rdata"])
+            hart.x[rs1] = record["rs1_rdata"]
+        if uses_rs2:
+            if record["rs2_addr"] != rs2:
+                problems.append(f"rs2_addr should be x{rs2}, "
+                                f"CPU read x{record['rs2_addr']}")
+            if uses_rs1 and rs1 == rs2 \
+                    and record["rs1_rdata"] != record["rs2_rdata"]:
+                problems.append("rs1 and rs2 are the same register but read "
+                                "different values")
+            problems += self._check_read(regs, rs2, record["rs2_rdata"],
+                                         _rs2_mask(fields))
+            hart.x[rs2] = record["rs2_rdata"]
+        hart.x[0] = 0
+
+        try:
+            hart.execute(insn)
+        except ModelError as e:
+            problems.append(f"model error: {e}")
+            raise Divergence(record, problems)
+
+        # Register writeback. CSR reads return counter values we can't
+        # predict, so only check that they went to the right place.
+        if writes_rd and rd != 0:
+            if record["rd_addr"] != rd:
+                problems.append(f"rd should be x{rd}, "
+                                f"CPU wrote x{record['rd_addr']}")
+            elif (fields & 0x7F) != 0b1110011 \
+                    and record["rd_wdata"] != hart.x[rd]:
+                problems.append(f"x{rd} should be {hart.x[rd]:08x}, "
+                                f"CPU wrote {record['rd_wdata']:08x}")
+        elif record["rd_addr"] != 0:
+            problems.append(f"CPU wrote x{record['rd_addr']} "
+                            "but the instruction has no destination")
+        if record["rd_addr"] != 0:
+            regs[record["rd_addr"]] = record["rd_wdata"]
+
+        # Next PC.
+        next_pc = hart.pc & self.pc_mask
+        if record["pc_wdata"] != next_pc:
+            problems.append(f"next PC should be {next_pc:08x}, "
+                            f"CPU went to {record['pc_wdata']:08x}")
+
+        problems += self._check_memory(record, bus.accesses)
+
+        if fields == 0x30200073:
+            # MRET
+            self.in_handler = False
+        self.expected_pc = record["pc_wdata"]
+        self.hart = (self.hart + 1) % self.harts
+        self.checked += 1
+        if problems:
+            raise Divergence(record, problems)
+
+    def _check_read(self, regs, reg, value, mask = 0xFFFF_FFFF):
+        # Checks the bits in 'mask' of a register read against what we know,
+        # or learns the register, if the CPU read all of it.
+        if reg == 0:
+            known = 0
+        elif reg in regs:
+            known = regs[reg]
+        else:
+            if mask == 0xFFFF_FFFF:
+                regs[reg] = value
+            return []
+        if value & mask != known & mask:
+            return [f"x{reg} should hold {known & mask:08x} (as last "
+                    f"written), CPU read {value & mask:08x}"]
+        return []
+
+    def _check_memory(self, record, accesses):
+        problems = []
+        rmask = wmask = wdata = 0
+        addr = None
+        for kind, a, size, value in accesses:
+            a &= self.addr_mask
+            addr = a & ~3
+            if kind == "r":
+                # The bus reads whole halfwords.
+                first = (a >> 1) & 1
+                last = ((a + size - 1) >> 1) & 1
+                for half in range(first, last + 1):
+                    rmask |= 0b11 << (2 * half)
+            else:
+                lanes = ((1 << size) - 1) << (a & 3)
+                wmask |= lanes
+                wdata |= value << (8 * (a & 3))
+
+        if record["mem_rmask"] != rmask:
+            problems.append(f"mem_rmask should be {rmask:04b}, "
+                            f"CPU used {record['mem_rmask']:04b}")
+        if record["mem_wmask"] != wmask:
+            problems.append(f"mem_wmask should be {wmask:04b}, "
+                            f"CPU used {record['mem_wmask']:04b}")
+        if addr is not None and record["mem_addr"] != addr:
+            problems.append(f"mem_addr should be {addr:08x}, "
+                            f"CPU used {record['mem_addr']:08x}")
+        lane_bits = sum(0xFF << (8 * i) for i in range(4) if wmask >> i & 1)
+        if record["mem_wdata"] & lane_bits != wdata:
+            problems.append(f"mem_wdata should be {wdata:08x}/{wmask:04b}, "
+                            f"CPU wrote {record['mem_wdata']:08x}")
+
+        # Check the bytes the CPU read against what we know, or learn them,
+        # then remember the ones it wrote.
+        base = record["mem_addr"] & self.addr_mask & ~3
+        for lane in range(4):
+            a = base + lane
+            if record["mem_rmask"] >> lane & 1:
+                value = (record["mem_rdata"] >> (8 * lane)) & 0xFF
+                known = self.memory.setdefault(a, value)
+                if value != known:
+                    problems.append(f"M[{a:08x}] should hold {known:02x} (as "
+                                    f"last written), CPU read {value:02x}")
+            if record["mem_wmask"] >> lane & 1:
+                self.memory[a] = (record["mem_wdata"] >> (8 * lane)) & 0xFF
+        return problems
+
+
+def read_rvfi(port):
+    """Simulator helper: reads all the fields the checker needs from an RVFI
+    port's payload, returning a dict."""
+    record = {}
+    for name in FIELDS:
+        record[name] = yield getattr(port.payload, name)
+    return record
+
+
+def rvfi_checker_process(port, checker, *, running = lambda: True,
+                         on_divergence = None):
+    """Builds a sync process that feeds every valid record on 'port' into
+    'checker' until 'running()' returns False. A Divergence propagates out of
+    the simulator, stopping the run on the first mismatch, unless
+    'on_divergence' is given, in which case it's called with the Divergence
+    instead and checking carries on."""
+    def process():
+        while running():
+            yield
+            if (yield port.valid):
+                record = yield from read_rvfi(port)
+                try:
+                    checker.check(record)
+                except Divergence as e:
+                    if on_divergence is None:
+                        raise
+                    on_divergence(e)
+    return process
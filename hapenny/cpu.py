@@ -1,17 +1,19 @@
 # An RV32I implementation using a 16-bit datapath to save space.
 
 from amaranth import *
+from amaranth.hdl import EnableInserter
 from amaranth.lib.wiring import *
 from amaranth.lib.enum import *
 import amaranth.lib.coding
 
-from hapenny import StreamSig, AlwaysReady, mux, oneof, onehot_choice
+from hapenny import StreamSig, AlwaysReady, mux, oneof, onehot_choice, treeduce
 from hapenny.decoder import ImmediateDecoder, Decoder, DecodeSignals
 from hapenny.regfile16 import RegFile16, RegWrite
 from hapenny.bus import BusPort, BusCmd
 from hapenny.sbox import SBox, STATE_COUNT
 from hapenny.fdbox import FDBox
 from hapenny.ewbox import EWBox
+from hapenny.icache import ICache
 from hapenny.rvfi import Rvfi, Mode, Ixl
 
 # Note: all debug port signals are directional from the perspective of the DEBUG
@@ -42,8 +44,10 @@ DebugPort = Signature({
 })
 
 class Cpu(Component):
-    """An RV32I core using a 16-bit datapath, with overlapped fetch and
-    execute for reasonable performance.
+    """An RV32I (or, optionally, RV32IM, RV32IC or RV32IMC) core using a
+    16-bit datapath, with overlapped fetch and execute for reasonable
+    performance, optional vectored interrupts, and optionally several
+    barrel-threaded harts.
 
     Parameters
     ----------
@@ -59,12 +63,80 @@ class Cpu(Component):
         address range, and I/O devices higher, you can set this parameter to
         smaller than addr_width to save some area. If not explicitly
         overridden, this is the same as addr_width.  addr_width.
+    counters (bool): implement the cycle and instret counters.
+    shift_bits_per_cycle (int): how many bits the shifter moves per cycle, one
+        of 1, 2, 4, 8 or 16. See EWBox. Default 1.
+    early_jal (bool): have the FD-Box redirect fetch to a JAL's target while
+        the JAL executes, saving the four-cycle refetch bubble at the cost of
+        a PC-width adder. Default False.
+    predict_branches (bool): have the FD-Box predict backward conditional
+        branches taken and fetch their targets early (static
+        backward-taken/forward-not-taken prediction). Default False.
+    wait_states (bool): give the bus a cmd.ready signal, so that devices can
+        insert wait states. While a command is waiting, the whole CPU stands
+        still, except for the cycle counter, which counts clock cycles
+        whether we're waiting or not. Default False, in which case the CPU is
+        exactly as it would be without this option.
+    icache_halfwords (int): size of an instruction cache between the FD-Box
+        and the bus, in halfwords (a power of two, at least 4), or 0 for no
+        cache. See ICache. Fetches that hit in the cache don't use the bus, so
+        code in a slow memory can run at full speed, but a miss stalls the
+        CPU for three cycles plus the memory's wait states. Default 0.
+    rf_read_ports (int): 1 or 2. With 2, the register file keeps a second
+        copy of the registers in another block RAM, so that rs1 and rs2 can be
+        read at the same time, and most instructions take a cycle less (ALU
+        ops take three). See EWBox. Default 1.
+    skip_rs2_reads (bool): with one register file read port, give the same
+        treatment to instructions that don't need rs2 early (everything but
+        register-register ALU ops and branches), and to the re-fetch bubble.
+        See EWBox. Default False.
+    muldiv (bool): implement the M extension (multiply and divide), making
+        this an RV32IM core. See MBox. Default False.
+    multiplier (str): how the M extension multiplies: "serial" (a bit per
+        cycle), "lut" (16x16 partial products in logic) or "dsp" (16x16
+        partial products in an iCE40 UltraPlus DSP block). Default None,
+        which picks "dsp" when building for an UltraPlus and "serial"
+        otherwise.
+    compressed (bool): implement the C extension (compressed instructions).
+        The FD-Box expands them into the instructions they stand for, so they
+        take just as long, but the PC can then be halfword-aligned, and the
+        FD-Box doesn't need to fetch the first halfword of an instruction that
+        follows a compressed one. See FDBox. Default False.
+    interrupts (int): number of interrupt request lines, or 0 (the default)
+        for no interrupt support. An interrupt on line n is taken between
+        instructions, if enabled, and jumps to interrupt_vector + 4*n; MRET
+        returns. See EWBox.
+    interrupt_vector (int): address of the interrupt vector table, which must
+        be aligned to its own size (four bytes per line). Default None, which
+        puts it at the first such address after the reset vector.
+    banked_interrupts (bool): give interrupt handlers a second bank of
+        registers, which the CPU switches to when it takes an interrupt and
+        back from on MRET, so that handlers needn't save and restore the
+        registers they use. Their values stay put between interrupts. This
+        costs no logic to speak of, since the register file has room for the
+        second bank in the same block RAM. Default False.
+    harts (int): number of hardware threads (harts). With more than one, the
+        CPU takes turns between them, an instruction each, and fetches each
+        hart's next instruction while executing the others', so jumps and
+        taken branches don't cost a re-fetch bubble. Each hart gets its own
+        bank of registers in the register file's block RAM, and a PC; the
+        mhartid CSR reads as its number. They all start at reset_vector. This
+        can't be combined with early_jal, predict_branches, compressed or
+        interrupts. See EWBox. Default 1.
 
     Attributes
     ----------
     bus (both): connection to the bus, 16 bit data path and `addr_width - 1`
         address bits.
-    debug (both): debug port for testing or development.
+    debug (both): debug port for testing or development. With
+        banked_interrupts, it reads and writes whichever bank is in use, and
+        with several harts, the registers and PC of the hart whose turn is
+        next. Single-stepping runs an instruction of that hart, and moves on
+        to the one after it.
+    irq (in): interrupt request lines, one bit per line, lowest numbered
+        first in priority. These are level sensitive: a device should hold its
+        line up until the handler tells it to stop. Only present with
+        interrupts.
     halt_request (in): when asserted (1), requests that the CPU stop at the
         next instruction boundary. Release (0) to resume.
     halted (out): raised when the CPU has halted.
@@ -80,28 +152,89 @@ class Cpu(Component):
                  reset_vector = 0,
                  addr_width = 32,
                  counters = False,
+                 shift_bits_per_cycle = 1,
+                 early_jal = False,
+                 predict_branches = False,
+                 wait_states = False,
+                 icache_halfwords = 0,
+                 rf_read_ports = 1,
+                 skip_rs2_reads = False,
+                 muldiv = False,
+                 multiplier = None,
+                 compressed = False,
+                 interrupts = 0,
+                 interrupt_vector = None,
+                 banked_interrupts = False,
+                 harts = 1,
                  prog_addr_width = None):
         super().__init__()
+        assert interrupts or not banked_interrupts, \
+                "banked_interrupts needs interrupts"
 
         # Capture and derive parameter values
         self.addr_width = addr_width
         self.prog_addr_width = prog_addr_width or addr_width
         self.reset_vector = reset_vector
+        self.counters = counters
+        self.wait_states = wait_states
+        self.rf_read_ports = rf_read_ports
+        self.compressed = compressed
+        self.interrupts = interrupts
+        self.banked_interrupts = banked_interrupts
+        self.harts = harts
+        if interrupts and interrupt_vector is None:
+            table = 4 << (interrupts - 1).bit_length()
+            interrupt_vector = (reset_vector // table + 1) * table
+        self.interrupt_vector = interrupt_vector
+        # Whether the schedule is picked per instruction (see EWBox).
+        self.per_instruction = skip_rs2_reads and rf_read_ports == 1
         
         # Create our parameterized ports and modules
-        self.bus = BusPort(addr = addr_width - 1, data = 16).create()
+        self.bus = BusPort(addr = addr_width - 1, data = 16,
+                           wait_states = wait_states).create()
+        if interrupts:
+            self.irq = Signal(interrupts)
 
         self.s = SBox()
-        self.rf = RegFile16()
+        self.rf = RegFile16(
+            banks = 2 if banked_interrupts else harts,
+            read_ports = rf_read_ports,
+        )
         self.fd = FDBox(
             prog_addr_width = self.prog_addr_width,
+            early_jal = early_jal,
+            predict_branches = predict_branches,
+            # The EW-Box can finish instructions a state earlier with two
+            # read ports, so it needs them fetched a state earlier. With
+            # skip_rs2_reads it tells the FD-Box when.
+            early_fetch = ("per_instruction" if self.per_instruction
+                           else rf_read_ports == 2),
+            compressed = compressed,
         )
         self.ew = EWBox(
             reset_vector = reset_vector,
             addr_width = addr_width,
             prog_addr_width = self.prog_addr_width,
             counters = counters,
+            shift_bits_per_cycle = shift_bits_per_cycle,
+            early_jal = early_jal,
+            predict_branches = predict_branches,
+            rf_read_ports = rf_read_ports,
+            skip_rs2_reads = skip_rs2_reads,
+            muldiv = muldiv,
+            multiplier = multiplier,
+            compressed = compressed,
+            interrupts = interrupts,
+            interrupt_vector = interrupt_vector or 0,
+            harts = harts,
         )
+        self.icache = None
+        if icache_halfwords:
+            self.icache = ICache(
+                addr_bits = self.prog_addr_width - 1,
+                halfwords = icache_halfwords,
+                wait_states = wait_states,
+            )
 
     def elaborate(self, platform):
         m = Module()
@@ -112,15 +245,24 @@ class Cpu(Component):
         m.submodules.fd = fd = self.fd
         m.submodules.ew = ew = self.ew
 
+        # Bus response as seen by the boxes, and whether they're stalled; see
+        # the wait state logic at the end.
+        bus_resp = Signal(16)
+        stall = Signal(1)
+
         m.d.comb += [
             fd.onehot_state.eq(s.onehot_state),
             fd.from_the_top.eq(ew.from_the_top),
+            fd.full.eq(ew.full),
 
             ew.onehot_state.eq(s.onehot_state),
             ew.inst_next.eq(fd.inst_next),
             ew.debug_pc_write.valid.eq(self.debug.pc_write.valid),
-            # Drop the bottom two bits of any incoming PC before feeding to EW.
-            ew.debug_pc_write.payload.eq(self.debug.pc_write.payload[2:]),
+            # Drop the bottom two bits of any incoming PC before feeding to EW
+            # (or just the one, with compressed instructions).
+            ew.debug_pc_write.payload.eq(
+                self.debug.pc_write.payload[ew.pc_lsbs:]
+            ),
 
             s.from_the_top.eq(ew.from_the_top),
             s.halt_request.eq(self.halt_request),
@@ -131,12 +273,40 @@ class Cpu(Component):
 
             self.debug.reg_value.eq(rf.read_resp),
             self.debug.state.eq(s.onehot_state),
-            # Internal PCs never have bits 0/1, but the debug port deals in
-            # 32-bit addresses, so add LSBs when exposing the PC:
-            self.debug.pc.eq(Cat(0, 0, ew.pc)),
+            # Internal PCs never have bits 0/1 (or just bit 0, with
+            # compressed instructions), but the debug port deals in 32-bit
+            # addresses, so add LSBs when exposing the PC:
+            self.debug.pc.eq(Cat(C(0, ew.pc_lsbs), ew.pc)),
             self.debug.pc_write.ready.eq(ew.debug_pc_write.ready),
         ]
         connect(m, ew.fetch_pc, fd.pc)
+        if self.per_instruction:
+            m.d.comb += fd.early.eq(ew.short)
+        if self.compressed:
+            m.d.comb += [
+                ew.inst_next_compressed.eq(fd.inst_next_compressed),
+                ew.inst_next_raw.eq(fd.inst_next_raw),
+            ]
+        if self.interrupts:
+            m.d.comb += ew.irq.eq(self.irq)
+
+        # With banked interrupts, the register bank is the top bit of the
+        # register file address, and everyone uses the one EW says. Writes go
+        # to the bank of the instruction doing them. Reads may be on behalf of
+        # the next instruction, though -- FD reads rs1.lo on the last cycle of
+        # the one before -- which may be in the other bank after an MRET, so
+        # they use the bank we're about to be in.
+        #
+        # Several harts work the same way, with a bank each: the last cycle
+        # of one hart's instruction is where FD reads for the next hart's.
+        if self.banked_interrupts:
+            write_bank = ew.in_handler
+            read_bank = ew.in_handler_next
+        elif self.harts > 1:
+            write_bank = ew.hart
+            read_bank = ew.hart_next
+        else:
+            write_bank = read_bank = C(0, 0)
 
         # Combine the register file write ports from EW (primary) and the debug
         # interface (secondary). We use an actual mux here instead of OR-ing to
@@ -149,13 +319,14 @@ class Cpu(Component):
                     ew.rf_write_cmd.valid,
                 ),
             ),
-            rf.write_cmd.payload.reg.eq(
+            rf.write_cmd.payload.reg.eq(Cat(
                 mux(
                     s.halted,
                     self.debug.reg_write.payload.reg,
                     ew.rf_write_cmd.payload.reg,
                 ),
-            ),
+                write_bank,
+            )),
             rf.write_cmd.payload.value.eq(
                 mux(
                     s.halted,
@@ -175,35 +346,71 @@ class Cpu(Component):
                 fd.rf_cmd.valid | ew.rf_read_cmd.valid
                 | (self.debug.reg_read.valid & s.halted)
             ),
-            rf.read_cmd.payload.eq(
+            rf.read_cmd.payload.eq(Cat(
                 fd.rf_cmd.payload | ew.rf_read_cmd.payload
-                | oneof([(s.halted, self.debug.reg_read.payload)])
-            ),
+                | oneof([(s.halted, self.debug.reg_read.payload)]),
+                read_bank,
+            )),
             ew.rf_resp.eq(rf.read_resp),
             self.debug.reg_read.ready.eq(s.halted),
         ]
+        # The second read port, if any, belongs to EW alone.
+        if self.rf_read_ports == 2:
+            m.d.comb += [
+                rf.read_cmd_b.valid.eq(ew.rf_read_cmd_b.valid),
+                rf.read_cmd_b.payload.eq(Cat(
+                    ew.rf_read_cmd_b.payload,
+                    read_bank,
+                )),
+                ew.rf_resp_b.eq(rf.read_resp_b),
+            ]
+        # FD fetches through the instruction cache, if we have one, which
+        # then shares the bus with EW in its place; see the end for the rest
+        # of its wiring.
+        fetch_bus = fd.bus if self.icache is None else self.icache.bus
+
+        # With compressed instructions, the instruction cache can also stall
+        # on a cycle when EW is issuing a load or store (see the end), so we
+        # keep EW's command off the bus until the stall is over.
+        ew_cmd_valid = ew.bus.cmd.valid
+        ew_cmd_addr = ew.bus.cmd.payload.addr
+        ew_cmd_lanes = ew.bus.cmd.payload.lanes
+        if self.icache is not None and self.compressed:
+            ew_cmd_valid = ew_cmd_valid & ~self.icache.stall
+            ew_cmd_addr = mux(self.icache.stall, 0, ew_cmd_addr)
+            ew_cmd_lanes = mux(self.icache.stall, 0, ew_cmd_lanes)
+
         # Combine the bus access ports. The debug port can't drive our bus, so
         # this is simpler.
         m.d.comb += [
             self.bus.cmd.valid.eq(
-                fd.bus.cmd.valid | ew.bus.cmd.valid
+                fetch_bus.cmd.valid | ew_cmd_valid
             ),
             # Note that this will implicitly zero-extend the FD address if it's
             # shorter than the full bus (because prog_addr_width is dialed
             # back).
             self.bus.cmd.payload.addr.eq(
-                fd.bus.cmd.payload.addr | ew.bus.cmd.payload.addr
+                fetch_bus.cmd.payload.addr | ew_cmd_addr
             ),
             self.bus.cmd.payload.data.eq(
-                fd.bus.cmd.payload.data | ew.bus.cmd.payload.data
+                fetch_bus.cmd.payload.data | ew.bus.cmd.payload.data
             ),
             self.bus.cmd.payload.lanes.eq(
-                fd.bus.cmd.payload.lanes | ew.bus.cmd.payload.lanes
+                fetch_bus.cmd.payload.lanes | ew_cmd_lanes
             ),
 
-            fd.bus.resp.eq(self.bus.resp),
-            ew.bus.resp.eq(self.bus.resp),
+            ew.bus.resp.eq(bus_resp),
         ]
+        if self.icache is None:
+            m.d.comb += fd.bus.resp.eq(bus_resp)
+
+        # The cycle counter counts clock cycles, stalled or not, so it has to
+        # live outside the part of the CPU that stands still during a stall
+        # (see below); instret does stand still, since we're not retiring
+        # anything.
+        if self.counters:
+            cycle_counter = Signal(32)
+            m.d.comb += ew.cycle_counter.eq(cycle_counter)
 
         # Trace port
         m.submodules.rvfi_adapter = rvfi = RvfiPort()
@@ -211,38 +418,128 @@ class Cpu(Component):
             rvfi.state.eq(s.onehot_state),
             rvfi.full.eq(ew.full),
             rvfi.end_of_instruction.eq(ew.from_the_top),
-            rvfi.pc.eq(Cat(0, 0, ew.pc)),
-            rvfi.pc_next.eq(Cat(0, 0, ew.fetch_pc.payload)),
-            rvfi.insn.eq(ew.debug_inst),
+            rvfi.stall.eq(stall),
+            rvfi.pc.eq(Cat(C(0, ew.pc_lsbs), ew.pc)),
+            rvfi.pc_next.eq(Cat(C(0, ew.pc_lsbs), ew.pc_next)),
+            rvfi.insn.eq(ew.debug_inst_raw if self.compressed
+                         else ew.debug_inst),
+            rvfi.decoded_insn.eq(ew.debug_inst),
             rvfi.rf_read_resp_snoop.eq(rf.read_resp),
 
             rvfi.rf_read_snoop.valid.eq(rf.read_cmd.valid),
-            rvfi.rf_read_snoop.payload.eq(rf.read_cmd.payload),
+            rvfi.rf_read_snoop.payload.eq(rf.read_cmd.payload[:6]),
 
             rvfi.rf_write_snoop.valid.eq(rf.write_cmd.valid),
-            rvfi.rf_write_snoop.payload.reg.eq(rf.write_cmd.payload.reg),
+            rvfi.rf_write_snoop.payload.reg.eq(rf.write_cmd.payload.reg[:6]),
             rvfi.rf_write_snoop.payload.value.eq(rf.write_cmd.payload.value),
 
-            rvfi.bus_snoop.valid.eq(self.bus.cmd.valid),
-            rvfi.bus_snoop.payload.addr.eq(self.bus.cmd.payload.addr),
-            rvfi.bus_snoop.payload.data.eq(self.bus.cmd.payload.data),
-            rvfi.bus_snoop.payload.lanes.eq(self.bus.cmd.payload.lanes),
-            rvfi.bus_resp_snoop.eq(self.bus.resp),
+            # RVFI doesn't consider fetch traffic, so we only show it EW's
+            # half of the bus.
+            rvfi.bus_snoop.valid.eq(ew.bus.cmd.valid),
+            rvfi.bus_snoop.payload.addr.eq(ew.bus.cmd.payload.addr),
+            rvfi.bus_snoop.payload.data.eq(ew.bus.cmd.payload.data),
+            rvfi.bus_snoop.payload.lanes.eq(ew.bus.cmd.payload.lanes),
+            rvfi.bus_resp_snoop.eq(bus_resp),
         ]
+        if self.rf_read_ports == 2:
+            m.d.comb += [
+                rvfi.rf_read_b_resp_snoop.eq(rf.read_resp_b),
+                rvfi.rf_read_b_snoop.valid.eq(rf.read_cmd_b.valid),
+                rvfi.rf_read_b_snoop.payload.eq(rf.read_cmd_b.payload[:6]),
+            ]
+        if self.interrupts:
+            m.d.comb += rvfi.interrupt_taken.eq(ew.interrupt_taken)
         connect(m, rvfi.rvfi_out, flipped(self.rvfi))
 
-        return m
+        if not self.wait_states and self.icache is None:
+            m.d.comb += bus_resp.eq(self.bus.resp)
+            if self.counters:
+                m.d.sync += cycle_counter.eq(cycle_counter + 1)
+            return m
+
+        # Wait states and cache stalls
+        #
+        # Rather than teach every box to cope with a command that hasn't been
+        # accepted, we stop the clock: while the bus isn't ready for a command
+        # we're issuing, every register in the CPU (S-Box state, FD/EW
+        # pipeline state, register file ports, trace port) but the cycle
+        # counter holds its value, so the same command stays on the bus and
+        # the CPU picks up exactly where it left off once the device accepts
+        # it.
+        #
+        # The other thing that doesn't stand still is the bus response. If we
+        # stall on the cycle when a previous command's response arrives, the
+        # device (and fabric) may move on and stop presenting it, so we keep a
+        # copy of it and present that to the boxes until the stall ends.
+        #
+        # The instruction cache stalls the CPU the same way while it fills or
+        # flushes, which is why it lives out here rather than in the core:
+        # it has to keep going while everything else stands still. It only
+        # stalls with FD waiting on a fetch, when EW isn't expecting a
+        # response, or at the start of an instruction. With compressed
+        # instructions, that can be the cycle when EW issues a load or store,
+        # which is why we hold EW's command back above.
+        stalls = []
+
+        top = Module()
+        top.submodules.core = EnableInserter(~stall)(m)
+        if self.counters:
+            top.d.sync += cycle_counter.eq(cycle_counter + 1)
+        if self.icache is not None:
+            top.submodules.icache = icache = self.icache
+            connect(top, fd.bus, icache.fetch)
+            top.d.comb += [
+                # The cache does its fills while everything else is stalled,
+                # so it takes responses straight from the bus.
+                icache.bus.resp.eq(self.bus.resp),
+                # It watches EW's stores so it can drop anything they
+                # overwrite.
+                icache.store.valid.eq(ew_cmd_valid & ew_cmd_lanes.any()),
+                icache.store.payload.eq(ew.bus.cmd.payload.addr),
+                icache.halted.eq(s.halted),
+                icache.stalled.eq(stall),
+            ]
+            if self.wait_states:
+                top.d.comb += icache.bus.cmd.ready.eq(self.bus.cmd.ready)
+            stalls.append(icache.stall)
+
+        if self.wait_states:
+            stalled = Signal(1)
+            held_resp = Signal(16)
+            stalls.append(self.bus.cmd.valid & ~self.bus.cmd.ready)
+            top.d.comb += bus_resp.eq(mux(stalled, held_resp, self.bus.resp))
+            top.d.sync += [
+                stalled.eq(stall),
+                held_resp.eq(bus_resp),
+            ]
+        else:
+            top.d.comb += bus_resp.eq(self.bus.resp)
+
+        top.d.comb += stall.eq(treeduce(lambda a, b: a | b, stalls))
+        return top
 
 class RvfiPort(Component):
     state: In(STATE_COUNT)
     full: In(1)
+    # The CPU is stalled (see Cpu), and so are we.
+    stall: In(1)
     end_of_instruction: In(1)
     pc: In(32)
     pc_next: In(32)
     insn: In(32)
+    # The instruction as EW decoded it, which differs from insn (what was in
+    # memory) only for compressed instructions. Register fields come from
+    # here.
+    decoded_insn: In(32)
+    # EW is taking an interrupt at the end of this instruction, so the next
+    # one we report is the first of its handler.
+    interrupt_taken: In(1)
 
     rf_read_snoop: In(AlwaysReady(6))
     rf_read_resp_snoop: In(16)
+    # Second register file read port, if there is one.
+    rf_read_b_snoop: In(AlwaysReady(6))
+    rf_read_b_resp_snoop: In(16)
 
     rf_write_snoop: In(AlwaysReady(RegWrite(6)))
 
@@ -264,20 +561,26 @@ class RvfiPort(Component):
 
         load_expected = Signal(2)
         after_end = Signal()
-        rs1_addr_d = Signal(5)
+        interrupted = Signal()
 
         m.d.sync += after_end.eq(self.end_of_instruction)
 
+        # We stand still during a stall like everything else, so a retirement
+        # would be reported on every cycle of one; we only report it on the
+        # cycle the stall ends.
+        valid = Signal()
+        m.d.comb += self.rvfi_out.valid.eq(valid & ~self.stall)
+
         with m.If(self.end_of_instruction):
             m.d.sync += [
-                self.rvfi_out.valid.eq(self.full),
+                valid.eq(self.full),
                 self.rvfi_out.payload.order.eq(self.rvfi_out.payload.order + 1),
                 self.rvfi_out.payload.pc_wdata.eq(self.pc_next),
-
-                rs1_addr_d.eq(self.rf_read_snoop.payload[:5]),
             ]
+            with m.If(self.interrupt_taken):
+                m.d.sync += interrupted.eq(1)
         with m.Else():
-            m.d.sync += self.rvfi_out.valid.eq(0)
+            m.d.sync += valid.eq(0)
 
         with m.If(after_end):
             m.d.sync += [
@@ -292,34 +595,64 @@ class RvfiPort(Component):
 
                 self.register_half_mismatch.eq(0),
                 self.disjoint_memory.eq(0),
-                self.rvfi_out.payload.rs1_addr.eq(rs1_addr_d),
             ]
 
+        # Register reads are matched up with the operand fields of the
+        # instruction, rather than inferred from the state, since the EW-Box
+        # doesn't always read the halves in the same order (stores, for
+        # instance, read rs2's low half twice). The response to a read arrives
+        # on the cycle after the command, so remember what we asked for.
+        reads = []
+        for (snoop, resp) in [
+            (self.rf_read_snoop, self.rf_read_resp_snoop),
+            (self.rf_read_b_snoop, self.rf_read_b_resp_snoop),
+        ]:
+            read_d = Signal(6)
+            read_valid_d = Signal()
+            m.d.sync += [
+                read_d.eq(snoop.payload),
+                read_valid_d.eq(snoop.valid),
+            ]
+            reads.append((read_d, read_valid_d, resp))
+        rs1_field = self.decoded_insn[15:20]
+        rs2_field = self.decoded_insn[20:25]
+
         with m.If(self.full):
             with m.If(self.state[0]):
                 m.d.sync += [
-                    self.rvfi_out.payload.rs1_rdata[:16].eq(self.rf_read_resp_snoop),
-                    self.rvfi_out.payload.rs2_addr.eq(self.rf_read_snoop.payload[:5]),
+                    self.rvfi_out.payload.rs1_addr.eq(rs1_field),
+                    self.rvfi_out.payload.rs2_addr.eq(rs2_field),
 
                     self.rvfi_out.payload.pc_rdata.eq(self.pc),
 
                     self.rvfi_out.payload.insn.eq(self.insn),
-                ]
 
-            with m.If(self.state[1]):
-                m.d.sync += [
-                    self.rvfi_out.payload.rs2_rdata[:16].eq(self.rf_read_resp_snoop),
+                    # The first instruction after an interrupt is taken is
+                    # flagged as such.
+                    self.rvfi_out.payload.intr.eq(interrupted),
+                    interrupted.eq(0),
                 ]
 
-            with m.If(self.state[2]):
-                m.d.sync += [
-                    self.rvfi_out.payload.rs1_rdata[16:].eq(self.rf_read_resp_snoop),
-                ]
+            for (read_d, read_valid_d, resp) in reads:
+                with m.If(read_valid_d & (read_d[:5] == rs1_field)):
+                    with m.If(read_d[5]):
+                        m.d.sync += self.rvfi_out.payload.rs1_rdata[16:].eq(
+                            resp
+                        )
+                    with m.Else():
+                        m.d.sync += self.rvfi_out.payload.rs1_rdata[:16].eq(
+                            resp
+                        )
 
-            with m.If(self.state[3]):
-                m.d.sync += [
-                    self.rvfi_out.payload.rs2_rdata[16:].eq(self.rf_read_resp_snoop),
-                ]
+                with m.If(read_valid_d & (read_d[:5] == rs2_field)):
+                    with m.If(read_d[5]):
+                        m.d.sync += self.rvfi_out.payload.rs2_rdata[16:].eq(
+                            resp
+                        )
+                    with m.Else():
+                        m.d.sync += self.rvfi_out.payload.rs2_rdata[:16].eq(
+                            resp
+                        )
 
             with m.If(self.rf_write_snoop.valid):
                 with m.If(self.rf_write_snoop.payload.reg[5]):
@@ -352,9 +685,9 @@ class RvfiPort(Component):
                         self.bus_resp_snoop
                     )
 
-            # Ignore bus activity in states 1/2 as RVFI doesn't consider fetch
-            # traffic.
-            with m.If(self.bus_snoop.valid & ~(self.state[1] | self.state[2])):
+            # The CPU only shows us EW's bus traffic, since RVFI doesn't
+            # consider fetches.
+            with m.If(self.bus_snoop.valid):
                 with m.If(self.rvfi_out.payload.mem_wmask.any() | self.rvfi_out.payload.mem_rmask.any()):
                     # If we've seen a halfword access already on this instruction,
                     # check the next one for consistency.
@@ -0,0 +1,484 @@
+# Compiled simulation through Yosys' CXXRTL backend.
+#
+# Amaranth's built-in simulator is great for unit tests but manages something
+# like ten thousand cycles a second on a whole SoC, which makes running real
+# firmware (Dhrystone, a bootloader followed by its payload) impractical. This
+# module takes the same Elaboratable the board scripts build, runs it through
+# write_cxxrtl, compiles the result into a shared library with the local C++
+# compiler, and drives it through the CXXRTL C API using ctypes.
+#
+# The compiled design is cached by a hash of its RTLIL, so re-running a
+# simulation of an unchanged design skips the (slow) compile.
+#
+# The clock is toggled by a small loop written in C rather than from Python,
+# which would otherwise dominate the run time. That loop can also record
+# activity on one output (transitions on a UART TX line, or bytes written to a
+# bus-level UART stand-in) and stop early when another output goes high.
+
+import ctypes
+import hashlib
+import importlib.resources
+import os
+import subprocess
+from pathlib import Path
+
+from amaranth.back import rtlil
+
+import logging
+
+log = logging.getLogger(__name__)
+
+# Glue between ctypes and the CXXRTL C API. cxxrtl_get is an inline function
+# in the header, so we can't call it from ctypes directly, and the object
+# struct carries more than we need; hp_get flattens it into hp_item. hp_run is
+# the hot loop.
+_SHIM = r"""
+#include <cxxrtl/capi/cxxrtl_capi.h>
+#include <cstdint>
+#include <cstddef>
+
+extern "C" {
+
+struct hp_item {
+    size_t width;
+    size_t depth;
+    uint32_t *curr;
+    uint32_t *next;
+    cxxrtl_outline outline;
+};
+
+int hp_get(cxxrtl_handle handle, const char *name, hp_item *out) {
+    size_t parts = 0;
+    cxxrtl_object *object = cxxrtl_get_parts(handle, name, &parts);
+    if (object == nullptr || parts != 1) return 0;
+    out->width = object->width;
+    out->depth = object->depth;
+    out->curr = object->curr;
+    out->next = object->next;
+    out->outline = object->outline;
+    return 1;
+}
+
+// Wires that the compiler optimized out are computed on demand.
+static uint32_t hp_bit(const hp_item *item) {
+    if (item->outline) cxxrtl_outline_eval(item->outline);
+    return item->curr[0] & 1;
+}
+
+// Runs up to 'cycles' clock cycles. If 'trace' is non-null, events on it are
+// appended to 'events': without 'data', every change in its bit 0 is recorded
+// as (cycle << 1) | value; with 'data', every cycle where its bit 0 is set is
+// recorded as (cycle << 32) | data. If 'stop' is non-null, stops at the end of
+// the first cycle where its bit 0 is set. Also stops early if 'events' fills
+// up. Returns the number of cycles run; the number of events recorded is
+// written to *event_count.
+uint64_t hp_run(cxxrtl_handle handle, uint32_t *clk, uint64_t cycles,
+                const hp_item *trace, const hp_item *data,
+                uint64_t *events, size_t capacity, size_t *event_count,
+                const hp_item *stop) {
+    uint32_t last = trace ? hp_bit(trace) : 0;
+    size_t count = 0;
+    uint64_t n = 0;
+    while (n < cycles && count < capacity) {
+        // Nothing in a synchronous design changes on the falling edge, so
+        // rather than evaluating the whole design we just commit, which is
+        // enough for the next rising edge to be noticed.
+        *clk = 0;
+        cxxrtl_commit(handle);
+        *clk = 1;
+        cxxrtl_step(handle);
+        n++;
+        if (trace) {
+            uint32_t value = hp_bit(trace);
+            if (data) {
+                if (value) {
+                    if (data->outline) cxxrtl_outline_eval(data->outline);
+                    events[count++] = (n << 32) | data->curr[0];
+                }
+            } else if (value != last) {
+                events[count++] = (n << 1) | value;
+            }
+            last = value;
+        }
+        if (stop && hp_bit(stop)) break;
+    }
+    *event_count = count;
+    return n;
+}
+
+}
+"""
+
+
+class _Item(ctypes.Structure):
+    _fields_ = [
+        ("width", ctypes.c_size_t),
+        ("depth", ctypes.c_size_t),
+        ("curr", ctypes.POINTER(ctypes.c_uint32)),
+        ("next", ctypes.POINTER(ctypes.c_uint32)),
+        ("outline", ctypes.c_void_p),
+    ]
+
+    @property
+    def chunks(self):
+        return (self.width + 31) // 32
+
+
+_ENUM_CALLBACK = ctypes.CFUNCTYPE(
+    None, ctypes.c_void_p, ctypes.c_char_p, ctypes.c_void_p, ctypes.c_size_t,
+)
+
+
+class BuildError(Exception):
+    pass
+
+
+def _include_dir():
+    override = os.environ.get("CXXRTL_INCLUDE")
+    if override:
+        return Path(override)
+    import yowasp_yosys
+    return Path(importlib.resources.files(yowasp_yosys)) \
+        / "share" / "include" / "backends" / "cxxrtl" / "runtime"
+
+
+def _run(cmd, cwd):
+    log.debug("running %s", " ".join(str(c) for c in cmd))
+    result = subprocess.run(cmd, cwd = cwd, capture_output = True, text = True)
+    if result.returncode != 0:
+        raise BuildError(
+            f"{cmd[0]} failed with status {result.returncode}:\n"
+            + result.stdout + result.stderr
+        )
+
+
+def build(design, *, name = "top", ports = (), cache_dir = "build/cxxrtl",
+          cell_models = False, opt = "-O1"):
+    """Compiles 'design' into a CXXRTL shared library, returning its path.
+
+    Parameters
+    ----------
+    design: the Elaboratable to simulate. It's elaborated with no platform.
+    name (str): name of the toplevel module.
+    ports (list of Signal): toplevel signals to expose as ports, beyond clk
+        and rst.
+    cache_dir (str or Path): where to keep build products. Designs are keyed
+        by a hash of their RTLIL, so this can be shared between designs.
+    cell_models (bool): read Yosys' simulation models for iCE40 primitives
+        so that Instances of them simulate. Off by default because some of
+        them (SB_SPRAM256KA in particular) take Yosys forever to convert;
+        modules that can should elaborate to plain logic when platform is
+        None instead.
+    opt (str): C++ compiler optimization flag. -O1 compiles much faster than
+        -O2/-O3 on designs this size and runs nearly as fast.
+    """
+    text = rtlil.convert(design, name = name, ports = list(ports))
+    cxx = os.environ.get("CXX", "c++")
+    include = _include_dir()
+
+    key = hashlib.sha256()
+    for part in (text, _SHIM, cxx, opt, str(cell_models)):
+        key.update(part.encode())
+    key = key.hexdigest()[:16]
+
+    cache_dir = Path(cache_dir)
+    library = cache_dir / f"{name}-{key}.so"
+    if library.exists():
+        log.info("using cached %s", library)
+        return library
+
+    cache_dir.mkdir(parents = True, exist_ok = True)
+    (cache_dir / f"{name}-{key}.il").write_text(text)
+    (cache_dir / "hp_shim.cc").write_text(_SHIM)
+
+    script = [f"read_rtlil {name}-{key}.il"]
+    if cell_models:
+        script.append("read_verilog +/ice40/cells_sim.v")
+    script += [
+        f"hierarchy -top {name}",
+        "proc",
+        "flatten",
+        f"write_cxxrtl -header {name}-{key}.cc",
+    ]
+    log.info("generating C++ for %s", name)
+    _run([os.environ.get("YOSYS", "yowasp-yosys"), "-q",
+          "-p", "; ".join(script)], cache_dir)
+
+    log.info("compiling %s (this takes a while)", library.name)
+    _run([
+        cxx, "-std=c++14", opt, "-shared", "-fPIC",
+        f"-I{include}",
+        f"{name}-{key}.cc",
+        "hp_shim.cc",
+        str(include / "cxxrtl" / "capi" / "cxxrtl_capi.cc"),
+        "-o", f"{library.name}.tmp",
+    ], cache_dir)
+    # Rename into place so that an interrupted compile doesn't leave a
+    # truncated library behind in the cache.
+    os.replace(cache_dir / f"{library.name}.tmp", library)
+    return library
+
+
+class UartDecoder:
+    """Turns a list of transitions on a UART TX line into bytes.
+
+    Parameters
+    ----------
+    cycles_per_bit (int): clock cycles per bit, i.e. clock frequency divided
+        by baud rate.
+
+    Attributes
+    ----------
+    data (bytearray): everything decoded so far.
+    """
+
+    def __init__(self, cycles_per_bit):
+        self.cycles_per_bit = cycles_per_bit
+        self.data = bytearray()
+        self.level = 1
+        self.frame_start = None
+        self.bits = []
+
+    def feed(self, events, now):
+        """Consumes (cycle, level) transitions, then decodes everything up to
+        cycle 'now'. Returns the bytes completed by this call."""
+        before = len(self.data)
+        for cycle, level in events:
+            self._advance(cycle)
+            self.level = level
+            if level == 0 and self.frame_start is None:
+                self.frame_start = cycle
+        self._advance(now)
+        return bytes(self.data[before:])
+
+    def _advance(self, until):
+        # Sample each bit in the middle of its period, using whatever level
+        # the line had at the time.
+        while self.frame_start is not None:
+            n = len(self.bits)
+            sample = self.frame_start + (n + 1) * self.cycles_per_bit \
+                + self.cycles_per_bit // 2
+            if sample > until:
+                break
+            self.bits.append(self.level)
+            if len(self.bits) == 9:
+                value = sum(b << i for i, b in enumerate(self.bits[:8]))
+                if self.bits[8]:
+                    self.data.append(value)
+                else:
+                    log.warning("UART framing error at cycle %d", sample)
+                self.bits = []
+                self.frame_start = None
+
+
+class Simulation:
+    """A compiled CXXRTL simulation of an Amaranth design.
+
+    Signals and memories are named by their hierarchical path with spaces
+    between levels, as CXXRTL presents them -- e.g. "cpu ew pc" for the PC, or
+    "bootmem U$0" for the array inside a BasicMemory. Use 'names()' to list
+    them.
+
+    Parameters
+    ----------
+    design: the Elaboratable to simulate; see 'build' for the other
+        parameters, which are passed through.
+
+    Attributes
+    ----------
+    cycle (int): number of clock cycles run since construction.
+    """
+
+    def __init__(self, design, *, name = "top", **kwargs):
+        self.library_path = build(design, name = name, **kwargs)
+        lib = self._lib = ctypes.CDLL(str(self.library_path))
+
+        lib.cxxrtl_design_create.restype = ctypes.c_void_p
+        lib.cxxrtl_create.restype = ctypes.c_void_p
+        lib.cxxrtl_create.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_destroy.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_step.argtypes = [ctypes.c_void_p]
+        lib.cxxrtl_enum.argtypes = [
+            ctypes.c_void_p, ctypes.c_void_p, _ENUM_CALLBACK,
+        ]
+        lib.hp_get.argtypes = [
+            ctypes.c_void_p, ctypes.c_char_p, ctypes.POINTER(_Item),
+        ]
+        lib.hp_run.restype = ctypes.c_uint64
+        lib.hp_run.argtypes = [
+            ctypes.c_void_p,
+            ctypes.POINTER(ctypes.c_uint32),
+            ctypes.c_uint64,
+            ctypes.POINTER(_Item),
+            ctypes.POINTER(_Item),
+            ctypes.POINTER(ctypes.c_uint64),
+            ctypes.c_size_t,
+            ctypes.POINTER(ctypes.c_size_t),
+            ctypes.POINTER(_Item),
+        ]
+        lib.cxxrtl_outline_eval.argtypes = [ctypes.c_void_p]
+
+        self._handle = lib.cxxrtl_create(lib.cxxrtl_design_create())
+        self._items = {}
+        self.cycle = 0
+        self._clk = self._item("clk")
+        self._trace = None
+        self._trace_data = None
+        self._decoder = None
+        self._output = bytearray()
+
+    def __del__(self):
+        handle = getattr(self, "_handle", None)
+        if handle is not None:
+            self._lib.cxxrtl_destroy(handle)
+            self._handle = None
+
+    def names(self):
+        """Returns the names of all signals and memories in the design."""
+        found = []
+        callback = _ENUM_CALLBACK(lambda data, name, obj, parts:
+                                  found.append(name.decode()))
+        self._lib.cxxrtl_enum(self._handle, None, callback)
+        return found
+
+    def _item(self, name):
+        item = self._items.get(name)
+        if item is None:
+            item = _Item()
+            if not self._lib.hp_get(self._handle, name.encode(),
+                                    ctypes.byref(item)):
+                raise KeyError(name)
+            self._items[name] = item
+        return item
+
+    def __getitem__(self, name):
+        "Reads the current value of a signal."
+        item = self._item(name)
+        if item.outline:
+            self._lib.cxxrtl_outline_eval(item.outline)
+        return _read_chunks(item.curr, 0, item.chunks)
+
+    def __setitem__(self, name, value):
+        """Sets a signal. Only toplevel inputs (and registers, if you know
+        what you're doing) hold a value set this way."""
+        item = self._item(name)
+        value &= (1 << item.width) - 1
+        _write_chunks(item.curr, 0, item.chunks, value)
+        if item.next:
+            _write_chunks(item.next, 0, item.chunks, value)
+
+    def read_memory(self, name, index):
+        "Reads row 'index' of a memory."
+        item = self._item(name)
+        if not 0 <= index < item.depth:
+            raise IndexError(f"{name}[{index}] out of range")
+        return _read_chunks(item.curr, index * item.chunks, item.chunks)
+
+    def load_memory(self, name, rows, offset = 0):
+        """Writes a sequence of ints into a memory starting at row 'offset',
+        e.g. to preload firmware without simulating a bootloader."""
+        item = self._item(name)
+        rows = list(rows)
+        if offset < 0 or offset + len(rows) > item.depth:
+            raise IndexError(f"{len(rows)} rows at {offset} don't fit in "
+                             f"{name} (depth {item.depth})")
+        mask = (1 << item.width) - 1
+        for i, value in enumerate(rows):
+            _write_chunks(item.curr, (offset + i) * item.chunks, item.chunks,
+                          value & mask)
+
+    def load_image(self, name, image, offset = 0):
+        """Loads a little-endian binary image into a memory, splitting it into
+        rows of the memory's width (which must be a multiple of 8 bits).
+        'offset' is in rows."""
+        item = self._item(name)
+        if item.width % 8 != 0:
+            raise ValueError(f"{name} is {item.width} bits wide")
+        row_bytes = item.width // 8
+        image = bytes(image)
+        if len(image) % row_bytes:
+            image += bytes(row_bytes - len(image) % row_bytes)
+        self.load_memory(name, (
+            int.from_bytes(image[i:i + row_bytes], "little")
+            for i in range(0, len(image), row_bytes)
+        ), offset)
+
+    def trace_uart(self, name, cycles_per_bit):
+        """Decodes serial output on the one-bit signal 'name' as the
+        simulation runs. Decoded bytes are returned by 'run' and collected in
+        'uart_output'."""
+        self._trace = self._item(name)
+        self._trace_data = None
+        self._decoder = UartDecoder(cycles_per_bit)
+
+    def trace_writes(self, strobe, data):
+        """Collects the low byte of signal 'data' on every cycle where signal
+        'strobe' is high -- for capturing output from a bus-level stand-in
+        for a UART, like hapenny.serial.SimUart, without simulating the
+        serial line. Bytes are returned by 'run' and collected in
+        'uart_output'."""
+        self._trace = self._item(strobe)
+        self._trace_data = self._item(data)
+        self._decoder = None
+
+    @property
+    def uart_output(self):
+        return bytes(self._output)
+
+    def reset(self, cycles = 2):
+        "Holds the design in reset for a few cycles."
+        self["rst"] = 1
+        self.run(cycles)
+        self["rst"] = 0
+
+    def step(self):
+        "Runs a single clock cycle."
+        self.run(1)
+
+    def run(self, cycles, *, until = None):
+        """Runs up to 'cycles' clock cycles, stopping early at the end of the
+        first cycle where the signal named 'until' is nonzero. Returns any
+        UART output decoded along the way."""
+        stop = ctypes.byref(self._item(until)) if until is not None else None
+        trace = ctypes.byref(self._trace) if self._trace is not None else None
+        data = ctypes.byref(self._trace_data) \
+            if self._trace_data is not None else None
+        capacity = 4096
+        events = (ctypes.c_uint64 * capacity)()
+        count = ctypes.c_size_t()
+        output = b""
+        remaining = cycles
+        while remaining > 0:
+            # hp_run returns early if the event buffer fills, in which case
+            # we drain it and keep going.
+            ran = self._lib.hp_run(
+                self._handle, self._clk.curr, remaining,
+                trace, data, events, capacity, ctypes.byref(count),
+                stop,
+            )
+            recorded = events[:count.value]
+            if self._decoder is not None:
+                output += self._decoder.feed(
+                    ((self.cycle + (e >> 1), e & 1) for e in recorded),
+                    self.cycle + ran,
+                )
+            elif data is not None:
+                output += bytes(e & 0xFF for e in recorded)
+            self.cycle += ran
+            remaining -= ran
+            if until is not None and self[until]:
+                break
+        self._output += output
+        return output
+
+
+def _read_chunks(pointer, start, count):
+    value = 0
+    for i in range(count):
+        value |= pointer[start + i] << (32 * i)
+    return value
+
+
+def _write_chunks(pointer, start, count, value):
+    for i in range(count):
+        pointer[start + i] = (value >> (32 * i)) & 0xFFFF_FFFF
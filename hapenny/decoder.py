@@ -6,6 +6,8 @@ from amaranth.lib.enum import *
 from amaranth.lib.data import *
 import amaranth.lib.coding
 
+from hapenny import mux
+
 class Opcode(Enum):
     LUI = 0b01101
     AUIPC = 0b00101
@@ -40,6 +42,7 @@ class DecodeSignals(Struct):
     is_alu_ri: unsigned(1)
     is_system: unsigned(1)
     is_custom0: unsigned(1)
+    is_muldiv: unsigned(1)
 
     # derived signals to make it easier to move the functions before a register.
     is_auipc_or_lui: unsigned(1)
@@ -68,6 +71,12 @@ class Decoder(Component):
     """The Decoder is a circuit that breaks an instruction into the various
     control signals. It's used by the larger components.
 
+    Parameters
+    ----------
+    muldiv (bool): decode the multiply and divide instructions of the M
+        extension as is_muldiv, rather than as the register-register ALU ops
+        they'd otherwise run as. Default False.
+
     Attributes
     ----------
     inst (input): instruction word.
@@ -77,10 +86,13 @@ class Decoder(Component):
 
     out: Out(DecodeSignals)
 
-    def __init__(self, 
+    def __init__(self, *,
+                 muldiv = False,
                  ):
         super().__init__()
 
+        self.muldiv = muldiv
+
     def elaborate(self, platform):
         m = Module()
 
@@ -91,6 +103,13 @@ class Decoder(Component):
         opcode = Signal(5)
         m.d.comb += opcode.eq(self.inst[2:7])
 
+        # M extension instructions are register-register ALU ops with a
+        # funct7 of 1. Other funct7 values only ever set bit 30, so bit 25 is
+        # enough to tell them apart.
+        is_muldiv = Signal(1)
+        if self.muldiv:
+            m.d.comb += is_muldiv.eq((opcode == Opcode.ALUREG) & self.inst[25])
+
         m.d.comb += [
             self.out.inst.eq(self.inst),
             self.out.opcode.eq(opcode),
@@ -105,10 +124,11 @@ class Decoder(Component):
             self.out.is_b.eq(opcode == Opcode.Bxx),
             self.out.is_load.eq(opcode == Opcode.Lxx),
             self.out.is_store.eq(opcode == Opcode.Sxx),
-            self.out.is_alu_rr.eq(opcode == Opcode.ALUREG),
+            self.out.is_alu_rr.eq((opcode == Opcode.ALUREG) & ~is_muldiv),
             self.out.is_alu_ri.eq(opcode == Opcode.ALUIMM),
             self.out.is_system.eq(opcode == Opcode.SYSTEM),
             self.out.is_custom0.eq(opcode == Opcode.CUSTOM0),
+            self.out.is_muldiv.eq(is_muldiv),
             self.out.funct3_is.eq(f3d.o),
         ]
 
@@ -230,3 +250,160 @@ class ImmediateDecoder(Component):
 
         return m
 
+
+class Expander(Component):
+    """The Expander turns an RV32C compressed instruction into the RV32I
+    instruction it stands for, so that the rest of the CPU never has to know
+    about compressed instructions (except when it's working out the address of
+    the next one). Instructions that aren't compressed pass through unchanged.
+
+    Compressed instructions that have no RV32I equivalent -- the
+    floating-point loads and stores, and the reserved encodings -- come out as
+    whatever's cheapest, just as the Decoder does with instructions it doesn't
+    implement.
+
+    Attributes
+    ----------
+    inst (input): instruction word. If its bottom two bits aren't both set,
+        the instruction is compressed, and only the low halfword matters.
+    out (output): the equivalent 32-bit instruction word.
+    compressed (output): the instruction was compressed.
+    """
+    inst: In(32)
+
+    out: Out(32)
+    compressed: Out(1)
+
+    def elaborate(self, platform):
+        m = Module()
+
+        c = self.inst[:16]
+
+        # The register fields. rd and rs1 share a field in most formats, and
+        # the three-bit forms can only name x8-x15.
+        rd = c[7:12]
+        rs2 = c[2:7]
+        rd_p = Cat(c[2:5], C(0b01, 2))
+        rs1_p = Cat(c[7:10], C(0b01, 2))
+        rs2_p = rd_p
+        sp = C(2, 5)
+        zero = C(0, 5)
+
+        # The six-bit sign-extended immediate of C.ADDI, C.LI and C.ANDI.
+        imm6 = Cat(c[2:7], c[12].replicate(7))
+        # Load and store offsets, which are zero-extended.
+        lw_offset = Cat(C(0, 2), c[6], c[10:13], c[5], C(0, 5))
+        lwsp_offset = Cat(C(0, 2), c[4:7], c[12], c[2:4], C(0, 4))
+        swsp_offset = Cat(C(0, 2), c[9:13], c[7:9], C(0, 4))
+        # The immediate of C.ADDI4SPN, also zero-extended.
+        addi4spn_imm = Cat(C(0, 2), c[6], c[5], c[11:13], c[7:11], C(0, 2))
+        # The immediate of C.ADDI16SP, sign-extended.
+        addi16sp_imm = Cat(C(0, 4), c[6], c[2], c[5], c[3:5], c[12].replicate(3))
+        # The upper immediate of C.LUI, sign-extended.
+        lui_imm = Cat(c[2:7], c[12].replicate(15))
+        # Jump and branch offsets, sign-extended.
+        j_offset = Cat(C(0, 1), c[3:6], c[11], c[2], c[7], c[6], c[9:11], c[8],
+                       c[12].replicate(10))
+        b_offset = Cat(C(0, 1), c[3:5], c[10:12], c[2], c[5:7],
+                       c[12].replicate(5))
+
+        # Encoders for the RV32I formats, taking the immediate as the
+        # instruction would use it.
+        def i_type(opcode, funct3, rd, rs1, imm):
+            return Cat(C(opcode, 7), rd, C(funct3, 3), rs1, imm[:12])
+        def s_type(opcode, funct3, rs1, rs2, imm):
+            return Cat(C(opcode, 7), imm[:5], C(funct3, 3), rs1, rs2,
+                       imm[5:12])
+        def r_type(funct7, funct3, rd, rs1, rs2):
+            return Cat(C(0b0110011, 7), rd, funct3, rs1, rs2, funct7)
+        def b_type(funct3, rs1, imm):
+            return Cat(C(0b1100011, 7), imm[11], imm[1:5], funct3, rs1, zero,
+                       imm[5:11], imm[12])
+        def j_type(rd, imm):
+            return Cat(C(0b1101111, 7), rd, imm[12:20], imm[11], imm[1:11],
+                       imm[20])
+
+        OP_IMM = 0b0010011
+        LOAD = 0b0000011
+        STORE = 0b0100011
+        JALR = 0b1100111
+
+        m.d.comb += [
+            self.compressed.eq(~c[:2].all()),
+            self.out.eq(self.inst),
+        ]
+
+        # Compressed instructions are identified by funct3 in their top three
+        # bits, and the quadrant in their bottom two.
+        with m.Switch(Cat(c[:2], c[13:16])):
+            with m.Case("000 00"): # C.ADDI4SPN
+                m.d.comb += self.out.eq(i_type(OP_IMM, 0b000, rd_p, sp,
+                                               addi4spn_imm))
+            with m.Case("010 00"): # C.LW
+                m.d.comb += self.out.eq(i_type(LOAD, 0b010, rd_p, rs1_p,
+                                               lw_offset))
+            with m.Case("110 00"): # C.SW
+                m.d.comb += self.out.eq(s_type(STORE, 0b010, rs1_p, rs2_p,
+                                               lw_offset))
+
+            with m.Case("000 01"): # C.ADDI
+                m.d.comb += self.out.eq(i_type(OP_IMM, 0b000, rd, rd, imm6))
+            with m.Case("001 01"): # C.JAL
+                m.d.comb += self.out.eq(j_type(C(1, 5), j_offset))
+            with m.Case("010 01"): # C.LI
+                m.d.comb += self.out.eq(i_type(OP_IMM, 0b000, rd, zero, imm6))
+            with m.Case("011 01"):
+                with m.If(rd == 2): # C.ADDI16SP
+                    m.d.comb += self.out.eq(i_type(OP_IMM, 0b000, sp, sp,
+                                                   addi16sp_imm))
+                with m.Else(): # C.LUI
+                    m.d.comb += self.out.eq(Cat(C(0b0110111, 7), rd, lui_imm))
+            with m.Case("100 01"):
+                with m.Switch(c[10:12]):
+                    with m.Case(0b00, 0b01): # C.SRLI, C.SRAI
+                        m.d.comb += self.out.eq(i_type(
+                            OP_IMM, 0b101, rs1_p, rs1_p,
+                            Cat(c[2:7], C(0, 5), c[10], C(0, 1)),
+                        ))
+                    with m.Case(0b10): # C.ANDI
+                        m.d.comb += self.out.eq(i_type(OP_IMM, 0b111, rs1_p,
+                                                       rs1_p, imm6))
+                    with m.Case(0b11):
+                        # C.SUB, C.XOR, C.OR and C.AND, whose funct3s are
+                        # 000, 100, 110 and 111.
+                        op = c[5:7]
+                        m.d.comb += self.out.eq(r_type(
+                            Cat(C(0, 5), op == 0, C(0, 1)),
+                            Cat(op.all(), op[1], op.any()),
+                            rs1_p, rs1_p, rs2_p,
+                        ))
+            with m.Case("101 01"): # C.J
+                m.d.comb += self.out.eq(j_type(zero, j_offset))
+            with m.Case("11- 01"): # C.BEQZ, C.BNEZ
+                m.d.comb += self.out.eq(b_type(Cat(c[13], C(0, 2)), rs1_p,
+                                               b_offset))
+
+            with m.Case("000 10"): # C.SLLI
+                m.d.comb += self.out.eq(i_type(OP_IMM, 0b001, rd, rd,
+                                               Cat(c[2:7], C(0, 7))))
+            with m.Case("010 10"): # C.LWSP
+                m.d.comb += self.out.eq(i_type(LOAD, 0b010, rd, sp,
+                                               lwsp_offset))
+            with m.Case("100 10"):
+                with m.If(rs2 != 0):
+                    # C.MV is ADD from x0, and C.ADD from rd.
+                    m.d.comb += self.out.eq(r_type(
+                        C(0, 7), C(0, 3), rd, mux(c[12], rd, zero), rs2,
+                    ))
+                with m.Elif(c[12] & (rd == 0)): # C.EBREAK
+                    m.d.comb += self.out.eq(0x00100073)
+                with m.Else():
+                    # C.JR links into x0, and C.JALR into x1.
+                    m.d.comb += self.out.eq(i_type(
+                        JALR, 0b000, Cat(c[12], C(0, 4)), rd, C(0, 12),
+                    ))
+            with m.Case("110 10"): # C.SWSP
+                m.d.comb += self.out.eq(s_type(STORE, 0b010, sp, rs2,
+                                               swsp_offset))
+
+        return m
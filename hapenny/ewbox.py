@@ -3,12 +3,14 @@
 from amaranth import *
 from amaranth.lib.wiring import *
 from amaranth.lib.enum import *
+import amaranth.lib.coding
 
 from hapenny import StreamSig, AlwaysReady, onehot_choice, oneof, mux, hihalf, lohalf, choosehalf
 from hapenny.sbox import STATE_COUNT
 from hapenny.regfile16 import RegFile16, RegWrite
 from hapenny.bus import BusPort
 from hapenny.decoder import Decoder, ImmediateDecoder, DecodeSignals
+from hapenny.mbox import MBox
 
 class EWBox(Component):
     """The EW-Box does execute and writeback -- basically all of the CPU logic
@@ -30,14 +32,34 @@ class EWBox(Component):
     - Bxx: perform low half of branch target computation
     - SW: store high half
     - SLT: rewrite register bottom half to set flag
-    - Shifts: shift one more bit and hold this state until done; write low half
-      of rd
+    - Shifts: shift up to shift_bits_per_cycle more bits and hold this state
+      until done; write low half of rd
+    - Multiply/divide: hold this state until the M-Box is done; write low
+      half of rd
 
     State 5:
     - LW: write top half of rd
     - LH/LB: write sign or zero to rd
     - Bxx: add high half of branch target, write PC
     - Shifts: write high half of rd
+    - Multiply/divide: write high half of rd
+
+    With a second register file read port (rf_read_ports = 2) we can read rs1
+    and rs2 at the same time, and run a short schedule that does without state
+    2: rs1.hi and rs2.lo are both read in state 0, and rs2.hi in state 1, so
+    state 1 can operate on the low halves and latch rs1.hi into the
+    accumulator at once. Everything that happens in states 3-5 above happens
+    one state earlier. (The FD-Box must fetch a state earlier to keep up; see
+    its early_fetch parameter.)
+
+    With only one read port, the short schedule still works for instructions
+    that don't need rs2.lo in state 0 -- everything except register-register
+    ALU ops (multiplies and divides included) and branches, which operate on
+    it in state 1 -- since the port is then free to read rs1.hi instead.
+    Stores read rs2 later, in states 1 and 2, which the port has free. With
+    skip_rs2_reads we run those instructions, and bubbles, on the short
+    schedule, and tell the FD-Box which schedule we're on through the short
+    output.
 
     Parameters
     ----------
@@ -55,14 +77,72 @@ class EWBox(Component):
         address range, and I/O devices higher, you can set this parameter to
         smaller than addr_width to save some area. If not explicitly
         overridden, this is the same as addr_width.  addr_width.
+    counters (bool): implement the cycle and instret counters.
+    shift_bits_per_cycle (int): how far the shifter can move bits in one
+        cycle: 1, 2, 4, 8 or 16. Larger values cost more logic but shorten
+        long shifts; a shift by N bits takes 6 + ceil(N / shift_bits_per_cycle)
+        cycles. Default 1.
+    early_jal (bool): set if the FD-Box has been configured to redirect fetch
+        for JAL itself, in which case we don't need to generate a bubble after
+        one. Default False.
+    predict_branches (bool): set if the FD-Box has been configured to predict
+        backward conditional branches as taken, in which case a taken
+        backward branch doesn't need a bubble, but a not-taken one does.
+        Default False.
+    rf_read_ports (int): number of read ports on the register file, 1 or 2.
+        With 2 we run the short schedule described above, and read rs2 on the
+        second port. Default 1.
+    skip_rs2_reads (bool): with one read port, run instructions that don't
+        need rs2 in state 0 on the short schedule. Default False.
+    muldiv (bool): implement the M extension, with an M-Box. It loads its
+        operands as we read them in states 1 and 3, and works while we hold
+        state 4. Default False.
+    multiplier (str): the M-Box's multiplier parameter. Default None, which
+        lets it choose.
+    compressed (bool): support the C extension. The FD-Box expands
+        compressed instructions for us, so all we need to know is which ones
+        were compressed, and so only two bytes long. The PC is then a halfword
+        address. Default False; FD must be configured to match.
+    interrupts (int): number of interrupt request lines, or 0 for none. See
+        below. Default 0.
+    interrupt_vector (int): address of the vector table. Line n enters its
+        handler at interrupt_vector + 4*n, which must be aligned to the size
+        of the table. Default 0.
+    harts (int): number of hardware threads to take turns between, as
+        described below. With more than one, FD must not be configured to
+        redirect fetch on its own (early_jal, predict_branches) or to keep
+        halfwords between instructions (compressed), and there are no
+        interrupts. Default 1.
+
+    Interrupts are taken at the end of an instruction (or bubble), if a line
+    is up, the MIE bit is set, and we aren't in a handler already: instead of
+    going on to the next instruction, we save its address in an EPC register
+    and start a bubble to fetch from the line's vector. The handler runs until
+    MRET, which goes back to the saved address. Handlers can't be
+    interrupted. The only other CSR access we understand is setting and
+    clearing MIE, with "csrsi mstatus, 8" and "csrci mstatus, 8"; it's clear
+    at reset.
+
+    With several harts, we take turns between them, one instruction each,
+    round robin. While we execute an instruction for one hart, FD fetches the
+    next hart's, whose address has been known since its last instruction
+    ended, so nothing we do is speculative and we never need a bubble: jumps
+    and taken branches just write the PC the hart will pick up on its next
+    turn. Each hart has its own bank of registers, and reads its number from
+    the mhartid CSR. The harts all start at the reset vector.
 
     Attributes
     ----------
     onehot_state (input): state input from the S-Box
     inst_next (input): instruction word from FD.
+    inst_next_compressed, inst_next_raw (input): whether the instruction on
+        inst_next was compressed, and if so, the halfword it was expanded
+        from, also from FD. Only present with compressed.
 
     rf_read_cmd (output): read command to the register file, intended to be OR'd.
     rf_resp (input): value most recently read from the register file.
+    rf_read_cmd_b, rf_resp_b: the same for the second read port, if we have
+        one. We have it to ourselves, so this isn't OR'd.
 
     bus (port): our connection to the memory fabric.
 
@@ -80,9 +160,39 @@ class EWBox(Component):
         stream changes.
     pc (output): Current contents of PC register, mostly for debug port.
     debug_pc_write (port): while halted, can overwrite the PC with a word
-        address (bottom two bits implied as zero).
+        address (bottom two bits implied as zero), or with compressed, a
+        halfword address.
     hold (output): Indicates that we're going to repeat this state, signals
         s-box to maintain it.
+    debug_inst (output): the instruction we're executing, expanded if it was
+        compressed.
+    debug_inst_raw (output): the same, but as it was in memory, i.e. not
+        expanded. Only present with compressed.
+    short (output): the current instruction is on the short schedule. Only
+        present with skip_rs2_reads and one read port; otherwise the schedule
+        is fixed.
+    irq (input): interrupt request lines, one bit per line. Lower numbered
+        lines take priority. Only present with interrupts.
+    in_handler (output): we're running an interrupt handler, i.e. we've
+        taken an interrupt and not yet executed MRET. Only present with
+        interrupts.
+    in_handler_next (output): what in_handler will be on the next cycle,
+        which the register file needs to pick a bank for reads. Only present
+        with interrupts.
+    interrupt_taken (output): we're taking an interrupt at the end of this
+        instruction. Only present with interrupts.
+    pc_next (output): address of the instruction the current hart will run
+        next, once it's known, which is what we send FD unless there are
+        several harts.
+    hart (output): the hart whose instruction we're executing. Only present
+        with more than one hart.
+    hart_next (output): what hart will be on the next cycle, which the
+        register file needs to pick a bank for reads. Only present with more
+        than one hart.
+    cycle_counter (input): the number of cycles since reset, for the cycle
+        CSR. Only present with counters. The CPU counts these, since they
+        have to keep counting while we're stalled; we count instret
+        ourselves.
     """
     onehot_state: In(STATE_COUNT)
     rf_read_cmd: Out(AlwaysReady(6))
@@ -93,7 +203,6 @@ class EWBox(Component):
     full: Out(1)
     hold: Out(1)
 
-    debug_pc_write: In(StreamSig(32 - 2))
     debug_inst: Out(32)
 
     def __init__(self, *,
@@ -101,32 +210,152 @@ class EWBox(Component):
                  addr_width = 32,
                  prog_addr_width = 32,
                  counters = False,
+                 shift_bits_per_cycle = 1,
+                 early_jal = False,
+                 predict_branches = False,
+                 rf_read_ports = 1,
+                 skip_rs2_reads = False,
+                 muldiv = False,
+                 multiplier = None,
+                 compressed = False,
+                 interrupts = 0,
+                 interrupt_vector = 0,
+                 harts = 1,
                  ):
         super().__init__()
+        assert rf_read_ports in (1, 2), \
+                f"can't use {rf_read_ports} register file read ports"
+        assert shift_bits_per_cycle in (1, 2, 4, 8, 16), \
+                f"can't shift {shift_bits_per_cycle} bits per cycle"
         assert reset_vector.bit_length() <= prog_addr_width, \
                 f"reset vector 0x{reset_vector:x} won't fit in PC"
+        assert harts == 1 or not (early_jal or predict_branches
+                                  or compressed or interrupts), \
+                "several harts can't have early_jal, predict_branches, " \
+                "compressed or interrupts"
 
         # Create a bus port of sufficient width to address anything on the bus.
         # (Width is -1 because we're addressing halfwords.)
         self.bus = BusPort(addr = addr_width - 1, data = 16).create()
 
-        # The PC width is -2 because it's addressing words.
-        self.fetch_pc = AlwaysReady(prog_addr_width - 2).create()
+        # The PC width is -2 because it's addressing words, or -1 if it's
+        # addressing halfwords.
+        self.pc_lsbs = 1 if compressed else 2
+        self.fetch_pc = AlwaysReady(prog_addr_width - self.pc_lsbs).create()
+        self.debug_pc_write = StreamSig(32 - self.pc_lsbs).flip().create()
+
+        if compressed:
+            self.inst_next_compressed = Signal(1)
+            self.inst_next_raw = Signal(16)
+            self.debug_inst_raw = Signal(32)
+
+        if rf_read_ports == 2:
+            self.rf_read_cmd_b = AlwaysReady(6).create()
+            self.rf_resp_b = Signal(16)
+        elif skip_rs2_reads:
+            # Starting out empty, we start on the short schedule.
+            self.short = Signal(1, init = 1)
+
+        if interrupts:
+            # Vectors are a word apart, so the table takes up this many bits
+            # of address.
+            table_bits = 2 + (interrupts - 1).bit_length()
+            assert interrupt_vector % (1 << table_bits) == 0, \
+                    f"interrupt vector 0x{interrupt_vector:x} must be " \
+                    f"aligned to {1 << table_bits} bytes"
+            assert (interrupt_vector + (1 << table_bits) - 1).bit_length() \
+                    <= prog_addr_width, \
+                    f"interrupt vector 0x{interrupt_vector:x} won't fit in PC"
+            self.irq = Signal(interrupts)
+            self.in_handler = Signal(1)
+            self.in_handler_next = Signal(1)
+            self.interrupt_taken = Signal(1)
+
+        if harts > 1:
+            self.hart = Signal(range(harts))
+            self.hart_next = Signal(range(harts))
+
+        if counters:
+            self.cycle_counter = Signal(32)
 
         self.accum = Signal(16)
-        self.pc = Signal(prog_addr_width - 2, reset = reset_vector >> 2)
+        self.pc = Signal(prog_addr_width - self.pc_lsbs,
+                         reset = reset_vector >> self.pc_lsbs)
+        self.pc_next = Signal.like(self.pc)
 
         self.counters = counters
+        self.shift_bits_per_cycle = shift_bits_per_cycle
+        self.early_jal = early_jal
+        self.predict_branches = predict_branches
+        self.rf_read_ports = rf_read_ports
+        self.skip_rs2_reads = skip_rs2_reads
+        self.muldiv = muldiv
+        self.multiplier = multiplier
+        self.compressed = compressed
+        self.interrupts = interrupts
+        self.interrupt_vector = interrupt_vector
+        self.harts = harts
 
     def elaborate(self, platform):
         m = Module()
 
-        cycle_counter = Signal(32)
+        # Most of the logic below is written in terms of the states of the
+        # (long) schedule described above. On the short schedule, state 2's
+        # work moves into state 1, and later states move down by one, which
+        # these helpers take care of: at(n) is the state bit for state n of
+        # the long schedule, and choice() renumbers the keys of an
+        # onehot_choice.
+        #
+        # short is True or False if the schedule is fixed, or our short
+        # output if it depends on the instruction, in which case at() muxes
+        # between the state bits and choice() has to use oneof instead.
+        two_ports = self.rf_read_ports == 2
+        if two_ports:
+            short = True
+        elif self.skip_rs2_reads:
+            short = self.short
+        else:
+            short = False
+        fixed = isinstance(short, bool)
+        def sched(long, short_value):
+            if fixed:
+                return short_value if short else long
+            return mux(short, short_value, long)
+        def state_for(n):
+            return n - 1 if n >= 2 else n
+        def at(n):
+            if n < 2:
+                return self.onehot_state[n]
+            return sched(self.onehot_state[n],
+                         self.onehot_state[state_for(n)])
+        def choice(options, default = None):
+            if short is False:
+                return onehot_choice(self.onehot_state, options, default)
+            if not fixed:
+                return oneof([
+                    (Cat(*(at(n) for n in key)) if isinstance(key, tuple)
+                     else at(key), value)
+                    for (key, value) in options.items()
+                ], default)
+            renumbered = {}
+            for (key, value) in options.items():
+                if isinstance(key, tuple):
+                    key = tuple(state_for(n) for n in key)
+                else:
+                    key = state_for(key)
+                assert key not in renumbered
+                renumbered[key] = value
+            return onehot_choice(self.onehot_state, renumbered, default)
+
+        # Register values for the right hand side of operations (i.e. rs2)
+        # come from the second read port, if we have one.
+        rhs_resp = self.rf_resp_b if two_ports else self.rf_resp
+
         instret_counter = Signal(32)
         csr_msbs = Signal(16)
 
         # Nested decoder bits
-        m.submodules.dec = Decoder()
+        m.submodules.dec = Decoder(muldiv = self.muldiv)
         m.submodules.imm = imm = ImmediateDecoder()
         # We register the output of the Decoder, above, whenever we load a new
         # instruction. This cuts the critical path from bus response to our
@@ -145,6 +374,24 @@ class EWBox(Component):
             self.debug_inst.eq(dec.inst),
         ]
 
+        # With compressed instructions, we register whether the instruction
+        # was compressed alongside dec (see below), and the halfword it was
+        # expanded from for the trace port, which reports the instruction as
+        # it was in memory.
+        if self.compressed:
+            compressed = Signal(1)
+            raw_inst = Signal(16)
+            m.d.comb += self.debug_inst_raw.eq(mux(
+                compressed,
+                raw_inst,
+                dec.inst,
+            ))
+
+        # PC values are word addresses, or halfword addresses with compressed
+        # instructions; this turns one into a byte address.
+        def pc_bytes(pc):
+            return Cat(C(0, self.pc_lsbs), pc)
+
         # The Adder
         #
         # The adder computes the sum of the accumulator register, the adder_rhs
@@ -169,16 +416,16 @@ class EWBox(Component):
             # then have as thin of a mux as possible to choose between this or
             # the register file at the very end.
             adder_immediate.eq(oneof([
-                (dec.is_b & (self.onehot_state[4] | self.onehot_state[5]),
-                    choosehalf(self.onehot_state[5], imm.b)),
+                (dec.is_b & (at(4) | at(5)),
+                    choosehalf(at(5), imm.b)),
                 (dec.is_auipc_or_lui,
-                 choosehalf(self.onehot_state[3], imm.u)),
+                 choosehalf(at(3), imm.u)),
                 (dec.is_jal,
-                 choosehalf(self.onehot_state[3], imm.j)),
+                 choosehalf(at(3), imm.j)),
                 (dec.is_any_imm_i,
-                 choosehalf(self.onehot_state[3] | self.onehot_state[4], imm.i)),
+                 choosehalf(at(3) | at(4), imm.i)),
                 (dec.is_store,
-                 choosehalf(self.onehot_state[3] | self.onehot_state[4], imm.s)),
+                 choosehalf(at(3) | at(4), imm.s)),
             ])),
 
             # Adder RHS operand selection. We choose the "positive" version of
@@ -194,8 +441,8 @@ class EWBox(Component):
                 # The select condition here is a function over four inputs, so
                 # this mux should require no more than two levels of logic.
                 dec.is_any_reg_to_adder
-                    & (self.onehot_state[1] | self.onehot_state[3]),
-                self.rf_resp,
+                    & (self.onehot_state[1] | at(3)),
+                rhs_resp,
                 adder_immediate,
             )),
             # Generate the final adder_rhs value by conditionally complementing
@@ -205,7 +452,7 @@ class EWBox(Component):
             adder_rhs.eq(
                 adder_rhs_pos ^
                 (dec.is_adder_rhs_complemented
-                    & (self.onehot_state[1] | self.onehot_state[3])).replicate(16)
+                    & (self.onehot_state[1] | at(3))).replicate(16)
             ),
             # Adder implementation:
             Cat(adder_result, adder_carry_out).eq(
@@ -214,25 +461,33 @@ class EWBox(Component):
             zero_out.eq(saved_zero & (adder_result == 0)),
         ]
         # Chain registers (saved carry and zero) update rules
+        carry_rules = {
+            # Initially set saved carry for instructions that subtract,
+            # clear otherwise.
+            0: dec.is_b
+                | dec.is_neg_reg_to_adder
+                | dec.is_neg_imm_i
+                | (dec.is_alu_rr & dec.inst[30]),
+            # Capture adder carry in state 1 and 4.
+            (1, 4): adder_carry_out,
+            # Preserve carry between operate states.
+            2: saved_carry,
+            # We need to clear saved carry for the branch target
+            # computation on a taken branch. For stores, we want to capture
+            # the adder output. None of the other instructions care about
+            # the carry at the end of step 3, so we can just switch off the
+            # branch signal:
+            3: mux(dec.is_b, 0, saved_carry),
+        }
+        if short is not False:
+            # On the short schedule there's nothing between the operate states
+            # to preserve it across. (On the long one, the default does it.)
+            del carry_rules[2]
         m.d.sync += [
-            saved_carry.eq(onehot_choice(self.onehot_state, {
-                # Initially set saved carry for instructions that subtract,
-                # clear otherwise.
-                0: dec.is_b
-                    | dec.is_neg_reg_to_adder
-                    | dec.is_neg_imm_i
-                    | (dec.is_alu_rr & dec.inst[30]),
-                # Capture adder carry in state 1 and 4.
-                (1, 4): adder_carry_out,
-                # Preserve carry between operate states.
-                2: saved_carry,
-                # We need to clear saved carry for the branch target
-                # computation on a taken branch. For stores, we want to capture
-                # the adder output. None of the other instructions care about
-                # the carry at the end of step 3, so we can just switch off the
-                # branch signal:
-                3: mux(dec.is_b, 0, saved_carry),
-            })),
+            saved_carry.eq(choice(
+                carry_rules,
+                default = None if fixed else saved_carry,
+            )),
 
             saved_zero.eq(oneof([
                 # Initially, set saved zero unconditionally, so that chaining
@@ -295,8 +550,10 @@ class EWBox(Component):
 
         # The Shifter
         #
-        # We use a dead-simple single-bit-per-cycle shifter, and as a result a
-        # shift can take up to 31 additional cycles.
+        # By default we use a dead-simple single-bit-per-cycle shifter, and as a
+        # result a shift can take up to 31 additional cycles. Setting
+        # shift_bits_per_cycle higher replaces it with a small barrel shifter
+        # that moves up to that many bits per cycle.
         #
         # During the shift, the bits being shifted are held in the accumulator
         # (hi half) and the shift_lo register (lo half). The shift_amt register
@@ -305,24 +562,77 @@ class EWBox(Component):
         shift_amt = Signal(5)
         shift_lo = Signal(16)
 
-        # Shifts are the only thing we do that can cause a state hold in the
-        # S-Box -- we repeat state 4 until the shift is done.
-        m.d.comb += self.hold.eq(
-            dec.is_shift & self.onehot_state[4] & (shift_amt != 0)
-        )
+        # The shift register contents after this cycle's step, and the size of
+        # the step.
+        shift_reg = Cat(shift_lo, self.accum)
+        shift_fill = dec.inst[30] & self.accum[15]
+        shifted = Signal(32)
+        step = self.shift_bits_per_cycle
+        if step == 1:
+            shift_step = 1
+            m.d.comb += shifted.eq(mux(
+                dec.funct3[2],
+                Cat(shift_reg[1:], shift_fill), # right shift
+                Cat(0, shift_reg[:-1]), # left shift
+            ))
+        else:
+            # Step by the full amount until fewer bits than that remain.
+            step_bits = step.bit_length() - 1
+            shift_step = Signal(range(step + 1))
+            m.d.comb += [
+                shift_step.eq(mux(
+                    shift_amt[step_bits:] != 0,
+                    step,
+                    shift_amt[:step_bits],
+                )),
+                shifted.eq(mux(
+                    dec.funct3[2],
+                    # right shift
+                    (Cat(shift_reg, shift_fill.replicate(step))
+                        >> shift_step)[:32],
+                    # left shift
+                    (shift_reg << shift_step)[:32],
+                )),
+            ]
+
+        # The M-Box
+        #
+        # Multiplies and divides happen in a box of their own, which picks up
+        # the operands as they go past: the low halves in state 1 (rs1's from
+        # the accumulator, rs2's from the register file), and the high halves
+        # in state 3 in the same way. It then takes as many cycles as it needs
+        # in state 4.
+        if self.muldiv:
+            m.submodules.mbox = mbox = MBox(multiplier = self.multiplier)
+            m.d.comb += [
+                mbox.funct3.eq(dec.funct3),
+                mbox.lhs.eq(self.accum),
+                mbox.rhs.eq(rhs_resp),
+                mbox.load_lo.eq(dec.is_muldiv & self.onehot_state[1]),
+                mbox.load_hi.eq(dec.is_muldiv & at(3)),
+                mbox.run.eq(dec.is_muldiv & at(4)),
+            ]
+
+        # Shifts (and multiplies and divides) are the only things we do that
+        # can cause a state hold in the S-Box -- we repeat state 4 until
+        # they're done.
+        hold = dec.is_shift & at(4) & (shift_amt != 0)
+        if self.muldiv:
+            hold |= dec.is_muldiv & at(4) & ~mbox.done
+        m.d.comb += self.hold.eq(hold)
 
         m.d.sync += [
-            shift_amt.eq(onehot_choice(self.onehot_state, {
+            shift_amt.eq(choice({
                 # Load shift_amt in state 1. Note that the immediate value for
                 # immediate shifts is taken from the rs2 _field_ in the
                 # instruction, not the corresponding register.
                 1: mux(
                     dec.is_alu_ri,
                     dec.rs2,
-                    self.rf_resp[:5],
+                    rhs_resp[:5],
                 ),
                 # Count shift_amt down while in state 4.
-                4: shift_amt - 1,
+                4: shift_amt - shift_step,
                 # Otherwise, do not update the register.
             }, default = shift_amt)),
             # The low half of the shifter. The high half is in the accumulator
@@ -332,11 +642,7 @@ class EWBox(Component):
                 # take the low half of the LHS operand).
                 (self.onehot_state[1], self.accum),
                 # Shift our bits either left or right in state 4.
-                (self.onehot_state[4] & (shift_amt != 0), mux(
-                     dec.funct3[2],
-                     Cat(shift_lo[1:], self.accum[0]), # right shift
-                     Cat(0, shift_lo), # left shift
-                 )),
+                (at(4) & (shift_amt != 0), shifted[:16]),
                 # Otherwise, do not update the register.
             ], default = shift_lo)),
         ]
@@ -354,7 +660,7 @@ class EWBox(Component):
             # When a transaction actually issues:
             self.bus.cmd.valid.eq(
                 # All bus transactions are conditional upon us being full.
-                self.full & onehot_choice(self.onehot_state, {
+                self.full & choice({
                     # Both loads and stores generate traffic in state 3.
                     3: dec.is_load | dec.is_store,
                     # If a store makes it to state 4, it generates a second
@@ -365,17 +671,18 @@ class EWBox(Component):
             ),
             # The address we generate to the bus. We only generate output in
             # states 3 and 4, to avoid interfering with bus usage by the FD-Box
-            # in states 1 and 2.
+            # in states 1 and 2. (On the short schedule, that's states 2 and 3
+            # for us and 0 and 1 for the FD-Box.)
             #
             # If we perform a multi-halfword operation, the second half always
             # occurs in state 4, so we can use state 4 to set the LSB of the
             # halfword address.
-            self.bus.cmd.payload.addr.eq(onehot_choice(self.onehot_state, {
-                (3, 4): Cat(mar_lo[1:] | self.onehot_state[4], adder_result),
+            self.bus.cmd.payload.addr.eq(choice({
+                (3, 4): Cat(mar_lo[1:] | at(4), adder_result),
             })),
             # The lane strobes determine whether we're doing a store, and can
             # affect a single byte within a halfword.
-            self.bus.cmd.payload.lanes.eq(onehot_choice(self.onehot_state, {
+            self.bus.cmd.payload.lanes.eq(choice({
                 # Again, we only use the bus in states 3 and 4.
                 (3, 4): mux(
                     self.full & dec.is_store,
@@ -394,20 +701,62 @@ class EWBox(Component):
                 # For byte stores,
                 dec.funct3_is[0b000],
                 # we repeat the same LSBs across both byte lanes.
-                self.rf_resp[:8].replicate(2),
+                rhs_resp[:8].replicate(2),
                 # Otherwise we just send the halfword unmodified.
-                self.rf_resp,
+                rhs_resp,
             )),
         ]
         # mar_lo updates: we latch the adder result in states 1 and 4. State 1
         # is low half effective address for loads, stores, and unconditional
         # computed branches. State 4 is low half EA for conditional branches.
         m.d.sync += mar_lo.eq(mux(
-            self.onehot_state[1] | self.onehot_state[4],
+            self.onehot_state[1] | at(4),
             adder_result,
             mar_lo,
         ))
 
+        # Interrupts
+        #
+        # We decide whether to take an interrupt from the irq lines as they
+        # are on the last cycle of an instruction, and if so, the lowest
+        # numbered line's vector replaces pc_next in the PC (which is saved
+        # in epc instead), and we start a bubble to fetch from it. So an
+        # interrupt costs a bubble, the same as a jump, after the instruction
+        # that's running when it arrives.
+        #
+        # MRET's target is in epc from the start, so we send it to FD as
+        # pc_next from the start, and it doesn't need a bubble.
+        take = C(0)
+        vector = C(0)
+        if self.interrupts:
+            m.submodules.irq_encoder = irq_encoder = \
+                    amaranth.lib.coding.PriorityEncoder(self.interrupts)
+            epc = Signal(self.pc.shape().width)
+            mie = Signal(1)
+            mie_next = Signal(1)
+            take = Signal(1)
+            vector = Signal(self.pc.shape().width)
+            # MRET is the only SYSTEM instruction with funct3 0 that sets bit
+            # 29, and CSRRSI and CSRRCI are the only ones with funct3 11x.
+            # Any CSR but the counters (whose numbers set bit 31) counts as
+            # mstatus, and we only look at MIE (bit 3) in the immediate.
+            is_mret = dec.is_system & dec.funct3_is[0b000] & dec.inst[29]
+            is_mie_write = (dec.is_system & dec.funct3[1] & dec.funct3[2]
+                            & ~dec.inst[31] & dec.inst[18] & self.full)
+            m.d.comb += [
+                irq_encoder.i.eq(self.irq),
+                vector.eq(Cat(
+                    C(0, 2 - self.pc_lsbs),
+                    irq_encoder.o,
+                    C(self.interrupt_vector >> (2 + len(irq_encoder.o)), 32),
+                )),
+                # CSRRSI sets it, CSRRCI clears it, and it takes effect at
+                # the end of the instruction, in time to decide whether to
+                # take an interrupt there.
+                mie_next.eq(mux(is_mie_write, ~dec.funct3[0], mie)),
+                take.eq(~irq_encoder.n & mie_next & ~self.in_handler),
+            ]
+
         # Program Counter and instruction lifecycle management.
         #
         # The address of the _current_ instruction we're executing is always
@@ -425,34 +774,46 @@ class EWBox(Component):
         #
         # The final cycle of an instruction is indicated through the
         # end_of_instruction signal.
+        #
+        # With several harts, the PCs of the harts waiting their turn are in
+        # pc_queue, next in line first. The next instruction FD needs is the
+        # next hart's, which is at the front of the queue, and never
+        # speculative; the current hart's pc_next joins the back of the
+        # queue at the end of the instruction, as the next hart's PC moves
+        # into self.pc.
         end_of_instruction = Signal(1)
         start_bubble = Signal(1)
-        pc_next = Signal(self.pc.shape().width)
+        pc_next = self.pc_next
         pc_inc = Signal(self.pc.shape().width)
+        # When full, the PC we send is either...
+        pc_when_full = mux(
+            # ... when taking a branch,
+            dec.is_jal_or_jalr
+                | (dec.is_b & at(5)),
+            # the computed PC,
+            Cat(mar_lo[self.pc_lsbs:], adder_result),
+            # Otherwise, PC+1
+            pc_inc,
+        )
+        if self.interrupts:
+            # ... or for MRET, the saved PC.
+            pc_when_full = mux(is_mret, epc, pc_when_full)
         m.d.comb += [
-            # Dedicated program counter incrementer.
-            pc_inc.eq(self.pc + 1),
+            # Dedicated program counter incrementer, which counts in
+            # halfwords with compressed instructions.
+            pc_inc.eq(self.pc + (mux(compressed, 1, 2) if self.compressed
+                                 else 1)),
             # Address we send to FD / load into PC
             pc_next.eq(mux(
                 self.full,
-                # When full, the PC we send is either...
-                mux(
-                    # ... when taking a branch,
-                    dec.is_jal_or_jalr
-                        | (dec.is_b & self.onehot_state[5]),
-                    # the computed PC,
-                    Cat(mar_lo[2:], adder_result),
-                    # Otherwise, PC+1
-                    pc_inc,
-                ),
+                pc_when_full,
                 # When not full, send current PC to fetch current instruction
                 # rather than next, as we are no longer speculating.
                 self.pc,
             )),
-            self.fetch_pc.payload.eq(pc_next),
             self.fetch_pc.valid.eq(~start_bubble),
             # Instruction termination
-            end_of_instruction.eq(onehot_choice(self.onehot_state, {
+            end_of_instruction.eq(choice({
                 3: oneof([
                     # Unconditionally end the instruction at cycle 3 if we're in
                     # a bubble.
@@ -469,7 +830,10 @@ class EWBox(Component):
                      ),
                     # Stores end here except for word stores.
                     (dec.is_store, ~dec.funct3_is[0b010]),
-                ]),
+                ] + ([
+                    # So does MRET.
+                    (is_mret, 1),
+                ] if self.interrupts else [])),
                 # Word stores and not-taken branches end in state 4.
                 4: dec.is_store | (dec.is_b & ~branch_taken_d),
                 # All other instructions end in state 5.
@@ -477,16 +841,58 @@ class EWBox(Component):
             })),
             # We signal state restart as a side effect of the EOI signal.
             self.from_the_top.eq(end_of_instruction),
-
+        ]
+        if self.harts == 1:
             # Bubble control, gated on self.full:
-            start_bubble.eq(self.full & oneof([
-                (dec.is_jal_or_jalr, 1),
+            m.d.comb += start_bubble.eq(self.full & oneof([
+                # If the FD-Box is handling JAL early, it has already fetched
+                # the target, so only JALR needs a bubble.
+                (dec.is_jalr if self.early_jal else dec.is_jal_or_jalr, 1),
                 # Any branch that makes it to state 5 is being taken, and so is
                 # creating a bubble. (Loads and shifts can make it to state 5
-                # without creating a bubble.)
-                (dec.is_b, self.onehot_state[5]),
-            ])),
-        ]
+                # without creating a bubble.) If the FD-Box is predicting
+                # branches, it has fetched the target of backward branches
+                # (which have the sign bit of their offset set) instead, so
+                # those need a bubble only when they end early, not taken.
+                (dec.is_b, mux(
+                    dec.inst[31],
+                    at(4),
+                    at(5),
+                ) if self.predict_branches else at(5)),
+            ]))
+        else:
+            # Several harts never need a bubble, since the next instruction
+            # is always another hart's.
+            m.d.comb += start_bubble.eq(0)
+
+        if self.harts > 1:
+            pc_queue = [Signal.like(self.pc, name = f"pc_queue{n}")
+                        for n in range(self.harts - 1)]
+            rotate = end_of_instruction & self.full
+            m.d.comb += [
+                # When full, FD fetches for the next hart; when not, for
+                # this one, as usual.
+                self.fetch_pc.payload.eq(mux(self.full, pc_queue[0], self.pc)),
+                self.hart_next.eq(mux(
+                    rotate,
+                    mux(self.hart == self.harts - 1, 0, self.hart + 1),
+                    self.hart,
+                )),
+            ]
+            m.d.sync += [
+                Cat(*pc_queue).eq(mux(
+                    rotate,
+                    Cat(*pc_queue[1:], pc_next),
+                    Cat(*pc_queue),
+                )),
+                self.hart.eq(self.hart_next),
+            ]
+            # At the end of an instruction, the next hart takes over.
+            pc_after = pc_queue[0]
+        else:
+            m.d.comb += self.fetch_pc.payload.eq(pc_next)
+            pc_after = pc_next
+
         m.d.sync += [
             # Program counter updates.
             self.pc.eq(oneof([
@@ -495,8 +901,12 @@ class EWBox(Component):
                 (self.onehot_state[STATE_COUNT - 1] & self.debug_pc_write.valid,
                  self.debug_pc_write.payload),
                 # Otherwise, in the final cycle of any instruction, we latch the
-                # pc_next value we were sending to FD-Box.
-                (end_of_instruction & self.full, pc_next),
+                # pc_next value we were sending to FD-Box (or with several
+                # harts, the next hart's PC)...
+                (end_of_instruction & self.full & ~take, pc_after),
+                # ... unless we're taking an interrupt, in which case we latch
+                # its vector, even at the end of a bubble.
+                (end_of_instruction & take, vector),
                 # In all other circumstancs we leave the register unchanged.
             ], default = self.pc)),
             # Bubble logic.
@@ -505,15 +915,29 @@ class EWBox(Component):
                 # we resume.
                 (self.onehot_state[STATE_COUNT - 1], 0),
                 # Otherwise, we become empty only at the end of an instruction
-                # when a bubble is required.
-                (end_of_instruction, ~start_bubble),
+                # when a bubble is required, or an interrupt is taken.
+                (end_of_instruction, ~start_bubble & ~take),
             ], default = self.full)),
         ]
+        if self.interrupts:
+            m.d.comb += [
+                self.in_handler_next.eq(oneof([
+                    (end_of_instruction & take, 1),
+                    (end_of_instruction & self.full & is_mret, 0),
+                ], default = self.in_handler)),
+                self.interrupt_taken.eq(end_of_instruction & take),
+            ]
+            m.d.sync += [
+                # The instruction we would have gone on to is where MRET goes
+                # back to.
+                epc.eq(mux(end_of_instruction & take, pc_next, epc)),
+                mie.eq(mux(end_of_instruction, mie_next, mie)),
+                self.in_handler.eq(self.in_handler_next),
+            ]
 
         # Maintaining the counters
         if self.counters:
             m.d.sync += [
-                cycle_counter.eq(cycle_counter + 1),
                 instret_counter.eq(mux(
                     self.full & end_of_instruction,
                     instret_counter + 1,
@@ -526,12 +950,31 @@ class EWBox(Component):
                     mux(
                         imm.i[1],
                         hihalf(instret_counter),
-                        hihalf(cycle_counter),
+                        hihalf(self.cycle_counter),
                     ),
                     csr_msbs,
                 )),
             ]
 
+        # CSR reads. Without counters, the only CSR we can read is mhartid,
+        # if there are several harts, and we don't look at the CSR number at
+        # all. With both, we only look at enough of it to tell them apart:
+        # bit 9 is set in mhartid's number (0xF14) and clear in the
+        # counters'. The value is written to rd in states 1 and 3, one half
+        # at a time.
+        reads_csrs = self.counters or self.harts > 1
+        if self.counters:
+            csr_lo = mux(imm.i[1], lohalf(instret_counter),
+                         lohalf(self.cycle_counter))
+            csr_hi = csr_msbs
+        if self.harts > 1:
+            if self.counters:
+                csr_lo = mux(imm.i[9], self.hart, csr_lo)
+                csr_hi = mux(imm.i[9], 0, csr_hi)
+            else:
+                csr_lo = self.hart
+                csr_hi = 0
+
         # Load lane mixer.
         #
         # RV32 has relatively fancy load instructions, at least compared to its
@@ -560,6 +1003,20 @@ class EWBox(Component):
         ]
 
         # Register file read port.
+        rs2_reads = [
+            # rs2.lo, which is only needed on the short schedule if there's a
+            # second port to read it on.
+            (self.onehot_state[0] if two_ports
+             else sched(self.onehot_state[0], 0), Cat(dec.rs2, 0)),
+            # rs2.hi, except for stores which read lo
+            (at(2), Cat(dec.rs2, ~dec.is_store)),
+            # duplicate rs2.hi for word stores
+            (at(3) & dec.is_store & dec.funct3_is[0b010] & self.full,
+             Cat(dec.rs2, 1)),
+        ]
+        # rs1.hi, which we read as soon as the port is free of rs2.lo.
+        rs1_read = (sched(self.onehot_state[1], self.onehot_state[0]),
+                    Cat(dec.rs1, 1))
         m.d.comb += [
             # We have control of the read port on every cycle but the last, when
             # the FD-Box kicks off the read of the low half of rs1. While we
@@ -569,18 +1026,17 @@ class EWBox(Component):
             # Because there's only one actual read port, and our nets are OR'd
             # with FD-Box's, we need to generate 0 here if we don't intend to
             # use the register file.
-            self.rf_read_cmd.payload.eq(oneof([
-                # rs2.lo
-                (self.onehot_state[0], Cat(dec.rs2, 0)),
-                # rs1.hi
-                (self.onehot_state[1], Cat(dec.rs1, 1)),
-                # rs2.hi, except for stores which read lo
-                (self.onehot_state[2], Cat(dec.rs2, ~dec.is_store)),
-                # duplicate rs2.hi for word stores
-                (self.onehot_state[3] & dec.is_store & dec.funct3_is[0b010] & self.full,
-                 Cat(dec.rs2, 1)),
-            ])),
+            self.rf_read_cmd.payload.eq(oneof(
+                [rs1_read] if two_ports
+                else rs2_reads[:1] + [rs1_read] + rs2_reads[1:]
+            )),
         ]
+        if two_ports:
+            # The second port is all ours, and only ever reads rs2.
+            m.d.comb += [
+                self.rf_read_cmd_b.valid.eq(1),
+                self.rf_read_cmd_b.payload.eq(oneof(rs2_reads)),
+            ]
 
         # Register file write port.
         #
@@ -588,17 +1044,17 @@ class EWBox(Component):
         # state.
         m.d.comb += [
             # When do we write? All writes gated on self.full.
-            self.rf_write_cmd.valid.eq(self.full & onehot_choice(self.onehot_state, {
-                (1, 3): dec.writes_rd_normally | (self.counters & dec.is_system),
+            self.rf_write_cmd.valid.eq(self.full & choice({
+                (1, 3): dec.writes_rd_normally | (reads_csrs & dec.is_system),
                 # loads and SLTs write in state 4, stores and branches do not.
-                4: dec.is_load | dec.is_alu,
+                4: dec.is_load | dec.is_alu | dec.is_muldiv,
                 # loads and shifts write in state 5, stores and branches do not.
-                5: dec.is_load | dec.is_shift,
+                5: dec.is_load | dec.is_shift | dec.is_muldiv,
             })),
             # We always write the register selected by the instruction, and use
             # states 3 and 5 as a hi-half strobe.
             self.rf_write_cmd.payload.reg.eq(
-                Cat(dec.rd, self.onehot_state[3] | self.onehot_state[5])
+                Cat(dec.rd, at(3) | at(5))
             ),
             # Value to write:
             self.rf_write_cmd.payload.value.eq(oneof([
@@ -611,14 +1067,14 @@ class EWBox(Component):
 
                 # JAL and JALR both store the incremented program counter.
                 (dec.is_jal_or_jalr, choosehalf(
-                    self.onehot_state[3],
-                    Cat(0, 0, pc_inc),
+                    at(3),
+                    pc_bytes(pc_inc),
                 )),
                 # The first half of a load always writes from the load mixer.
-                (dec.is_load & self.onehot_state[4], load_result),
+                (dec.is_load & at(4), load_result),
                 # The second half may write the accumulator instead to do
                 # sign/zero extension of a byte or halfword.
-                (dec.is_load & self.onehot_state[5], mux(
+                (dec.is_load & at(5), mux(
                     dec.funct3_is[2],
                     load_result,
                     self.accum,
@@ -627,19 +1083,19 @@ class EWBox(Component):
                 (dec.is_alu, onehot_choice(dec.funct3_is, {
                     # Shifts
                     (0b001, 0b101): mux(
-                        self.onehot_state[5],
+                        at(5),
                         self.accum,
                         shift_lo,
                     ),
                     # SLT
                     0b010: mux(
-                        self.onehot_state[3],
+                        at(3),
                         0,
                         signed_less_than_d,
                     ),
                     # SLTU
                     0b011: mux(
-                        self.onehot_state[3],
+                        at(3),
                         0,
                         unsigned_less_than_d,
                     ),
@@ -650,12 +1106,15 @@ class EWBox(Component):
                     # AND
                     0b111: self.accum & adder_rhs,
                 })),
-                (self.counters & dec.is_system, onehot_choice(self.onehot_state, {
-                    1: mux(imm.i[1], lohalf(instret_counter),
-                           lohalf(cycle_counter)),
-                    3: csr_msbs,
+            ] + ([
+                (dec.is_system, choice({
+                    1: csr_lo,
+                    3: csr_hi,
                 })),
-            ])),
+            ] if reads_csrs else []) + ([
+                # The M-Box's result, which it holds once it's done.
+                (dec.is_muldiv, choosehalf(at(5), mbox.result)),
+            ] if self.muldiv else []))),
         ]
 
         # Next instruction capture.
@@ -667,17 +1126,44 @@ class EWBox(Component):
             m.submodules.dec.out,
             dec,
         ))
+        if self.compressed:
+            m.d.sync += [
+                compressed.eq(mux(
+                    end_of_instruction,
+                    self.inst_next_compressed,
+                    compressed,
+                )),
+                raw_inst.eq(mux(
+                    end_of_instruction,
+                    self.inst_next_raw,
+                    raw_inst,
+                )),
+            ]
+        if not fixed:
+            # We pick the next instruction's schedule at the same time, and
+            # register that too, since nearly everything depends on it.
+            # Register-register ALU ops, branches and multiplies/divides need
+            # rs2.lo in state 1.
+            # Bubbles don't care, so they take the shorter route to the next
+            # instruction. This follows the updates to self.full above.
+            m.d.sync += short.eq(oneof([
+                (self.onehot_state[STATE_COUNT - 1], 1),
+                (end_of_instruction, start_bubble | take
+                    | ~(m.submodules.dec.out.is_alu_rr
+                        | m.submodules.dec.out.is_b
+                        | m.submodules.dec.out.is_muldiv)),
+            ], default = short))
 
         # Accumulator update. This mashes together a bunch of concerns from
         # various instructions, by necessity, since they share the accumulator.
-        m.d.sync += self.accum.eq(onehot_choice(self.onehot_state, {
+        m.d.sync += self.accum.eq(choice({
             # Load the accumulator with a new LHS in states 0 and 2. The LHS is
             # usually a value read from a register, but is occasionally the PC.
             (0, 2): oneof([
                 # Load program counter instead.
                 (dec.is_auipc_or_jal, choosehalf(
-                    self.onehot_state[2],
-                    Cat(0, 0, self.pc),
+                    at(2),
+                    pc_bytes(self.pc),
                 )),
                 # Make the adder pass through the immediate without changes.
                 (dec.is_lui, 0),
@@ -689,14 +1175,14 @@ class EWBox(Component):
                 # For branches,
                 dec.is_b,
                 # load the PC to begin the target calculation.
-                lohalf(Cat(0, 0, self.pc)),
+                lohalf(pc_bytes(self.pc)),
                 # Otherwise preserve it for shifts and EA generation.
                 self.accum,
             ),
             4: oneof([
                 # Prepare for a taken branch. We'll do this even if it's not
                 # taken because it's slightly cheaper to do so.
-                (dec.is_b, hihalf(Cat(0, 0, self.pc))),
+                (dec.is_b, hihalf(pc_bytes(self.pc))),
 
                 # Loads use the accumulator to zero/sign-extend halfwords and
                 # bytes.
@@ -709,11 +1195,7 @@ class EWBox(Component):
                 # register.
                 (dec.is_shift, mux(
                     shift_amt != 0,
-                    mux(
-                        dec.funct3[2] == 0, # left shift
-                        Cat(shift_lo[15], self.accum[:15]),
-                        Cat(self.accum[1:], dec.inst[30] & self.accum[15]),
-                    ),
+                    shifted[16:],
                     self.accum,
                 )),
                 # Otherwise, trash it.
@@ -5,9 +5,10 @@ from amaranth.lib.wiring import *
 from amaranth.lib.enum import *
 from amaranth.lib.coding import Encoder, Decoder
 
-from hapenny import StreamSig, AlwaysReady, onehot_choice, mux, oneof
+from hapenny import StreamSig, AlwaysReady, mux, oneof
 from hapenny.sbox import STATE_COUNT
 from hapenny.bus import BusPort
+from hapenny.decoder import ImmediateDecoder, Expander, Opcode
 
 class FDBox(Component):
     """The FD-Box fetches and decodes instructions.
@@ -16,10 +17,35 @@ class FDBox(Component):
     transactions to collect both halfwords of an instruction, and then provides
     it on an output signal to the EW-box.
 
+    With compressed instructions, the PC is a halfword address, so the two
+    halfwords needn't be in the same word. We still fetch both, since we can't
+    tell whether we need the second until the first arrives, and expand the
+    instruction if it turns out to be compressed. The second halfword of a
+    compressed instruction is then the first of the next, if execution goes on
+    in a straight line, so we keep it and fetch only the other half of the
+    next instruction.
+
     Parameters
     ----------
     prog_addr_width (integer): number of bits in a program address, 32 by default
         but can be shrunk to save logic.
+    early_jal (bool): if True, recognize JAL instructions ourselves and fetch
+        from their target while EW is executing them, instead of fetching the
+        following instruction and relying on EW to generate a bubble. Costs a
+        PC-width adder. Default False; EW must be configured to match.
+    predict_branches (bool): if True, predict that backward conditional
+        branches are taken and fetch from their targets while EW is
+        executing them. Shares the adder with early_jal. Default False; EW
+        must be configured to match.
+    early_fetch (bool or str): if True, fetch in states 0 and 1 instead of 1
+        and 2, so that the instruction is ready in state 2, for an EW-Box that
+        can finish an instruction there (see its rf_read_ports parameter). If
+        "per_instruction", do so only while the early input is set, for an
+        EW-Box that picks its schedule for each instruction (see its
+        skip_rs2_reads parameter). Default False.
+    compressed (bool): if True, support the C extension, as described
+        above. The PC is then a halfword address. Default False; EW must be
+        configured to match.
 
     Attributes
     ----------
@@ -33,6 +59,14 @@ class FDBox(Component):
     bus (port): our connection to the memory fabric.
     from_the_top (input): signal from EW indicating that this is the final
         cycle of the instruction. We use this to gate register reads.
+    full (input): EW's full signal, indicating that the instruction it's
+        executing (the one in our inst register) is real. Only used with
+        early_jal, predict_branches or compressed.
+    early (input): fetch early for this instruction. Only present if
+        early_fetch is "per_instruction".
+    inst_next_compressed (output): the instruction on inst_next was
+        compressed, and inst_next_raw (output) is the halfword it was
+        expanded from. Only present with compressed.
     """
     onehot_state: In(STATE_COUNT)
     rf_cmd: Out(AlwaysReady(6))
@@ -41,76 +75,243 @@ class FDBox(Component):
 
     def __init__(self, *,
                  prog_addr_width = 32,
+                 early_jal = False,
+                 predict_branches = False,
+                 early_fetch = False,
+                 compressed = False,
                  ):
         super().__init__()
+        assert early_fetch in (False, True, "per_instruction"), \
+                f"early_fetch can't be {early_fetch!r}"
+
+        self.early_jal = early_jal
+        self.predict_branches = predict_branches
+        self.early_fetch = early_fetch
+        self.compressed = compressed
 
         # Create a bus port of sufficient width to fetch instructions only.
         # (Width is -1 because we're addressing halfwords.)
         self.bus = BusPort(addr = prog_addr_width - 1, data = 16).create()
 
-        # The PC width is -2 because it's addressing words.
-        self.pc = AlwaysReady(prog_addr_width - 2).flip().create()
+        # The PC width is -2 because it's addressing words, or -1 if it's
+        # addressing halfwords.
+        self.pc_lsbs = 1 if compressed else 2
+        self.pc = AlwaysReady(prog_addr_width - self.pc_lsbs).flip().create()
 
         self.inst = Signal(32)
+        self.full = Signal(1)
+        if early_fetch == "per_instruction":
+            self.early = Signal(1)
+        if compressed:
+            self.inst_next_compressed = Signal(1)
+            self.inst_next_raw = Signal(16)
 
     def elaborate(self, platform):
         m = Module()
 
+        # The states we fetch the low and high halves of the instruction in,
+        # and the state in which the high half arrives.
+        if self.early_fetch is True:
+            fetch_lo, fetch_hi, arrive = (self.onehot_state[n] for n in (0, 1, 2))
+        elif self.early_fetch is False:
+            fetch_lo, fetch_hi, arrive = (self.onehot_state[n] for n in (1, 2, 3))
+        else:
+            fetch_lo, fetch_hi, arrive = (
+                mux(self.early, self.onehot_state[n - 1], self.onehot_state[n])
+                for n in (1, 2, 3)
+            )
+
+        # With compressed instructions, the instruction goes through the
+        # Expander on its way out to EW, and we look at the expanded version
+        # ourselves, too.
+        if self.compressed:
+            m.submodules.expander = expander = Expander()
+            m.d.comb += expander.inst.eq(Cat(
+                self.inst[:16],
+                mux(arrive, self.bus.resp, self.inst[16:]),
+            ))
+            inst = expander.out
+        else:
+            inst = self.inst
+
+        # Address to fetch from in states 1 and 2. Normally this is whatever
+        # EW is asking for.
+        fetch_addr = Signal(self.pc.payload.shape())
+        # Whether we're fetching from somewhere else instead.
+        redirecting = C(0)
+        # Address of the instruction in inst, which we track ourselves if we
+        # need it by latching the address we fetched it from.
+        if self.early_jal or self.predict_branches or self.compressed:
+            inst_pc = Signal(self.pc.payload.shape())
+            m.d.sync += inst_pc.eq(mux(fetch_lo, fetch_addr, inst_pc))
+        if self.early_jal or self.predict_branches:
+            # JAL's target only depends on its own address and instruction
+            # word, both of which we have by state 0 of its execution, and the
+            # same goes for a conditional branch's target if it's taken. So in
+            # state 0 we compute the target and decide whether to redirect: for
+            # JAL always, and for branches if they go backwards, since those
+            # are usually loops and usually taken. In states 1 and 2, if EW
+            # confirms that it is executing that instruction (rather than a
+            # bubble), we fetch from the target instead. EW makes the same
+            # decision from the same instruction, so it knows to skip the
+            # bubble after a JAL or taken backward branch -- and to generate
+            # one after a backward branch that turns out not to be taken.
+            #
+            # With early_fetch, the first fetch may happen in state 0 itself,
+            # so it takes the target and decision straight from the logic
+            # that computes them, and the second uses the registered copies.
+            target = Signal(self.pc.payload.shape())
+            redirect = Signal(1)
+            m.submodules.imm = imm = ImmediateDecoder()
+
+            opcode_is = lambda op: inst[:7] == Cat(C(0b11, 2),
+                                                   C(op.value, 5))
+            is_jal = opcode_is(Opcode.JAL) if self.early_jal else 0
+            # The sign bit of a B-format immediate is the top bit of the
+            # instruction.
+            is_backward_b = ((opcode_is(Opcode.Bxx) & inst[31])
+                             if self.predict_branches else 0)
+
+            # The target is only used when we redirect, so if we only
+            # redirect for one kind of instruction we can use its offset
+            # unconditionally.
+            lsbs = self.pc_lsbs
+            if self.early_jal and self.predict_branches:
+                offset = mux(is_jal, imm.j[lsbs:], imm.b[lsbs:])
+            elif self.early_jal:
+                offset = imm.j[lsbs:]
+            else:
+                offset = imm.b[lsbs:]
+
+            target_now = Signal.like(target)
+            redirect_now = Signal(1)
+            m.d.comb += [
+                imm.inst.eq(inst),
+                target_now.eq(mux(
+                    self.onehot_state[0],
+                    inst_pc + offset,
+                    target,
+                )),
+                redirect_now.eq(mux(
+                    self.onehot_state[0],
+                    is_jal | is_backward_b,
+                    redirect,
+                )),
+            ]
+            if self.early_fetch is not False:
+                redirecting = redirect_now & self.full
+                m.d.comb += fetch_addr.eq(mux(
+                    redirecting,
+                    target_now,
+                    self.pc.payload,
+                ))
+            else:
+                redirecting = redirect & self.full
+                m.d.comb += fetch_addr.eq(mux(
+                    redirecting,
+                    target,
+                    self.pc.payload,
+                ))
+            m.d.sync += [
+                target.eq(target_now),
+                redirect.eq(redirect_now),
+            ]
+        else:
+            m.d.comb += fetch_addr.eq(self.pc.payload)
+
         # State 0: we don't really do anything.
         # State 1: we start the low half fetch.
         # State 2: we receive the low half of the instruction word and issue
         # the high half fetch.
         # State 3: we receive the high half fetch and begin a register read.
         # State 4+: we don't do anything.
+        #
+        # With early_fetch, all of that happens a state earlier.
+
+        if self.compressed:
+            # If the instruction EW is executing is compressed, and it's
+            # asking for the next one in line (which it always is when it's
+            # full, unless it's about to jump anyway), the second halfword we
+            # fetched last time is the first we'd fetch this time, so we
+            # don't. We fetch the second halfword from the address after the
+            # first, which may be in the next word.
+            use_spare = self.full & ~self.inst[:2].all() & ~redirecting
+            spare = Signal(1)
+            m.d.sync += spare.eq(mux(fetch_lo, use_spare, spare))
+            fetch_lo_valid = fetch_lo & ~use_spare
+            lo_addr = fetch_addr
+            hi_addr = inst_pc + 1
+            lo_resp = mux(spare, self.inst[16:], self.bus.resp)
+        else:
+            fetch_lo_valid = fetch_lo
+            lo_addr = Cat(0, fetch_addr)
+            hi_addr = Cat(1, fetch_addr)
+            lo_resp = self.bus.resp
 
         m.d.comb += [
             # We issue bus transactions in states 1 and 2 only.
             self.bus.cmd.valid.eq(
-                self.pc.valid & (self.onehot_state[1] | self.onehot_state[2])
+                self.pc.valid & (fetch_lo_valid | fetch_hi)
             ),
             # In those states we select the bottom and top halves of the
             # instruction, respectively.
-            self.bus.cmd.payload.addr.eq(onehot_choice(self.onehot_state, {
-                1: Cat(0, self.pc.payload),
-                2: Cat(1, self.pc.payload),
-            })),
+            self.bus.cmd.payload.addr.eq(oneof([
+                (fetch_lo, lo_addr),
+                (fetch_hi, hi_addr),
+            ])),
 
             # We access the register file only in the last cycle.
             self.rf_cmd.valid.eq(self.from_the_top),
-            # If the last cycle is state 3, our fetch is still completing, so
-            # we need to forward the bus response to the register file. If it
-            # isn't state 3, we can serve out of our inst register.
-            # (It's important to send zeros in other states instead of
-            # hardwiring this so that we can OR.)
-            self.rf_cmd.payload.eq(oneof([
-                (self.from_the_top & self.onehot_state[3],
-                 Cat(self.inst[15], self.bus.resp[0:4], 0)),
-                (self.from_the_top & ~self.onehot_state[3],
-                 Cat(self.inst[15:20], 0)),
-            ])),
-
-            # Forward the instruction through so it's valid in states 3+. In
-            # state 3 specifically, forward the top half from the bus. In other
-            # states, serve up the contents of our registers. EW's not supposed
-            # to look at this in states 0-2.
-            self.inst_next[:16].eq(self.inst[:16]),
-            self.inst_next[16:].eq(mux(
-                self.onehot_state[3],
-                self.bus.resp,
-                self.inst[16:],
-            )),
         ]
+        if self.compressed:
+            m.d.comb += [
+                # The register number moves around in compressed
+                # instructions, so we take it from the expanded instruction,
+                # which is forwarded from the bus in state 3 like the
+                # uncompressed one below.
+                self.rf_cmd.payload.eq(oneof([
+                    (self.from_the_top, Cat(inst[15:20], 0)),
+                ])),
+                self.inst_next.eq(inst),
+                self.inst_next_compressed.eq(expander.compressed),
+                self.inst_next_raw.eq(self.inst[:16]),
+            ]
+        else:
+            m.d.comb += [
+                # If the last cycle is state 3, our fetch is still
+                # completing, so we need to forward the bus response to the
+                # register file. If it isn't state 3, we can serve out of our
+                # inst register. (It's important to send zeros in other
+                # states instead of hardwiring this so that we can OR.)
+                self.rf_cmd.payload.eq(oneof([
+                    (self.from_the_top & arrive,
+                     Cat(self.inst[15], self.bus.resp[0:4], 0)),
+                    (self.from_the_top & ~arrive,
+                     Cat(self.inst[15:20], 0)),
+                ])),
+
+                # Forward the instruction through so it's valid in states
+                # 3+. In state 3 specifically, forward the top half from the
+                # bus. In other states, serve up the contents of our
+                # registers. EW's not supposed to look at this in states 0-2.
+                self.inst_next[:16].eq(self.inst[:16]),
+                self.inst_next[16:].eq(mux(
+                    arrive,
+                    self.bus.resp,
+                    self.inst[16:],
+                )),
+            ]
 
         m.d.sync += [
             # Latch the bottom half of the instruction at the end of state 2.
             self.inst[:16].eq(mux(
-                self.onehot_state[2],
-                self.bus.resp,
+                fetch_hi,
+                lo_resp,
                 self.inst[:16],
             )),
             # Latch the top half at the end of state 3.
             self.inst[16:].eq(mux(
-                self.onehot_state[3],
+                arrive,
                 self.bus.resp,
                 self.inst[16:],
             )),
@@ -0,0 +1,241 @@
+# A small instruction cache, for running from memories with wait states.
+
+from amaranth import *
+from amaranth.lib.wiring import *
+from amaranth.lib.enum import *
+
+from hapenny import AlwaysReady, mux, oneof
+from hapenny.bus import BusPort
+
+class ICache(Component):
+    """A direct-mapped cache of instruction words in block RAM, which sits
+    between the FD-Box and the bus.
+
+    The FD-Box fetches each instruction as a pair of halfword reads, in states
+    1 and 2 (or 0 and 1), and expects each response on the following cycle.
+    With compressed instructions, the pair may straddle two words, or be only
+    the second read, so we don't rely on its halves sharing an entry. We read
+    both of our RAMs at the fetch address every cycle, so on the cycle after
+    each read -- the one where the FD-Box takes the response -- we know
+    whether it hit, and if it did, the RAM's output is the right answer. A hit
+    generates no bus traffic at all, which is the point: code can run from a
+    memory with wait states (e.g. SpiFlashMemory) at full speed once it's in
+    the cache, and the bus sits idle during fetches.
+
+    A miss is noticed just as the response is due, so we ask the CPU to stall
+    (see Cpu) while we fetch the missed halfword and its neighbor in the same
+    word over the bus, and then let that cycle go around again. This costs
+    three cycles plus the wait states of two bus reads. The other read of a
+    pair then hits, unless it's in a different word.
+
+    While the CPU is stalled, for any reason, the RAM outputs hold still, so
+    that the response is still there when it resumes.
+
+    Tags are per instruction word, with a valid bit on top. To stay coherent
+    with the CPU's own stores (e.g. a bootloader loading a program), any store
+    invalidates the entry at its index, whether or not it was the cached word.
+    Nothing else can be seen, so we also invalidate everything at reset and
+    whenever the CPU halts, in case a debugger changes memory while it's
+    stopped. That takes a cycle per entry, and runs in the background while
+    the CPU is halted; if it resumes before the flush is done, it stalls
+    until it is.
+
+    Parameters
+    ----------
+    addr_bits (int): number of halfword address bits on the fetch side.
+    halfwords (int): size of the cache in halfwords, a power of two, at least
+        4.
+    wait_states (bool): whether the bus we fetch from has wait states.
+
+    Attributes
+    ----------
+    fetch (in bus): the FD-Box's fetch port.
+    bus (out bus): our connection to memory, for cache fills.
+    store (in): halfword address of a store the CPU is issuing on the bus,
+        when valid.
+    halted (in): the CPU is halted.
+    stalled (in): the CPU is standing still this cycle, whether because of
+        us or anything else.
+    stall (out): the CPU must stand still this cycle.
+    flushing (out): an invalidation of the whole cache is in progress.
+    """
+    def __init__(self, *, addr_bits, halfwords, wait_states = False):
+        assert halfwords >= 4 and halfwords & (halfwords - 1) == 0, \
+                "halfwords must be a power of two, at least 4"
+        assert halfwords <= 1 << addr_bits, "cache is bigger than the memory"
+        super().__init__({
+            "fetch": In(BusPort(addr = addr_bits, data = 16)),
+            "bus": Out(BusPort(addr = addr_bits, data = 16,
+                               wait_states = wait_states)),
+            "store": In(AlwaysReady(addr_bits)),
+            "halted": In(1),
+            "stalled": In(1),
+            "stall": Out(1),
+            "flushing": Out(1),
+        })
+        self.addr_bits = addr_bits
+        self.halfwords = halfwords
+        self.wait_states = wait_states
+
+    class State(Enum):
+        # Invalidating every entry, one per cycle.
+        FLUSH = 0
+        # Answering fetches.
+        IDLE = 1
+        # Reading the missed halfword and then the other one in its word.
+        FILL_FIRST = 2
+        FILL_SECOND = 3
+        # Receiving the second halfword and writing the tag.
+        WRITE = 4
+
+    def elaborate(self, platform):
+        m = Module()
+
+        State = self.State
+        state = Signal(State, init = State.FLUSH)
+
+        # Split the halfword address into half-of-word, index and tag. We
+        # look up the address being fetched now, and check (and fill) the one
+        # fetched on the previous cycle, which we remember in last_addr.
+        index_bits = (self.halfwords // 2 - 1).bit_length()
+        tag_bits = self.addr_bits - 1 - index_bits
+        addr = self.fetch.cmd.payload.addr
+        index = addr[1:1 + index_bits]
+        last_addr = Signal(self.addr_bits)
+        last_index = last_addr[1:1 + index_bits]
+        last_tag = last_addr[1 + index_bits:]
+
+        # Tags are stored with a valid bit on top, which is clear in zeroed
+        # RAM (and after a flush).
+        m.submodules.tags = tags = Memory(
+            width = tag_bits + 1,
+            depth = self.halfwords // 2,
+            name = "icache_tags",
+            init = [],
+        )
+        m.submodules.words = words = Memory(
+            width = 16,
+            depth = self.halfwords,
+            name = "icache_words",
+            init = [],
+        )
+        tag_rp = tags.read_port(transparent = False)
+        tag_wp = tags.write_port()
+        word_rp = words.read_port(transparent = False)
+        word_wp = words.write_port()
+
+        # looked_up means the tag RAM's output is for last_addr, which the
+        # FD-Box wants the answer for now. filled means we've just filled it,
+        # in which case the tag RAM doesn't know yet; it lasts until the CPU
+        # moves on.
+        looked_up = Signal(1)
+        filled = Signal(1)
+        hit = Signal(1)
+        miss = Signal(1)
+        m.d.comb += [
+            tag_rp.addr.eq(index),
+            tag_rp.en.eq(~self.stalled),
+            # Normally we read the halfword being fetched, but on the last
+            # cycle of a fill we read the missed one back, since that's what
+            # the FD-Box is still waiting for.
+            word_rp.addr.eq(mux(state == State.WRITE, last_addr, addr)),
+            word_rp.en.eq(~self.stalled | (state == State.WRITE)),
+
+            hit.eq(filled | (tag_rp.data == Cat(last_tag, 1))),
+            miss.eq((state == State.IDLE) & looked_up & ~hit),
+            self.fetch.resp.eq(word_rp.data),
+
+            self.stall.eq(miss | oneof([
+                (state == State.FLUSH, ~self.halted),
+                (state == State.FILL_FIRST, 1),
+                (state == State.FILL_SECOND, 1),
+                (state == State.WRITE, 1),
+            ])),
+        ]
+        with m.If(state == State.WRITE):
+            m.d.sync += filled.eq(1)
+        with m.Elif(~self.stalled):
+            m.d.sync += [
+                filled.eq(0),
+                looked_up.eq((state == State.IDLE) & self.fetch.cmd.valid),
+                last_addr.eq(addr),
+            ]
+
+        # Fills. The CPU is stalled, so last_addr stays put and tells us which
+        # halfword to fetch. We fetch it first, so that it's in the RAM in
+        # time to read it back on the last cycle. Responses arrive on the
+        # cycle after each read is accepted, and we write them straight into
+        # the RAM.
+        accepted = Signal(1)
+        resp_due = Signal(1)
+        resp_half = Signal(1)
+        m.d.comb += [
+            self.bus.cmd.valid.eq((state == State.FILL_FIRST)
+                                  | (state == State.FILL_SECOND)),
+            # The CPU ORs its bus commands together, so the address must be
+            # zero when we're not using it.
+            self.bus.cmd.payload.addr.eq(mux(
+                self.bus.cmd.valid,
+                Cat(last_addr[0] ^ (state == State.FILL_SECOND),
+                    last_addr[1:]),
+                0,
+            )),
+            accepted.eq(self.bus.cmd.valid & (self.bus.cmd.ready
+                                              if self.wait_states else 1)),
+
+            word_wp.addr.eq(Cat(resp_half, last_index)),
+            word_wp.data.eq(self.bus.resp),
+            word_wp.en.eq(resp_due),
+        ]
+        m.d.sync += [
+            resp_due.eq(accepted),
+            resp_half.eq(self.bus.cmd.payload.addr[0]),
+        ]
+
+        # The tag RAM is written when a fill finishes, by flushes, and by
+        # stores, which never happen at the same time: fills and flushes
+        # only happen while the CPU is stalled or halted.
+        flush_index = Signal(index_bits)
+        store_index = self.store.payload[1:1 + index_bits]
+        m.d.comb += [
+            tag_wp.addr.eq(oneof([
+                (state == State.WRITE, last_index),
+                (state == State.FLUSH, flush_index),
+                (self.store.valid, store_index),
+            ])),
+            tag_wp.data.eq(mux(state == State.WRITE, Cat(last_tag, 1), 0)),
+            tag_wp.en.eq((state == State.WRITE) | (state == State.FLUSH)
+                         | self.store.valid),
+        ]
+
+        # A flush starts on the cycle after the CPU halts; we report it as
+        # under way from the moment it halts.
+        halted_d = Signal(1)
+        m.d.sync += halted_d.eq(self.halted)
+        m.d.comb += self.flushing.eq((state == State.FLUSH)
+                                     | (self.halted & ~halted_d))
+
+        with m.If(self.halted & ~halted_d):
+            m.d.sync += [
+                state.eq(State.FLUSH),
+                flush_index.eq(0),
+            ]
+        with m.Else():
+            with m.Switch(state):
+                with m.Case(State.FLUSH):
+                    m.d.sync += flush_index.eq(flush_index + 1)
+                    with m.If(flush_index == self.halfwords // 2 - 1):
+                        m.d.sync += state.eq(State.IDLE)
+                with m.Case(State.IDLE):
+                    with m.If(miss):
+                        m.d.sync += state.eq(State.FILL_FIRST)
+                with m.Case(State.FILL_FIRST):
+                    with m.If(accepted):
+                        m.d.sync += state.eq(State.FILL_SECOND)
+                with m.Case(State.FILL_SECOND):
+                    with m.If(accepted):
+                        m.d.sync += state.eq(State.WRITE)
+                with m.Case(State.WRITE):
+                    m.d.sync += state.eq(State.IDLE)
+
+        return m
@@ -0,0 +1,106 @@
+from amaranth import *
+from amaranth.lib.wiring import *
+
+from hapenny import mux, oneof
+from hapenny.bus import BusPort
+
+class Mailbox(Component):
+    """Spinlocks and mailboxes, for coordinating the cores of a multi-core
+    SoC. This sits behind a BusArbiter, which tells it which core is asking;
+    see MultiCore.
+
+    Memory Map
+    ----------
+    +00      ID - reads as the number of the core reading it
+    +02      FULL - bit n is set while core n's inbox holds a message
+    +04      INBOX - reads as the message in the reading core's inbox; writing
+             anything empties it
+    +06      CORES - reads as the number of cores
+    +20+2n   SEND - writing puts a message in core n's inbox, replacing
+             whatever was there
+    +40+2n   LOCK - reading lock n takes it, and reads as 0 if it was free or
+             1 if someone already had it; writing anything frees it
+
+    The registers are all halfwords, and reading some of them has side
+    effects, so use LHU and SH; a LW of a lock would take two of them.
+    Messages are 16 bits. Sending to a core whose inbox is full overwrites the
+    message it hasn't read yet, so a sender that cares should check FULL
+    first -- or hold a lock that says whose turn it is.
+
+    Parameters
+    ----------
+    cores (integer): number of cores, 1-16.
+    locks (integer): number of locks, 1-32. Default 8.
+
+    Attributes
+    ----------
+    bus (port): connection to the fabric.
+    requester (in): number of the core whose command is on the bus.
+    full (out): bit n is set while core n's inbox holds a message, e.g. for
+        an interrupt line.
+    """
+    def __init__(self, cores, locks = 8):
+        assert 1 <= cores <= 16, "FULL only has room for 16 cores"
+        assert 1 <= locks <= 32, "only room for 32 locks"
+        super().__init__({
+            "bus": In(BusPort(addr = 6, data = 16)),
+            "requester": In(range(cores)),
+            "full": Out(cores),
+        })
+        self.cores = cores
+        self.locks = locks
+
+    def elaborate(self, platform):
+        m = Module()
+
+        a = self.bus.cmd.payload.addr
+        d = self.bus.cmd.payload.data
+        write = Signal(1)
+        read = Signal(1)
+        m.d.comb += [
+            write.eq(self.bus.cmd.valid & self.bus.cmd.payload.lanes.any()),
+            read.eq(self.bus.cmd.valid & ~self.bus.cmd.payload.lanes.any()),
+        ]
+
+        # Halfword address 0 is ID, 1 is FULL, 2 is INBOX, 3 is CORES, 16 + n
+        # is SEND to core n, and 32 + n is lock n.
+        is_inbox = a == 2
+        is_send = a[4:] == 0b01
+        is_lock = a[5]
+
+        inboxes = [Signal(16, name = f"inbox_{n}") for n in range(self.cores)]
+        for (n, inbox) in enumerate(inboxes):
+            sent = write & is_send & (a[:4] == n)
+            emptied = write & is_inbox & (self.requester == n)
+            m.d.sync += [
+                inbox.eq(mux(sent, d, inbox)),
+                self.full[n].eq(oneof([
+                    (sent, 1),
+                    (emptied, 0),
+                ], default = self.full[n])),
+            ]
+
+        # Reading a lock takes it, and writing frees it. The read answers
+        # with the lock as it was before.
+        locks = Signal(self.locks)
+        for n in range(self.locks):
+            touched = is_lock & (a[:5] == n)
+            m.d.sync += locks[n].eq(oneof([
+                (read & touched, 1),
+                (write & touched, 0),
+            ], default = locks[n]))
+
+        # Answer whatever the address on the bus asks about, whether it's a
+        # read or not, like BidiUart.
+        m.d.sync += self.bus.resp.eq(oneof([
+            (a == 0, self.requester),
+            (a == 1, self.full),
+            (a == 3, self.cores),
+            (is_inbox, oneof([
+                (self.requester == n, inbox)
+                for (n, inbox) in enumerate(inboxes)
+            ])),
+            (is_lock, locks.bit_select(a[:5], 1)),
+        ]))
+
+        return m
@@ -0,0 +1,317 @@
+# The M-Box, responsible for multiplication and division.
+
+from amaranth import *
+from amaranth.lib.wiring import *
+
+from hapenny import mux, oneof
+
+# Multipliers the M-Box can use; see its multiplier parameter.
+MULTIPLIERS = ("serial", "lut", "dsp")
+
+class MBox(Component):
+    """The M-Box implements the multiply and divide instructions of the RV32M
+    extension, for the EW-Box.
+
+    The EW-Box streams the operands past us a halfword at a time, the same way
+    it runs them through its own adder: we latch the low halves of rs1 and rs2
+    when load_lo is set, and the high halves when load_hi is set. From then
+    on, each cycle that run is set we take one step, until done. The EW-Box
+    holds its state (see SBox) while we work, and then writes our result to
+    rd.
+
+    Our datapath is 32 bits wide, unlike the rest of the CPU, built around a
+    34-bit adder and three registers: lo (rs1, which becomes the quotient or
+    low half of the product as it shifts out), d (rs2, the divisor or
+    multiplicand), and hi (the remainder, or the high half of the product).
+
+    Division is restoring division on magnitudes, one quotient bit per step.
+    We negate a negative dividend in a first step, and the quotient or
+    remainder in a last one if it should be negative, for 34 steps in all. A
+    negative divisor never gets negated: we add it instead of subtracting.
+    Division by zero and overflow give the results the spec asks for without
+    any special cases, except that a quotient of all ones from dividing by
+    zero mustn't be negated.
+
+    Multiplication depends on the multiplier parameter.
+
+    - "serial": shift-and-add, one bit of rs1 per step, in the same adder as
+      division, for 32 steps. We sign-extend the multiplicand for MULH, and
+      subtract it instead of adding in the last step for MULH and MULHSU,
+      which makes the product signed.
+    - "lut" or "dsp": one 16x16 unsigned partial product per step, summed a
+      column at a time into hi (shifting out the low half of the product into
+      its own register as it's finished), for 3 steps for MUL and 4 for
+      MULHU. MULHSU and MULH then correct the unsigned high half for negative
+      operands, by subtracting the other operand, in a step each. "lut" builds
+      the 16x16 multiplier out of logic, and "dsp" uses an SB_MAC16, the DSP
+      block on iCE40 UltraPlus parts.
+
+    Parameters
+    ----------
+    multiplier (str): "serial", "lut" or "dsp", as described above. If None
+        (the default), we use "dsp" when building for an iCE40 UltraPlus and
+        "serial" otherwise -- a 16x16 multiplier in logic would be most of an
+        iCE40HX1K. "dsp" can only be simulated with the iCE40 cell models (see
+        hapenny.cxxrtl).
+
+    Attributes
+    ----------
+    funct3 (input): funct3 field of the instruction, which selects the
+        operation.
+    lhs (input): a halfword of rs1.
+    rhs (input): a halfword of rs2.
+    load_lo (input): lhs and rhs are the low halves of the operands.
+    load_hi (input): lhs and rhs are the high halves of the operands.
+    run (input): take a step if we're not done.
+    done (output): result is ready. Only meaningful after load_hi.
+    result (output): value to write to rd.
+    """
+    funct3: In(3)
+    lhs: In(16)
+    rhs: In(16)
+    load_lo: In(1)
+    load_hi: In(1)
+    run: In(1)
+    done: Out(1)
+    result: Out(32)
+
+    def __init__(self, *, multiplier = None):
+        super().__init__()
+        assert multiplier is None or multiplier in MULTIPLIERS, \
+                f"multiplier can't be {multiplier!r}"
+
+        self.multiplier = multiplier
+
+    def elaborate(self, platform):
+        m = Module()
+
+        multiplier = self.multiplier
+        if multiplier is None:
+            device = getattr(platform, "device", "")
+            multiplier = "dsp" if device.startswith("iCE40UP") else "serial"
+        serial = multiplier == "serial"
+
+        lo = Signal(32)
+        d = Signal(32)
+        hi = Signal(33)
+        step = Signal(range(35))
+
+        # Decoding of funct3.
+        is_div = self.funct3[2]
+        is_rem = self.funct3[1]
+        div_signed = ~self.funct3[0]
+        mul_low = self.funct3 == 0b000
+        # MULH and MULHSU treat rs1 as signed, and MULH rs2 too.
+        a_signed = (self.funct3 == 0b001) | (self.funct3 == 0b010)
+        b_signed = self.funct3 == 0b001
+
+        # Number of steps the operation takes.
+        if serial:
+            last = mux(is_div, 34, 32)
+        else:
+            last = oneof([
+                (is_div, 34),
+                (mul_low, 3),
+                (self.funct3 == 0b011, 4),
+                (self.funct3 == 0b010, 5),
+                (self.funct3 == 0b001, 6),
+            ])
+        m.d.comb += self.done.eq(step == last)
+        advance = self.run & ~self.done
+
+        # The adder's inputs depend on which step we're in, and the adder is
+        # our critical path, so rather than compare step against constants in
+        # front of it we keep flags for the steps that matter, updated
+        # alongside step.
+        at_step = {n: Signal(1, name = f"at_step{n}") for n in (0, 4, 31, 33)}
+
+        # The adder. Everything is sign-extended to 34 bits, which is enough
+        # for the sum of two 33-bit values.
+        lhs = Signal(34)
+        rhs = Signal(34)
+        carry_in = Signal(1)
+        total = Signal(34)
+        m.d.comb += total.eq(lhs + rhs + carry_in)
+
+        # Division.
+        #
+        # In the first step (0) we negate a negative dividend, and in the last
+        # (33) we negate the result if need be, putting it in lo either way.
+        # In between, we shift the next dividend bit into the remainder and
+        # subtract the divisor's magnitude, keeping the difference and
+        # shifting in a quotient bit of 1 if it's not negative.
+        #
+        # Whether to negate is decided ahead of time, on the way into each of
+        # those steps, and kept in a register.
+        a_neg = Signal(1)
+        d_neg = div_signed & d[31]
+        negate = Signal(1)
+        div_iterate = ~at_step[0] & ~at_step[33]
+        shifted = Cat(lo[31], hi[:32])
+        quotient_bit = ~total[33]
+        negate_src = mux(at_step[33] & is_rem, hi[:32], lo)
+        div_lhs = Cat(shifted, 0) & div_iterate.replicate(34)
+        div_rhs = mux(
+            div_iterate,
+            Cat(d ^ (~d_neg).replicate(32), 1, 1),
+            Cat(negate_src ^ negate.replicate(32), negate.replicate(2)),
+        )
+        div_carry = mux(div_iterate, ~d_neg, negate)
+
+        with m.If(advance & is_div):
+            with m.If(div_iterate):
+                m.d.sync += [
+                    lo.eq(Cat(quotient_bit, lo[:31])),
+                    hi.eq(mux(quotient_bit, total[:33], shifted)),
+                ]
+            with m.Else():
+                m.d.sync += lo.eq(total[:32])
+
+        if serial:
+            # Shift-and-add, from the bottom bit of rs1 up, shifting the sum
+            # and rs1 right together.
+            add = lo[0]
+            subtract = at_step[31] & a_signed
+            addend = Cat(d, b_signed & d[31]) ^ subtract.replicate(33)
+            mul_lhs = Cat(hi, hi[32])
+            mul_rhs = (Cat(addend, addend[32])
+                       & add.replicate(34))
+            mul_carry = add & subtract
+
+            m.d.comb += self.result.eq(mux(is_div | mul_low, lo, hi[:32]))
+            with m.If(advance & ~is_div):
+                m.d.sync += [
+                    lo.eq(Cat(lo[1:], total[0])),
+                    hi.eq(total[1:]),
+                ]
+        else:
+            # Partial products, in steps 0-3: al * bl, al * bh, ah * bl, and
+            # ah * bh, where al and ah are the halves of rs1, and bl and bh of
+            # rs2. Before the second and fourth, the bottom 16 bits of the sum
+            # are final, and we shift them out of the adder's input. The first
+            # lot goes into p_lo, and the second stays in the bottom of hi
+            # until the next shift, which MUL doesn't get to.
+            #
+            # The unsigned high half of the product is then off by rs2 if rs1
+            # was signed and negative, and vice versa, so in steps 4 and 5 we
+            # subtract those.
+            p_lo = Signal(16)
+            a_half = mux(step[1], lo[16:], lo[:16])
+            b_half = mux(step[0], d[16:], d[:16])
+            product = Signal(32)
+            if multiplier == "dsp":
+                m.submodules.mac = Instance(
+                    "SB_MAC16",
+                    # A plain combinational 16x16 unsigned multiplier: no
+                    # registers, accumulator or 8x8 mode, and both output
+                    # halves straight from the multiplier.
+                    p_NEG_TRIGGER = 0,
+                    p_A_REG = 0,
+                    p_B_REG = 0,
+                    p_C_REG = 0,
+                    p_D_REG = 0,
+                    p_TOP_8x8_MULT_REG = 0,
+                    p_BOT_8x8_MULT_REG = 0,
+                    p_PIPELINE_16x16_MULT_REG1 = 0,
+                    p_PIPELINE_16x16_MULT_REG2 = 0,
+                    p_TOPOUTPUT_SELECT = 0b11,
+                    p_TOPADDSUB_LOWERINPUT = 0b00,
+                    p_TOPADDSUB_UPPERINPUT = 0,
+                    p_TOPADDSUB_CARRYSELECT = 0b00,
+                    p_BOTOUTPUT_SELECT = 0b11,
+                    p_BOTADDSUB_LOWERINPUT = 0b00,
+                    p_BOTADDSUB_UPPERINPUT = 0,
+                    p_BOTADDSUB_CARRYSELECT = 0b00,
+                    p_MODE_8x8 = 0,
+                    p_A_SIGNED = 0,
+                    p_B_SIGNED = 0,
+                    i_CLK = 0,
+                    i_CE = 0,
+                    i_A = a_half,
+                    i_B = b_half,
+                    i_C = 0,
+                    i_D = 0,
+                    i_AHOLD = 0,
+                    i_BHOLD = 0,
+                    i_CHOLD = 0,
+                    i_DHOLD = 0,
+                    i_IRSTTOP = 0,
+                    i_IRSTBOT = 0,
+                    i_ORSTTOP = 0,
+                    i_ORSTBOT = 0,
+                    i_OLOADTOP = 0,
+                    i_OLOADBOT = 0,
+                    i_ADDSUBTOP = 0,
+                    i_ADDSUBBOT = 0,
+                    i_OHOLDTOP = 0,
+                    i_OHOLDBOT = 0,
+                    i_CI = 0,
+                    i_ACCUMCI = 0,
+                    i_SIGNEXTIN = 0,
+                    o_O = product,
+                )
+            else:
+                m.d.comb += product.eq(a_half * b_half)
+
+            partial = step[2:] == 0
+            shift_in = partial & step[0]
+            # Which operand the correction subtracts, and whether it's
+            # needed.
+            correct_a = at_step[4]
+            correction = mux(correct_a, d, lo)
+            correct = mux(correct_a, a_signed & lo[31], b_signed & d[31])
+            # The sum is never negative during the partial products, so the
+            # sign extension only matters for the corrections.
+            mul_lhs = mux(shift_in, hi[16:], Cat(hi, hi[32]))
+            mul_rhs = mux(
+                partial,
+                product,
+                Cat(~correction, 1, 1) & correct.replicate(34),
+            )
+            mul_carry = ~partial & correct
+
+            m.d.comb += self.result.eq(oneof([
+                (is_div, lo),
+                (mul_low, Cat(p_lo, hi[:16])),
+            ], default = hi[:32]))
+            with m.If(advance & ~is_div):
+                m.d.sync += hi.eq(total[:33])
+                with m.If(shift_in):
+                    m.d.sync += p_lo.eq(hi[:16])
+
+        m.d.comb += [
+            lhs.eq(mux(is_div, div_lhs, mul_lhs)),
+            rhs.eq(mux(is_div, div_rhs, mul_rhs)),
+            carry_in.eq(mux(is_div, div_carry, mul_carry)),
+        ]
+
+        # Operand loading, which for the high halves also resets everything
+        # for a new operation, and stepping.
+        with m.If(self.load_lo):
+            m.d.sync += [
+                lo[:16].eq(self.lhs),
+                d[:16].eq(self.rhs),
+            ]
+        with m.If(self.load_hi):
+            m.d.sync += [
+                lo[16:].eq(self.lhs),
+                d[16:].eq(self.rhs),
+                hi.eq(0),
+                step.eq(0),
+                a_neg.eq(div_signed & self.lhs[15]),
+                negate.eq(div_signed & self.lhs[15]),
+            ]
+            m.d.sync += [flag.eq(n == 0) for n, flag in at_step.items()]
+        with m.Elif(advance):
+            m.d.sync += step.eq(step + 1)
+            m.d.sync += [flag.eq(step == n - 1) for n, flag in at_step.items()]
+            # The quotient is negative if exactly one operand was, unless
+            # the divisor was zero, and the remainder has the dividend's sign.
+            with m.If(step == 32):
+                m.d.sync += negate.eq(mux(
+                    is_rem,
+                    a_neg,
+                    (a_neg ^ d_neg) & d.any(),
+                ))
+
+        return m
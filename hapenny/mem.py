@@ -6,7 +6,7 @@ from amaranth.lib import wiring
 from amaranth.lib.enum import *
 from amaranth.lib.coding import Encoder, Decoder
 
-from hapenny import StreamSig, AlwaysReady, mux
+from hapenny import StreamSig, AlwaysReady, mux, oneof
 from hapenny.bus import BusPort
 
 import struct
@@ -84,12 +84,41 @@ class BasicMemory(Component):
     def build(self):
         return False
 
+    # Simulation backdoor. These go straight to the memory contents without
+    # using the bus or taking any clock cycles, so they're only usable from a
+    # simulator process (via 'yield from') after elaboration. Addresses are
+    # halfword indices and wrap at the memory's depth, like the bus does.
+
+    def load(self, contents, offset = 0):
+        "Writes a list of 16-bit halfwords into the memory at 'offset'."
+        for i, halfword in enumerate(contents):
+            yield self.m[(offset + i) % self.depth].eq(halfword)
+
+    def load_image(self, image, offset = 0):
+        "Writes a binary image (bytes) into the memory at halfword 'offset'."
+        if len(image) % 2:
+            image = image + b"\0"
+        yield from self.load(
+            struct.unpack("<" + "H" * (len(image) // 2), image),
+            offset,
+        )
+
+    def poke(self, addr, value):
+        "Writes one halfword."
+        yield self.m[addr % self.depth].eq(value & 0xFFFF)
+
+    def peek(self, addr):
+        "Reads one halfword."
+        return (yield self.m[addr % self.depth])
+
     def elaborate(self, platform):
         m = Module()
 
         if self.file_name is not None:
             self.fetch()
-        mem = Memory(
+        # Keep a reference to the memory so subclasses (and test benches) can
+        # add ports or inspect it.
+        self.m = mem = Memory(
             width=16,
             depth=self.depth,
             name="basicram",
@@ -139,6 +168,24 @@ class SpramMemory(Component):
     def elaborate(self, platform):
         m = Module()
 
+        if platform is None:
+            # Simulating: stand in a generic memory with the same behavior,
+            # which simulators can handle without a model of the primitive.
+            self.m = mem = Memory(width=16, depth=16384, name="spram", init=[])
+            m.submodules += mem
+            rp = mem.read_port(transparent=False)
+            wp = mem.write_port(granularity=8)
+            m.d.comb += [
+                rp.addr.eq(self.bus.cmd.payload.addr),
+                rp.en.eq(self.bus.cmd.valid & (self.bus.cmd.payload.lanes == 0)),
+                self.bus.resp.eq(rp.data),
+                wp.addr.eq(self.bus.cmd.payload.addr),
+                wp.data.eq(self.bus.cmd.payload.data),
+                wp.en[0].eq(self.bus.cmd.valid & self.bus.cmd.payload.lanes[0]),
+                wp.en[1].eq(self.bus.cmd.valid & self.bus.cmd.payload.lanes[1]),
+            ]
+            return m
+
         m.submodules.spram = Instance(
             "SB_SPRAM256KA",
             i_CLOCK=ClockSignal("sync"),
@@ -160,3 +207,359 @@ class SpramMemory(Component):
         )
 
         return m
+
+
+class SpiFlashReader(Component):
+    """Reads halfwords from a standard SPI NOR flash, keeping the flash
+    selected between reads so that sequential reads stream.
+
+    This uses the FAST READ (0x0B) command, which nearly every 25-series flash
+    supports, and runs the SPI clock at half the sync clock. A read from an
+    arbitrary address costs 40 SPI clocks of command, address and dummy byte
+    before the 16 clocks of data. But after each read we leave the flash
+    selected with the clock stopped, and if the next read is for the following
+    halfword, we simply resume clocking -- so runs of sequential reads (code
+    fetches, cache line fills) cost 16 SPI clocks each.
+
+    At reset we send RELEASE POWER-DOWN (0xAB) and wait, since some FPGAs put
+    their configuration flash to sleep once they've loaded their bitstream.
+
+    Parameters
+    ----------
+    addr_bits (int): number of halfword address bits; at most 23, since we use
+        24-bit flash addresses.
+    wakeup_cycles (int): cycles to wait after RELEASE POWER-DOWN before the
+        first read. The default, 256, covers the usual 3 us at up to 85 MHz.
+
+    Attributes
+    ----------
+    req (in stream): halfword address to read. Accepted once any previous read
+        has finished.
+    resp (out): the halfword read, valid for one cycle.
+    flash_cs (out): chip select, active high (the board resource inverts it).
+    flash_clk (out): SPI clock.
+    flash_copi (out): data to the flash.
+    flash_cipo (in): data from the flash.
+    """
+    def __init__(self, *, addr_bits = 23, wakeup_cycles = 256):
+        assert addr_bits <= 23, "24-bit flash addresses only go so far"
+        super().__init__({
+            "req": In(StreamSig(addr_bits)),
+            "resp": Out(AlwaysReady(16)),
+            "flash_cs": Out(1),
+            "flash_clk": Out(1),
+            "flash_copi": Out(1),
+            "flash_cipo": In(1),
+        })
+        self.addr_bits = addr_bits
+        self.wakeup_cycles = wakeup_cycles
+
+    class State(Enum):
+        # Sending RELEASE POWER-DOWN.
+        WAKE = 0
+        # Deselected, waiting out 'timer' before we can do anything.
+        DESELECT = 1
+        # Deselected and ready for a read.
+        IDLE = 2
+        # Sending command, address and dummy byte.
+        COMMAND = 3
+        # Receiving a halfword.
+        DATA = 4
+        # Selected with the clock stopped, after a read.
+        HOLD = 5
+
+    def elaborate(self, platform):
+        m = Module()
+
+        State = self.State
+        state = Signal(State, init = State.WAKE)
+        # Bits to send, MSB first. Long enough for a command, address and
+        # dummy byte.
+        shift_out = Signal(40, init = 0xAB << 32)
+        shift_in = Signal(16)
+        bits_left = Signal(range(40), init = 7)
+        timer = Signal(range(max(self.wakeup_cycles, 2) + 1))
+        # Address of the halfword the flash will send next if we resume
+        # clocking in the HOLD state.
+        next_addr = Signal(self.addr_bits)
+
+        # We shift on every other cycle, when the clock is about to fall: the
+        # flash samples our data on the rising edge and changes its own after
+        # the falling edge, so this is the right time both to sample its data
+        # and to change ours.
+        shifting = Signal(1)
+        falling = Signal(1)
+        last_bit = Signal(1)
+        m.d.comb += [
+            shifting.eq((state == State.WAKE) | (state == State.COMMAND)
+                        | (state == State.DATA)),
+            falling.eq(shifting & self.flash_clk),
+            last_bit.eq(falling & (bits_left == 0)),
+
+            self.flash_copi.eq(shift_out[-1]),
+
+            self.req.ready.eq(
+                (state == State.IDLE)
+                | ((state == State.HOLD) & (self.req.payload == next_addr))
+            ),
+
+            # Bytes come MSB first, in address order, and our halfwords are
+            # little-endian.
+            self.resp.valid.eq((state == State.DATA) & last_bit),
+            self.resp.payload.eq(Cat(shift_in[7:15],
+                                     self.flash_cipo, shift_in[:7])),
+        ]
+        m.d.sync += [
+            # The clock doesn't start until the flash has been selected for a
+            # cycle.
+            self.flash_clk.eq(shifting & self.flash_cs & ~self.flash_clk),
+            self.flash_cs.eq(
+                (state == State.WAKE) | (state == State.COMMAND)
+                | (state == State.DATA) | (state == State.HOLD)
+            ),
+        ]
+
+        with m.If(falling):
+            m.d.sync += [
+                shift_out.eq(shift_out << 1),
+                shift_in.eq(Cat(self.flash_cipo, shift_in[:-1])),
+                bits_left.eq(bits_left - 1),
+            ]
+
+        with m.Switch(state):
+            with m.Case(State.WAKE):
+                with m.If(last_bit):
+                    m.d.sync += [
+                        state.eq(State.DESELECT),
+                        timer.eq(self.wakeup_cycles),
+                    ]
+            with m.Case(State.DESELECT):
+                m.d.sync += timer.eq(timer - 1)
+                with m.If(timer == 0):
+                    m.d.sync += state.eq(State.IDLE)
+            with m.Case(State.IDLE):
+                with m.If(self.req.valid):
+                    m.d.sync += [
+                        state.eq(State.COMMAND),
+                        # FAST READ, 24-bit byte address, dummy byte.
+                        shift_out.eq(Cat(C(0, 8), C(0, 1), self.req.payload,
+                                         C(0, 23 - self.addr_bits),
+                                         C(0x0B, 8))),
+                        bits_left.eq(39),
+                        next_addr.eq(self.req.payload),
+                    ]
+            with m.Case(State.COMMAND):
+                with m.If(last_bit):
+                    m.d.sync += [
+                        state.eq(State.DATA),
+                        bits_left.eq(15),
+                    ]
+            with m.Case(State.DATA):
+                with m.If(last_bit):
+                    m.d.sync += [
+                        state.eq(State.HOLD),
+                        next_addr.eq(next_addr + 1),
+                    ]
+            with m.Case(State.HOLD):
+                with m.If(self.req.valid):
+                    with m.If(self.req.ready):
+                        # Sequential: just keep going.
+                        m.d.sync += [
+                            state.eq(State.DATA),
+                            bits_left.eq(15),
+                        ]
+                    with m.Else():
+                        # Anywhere else needs a new command, and flashes want
+                        # to be deselected briefly between commands.
+                        m.d.sync += [
+                            state.eq(State.DESELECT),
+                            timer.eq(1),
+                        ]
+
+        return m
+
+
+class SpiFlashMemory(Component):
+    """Maps part of an SPI NOR flash into the bus address space for reads,
+    e.g. to run code straight out of an FPGA board's configuration flash.
+
+    Reads are slow -- dozens of cycles even when they stream, see
+    SpiFlashReader -- so this device uses wait states (the CPU must be built
+    with wait_states = True), and can keep recently used data in a
+    direct-mapped cache of block RAM. The cache is filled a line at a time,
+    and since both a line fill and the next line's fill after it are
+    sequential reads, straight-line code streams out of the flash. Hits take
+    one wait state.
+
+    Writes are accepted and ignored. The cache is never invalidated, since
+    the flash doesn't change under us.
+
+    Parameters
+    ----------
+    addr_bits (int): number of halfword address bits on the bus, which sets
+        the size of the window into the flash.
+    offset (int): byte address in the flash where the window starts, e.g. to
+        skip over the FPGA bitstream. Must be a multiple of the window size.
+    cache_lines (int): number of lines in the cache, a power of two, or 0 for
+        no cache. Default 64.
+    line_words (int): halfwords per cache line, a power of two. Default 8.
+    wakeup_cycles (int): see SpiFlashReader.
+
+    Attributes
+    ----------
+    bus: a BusPort with wait states, addr_bits address bits and a 16-bit data
+        path.
+    flash_cs, flash_clk, flash_copi, flash_cipo: the SPI signals; see
+        SpiFlashReader.
+    """
+    def __init__(self, *, addr_bits, offset = 0, cache_lines = 64,
+                 line_words = 8, wakeup_cycles = 256):
+        window = 2 << addr_bits
+        assert offset % window == 0, \
+                "flash offset must be a multiple of the window size"
+        assert offset + window <= 1 << 24, "window doesn't fit in 16 MiB"
+        assert cache_lines & (cache_lines - 1) == 0, \
+                "cache_lines must be a power of two"
+        assert line_words & (line_words - 1) == 0 and line_words > 0, \
+                "line_words must be a power of two"
+        assert (cache_lines * line_words).bit_length() - 1 <= addr_bits, \
+                "cache is bigger than the window"
+        super().__init__({
+            "bus": In(BusPort(addr = addr_bits, data = 16,
+                              wait_states = True)),
+            "flash_cs": Out(1),
+            "flash_clk": Out(1),
+            "flash_copi": Out(1),
+            "flash_cipo": In(1),
+        })
+        self.addr_bits = addr_bits
+        self.offset = offset
+        self.cache_lines = cache_lines
+        self.line_words = line_words
+        self.wakeup_cycles = wakeup_cycles
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.reader = reader = SpiFlashReader(
+            addr_bits = 23,
+            wakeup_cycles = self.wakeup_cycles,
+        )
+        m.d.comb += [
+            self.flash_cs.eq(reader.flash_cs),
+            self.flash_clk.eq(reader.flash_clk),
+            self.flash_copi.eq(reader.flash_copi),
+            reader.flash_cipo.eq(self.flash_cipo),
+        ]
+
+        # Converts a halfword address in our window to one in the flash.
+        def flash_addr(addr):
+            return addr | (self.offset >> 1)
+
+        cmd = self.bus.cmd
+        is_read = Signal(1)
+        m.d.comb += is_read.eq(cmd.valid & (cmd.payload.lanes == 0))
+
+        if self.cache_lines == 0:
+            # No cache: each read waits for its own halfword, which we keep in
+            # a register to answer with on the cycle after we accept it.
+            data = Signal(16)
+            have_data = Signal(1)
+            pending = Signal(1)
+            m.d.comb += [
+                reader.req.valid.eq(is_read & ~have_data & ~pending),
+                reader.req.payload.eq(flash_addr(cmd.payload.addr)),
+                cmd.ready.eq(~is_read | have_data),
+                self.bus.resp.eq(data),
+            ]
+            m.d.sync += [
+                pending.eq(oneof([
+                    (reader.req.valid & reader.req.ready, 1),
+                    (reader.resp.valid, 0),
+                ], default = pending)),
+                have_data.eq(oneof([
+                    (reader.resp.valid, 1),
+                    (is_read & have_data, 0),
+                ], default = have_data)),
+                data.eq(mux(reader.resp.valid, reader.resp.payload, data)),
+            ]
+            return m
+
+        # Split the halfword address into word-within-line, line index, and
+        # tag.
+        word_bits = (self.line_words - 1).bit_length()
+        index_bits = (self.cache_lines - 1).bit_length()
+        tag_bits = self.addr_bits - word_bits - index_bits
+        index = cmd.payload.addr[word_bits:word_bits + index_bits]
+        tag = cmd.payload.addr[word_bits + index_bits:]
+
+        # Tags are stored with a valid bit on top, which the RAM's zero
+        # initialization clears.
+        m.submodules.tags = tags = Memory(
+            width = tag_bits + 1,
+            depth = self.cache_lines,
+            name = "flash_tags",
+            init = [],
+        )
+        m.submodules.lines = lines = Memory(
+            width = 16,
+            depth = self.cache_lines * self.line_words,
+            name = "flash_lines",
+            init = [],
+        )
+        tag_rp = tags.read_port(transparent = False)
+        tag_wp = tags.write_port()
+        line_rp = lines.read_port(transparent = False)
+        line_wp = lines.write_port()
+
+        # Both RAMs are read at the address on the bus every cycle. A
+        # command that isn't accepted stays on the bus, so the cycle after a
+        # read first appears we can check its tag, and if it hits, accept it
+        # -- by which time the line RAM is reading it a second time, with
+        # the result arriving right on time for the response.
+        looked_up = Signal(1)
+        hit = Signal(1)
+        filling = Signal(1)
+        fill_addr = Signal(self.addr_bits)
+        fill_last = Signal(1)
+        m.d.comb += [
+            tag_rp.addr.eq(index),
+            tag_rp.en.eq(1),
+            line_rp.addr.eq(cmd.payload.addr[:word_bits + index_bits]),
+            line_rp.en.eq(1),
+
+            hit.eq(looked_up & (tag_rp.data == Cat(tag, 1))),
+            cmd.ready.eq(~is_read | hit),
+            self.bus.resp.eq(line_rp.data),
+        ]
+        m.d.sync += looked_up.eq(is_read & ~cmd.ready & ~filling)
+
+        # On a miss, fill the whole line in order, then mark it valid. The
+        # read that missed is still on the bus and gets looked up again.
+        fill_word = fill_addr[:word_bits]
+        m.d.comb += [
+            fill_last.eq(fill_word == self.line_words - 1),
+            reader.req.valid.eq(filling),
+            reader.req.payload.eq(flash_addr(fill_addr)),
+
+            line_wp.addr.eq(fill_addr[:word_bits + index_bits]),
+            line_wp.data.eq(reader.resp.payload),
+            line_wp.en.eq(filling & reader.resp.valid),
+
+            tag_wp.addr.eq(fill_addr[word_bits:word_bits + index_bits]),
+            tag_wp.data.eq(Cat(fill_addr[word_bits + index_bits:], 1)),
+            tag_wp.en.eq(filling & reader.resp.valid & fill_last),
+        ]
+        with m.If(looked_up & is_read & ~hit & ~filling):
+            m.d.sync += [
+                filling.eq(1),
+                fill_addr.eq(Cat(C(0, word_bits),
+                                 cmd.payload.addr[word_bits:])),
+            ]
+        with m.Elif(filling & reader.resp.valid):
+            m.d.sync += [
+                fill_addr.eq(fill_addr + 1),
+                filling.eq(~fill_last),
+            ]
+
+        return m
@@ -0,0 +1,928 @@
+# Functional (instruction-level) model of the hapenny CPUs.
+#
+# This is a plain-Python RV32I (or RV32IMC) interpreter. It knows nothing about the
+# internals of the EW-Box or FD-Box; instead, it executes instructions one at a
+# time against a simple bus model, and (optionally) charges each instruction
+# the number of cycles the RTL would take to run it, as measured by the test
+# benches. That makes it useful for two things:
+#
+# - Running whole firmware images (tinyboot, Dhrystone, etc.) in seconds rather
+#   than hours.
+# - Estimating CPI for a given core configuration without simulating RTL.
+#
+# The cycle tables are only as accurate as our knowledge of the RTL, so if you
+# change the timing of an instruction in the RTL, update the table here too.
+
+import copy
+import struct
+from pathlib import Path
+
+import logging
+
+log = logging.getLogger(__name__)
+
+MASK32 = 0xFFFF_FFFF
+
+def sext(value, bits):
+    "Sign-extends the low 'bits' of 'value' to a Python int."
+    value &= (1 << bits) - 1
+    if value & (1 << (bits - 1)):
+        value -= 1 << bits
+    return value
+
+
+def signed(value):
+    "Interprets a 32-bit word as a two's complement signed value."
+    return sext(value, 32)
+
+
+class Timing:
+    """Cycle costs for each class of instruction on a particular core.
+
+    The numbers are taken from the tables in the README (hapenny) and
+    doc/chonk.mkdn (chonk), which are in turn measured by the sim-cpu.py and
+    sim-chonk.py test benches.
+
+    Parameters
+    ----------
+    name (str): name of the core, for reports.
+    lui, auipc, jal, jalr, load, sw, sb_sh, slt, alu, system (int): cycle
+        counts for each class of instruction.
+    branch (int, int): cycle counts for (not taken, taken) branches.
+    shift (int): cycle count for a shift by zero bits.
+    alu_imm, slt_imm, shift_imm (int): the same for the immediate forms of
+        those instructions, if they differ from the register forms.
+    early_jal (int): cycle count for JAL when the FD-Box redirects fetch for
+        it (the early_jal CPU parameter), or None if the core can't.
+    predicted_branch (int, int): cycle counts for (not taken, taken) backward
+        branches when the FD-Box predicts them taken (the predict_branches
+        CPU parameter), or None if the core can't.
+    shift_bits_per_cycle (int): how many bits the core's shifter moves each
+        additional cycle (the EW-Box parameter of the same name). Default 1.
+    dual_port (dict): the parameters above that change when the register
+        file has a second read port (the rf_read_ports CPU parameter), or None
+        if the core can't have one.
+    skip_rs2_reads (dict): the same for the skip_rs2_reads CPU parameter,
+        which makes no difference on top of a second read port.
+    muldiv (int): cycle count for an M extension instruction, not counting
+        the steps the M-Box takes, or None if the core can't have one.
+    multiplier (str): the M-Box's multiplier ("serial", "lut" or "dsp"),
+        which determines how many steps a multiply takes. Default "serial".
+    compressed (bool): whether the core can run compressed instructions (the
+        compressed CPU parameter). They take exactly as long as the
+        instructions they stand for. Default False.
+    interrupt, mret (int): cycles spent entering an interrupt handler, on
+        top of the instruction that was running, and cycle count for MRET;
+        None if the core has no interrupts (the interrupts CPU parameter).
+    bubble (int): cycles of re-fetch bubble included in the counts for
+        jumps and taken branches, which a core with several barrel-threaded
+        harts (the harts CPU parameter) doesn't need; None if the core can't
+        have them. Each hart's instructions then take that much less, and
+        the harts take turns, so the cycles charged for one hart's
+        instructions add up to the time the whole core spends on them.
+    other (int): cycle count for instructions the core doesn't implement
+        (e.g. FENCE), which the RTL treats as no-ops.
+    """
+
+    def __init__(self, *, name, lui, auipc, jal, jalr, branch, load, sw,
+                 sb_sh, slt, shift, alu, system, other, early_jal=None,
+                 predicted_branch=None, shift_bits_per_cycle=1,
+                 alu_imm=None, slt_imm=None, shift_imm=None,
+                 dual_port=None, skip_rs2_reads=None, muldiv=None,
+                 multiplier="serial", compressed=False, interrupt=None,
+                 mret=None, bubble=None):
+        self.name = name
+        self.lui = lui
+        self.auipc = auipc
+        self.jal = jal
+        self.jalr = jalr
+        self.branch = branch
+        self.load = load
+        self.sw = sw
+        self.sb_sh = sb_sh
+        self.slt = slt
+        self.shift = shift
+        self.alu = alu
+        self.alu_imm = alu if alu_imm is None else alu_imm
+        self.slt_imm = slt if slt_imm is None else slt_imm
+        self.shift_imm = shift if shift_imm is None else shift_imm
+        self.system = system
+        self.other = other
+        self.early_jal = early_jal
+        self.predicted_branch = predicted_branch
+        # Timings actually charged for backward branches, which differ from
+        # forward ones only when predicting.
+        self.backward_branch = branch
+        self.shift_bits_per_cycle = shift_bits_per_cycle
+        self.dual_port = dual_port
+        self.skip_rs2_reads = skip_rs2_reads
+        self.muldiv = muldiv
+        self.multiplier = multiplier
+        self.compressed = compressed
+        self.interrupt = interrupt
+        self.mret = mret
+        self.bubble = bubble
+
+    def shift_cycles(self, amount, *, imm=False):
+        "Cycle count for a shift by 'amount' bits."
+        step = self.shift_bits_per_cycle
+        base = self.shift_imm if imm else self.shift
+        return base + ((amount & 31) + step - 1) // step
+
+    def muldiv_cycles(self, funct3):
+        "Cycle count for the M extension instruction with this funct3."
+        if funct3 & 4:
+            # Divides: negate, 32 quotient bits, negate.
+            steps = 34
+        elif self.multiplier == "serial":
+            steps = 32
+        else:
+            # MUL, MULH, MULHSU and MULHU: three or four partial products,
+            # and a correction for each signed operand of a high multiply.
+            steps = (3, 6, 5, 4)[funct3]
+        return self.muldiv + steps
+
+    def branch_cycles(self, taken, offset):
+        "Cycle count for a branch by 'offset' bytes."
+        costs = self.backward_branch if offset < 0 else self.branch
+        return costs[1] if taken else costs[0]
+
+    def configure(self, *, shift_bits_per_cycle=1, early_jal=False,
+                  predict_branches=False, rf_read_ports=1,
+                  skip_rs2_reads=False, muldiv=False, multiplier=None,
+                  compressed=False, interrupts=0, harts=1):
+        """Returns a copy of these timings for a core built with the given
+        options, which mirror the CPU parameters of the same names."""
+        timing = copy.copy(self)
+        timing.shift_bits_per_cycle = shift_bits_per_cycle
+        if muldiv:
+            if self.muldiv is None:
+                raise ValueError(f"{self.name} has no muldiv option")
+            # The M-Box picks DSPs for itself when it can, but we don't know
+            # what we're building for; assume it can't.
+            timing.multiplier = multiplier or "serial"
+        if compressed and not self.compressed:
+            raise ValueError(f"{self.name} has no compressed option")
+        if interrupts and self.interrupt is None:
+            raise ValueError(f"{self.name} has no interrupts option")
+        if harts > 1:
+            if self.bubble is None:
+                raise ValueError(f"{self.name} has no harts option")
+            if early_jal or predict_branches or compressed or interrupts:
+                raise ValueError("harts can't be combined with early_jal, "
+                                 "predict_branches, compressed or interrupts")
+        if rf_read_ports == 2:
+            if self.dual_port is None:
+                raise ValueError(f"{self.name} has no rf_read_ports option")
+            overrides = self.dual_port
+        elif skip_rs2_reads:
+            if self.skip_rs2_reads is None:
+                raise ValueError(f"{self.name} has no skip_rs2_reads option")
+            overrides = self.skip_rs2_reads
+        else:
+            overrides = {}
+        for (name, cycles) in overrides.items():
+            setattr(timing, name, cycles)
+        timing.backward_branch = timing.branch
+        if early_jal:
+            if self.early_jal is None:
+                raise ValueError(f"{self.name} has no early_jal option")
+            timing.jal = timing.early_jal
+        if predict_branches:
+            if self.predicted_branch is None:
+                raise ValueError(f"{self.name} has no predict_branches option")
+            timing.backward_branch = timing.predicted_branch
+        if harts > 1:
+            bubble = timing.bubble
+            timing.jal -= bubble
+            timing.jalr -= bubble
+            timing.branch = (timing.branch[0], timing.branch[1] - bubble)
+            timing.backward_branch = timing.branch
+        return timing
+
+
+HAPENNY = Timing(
+    name = "hapenny",
+    lui = 4,
+    auipc = 4,
+    jal = 8,
+    jalr = 8,
+    early_jal = 4,
+    predicted_branch = (9, 6),
+    branch = (5, 10),
+    load = 6,
+    sw = 5,
+    sb_sh = 4,
+    slt = 6,
+    shift = 6,
+    alu = 4,
+    system = 6,
+    other = 6,
+    muldiv = 6,
+    compressed = True,
+    # Entering a handler costs a re-fetch bubble.
+    interrupt = 4,
+    mret = 4,
+    bubble = 4,
+    # Everything takes a cycle less with the short schedule, including the
+    # re-fetch bubble.
+    dual_port = dict(
+        lui = 3,
+        auipc = 3,
+        jal = 6,
+        jalr = 6,
+        early_jal = 3,
+        predicted_branch = (7, 5),
+        branch = (4, 8),
+        load = 5,
+        sw = 4,
+        sb_sh = 3,
+        slt = 5,
+        shift = 5,
+        alu = 3,
+        alu_imm = 3,
+        slt_imm = 5,
+        shift_imm = 5,
+        system = 5,
+        other = 5,
+        muldiv = 5,
+        interrupt = 3,
+        mret = 3,
+        bubble = 3,
+    ),
+    # With one port, only instructions that don't read rs2 in state 0 (and
+    # the re-fetch bubble) get the short schedule.
+    skip_rs2_reads = dict(
+        lui = 3,
+        auipc = 3,
+        jal = 6,
+        jalr = 6,
+        early_jal = 3,
+        predicted_branch = (8, 6),
+        branch = (5, 9),
+        load = 5,
+        sw = 4,
+        sb_sh = 3,
+        alu_imm = 3,
+        slt_imm = 5,
+        shift_imm = 5,
+        system = 5,
+        other = 5,
+        interrupt = 3,
+        mret = 3,
+        bubble = 3,
+    ),
+)
+
+CHONK = Timing(
+    name = "chonk",
+    lui = 2,
+    auipc = 2,
+    jal = 4,
+    jalr = 4,
+    branch = (3, 5),
+    load = 3,
+    sw = 2,
+    sb_sh = 2,
+    slt = 3,
+    shift = 3,
+    alu = 2,
+    system = 3,
+    other = 3,
+)
+
+
+class ModelError(Exception):
+    "Raised when the model can't continue, e.g. on a bus fault."
+
+
+class Ram:
+    """A byte-addressed RAM (or ROM) for the model's bus.
+
+    Parameters
+    ----------
+    size (int): size in bytes.
+    contents (bytes): initial contents, loaded at offset 0.
+    read_only (bool): if True, writes are ignored, like a program ROM.
+    """
+
+    def __init__(self, size, *, contents=b"", read_only=False):
+        assert len(contents) <= size, "contents don't fit in memory"
+        self.data = bytearray(size)
+        self.data[:len(contents)] = contents
+        self.read_only = read_only
+
+    @classmethod
+    def from_file(cls, file_name, *, size=None, **kwargs):
+        "Creates a Ram initialized with a binary image."
+        contents = Path(file_name).read_bytes()
+        if size is None:
+            size = len(contents)
+        return cls(size, contents=contents, **kwargs)
+
+    def load_image(self, image, offset=0):
+        "Copies 'image' (bytes) into the memory at 'offset'."
+        self.data[offset:offset + len(image)] = image
+
+    def load_halfwords(self, halfwords, offset=0):
+        "Copies a list of 16-bit words into the memory at 'offset'."
+        self.load_image(struct.pack(f"<{len(halfwords)}H", *halfwords), offset)
+
+    def read(self, offset, size):
+        return int.from_bytes(self.data[offset:offset + size], "little")
+
+    def write(self, offset, size, value):
+        if not self.read_only:
+            self.data[offset:offset + size] = value.to_bytes(size, "little")
+
+
+class Uart:
+    """Stand-in for hapenny.serial.BidiUart with the same register layout.
+
+    Transmitted characters are collected in 'output' (and optionally passed to
+    'on_tx'); received characters are taken from 'input'. The transmitter is
+    always ready, since the model has no notion of baud rate.
+
+    Attributes
+    ----------
+    output (bytearray): characters written to the transmit register.
+    input (bytearray): characters waiting to be received.
+    """
+
+    def __init__(self, *, on_tx=None):
+        self.output = bytearray()
+        self.input = bytearray()
+        self.on_tx = on_tx
+
+    def read(self, offset, size):
+        if offset & 2 == 0:
+            # Receive data register; bit 15 set means empty.
+            if self.input:
+                return self.input.pop(0)
+            return 0x8000
+        # Transmit holding register; nonzero means busy.
+        return 0
+
+    def write(self, offset, size, value):
+        if offset & 2:
+            self.output.append(value & 0xFF)
+            if self.on_tx is not None:
+                self.on_tx(value & 0xFF)
+
+
+class Bus:
+    """Address decoder for the model.
+
+    Devices are attached at base addresses with a size; accesses are routed to
+    the first device whose range contains them. Addresses are truncated to
+    'addr_width' bits first, which reproduces the aliasing of the real
+    (partially decoded) fabric.
+
+    Parameters
+    ----------
+    addr_width (int): number of byte address bits the CPU drives.
+    """
+
+    def __init__(self, *, addr_width=32):
+        self.addr_mask = (1 << addr_width) - 1
+        self.devices = []
+
+    def add(self, base, size, device):
+        "Maps 'device' at byte address 'base', covering 'size' bytes."
+        self.devices.append((base, base + size, device))
+        return device
+
+    def _find(self, addr):
+        addr &= self.addr_mask
+        for start, end, device in self.devices:
+            if start <= addr < end:
+                return device, addr - start
+        raise ModelError(f"bus fault at {addr:08x}")
+
+    def read(self, addr, size):
+        device, offset = self._find(addr)
+        return device.read(offset, size)
+
+    def write(self, addr, size, value):
+        device, offset = self._find(addr)
+        device.write(offset, size, value & ((1 << (size * 8)) - 1))
+
+
+class Hart:
+    """A single RV32I hardware thread.
+
+    Parameters
+    ----------
+    bus (Bus): where loads, stores, and fetches go.
+    reset_vector (int): initial PC.
+    timing (Timing or None): cycle model to charge instructions against. If
+        None, 'cycles' counts one per instruction.
+    counters (bool): if True, the cycle/instret CSRs can be read, like a Cpu
+        built with counters=True. Otherwise, SYSTEM instructions are no-ops
+        (but see hartid).
+    muldiv (bool): if True, implement the M extension, like a Cpu built with
+        muldiv=True. Otherwise, its instructions run as the base ALU ops they
+        resemble, as they do on such a Cpu.
+    compressed (bool): if True, implement the C extension, like a Cpu built
+        with compressed=True, and allow the PC to be halfword-aligned.
+    interrupt_vector (int or None): if not None, implement interrupts like a
+        Cpu built with interrupts and this interrupt_vector: MRET, and
+        setting and clearing mstatus.MIE. Call interrupt() to raise one.
+    banked_interrupts (bool): if True, switch to a second set of registers
+        while in an interrupt handler, like a Cpu built with
+        banked_interrupts=True.
+    hartid (int or None): if not None, this is one of several harts, like
+        those of a Cpu built with harts > 1, and the mhartid CSR reads as
+        this.
+
+    Attributes
+    ----------
+    x (list of int): the 32 integer registers (x[0] is always 0), from the
+        bank in use, if there's more than one.
+    mie (bool): interrupts are enabled.
+    in_handler (bool): an interrupt has been taken, and MRET not yet run.
+    epc (int): where MRET will go back to.
+    pc (int): address of the next instruction to execute.
+    cycles (int): estimated cycle count so far.
+    instret (int): number of instructions retired so far.
+    histogram (dict): instruction mnemonic -> number of times executed.
+    """
+
+    def __init__(self, bus, *, reset_vector=0, timing=HAPENNY, counters=True,
+                 muldiv=False, compressed=False, interrupt_vector=None,
+                 banked_interrupts=False, hartid=None):
+        self.bus = bus
+        self.timing = timing
+        self.counters = counters
+        self.muldiv = muldiv
+        self.compressed = compressed
+        self.interrupt_vector = interrupt_vector
+        self.hartid = hartid
+        # Length in bytes of the instruction being executed, which is where
+        # the next one starts unless it jumps.
+        self.ilen = 4
+        self.x = [0] * 32
+        self.banks = [self.x, [0] * 32] if banked_interrupts else [self.x]
+        self.mie = False
+        self.in_handler = False
+        self.epc = 0
+        self.pc = reset_vector
+        self.cycles = 0
+        self.instret = 0
+        self.histogram = {}
+        # Decoded instructions, keyed by instruction word. Firmware tends to
+        # execute the same few hundred words over and over, so this saves us
+        # re-decoding them every time.
+        self._decoded = {}
+
+    def fetch(self):
+        if not self.compressed:
+            if self.pc & 3:
+                raise ModelError(f"misaligned PC {self.pc:08x}")
+            return self.bus.read(self.pc, 4)
+        if self.pc & 1:
+            raise ModelError(f"misaligned PC {self.pc:08x}")
+        # Compressed instructions are only a halfword long, and the rest may
+        # straddle a word boundary.
+        insn = self.bus.read(self.pc, 2)
+        if insn & 3 == 3:
+            insn |= self.bus.read((self.pc + 2) & MASK32, 2) << 16
+        return insn
+
+    def step(self):
+        """Executes one instruction, returning its estimated cycle count."""
+        return self.execute(self.fetch())
+
+    def run(self, *, max_instructions=None, until_pc=None):
+        """Runs until the PC reaches 'until_pc' or 'max_instructions' have
+        retired, whichever happens first. Returns the number of instructions
+        executed."""
+        count = 0
+        while max_instructions is None or count < max_instructions:
+            if self.pc == until_pc:
+                break
+            self.step()
+            count += 1
+        return count
+
+    def cpi(self):
+        "Average cycles per instruction so far."
+        return self.cycles / self.instret if self.instret else 0.0
+
+    def execute(self, insn):
+        """Executes the instruction 'insn' at the current PC, updating the
+        registers, PC, and counters. Returns the estimated cycle count."""
+        try:
+            decoded = self._decoded[insn]
+        except KeyError:
+            decoded = self._decoded[insn] = decode(
+                insn, muldiv=self.muldiv, compressed=self.compressed,
+                interrupts=self.interrupt_vector is not None,
+            )
+        mnemonic, handler, operands = decoded
+        self.ilen = 4 if insn & 3 == 3 else 2
+        cost = handler(self, *operands)
+        self.x[0] = 0
+        if self.timing is None:
+            cost = 1
+        self.cycles += cost
+        self.instret += 1
+        self.histogram[mnemonic] = self.histogram.get(mnemonic, 0) + 1
+        return cost
+
+    def interrupt(self, line):
+        """Takes an interrupt on 'line' before the next instruction, if
+        interrupts are enabled and we're not in a handler already. Returns
+        whether it was taken."""
+        if not self.mie or self.in_handler:
+            return False
+        self.epc = self.pc
+        self.pc = (self.interrupt_vector + 4 * line) & MASK32
+        self._switch_bank(True)
+        if self.timing is not None:
+            self.cycles += self.timing.interrupt
+        return True
+
+    def _switch_bank(self, in_handler):
+        self.in_handler = in_handler
+        self.x = self.banks[-1 if in_handler else 0]
+
+    def read_csr(self, csr):
+        # The RTL only decodes enough bits of the CSR number to tell cycle
+        # from instret (so e.g. cycleh reads as cycle), and those from
+        # mhartid; mimic that rather than the spec.
+        if self.hartid is not None and (csr & 0x200 or not self.counters):
+            return self.hartid
+        if not self.counters:
+            return 0
+        value = self.instret if csr & 2 else self.cycles
+        return value & MASK32
+
+
+# Instruction handlers. Each takes the hart and the decoded operands, and
+# returns the cycle cost from the hart's timing model. They're module-level
+# functions (rather than methods) so the decode cache can store them directly.
+
+def _lui(h, rd, imm):
+    h.x[rd] = imm & MASK32
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.lui
+
+def _auipc(h, rd, imm):
+    h.x[rd] = (h.pc + imm) & MASK32
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.auipc
+
+def _jal(h, rd, imm):
+    target = (h.pc + imm) & MASK32
+    h.x[rd] = (h.pc + h.ilen) & MASK32
+    h.pc = target
+    return h.timing and h.timing.jal
+
+def _jalr(h, rd, rs1, imm):
+    # The RTL ignores the bottom two bits of the target, since it doesn't
+    # support misaligned PCs -- or just the bottom bit, as the spec says, with
+    # compressed instructions.
+    target = (h.x[rs1] + imm) & MASK32 & ~(1 if h.compressed else 3)
+    h.x[rd] = (h.pc + h.ilen) & MASK32
+    h.pc = target
+    return h.timing and h.timing.jalr
+
+def _branch(h, cond, rs1, rs2, imm):
+    taken = cond(h.x[rs1], h.x[rs2])
+    h.pc = (h.pc + (imm if taken else h.ilen)) & MASK32
+    return h.timing and h.timing.branch_cycles(taken, imm)
+
+def _load(h, size, sign, rd, rs1, imm):
+    value = h.bus.read((h.x[rs1] + imm) & MASK32, size)
+    if sign:
+        value = sext(value, size * 8) & MASK32
+    h.x[rd] = value
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.load
+
+def _store(h, size, rs1, rs2, imm):
+    h.bus.write((h.x[rs1] + imm) & MASK32, size, h.x[rs2])
+    h.pc = (h.pc + h.ilen) & MASK32
+    if h.timing is None:
+        return 1
+    return h.timing.sw if size == 4 else h.timing.sb_sh
+
+def _alu_imm(h, op, kind, rd, rs1, imm):
+    a = h.x[rs1]
+    h.x[rd] = op(a, imm & MASK32) & MASK32
+    h.pc = (h.pc + h.ilen) & MASK32
+    return _alu_cost(h, kind, imm, True)
+
+def _alu_reg(h, op, kind, rd, rs1, rs2):
+    b = h.x[rs2]
+    h.x[rd] = op(h.x[rs1], b) & MASK32
+    h.pc = (h.pc + h.ilen) & MASK32
+    return _alu_cost(h, kind, b, False)
+
+def _alu_cost(h, kind, b, imm):
+    if h.timing is None:
+        return 1
+    if kind == "shift":
+        return h.timing.shift_cycles(b, imm=imm)
+    if kind == "slt":
+        return h.timing.slt_imm if imm else h.timing.slt
+    return h.timing.alu_imm if imm else h.timing.alu
+
+def _muldiv(h, op, funct3, rd, rs1, rs2):
+    h.x[rd] = op(h.x[rs1], h.x[rs2]) & MASK32
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.muldiv_cycles(funct3)
+
+def _system(h, rd, rs1, csr, funct3):
+    if funct3 != 0:
+        h.x[rd] = h.read_csr(csr)
+    # Like the RTL, take CSRRSI/CSRRCI of bit 3 of anything but the counters
+    # as setting or clearing mstatus.MIE.
+    if h.interrupt_vector is not None and funct3 & 0b110 == 0b110 \
+            and not csr & 0x800 and rs1 & 8:
+        h.mie = not funct3 & 1
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.system
+
+def _mret(h):
+    h.pc = h.epc
+    h._switch_bank(False)
+    return h.timing and h.timing.mret
+
+def _other(h):
+    # The RTL treats FENCE and friends as no-ops.
+    h.pc = (h.pc + h.ilen) & MASK32
+    return h.timing and h.timing.other
+
+
+def _sll(a, b): return a << (b & 31)
+def _srl(a, b): return a >> (b & 31)
+def _sra(a, b): return signed(a) >> (b & 31)
+def _slt(a, b): return int(signed(a) < signed(b))
+def _sltu(a, b): return int(a < b)
+
+def _div(a, b):
+    a, b = signed(a), signed(b)
+    if b == 0:
+        return -1
+    q = abs(a) // abs(b)
+    return -q if (a < 0) != (b < 0) else q
+
+def _rem(a, b):
+    a, b = signed(a), signed(b)
+    if b == 0:
+        return a
+    r = abs(a) % abs(b)
+    return -r if a < 0 else r
+
+_BRANCHES = {
+    0b000: ("beq", lambda a, b: a == b),
+    0b001: ("bne", lambda a, b: a != b),
+    0b100: ("blt", lambda a, b: signed(a) < signed(b)),
+    0b101: ("bge", lambda a, b: signed(a) >= signed(b)),
+    0b110: ("bltu", lambda a, b: a < b),
+    0b111: ("bgeu", lambda a, b: a >= b),
+}
+
+_LOADS = {
+    0b000: ("lb", 1, True),
+    0b001: ("lh", 2, True),
+    0b010: ("lw", 4, False),
+    0b100: ("lbu", 1, False),
+    0b101: ("lhu", 2, False),
+}
+
+_STORES = {
+    0b000: ("sb", 1),
+    0b001: ("sh", 2),
+    0b010: ("sw", 4),
+}
+
+# funct3 -> (mnemonic, operation, cost class). funct3 values 0 and 5 are
+# further distinguished by bit 30, handled in decode.
+_ALU = {
+    0b000: ("add", lambda a, b: a + b, "alu"),
+    0b001: ("sll", _sll, "shift"),
+    0b010: ("slt", _slt, "slt"),
+    0b011: ("sltu", _sltu, "slt"),
+    0b100: ("xor", lambda a, b: a ^ b, "alu"),
+    0b101: ("srl", _srl, "shift"),
+    0b110: ("or", lambda a, b: a | b, "alu"),
+    0b111: ("and", lambda a, b: a & b, "alu"),
+}
+
+# funct3 -> (mnemonic, operation) for the M extension.
+_MULDIV = {
+    0b000: ("mul", lambda a, b: a * b),
+    0b001: ("mulh", lambda a, b: (signed(a) * signed(b)) >> 32),
+    0b010: ("mulhsu", lambda a, b: (signed(a) * b) >> 32),
+    0b011: ("mulhu", lambda a, b: (a * b) >> 32),
+    0b100: ("div", _div),
+    0b101: ("divu", lambda a, b: a // b if b else MASK32),
+    0b110: ("rem", _rem),
+    0b111: ("remu", lambda a, b: a % b if b else a),
+}
+
+
+def decode(insn, *, muldiv=False, compressed=False, interrupts=False):
+    """Decodes an instruction word into (mnemonic, handler, operands). If
+    'muldiv' is set, M extension instructions are decoded too, and if
+    'compressed' is set, so are C extension instructions, which are only the
+    bottom halfword of 'insn'. If 'interrupts' is set, so is MRET."""
+    if compressed and insn & 3 != 3:
+        expanded = expand(insn)
+        if expanded is None:
+            return ("other", _other, ())
+        name, handler, operands = decode(expanded, muldiv=muldiv,
+                                         interrupts=interrupts)
+        return ("c." + name, handler, operands)
+
+    opcode = insn & 0x7F
+    rd = (insn >> 7) & 0x1F
+    funct3 = (insn >> 12) & 7
+    rs1 = (insn >> 15) & 0x1F
+    rs2 = (insn >> 20) & 0x1F
+    imm_i = sext(insn >> 20, 12)
+    imm_s = sext(((insn >> 25) << 5) | rd, 12)
+    imm_b = sext(
+        ((insn >> 31) << 12)
+        | (((insn >> 7) & 1) << 11)
+        | (((insn >> 25) & 0x3F) << 5)
+        | (((insn >> 8) & 0xF) << 1),
+        13,
+    )
+    imm_u = insn & 0xFFFF_F000
+    imm_j = sext(
+        ((insn >> 31) << 20)
+        | (((insn >> 12) & 0xFF) << 12)
+        | (((insn >> 20) & 1) << 11)
+        | (((insn >> 21) & 0x3FF) << 1),
+        21,
+    )
+
+    if opcode == 0b0110111:
+        return ("lui", _lui, (rd, imm_u))
+    if opcode == 0b0010111:
+        return ("auipc", _auipc, (rd, imm_u))
+    if opcode == 0b1101111:
+        return ("jal", _jal, (rd, imm_j))
+    if opcode == 0b1100111:
+        return ("jalr", _jalr, (rd, rs1, imm_i))
+    if opcode == 0b1100011 and funct3 in _BRANCHES:
+        name, cond = _BRANCHES[funct3]
+        return (name, _branch, (cond, rs1, rs2, imm_b))
+    if opcode == 0b0000011 and funct3 in _LOADS:
+        name, size, sign = _LOADS[funct3]
+        return (name, _load, (size, sign, rd, rs1, imm_i))
+    if opcode == 0b0100011 and funct3 in _STORES:
+        name, size = _STORES[funct3]
+        return (name, _store, (size, rs1, rs2, imm_s))
+    # Like the RTL, we only look at the bit of funct7 that tells M extension
+    # instructions apart.
+    if opcode == 0b0110011 and muldiv and (insn >> 25) & 1:
+        name, op = _MULDIV[funct3]
+        return (name, _muldiv, (op, funct3, rd, rs1, rs2))
+    if opcode in (0b0010011, 0b0110011):
+        name, op, kind = _ALU[funct3]
+        alt = (insn >> 30) & 1
+        if funct3 == 0b101 and alt:
+            name, op = "sra", _sra
+        elif funct3 == 0b000 and alt and opcode == 0b0110011:
+            name, op = "sub", lambda a, b: a - b
+        if opcode == 0b0010011:
+            return (name + "i", _alu_imm, (op, kind, rd, rs1, imm_i))
+        return (name, _alu_reg, (op, kind, rd, rs1, rs2))
+    # Like the RTL, we only look at the one bit that tells MRET apart from the
+    # other SYSTEM instructions with funct3 0.
+    if opcode == 0b1110011 and interrupts and funct3 == 0 and (insn >> 29) & 1:
+        return ("mret", _mret, ())
+    if opcode == 0b1110011:
+        return ("system", _system, (rd, rs1, insn >> 20, funct3))
+    return ("other", _other, ())
+
+
+def _bits(value, hi, lo):
+    "Extracts bits hi..lo (inclusive) of value."
+    return (value >> lo) & ((1 << (hi - lo + 1)) - 1)
+
+def _i_type(opcode, funct3, rd, rs1, imm):
+    return ((imm & 0xFFF) << 20) | (rs1 << 15) | (funct3 << 12) | (rd << 7) \
+        | opcode
+
+def _s_type(funct3, rs1, rs2, imm):
+    return (_bits(imm, 11, 5) << 25) | (rs2 << 20) | (rs1 << 15) \
+        | (funct3 << 12) | (_bits(imm, 4, 0) << 7) | 0b0100011
+
+def _r_type(funct7, funct3, rd, rs1, rs2):
+    return (funct7 << 25) | (rs2 << 20) | (rs1 << 15) | (funct3 << 12) \
+        | (rd << 7) | 0b0110011
+
+def expand(c):
+    """Expands the compressed instruction 'c' (a halfword) into the RV32I
+    instruction it stands for, like the RTL's Expander. Returns None for
+    encodings with no RV32I equivalent."""
+    quadrant = c & 3
+    funct3 = c >> 13
+    rd = _bits(c, 11, 7)
+    rs2 = _bits(c, 6, 2)
+    rd_p = 8 + _bits(c, 4, 2)
+    rs1_p = 8 + _bits(c, 9, 7)
+    imm6 = sext((_bits(c, 12, 12) << 5) | _bits(c, 6, 2), 6)
+
+    if quadrant == 0:
+        lw_offset = (_bits(c, 5, 5) << 6) | (_bits(c, 12, 10) << 3) \
+            | (_bits(c, 6, 6) << 2)
+        if funct3 == 0b000:
+            imm = (_bits(c, 10, 7) << 6) | (_bits(c, 12, 11) << 4) \
+                | (_bits(c, 5, 5) << 3) | (_bits(c, 6, 6) << 2)
+            if imm == 0:
+                return None
+            return _i_type(0b0010011, 0, rd_p, 2, imm)
+        if funct3 == 0b010:
+            return _i_type(0b0000011, 0b010, rd_p, rs1_p, lw_offset)
+        if funct3 == 0b110:
+            return _s_type(0b010, rs1_p, rd_p, lw_offset)
+        return None
+
+    if quadrant == 1:
+        if funct3 == 0b000:
+            return _i_type(0b0010011, 0, rd, rd, imm6)
+        if funct3 in (0b001, 0b101):
+            offset = sext(
+                (_bits(c, 12, 12) << 11) | (_bits(c, 11, 11) << 4)
+                | (_bits(c, 10, 9) << 8) | (_bits(c, 8, 8) << 10)
+                | (_bits(c, 7, 7) << 6) | (_bits(c, 6, 6) << 7)
+                | (_bits(c, 5, 3) << 1) | (_bits(c, 2, 2) << 5),
+                12,
+            )
+            link = 1 if funct3 == 0b001 else 0
+            return (_bits(offset, 20, 20) << 31) | (_bits(offset, 10, 1) << 21) \
+                | (_bits(offset, 11, 11) << 20) | (_bits(offset, 19, 12) << 12) \
+                | (link << 7) | 0b1101111
+        if funct3 == 0b010:
+            return _i_type(0b0010011, 0, rd, 0, imm6)
+        if funct3 == 0b011:
+            if rd == 2:
+                imm = sext(
+                    (_bits(c, 12, 12) << 9) | (_bits(c, 6, 6) << 4)
+                    | (_bits(c, 5, 5) << 6) | (_bits(c, 4, 3) << 7)
+                    | (_bits(c, 2, 2) << 5),
+                    10,
+                )
+                if imm == 0:
+                    return None
+                return _i_type(0b0010011, 0, 2, 2, imm)
+            if imm6 == 0:
+                return None
+            return ((imm6 << 12) & MASK32) | (rd << 7) | 0b0110111
+        if funct3 == 0b100:
+            kind = _bits(c, 11, 10)
+            if kind in (0b00, 0b01):
+                if c & (1 << 12):
+                    return None
+                return _i_type(0b0010011, 0b101, rs1_p, rs1_p,
+                               (kind << 10) | rs2)
+            if kind == 0b10:
+                return _i_type(0b0010011, 0b111, rs1_p, rs1_p, imm6)
+            if c & (1 << 12):
+                return None
+            op = _bits(c, 6, 5)
+            funct3 = (0b000, 0b100, 0b110, 0b111)[op]
+            return _r_type(0b0100000 if op == 0 else 0, funct3, rs1_p,
+                           rs1_p, rd_p)
+        # C.BEQZ, C.BNEZ
+        offset = sext(
+            (_bits(c, 12, 12) << 8) | (_bits(c, 11, 10) << 3)
+            | (_bits(c, 6, 5) << 6) | (_bits(c, 4, 3) << 1)
+            | (_bits(c, 2, 2) << 5),
+            9,
+        )
+        return (_bits(offset, 12, 12) << 31) | (_bits(offset, 10, 5) << 25) \
+            | (rs1_p << 15) | ((funct3 & 1) << 12) \
+            | (_bits(offset, 4, 1) << 8) | (_bits(offset, 11, 11) << 7) \
+            | 0b1100011
+
+    if quadrant == 2:
+        if funct3 == 0b000:
+            if c & (1 << 12):
+                return None
+            return _i_type(0b0010011, 0b001, rd, rd, rs2)
+        if funct3 == 0b010:
+            if rd == 0:
+                return None
+            offset = (_bits(c, 3, 2) << 6) | (_bits(c, 12, 12) << 5) \
+                | (_bits(c, 6, 4) << 2)
+            return _i_type(0b0000011, 0b010, rd, 2, offset)
+        if funct3 == 0b100:
+            if rs2 != 0:
+                return _r_type(0, 0, rd, rd if c & (1 << 12) else 0, rs2)
+            if c & (1 << 12) and rd == 0:
+                return 0x0010_0073
+            if rd == 0:
+                return None
+            return _i_type(0b1100111, 0, c >> 12 & 1, rd, 0)
+        if funct3 == 0b110:
+            offset = (_bits(c, 8, 7) << 6) | (_bits(c, 12, 9) << 2)
+            return _s_type(0b010, 2, rs2, offset)
+    return None
@@ -0,0 +1,103 @@
+from amaranth import *
+from amaranth.lib.wiring import *
+
+from hapenny.cpu import Cpu
+from hapenny.bus import SimpleFabric, BusArbiter, partial_decode
+from hapenny.mem import BasicMemory
+from hapenny.mailbox import Mailbox
+
+class MultiCore(Elaboratable):
+    """Several hapenny CPUs sharing memory and peripherals.
+
+    Each core has a private scratchpad of block RAM at address 0, for its
+    code, stack and whatever else it uses a lot, which it can get at without
+    waiting for the others. Above that, every core sees the same shared
+    region: the shared devices given (say, a SpramMemory for bulk data and a
+    UART) followed by a Mailbox, in that order. The cores take turns at it
+    through a BusArbiter, one command per cycle, waiting if another core got
+    there first.
+
+    Every scratchpad starts out with the same image, and every core starts at
+    address 0; they tell themselves apart by reading the Mailbox's ID
+    register.
+
+    Parameters
+    ----------
+    cores (int): number of CPUs, 1-16.
+    shared (list of port): bus ports of the shared devices, like
+        SimpleFabric's devices. The caller adds the devices themselves to its
+        own module.
+    image (list of int): halfwords to load into every scratchpad.
+    scratchpad_words (int): size of each scratchpad in halfwords, a power of
+        two. Default 1024 (2 kiB, or four iCE40 block RAMs).
+    locks (int): number of locks in the Mailbox. Default 8.
+    cpu_args (dict): other Cpu parameters for every core, e.g. counters or
+        muldiv. Every core gets wait_states, since it has to be able to wait
+        its turn.
+
+    Attributes
+    ----------
+    cpus (list of Cpu): the cores.
+    scratchpads (list of BasicMemory): their scratchpads.
+    mailbox (Mailbox): the mailbox.
+    arbiter (BusArbiter): the arbiter in front of the shared region.
+    shared_base (int): byte address of the shared region.
+    addresses (list of int): byte addresses of the shared devices, in the
+        order they were given, then the mailbox's.
+    """
+    def __init__(self, *, cores, shared, image, scratchpad_words = 1024,
+                 locks = 8, cpu_args = {}):
+        assert scratchpad_words & (scratchpad_words - 1) == 0, \
+                "scratchpad_words must be a power of two"
+        self.cores = cores
+
+        self.mailbox = Mailbox(cores, locks = locks)
+        self.fabric = SimpleFabric(list(shared) + [self.mailbox.bus])
+        self.arbiter = BusArbiter(self.fabric.bus, cores)
+        self.scratchpads = [
+            BasicMemory(depth = scratchpad_words, contents = image)
+            for _ in range(cores)
+        ]
+
+        # Each core's own fabric puts its scratchpad in the bottom half of
+        # its address space and the shared region in the top half, so both
+        # halves are the size of the bigger one. (+1 for the fabric's
+        # select bit, and +1 again to go from halfword to byte addresses.)
+        shared_bits = self.fabric.bus.cmd.payload.addr.shape().width
+        self.half_bits = max(shared_bits,
+                             self.scratchpads[0].addr_bits)
+        self.shared_base = 2 << self.half_bits
+        self.addresses = [
+            self.shared_base + (i << (self.fabric.addr_bits + 1))
+            for i in range(len(self.fabric.devices))
+        ]
+
+        self.cpus = [
+            Cpu(
+                reset_vector = 0,
+                addr_width = self.half_bits + 1 + 1,
+                **cpu_args,
+                wait_states = True,
+            )
+            for _ in range(cores)
+        ]
+
+    def elaborate(self, platform):
+        m = Module()
+
+        m.submodules.mailbox = self.mailbox
+        m.submodules.fabric = self.fabric
+        m.submodules.arbiter = arbiter = self.arbiter
+        m.d.comb += self.mailbox.requester.eq(arbiter.grant)
+
+        for (n, (cpu, scratchpad)) in enumerate(zip(self.cpus,
+                                                    self.scratchpads)):
+            m.submodules[f"cpu{n}"] = cpu
+            m.submodules[f"scratchpad{n}"] = scratchpad
+            m.submodules[f"fabric{n}"] = fabric = SimpleFabric([
+                partial_decode(m, scratchpad.bus, self.half_bits),
+                partial_decode(m, arbiter.buses[n], self.half_bits),
+            ])
+            connect(m, cpu.bus, fabric.bus)
+
+        return m
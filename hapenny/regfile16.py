@@ -13,47 +13,101 @@ def RegWrite(addrbits = 5):
     })
 
 class RegFile16(Component):
+    """A register file of 16-bit halves, with one write port and one or two
+    read ports, each of which answers on the cycle after it's asked.
+
+    Block RAMs on our FPGAs have only one read port, so a second read port
+    costs a second copy of the registers: both copies take every write, and
+    each port reads its own.
+
+    Parameters
+    ----------
+    banks (int): number of sets of 32 registers. Default 1.
+    read_ports (int): 1 or 2. Default 1.
+
+    Attributes
+    ----------
+    read_cmd (in): register half to read.
+    read_resp (out): value read by read_cmd.
+    read_cmd_b, read_resp_b: the same again for the second read port, if
+        read_ports is 2.
+    write_cmd (in): register half to write, and the value.
+    """
     read_resp: Out(16)
 
     def __init__(self, *, 
-                 banks = 1):
+                 banks = 1,
+                 read_ports = 1):
         super().__init__()
+        assert read_ports in (1, 2), "only one or two read ports, please"
 
         self.banks = banks
+        self.read_ports = read_ports
 
         # 5 bits for x0..x31, 1 bit for top vs bottom half, then bank bits
         select_bits = 5 + 1 + (banks - 1).bit_length()
 
         self.read_cmd = AlwaysReady(select_bits).flip().create()
         self.write_cmd = AlwaysReady(RegWrite(select_bits)).flip().create()
+        if read_ports == 2:
+            self.read_cmd_b = AlwaysReady(select_bits).flip().create()
+            self.read_resp_b = Signal(16)
+
+    # Simulation backdoor. These bypass the ports and poke at the memory
+    # directly, taking no clock cycles, so they're only usable from a
+    # simulator process (via 'yield from') after elaboration. Note that they
+    # don't know about x0; writing it is on you.
+
+    def poke(self, reg, value, *, bank = 0):
+        "Sets both halves of register 'reg' to 'value'."
+        base = bank * 64
+        for mem in self.mems:
+            yield mem[base + reg].eq(value & 0xFFFF)
+            yield mem[base + reg + 32].eq((value >> 16) & 0xFFFF)
+
+    def peek(self, reg, *, bank = 0):
+        "Reads both halves of register 'reg'."
+        base = bank * 64
+        bottom = yield self.mem[base + reg]
+        top = yield self.mem[base + reg + 32]
+        return bottom | (top << 16)
 
     def elaborate(self, platform):
         m = Module()
 
         nregs = 32 * self.banks
 
-        m.submodules.mem = mem = Memory(
-            width = 16,
-            depth = 2 * nregs,
-            name = "regfile",
-            attrs = {
-                'ram_style': 'block',
-            },
-        )
-
-        rp = mem.read_port(transparent = False)
-        wp = mem.write_port()
-
-        m.d.comb += [
-            rp.addr.eq(self.read_cmd.payload),
-            rp.en.eq(self.read_cmd.valid),
-
-            self.read_resp.eq(rp.data),
-
-            wp.addr.eq(self.write_cmd.payload.reg),
-            wp.data.eq(self.write_cmd.payload.value),
-            # Block writes to both halves of x0 in all banks.
-            wp.en.eq((self.write_cmd.payload.reg[:5] != 0) & self.write_cmd.valid),
-        ]
+        ports = [(self.read_cmd, self.read_resp)]
+        if self.read_ports == 2:
+            ports.append((self.read_cmd_b, self.read_resp_b))
+
+        self.mems = []
+        for i, (read_cmd, read_resp) in enumerate(ports):
+            mem = Memory(
+                width = 16,
+                depth = 2 * nregs,
+                name = "regfile" if i == 0 else "regfile_b",
+                attrs = {
+                    'ram_style': 'block',
+                },
+            )
+            m.submodules["mem" if i == 0 else "mem_b"] = mem
+            self.mems.append(mem)
+
+            rp = mem.read_port(transparent = False)
+            wp = mem.write_port()
+
+            m.d.comb += [
+                rp.addr.eq(read_cmd.payload),
+                rp.en.eq(read_cmd.valid),
+
+                read_resp.eq(rp.data),
+
+                wp.addr.eq(self.write_cmd.payload.reg),
+                wp.data.eq(self.write_cmd.payload.value),
+                # Block writes to both halves of x0 in all banks.
+                wp.en.eq((self.write_cmd.payload.reg[:5] != 0) & self.write_cmd.valid),
+            ]
+        self.mem = self.mems[0]
 
         return m
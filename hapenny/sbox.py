@@ -27,7 +27,8 @@ class SBox(Component):
     ----------
     from_the_top (input): restarts the count for the next instruction.
     hold (input): input from EW-box to keep doing this same state. Only safe for
-        use after state 3 to avoid weird side effects.
+        use once the FD-Box has finished fetching (after state 3, or after
+        state 2 if it fetches early) to avoid weird side effects.
     halt_request (input): when high, redirects the next from_the_top assertion
         to go to the halted state instead.
     not_a_bubble (input): indicates that the CPU is doing useful work and not
@@ -0,0 +1,195 @@
+# Triggered, windowed waveform capture for test benches.
+#
+# Dumping every signal for a whole simulation with write_vcd is slow and makes
+# enormous files, and usually we only care about a few hundred cycles around
+# whatever went wrong. WindowedCapture instead samples a chosen set of signals
+# into a ring buffer every cycle and only keeps the samples when a trigger
+# fires -- at which point the buffer (the lead-up) is kept, followed by
+# everything until the trigger goes away again plus a few cycles of
+# aftermath. The result is written as a VCD with one window per trigger.
+#
+# None of this costs anything unless a capture is actually set up.
+
+from collections import deque
+
+import logging
+
+log = logging.getLogger(__name__)
+
+
+class Trigger:
+    """Conditions that open a capture window. Any one of them being true
+    triggers; leaving all of them at their defaults never triggers.
+
+    Parameters
+    ----------
+    pcs (collection of int): retire-time PCs (RVFI pc_rdata) to trigger on.
+    orders (range): RVFI order numbers to trigger on.
+    tests (list of str): trigger for the whole of any test case whose name
+        contains one of these strings.
+    cycles (range): simulation cycles to trigger on.
+    """
+
+    def __init__(self, *, pcs = (), orders = None, tests = (), cycles = None):
+        self.pcs = set(pcs)
+        self.orders = orders
+        self.tests = list(tests)
+        self.cycles = cycles
+
+    @property
+    def uses_rvfi(self):
+        return bool(self.pcs) or self.orders is not None
+
+    def __bool__(self):
+        return self.uses_rvfi or bool(self.tests) or self.cycles is not None
+
+
+class WindowedCapture:
+    """Samples signals every cycle and keeps only the windows around triggers.
+
+    Parameters
+    ----------
+    signals (list): Signals to capture, or (name, Signal) pairs to override
+        the name shown in the waveform viewer.
+    trigger (Trigger): when to capture.
+    depth (int): number of cycles of lead-up to keep before a trigger.
+    post (int): number of cycles to keep after a trigger goes away. Defaults
+        to 'depth'.
+    rvfi: the Cpu's RVFI port, required for PC and order triggers.
+    test_name (callable): returns the name of the test case currently
+        running, for test name triggers.
+
+    Attributes
+    ----------
+    windows (list): captured windows, each a list of (cycle, values) pairs.
+    """
+
+    def __init__(self, signals, *, trigger, depth = 64, post = None,
+                 rvfi = None, test_name = lambda: None):
+        if trigger.uses_rvfi and rvfi is None:
+            raise ValueError("PC and order triggers need an RVFI port")
+
+        self.names = []
+        self.signals = []
+        seen = {}
+        for entry in signals:
+            if isinstance(entry, tuple):
+                name, signal = entry
+            else:
+                name, signal = entry.name, entry
+            # VCD variables in a scope need distinct names.
+            count = seen.get(name, 0)
+            seen[name] = count + 1
+            if count:
+                name = f"{name}${count}"
+            self.names.append(name)
+            self.signals.append(signal)
+
+        self.trigger = trigger
+        self.depth = depth
+        self.post = depth if post is None else post
+        self.rvfi = rvfi
+        self.test_name = test_name
+
+        self.windows = []
+        self._buffer = deque(maxlen = depth)
+        self._window = None
+        self._remaining = 0
+        self._forced = False
+        self.cycle = 0
+
+    def fire(self):
+        """Triggers a capture from outside, e.g. when a test bench notices a
+        failure. Keeps the lead-up buffer and 'post' cycles after."""
+        self._forced = True
+
+    def snapshot(self):
+        """Keeps whatever is in the lead-up buffer as a window right away,
+        for when the simulation has stopped and 'fire' would never be seen."""
+        if self._window is None and self._buffer:
+            self.windows.append(list(self._buffer))
+            self._buffer.clear()
+
+    def _triggered(self):
+        t = self.trigger
+        if self._forced:
+            self._forced = False
+            return True
+        if t.cycles is not None and self.cycle in t.cycles:
+            return True
+        if t.tests:
+            name = self.test_name()
+            if name is not None and any(s in name for s in t.tests):
+                return True
+        if t.uses_rvfi and (yield self.rvfi.valid):
+            if (yield self.rvfi.payload.pc_rdata) in t.pcs:
+                return True
+            if t.orders is not None \
+                    and (yield self.rvfi.payload.order) in t.orders:
+                return True
+        return False
+
+    def process(self, *, running = lambda: True):
+        """Builds a sync process that does the sampling until 'running()'
+        returns False."""
+        def process():
+            while running():
+                yield
+                self.cycle += 1
+                values = []
+                for signal in self.signals:
+                    values.append((yield signal))
+                sample = (self.cycle, values)
+
+                if (yield from self._triggered()):
+                    self._remaining = self.post
+                    if self._window is None:
+                        log.debug("capture triggered at cycle %d", self.cycle)
+                        self._window = list(self._buffer)
+                        self._buffer.clear()
+                        self.windows.append(self._window)
+                    self._window.append(sample)
+                elif self._window is not None and self._remaining > 0:
+                    self._remaining -= 1
+                    self._window.append(sample)
+                else:
+                    self._window = None
+                    self._buffer.append(sample)
+        return process
+
+    def write_vcd(self, path, *, timescale = "1 us", scope = "top"):
+        """Writes the captured windows to 'path'. Time is in cycles, and the
+        'capture' variable is high inside windows. Returns the number of
+        windows written; if there are none, no file is created."""
+        if not self.windows:
+            return 0
+
+        from vcd import VCDWriter
+
+        with open(path, "w") as f:
+            with VCDWriter(f, timescale = timescale) as writer:
+                marker = writer.register_var(scope, "capture", "wire", size = 1)
+                variables = [
+                    writer.register_var(scope, name, "wire", size = len(signal))
+                    for name, signal in zip(self.names, self.signals)
+                ]
+                for window in self.windows:
+                    writer.change(marker, window[0][0], 1)
+                    for cycle, values in window:
+                        for var, value in zip(variables, values):
+                            writer.change(var, cycle, value)
+                    writer.change(marker, window[-1][0] + 1, 0)
+        return len(self.windows)
+
+
+def parse_range(text):
+    """Parses a command line range: "N" for just N, "A:B" for A up to but not
+    including B, "A:" for A onwards. Numbers can be in any base Python
+    understands."""
+    if ":" not in text:
+        start = int(text, 0)
+        return range(start, start + 1)
+    start, end = text.split(":", 1)
+    start = int(start, 0) if start else 0
+    end = int(end, 0) if end else 1 << 64
+    return range(start, end)
@@ -17,6 +17,7 @@ from amaranth_boards.icestick import ICEStickPlatform
 import amaranth.lib.cdc
 
 from hapenny import StreamSig
+import hapenny.build
 import hapenny.chonk.cpu
 from hapenny.bus import BusPort, SimpleFabric, partial_decode
 from hapenny.chonk.gpio32 import OutputPort32
@@ -36,7 +37,20 @@ RAM_ADDR_BITS = (RAM_WORDS - 1).bit_length()
 BUS_ADDR_BITS = RAM_ADDR_BITS + 1
 print(f"BUS_ADDR_BITS = {BUS_ADDR_BITS}")
 
+# Used by sweep.py to build this design for the right board.
+PLATFORM = ICEStickPlatform
+
 class Test(Elaboratable):
+    """The SoC, with knobs for sweep.py.
+
+    Parameters
+    ----------
+    shift_bits_per_cycle: how many bits the CPU's shifter moves per cycle (1,
+        2, 4, 8 or 16); more is faster but bigger.
+    """
+    def __init__(self, shift_bits_per_cycle = 1):
+        self.shift_bits_per_cycle = shift_bits_per_cycle
+
     def elaborate(self, platform):
         m = Module()
 
@@ -48,14 +62,14 @@ class Test(Elaboratable):
         # least six years.
         #
         # So, we're going to reconstruct it manually.
-        clk12 = platform.request("clk12", dir = "-")
+        clk12 = platform.request("clk12", dir = "i")
 
         # 15us delay, 12 MHz clock: 180 cycles
         por_delay = int(15e-6 * 12e6)
         m.domains += ClockDomain("por", reset_less=True, local=True)
         por_timer = Signal(range(por_delay))
         por_ready = Signal()
-        m.d.comb += ClockSignal("por").eq(clk12.io)
+        m.d.comb += ClockSignal("por").eq(clk12.i)
         with m.If(por_timer == por_delay):
             m.d.por += por_ready.eq(1)
         with m.Else():
@@ -80,7 +94,7 @@ class Test(Elaboratable):
             p_DIVQ = pll_q,
             p_FILTER_RANGE = filter_range,
 
-            i_REFERENCECLK = clk12.io,
+            i_REFERENCECLK = clk12.i,
             i_RESETB = 1,
             o_PLLOUTGLOBAL = cd_sync.clk,
         )
@@ -95,6 +109,7 @@ class Test(Elaboratable):
             # (+2 because, again, our RAM is word addressed but this parameter
             # is in bytes.)
             prog_addr_width = RAM_ADDR_BITS + 2,
+            shift_bits_per_cycle = self.shift_bits_per_cycle,
         )
         m.submodules.mem = mem = BasicMemory(depth = RAM_WORDS,
                                              contents = boot_image)
@@ -113,11 +128,36 @@ class Test(Elaboratable):
 
         return m
 
-parser = argparse.ArgumentParser(
-    prog = "icestick-smallestbig",
-    description = "Script for synthesizing smallest image for HX1K",
-)
-args = parser.parse_args()
-
-p = ICEStickPlatform()
-p.build(Test(), do_program = True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "icestick-smallestbig",
+        description = "Script for synthesizing smallest image for HX1K",
+    )
+    parser.add_argument('--seeds', type = int,
+                        help = 'try this many nextpnr seeds, keep the fastest')
+    parser.add_argument('-j', '--jobs', type = int,
+                        help = 'number of seeds to place at once')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'rebuild from scratch instead of reusing '
+                               'results from build/cache')
+    parser.add_argument('--firmware-only', action = 'store_true',
+                        help = 'just put new memory contents into the last '
+                               'build\'s bitstream, skipping synthesis and '
+                               'place and route')
+    args = parser.parse_args()
+
+    p = ICEStickPlatform()
+    if args.firmware_only:
+        report = hapenny.build.update_memories(p, Test(), build_dir = "build",
+                                               do_program = True)
+    else:
+        report = hapenny.build.build(
+            p, Test(),
+            build_dir = "build",
+            seeds = args.seeds,
+            jobs = args.jobs,
+            cache = None if args.no_cache else "build/cache",
+            do_program = True,
+        )
+    if report.seeds is not None:
+        print(hapenny.build.seed_summary(report))
@@ -23,6 +23,7 @@ from amaranth_boards.icestick import ICEStickPlatform
 import amaranth.lib.cdc
 
 from hapenny import StreamSig
+import hapenny.build
 import hapenny.cpu
 from hapenny.bus import BusPort, SimpleFabric, partial_decode
 from hapenny.gpio import OutputPort
@@ -45,12 +46,63 @@ if problems:
 
 # the blinky program does not use RAM at all, so we can fit it in a single block RAM.
 RAM_WORDS = 256 * 1
-RAM_ADDR_BITS = (RAM_WORDS - 1).bit_length()
 
-# Add an extra bit to the implemented bus so we can also address I/O.
-BUS_ADDR_BITS = RAM_ADDR_BITS + 1
+# Used by sweep.py to build this design for the right board.
+PLATFORM = ICEStickPlatform
 
 class Test(Elaboratable):
+    """The SoC, with knobs for sweep.py.
+
+    Parameters
+    ----------
+    ram_words: size of the program RAM in halfwords (a power of two). The bus
+        and PC are sized to fit it.
+    narrow_pc: if True (the default), only implement enough PC bits to address
+        the program RAM; if False, the PC is as wide as the bus.
+    counters: include the CPU's cycle and instret counters.
+    shift_bits_per_cycle: how many bits the CPU's shifter moves per cycle (1,
+        2, 4, 8 or 16); more is faster but bigger.
+    early_jal: have the CPU redirect fetch for JAL early, saving four cycles
+        per JAL.
+    predict_branches: have the CPU predict backward branches taken.
+    rf_read_ports: give the CPU's register file a second read port (and a
+        second block RAM), saving a cycle on most instructions.
+    skip_rs2_reads: have the CPU save a cycle on instructions that don't
+        need rs2 early, without a second read port.
+    muldiv: give the CPU the M extension.
+    multiplier: which multiplier the M extension uses, "serial" (the default)
+        or "lut". The HX1K has no DSPs.
+    compressed: give the CPU the C extension.
+    interrupts: give the CPU this many interrupt lines, wired to the UART's RX
+        pin so that they don't optimize away. (The boot program never enables
+        them, but synthesis can't tell that.)
+    banked_interrupts: give interrupt handlers their own register bank.
+    harts: give the CPU this many barrel-threaded harts. They all run the
+        boot program, which doesn't look at mhartid, so they all toggle the
+        LED; that's fine for measuring size.
+    """
+    def __init__(self, ram_words = RAM_WORDS, narrow_pc = True,
+                 counters = False, shift_bits_per_cycle = 1,
+                 early_jal = False, predict_branches = False,
+                 rf_read_ports = 1, skip_rs2_reads = False,
+                 muldiv = False, multiplier = "serial",
+                 compressed = False, interrupts = 0,
+                 banked_interrupts = False, harts = 1):
+        self.ram_words = ram_words
+        self.narrow_pc = narrow_pc
+        self.counters = counters
+        self.shift_bits_per_cycle = shift_bits_per_cycle
+        self.early_jal = early_jal
+        self.predict_branches = predict_branches
+        self.rf_read_ports = rf_read_ports
+        self.skip_rs2_reads = skip_rs2_reads
+        self.muldiv = muldiv
+        self.multiplier = multiplier
+        self.compressed = compressed
+        self.interrupts = interrupts
+        self.banked_interrupts = banked_interrupts
+        self.harts = harts
+
     def elaborate(self, platform):
         m = Module()
 
@@ -62,14 +114,14 @@ class Test(Elaboratable):
         # least six years.
         #
         # So, we're going to reconstruct it manually.
-        clk12 = platform.request("clk12", dir = "-")
+        clk12 = platform.request("clk12", dir = "i")
 
         # 15us delay, 12 MHz clock: 180 cycles
         por_delay = int(20e-6 * 12e6)
         m.domains += ClockDomain("por", reset_less=True, local=True)
         por_timer = Signal(range(por_delay))
         por_ready = Signal()
-        m.d.comb += ClockSignal("por").eq(clk12.io)
+        m.d.comb += ClockSignal("por").eq(clk12.i)
         with m.If(por_timer == por_delay):
             m.d.por += por_ready.eq(1)
         with m.Else():
@@ -94,44 +146,90 @@ class Test(Elaboratable):
             p_DIVQ = pll_q,
             p_FILTER_RANGE = 1,
 
-            i_REFERENCECLK = clk12.io,
+            i_REFERENCECLK = clk12.i,
             i_RESETB = 1,
             o_PLLOUTGLOBAL = cd_sync.clk,
         )
 
         # Ok, back to the design.
+        ram_addr_bits = (self.ram_words - 1).bit_length()
+        # Add an extra bit to the implemented bus so we can also address I/O.
+        bus_addr_bits = ram_addr_bits + 1
+
         m.submodules.cpu = cpu = hapenny.cpu.Cpu(
             # +1 to adjust from bus halfword addressing to CPU byte
             # addressing.
-            addr_width = BUS_ADDR_BITS + 1,
+            addr_width = bus_addr_bits + 1,
             # Program addresses only need to be able to address program
             # memory, so configure the PC and fetch port to be narrower.
             # (+1 because, again, our RAM is halfword addressed but this
             # parameter is in bytes.)
-            prog_addr_width = RAM_ADDR_BITS + 1,
+            prog_addr_width = (ram_addr_bits + 1 if self.narrow_pc
+                               else bus_addr_bits + 1),
+            counters = self.counters,
+            shift_bits_per_cycle = self.shift_bits_per_cycle,
+            early_jal = self.early_jal,
+            predict_branches = self.predict_branches,
+            rf_read_ports = self.rf_read_ports,
+            skip_rs2_reads = self.skip_rs2_reads,
+            muldiv = self.muldiv,
+            multiplier = self.multiplier,
+            compressed = self.compressed,
+            interrupts = self.interrupts,
+            banked_interrupts = self.banked_interrupts,
+            harts = self.harts,
         )
-        m.submodules.mem = mem = BasicMemory(depth = RAM_WORDS,
+        m.submodules.mem = mem = BasicMemory(depth = self.ram_words,
                                              contents = boot_image)
         # Make the simplest output port possible.
         m.submodules.outport = outport = OutputPort(1, read_back = False)
         m.submodules.fabric = fabric = SimpleFabric([
             mem.bus,
-            partial_decode(m, outport.bus, RAM_ADDR_BITS),
+            partial_decode(m, outport.bus, ram_addr_bits),
         ])
 
         connect(m, cpu.bus, fabric.bus)
 
+        if self.interrupts:
+            rx = platform.request("uart", 0).rx
+            m.d.comb += cpu.irq.eq(rx.i.replicate(self.interrupts))
+
         for i in range(1):
             led = platform.request("led", i)
             m.d.comb += led.o.eq(outport.pins[i])
 
         return m
 
-parser = argparse.ArgumentParser(
-    prog = "icestick-smallest",
-    description = "Script for synthesizing smallest image for HX1K",
-)
-args = parser.parse_args()
-
-p = ICEStickPlatform()
-p.build(Test(), do_program = True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "icestick-smallest",
+        description = "Script for synthesizing smallest image for HX1K",
+    )
+    parser.add_argument('--seeds', type = int,
+                        help = 'try this many nextpnr seeds, keep the fastest')
+    parser.add_argument('-j', '--jobs', type = int,
+                        help = 'number of seeds to place at once')
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'rebuild from scratch instead of reusing '
+                               'results from build/cache')
+    parser.add_argument('--firmware-only', action = 'store_true',
+                        help = 'just put new memory contents into the last '
+                               'build\'s bitstream, skipping synthesis and '
+                               'place and route')
+    args = parser.parse_args()
+
+    p = ICEStickPlatform()
+    if args.firmware_only:
+        report = hapenny.build.update_memories(p, Test(), build_dir = "build",
+                                               do_program = True)
+    else:
+        report = hapenny.build.build(
+            p, Test(),
+            build_dir = "build",
+            seeds = args.seeds,
+            jobs = args.jobs,
+            cache = None if args.no_cache else "build/cache",
+            do_program = True,
+        )
+    if report.seeds is not None:
+        print(hapenny.build.seed_summary(report))
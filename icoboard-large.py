@@ -11,6 +11,7 @@ from amaranth.build import ResourceError, Resource, Pins, Attrs
 from boards.icoboard import IcoboardPlatform
 
 from hapenny import StreamSig
+import hapenny.build
 from hapenny.cpu import Cpu
 from hapenny.bus import BusPort, SimpleFabric, partial_decode
 from hapenny.gpio import OutputPort, InputPort
@@ -27,6 +28,9 @@ boot_image = struct.unpack("<" + "H" * (len(bootloader) // 2), bootloader)
 assert len(boot_image) <= BOOT_ROM_WORDS, \
         f"bootloader is {len(boot(image))} words long, too big for boot ROM"
 
+# Used by sweep.py to build this design for the right board.
+PLATFORM = IcoboardPlatform
+
 class Test(Elaboratable):
     def elaborate(self, platform):
         m = Module()
@@ -42,14 +46,14 @@ class Test(Elaboratable):
         # least six years.
         #
         # So, we're going to reconstruct it manually.
-        clk100 = platform.request("clk100", dir = "-")
+        clk100 = platform.request("clk100", dir = "i")
 
         # 15us delay, 100 MHz clock: 1500 cycles
         por_delay = int(15e-6 * 100e6)
         m.domains += ClockDomain("por", reset_less=True, local=True)
         por_timer = Signal(range(por_delay))
         por_ready = Signal()
-        m.d.comb += ClockSignal("por").eq(clk100.io)
+        m.d.comb += ClockSignal("por").eq(clk100.i)
         with m.If(por_timer == por_delay):
             m.d.por += por_ready.eq(1)
         with m.Else():
@@ -82,7 +86,7 @@ class Test(Elaboratable):
             p_DIVQ = pll_q,
             p_FILTER_RANGE = filter_range,
 
-            i_REFERENCECLK = clk100.io,
+            i_REFERENCECLK = clk100.i,
             i_RESETB = 1,
             o_PLLOUTGLOBALA = cd_sync.clk,
             o_PLLOUTCOREB = clk_90,
@@ -184,5 +188,25 @@ class Test(Elaboratable):
 
         return m
 
-p = IcoboardPlatform()
-p.build(Test(), do_program = True)
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "icoboard-large",
+        description = "Script for synthesizing an Icoboard SoC using external SRAM",
+    )
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'rebuild from scratch instead of reusing '
+                               'results from build/cache')
+    parser.add_argument('--firmware-only', action = 'store_true',
+                        help = 'just put new memory contents into the last '
+                               'build\'s bitstream, skipping synthesis and '
+                               'place and route')
+    args = parser.parse_args()
+
+    p = IcoboardPlatform()
+    if args.firmware_only:
+        hapenny.build.update_memories(p, Test(), build_dir = "build",
+                                      do_program = True)
+    else:
+        hapenny.build.build(p, Test(), build_dir = "build",
+                            cache = None if args.no_cache else "build/cache",
+                            do_program = True)
@@ -0,0 +1,116 @@
+import argparse
+import sys
+
+from hapenny.model import Bus, Hart, Ram, Uart, HAPENNY, CHONK, ModelError
+
+# Runs a firmware image on the Python model of the CPU and reports the
+# estimated cycle count. The default memory map matches upduino-large.py and
+# the Dhrystone Makefile (RAM at 0, UART at 0x18000, stack at 0x8000).
+
+# The model stops when the firmware returns to this address, which we load
+# into ra before starting -- so a program that ends by returning from its
+# entry point (like dhrystone/start.S) exits cleanly.
+EXIT_ADDRESS = 0xFFFF_FFF0
+
+parser = argparse.ArgumentParser(
+    prog = "run-model",
+    description = "Run a binary on the Python model of hapenny",
+)
+parser.add_argument('image', help = 'raw binary to load')
+parser.add_argument('--core', choices = ['hapenny', 'chonk'],
+                    default = 'hapenny',
+                    help = 'which core\'s cycle timings to use')
+parser.add_argument('--shift-bits', type = int, choices = [1, 2, 4, 8, 16],
+                    default = 1,
+                    help = 'bits the core\'s shifter moves per cycle')
+parser.add_argument('--early-jal', action = 'store_true',
+                    help = 'assume the FD-Box redirects fetch for JAL')
+parser.add_argument('--predict-branches', action = 'store_true',
+                    help = 'assume the FD-Box predicts backward branches '
+                           'taken')
+parser.add_argument('--rf-read-ports', type = int, choices = [1, 2],
+                    default = 1,
+                    help = 'assume a register file with this many read ports')
+parser.add_argument('--skip-rs2-reads', action = 'store_true',
+                    help = 'assume the CPU skips rs2 reads where it can')
+parser.add_argument('--muldiv', action = 'store_true',
+                    help = 'implement the M extension, like a CPU built '
+                           'with muldiv')
+parser.add_argument('--multiplier', choices = ['serial', 'lut', 'dsp'],
+                    default = 'serial',
+                    help = 'which multiplier the M-Box uses')
+parser.add_argument('--compressed', action = 'store_true',
+                    help = 'implement the C extension, like a CPU built '
+                           'with compressed')
+parser.add_argument('--harts', type = int, default = 1,
+                    help = 'assume a core with this many barrel-threaded '
+                           'harts, and count the cycles it spends on hart 0')
+parser.add_argument('--load-addr', type = lambda s: int(s, 0), default = 0,
+                    help = 'address to load the image at')
+parser.add_argument('--reset-vector', type = lambda s: int(s, 0),
+                    help = 'address to start at (default: load address)')
+parser.add_argument('--ram-size', type = lambda s: int(s, 0),
+                    default = 0x10000,
+                    help = 'bytes of RAM mapped at address 0')
+parser.add_argument('--uart-addr', type = lambda s: int(s, 0),
+                    default = 0x18000,
+                    help = 'address of the UART')
+parser.add_argument('--addr-width', type = int, default = 32,
+                    help = 'number of address bits driven by the CPU')
+parser.add_argument('--max-insns', type = int, default = 100_000_000,
+                    help = 'give up after this many instructions')
+parser.add_argument('--histogram', action = 'store_true',
+                    help = 'print instruction counts by mnemonic')
+args = parser.parse_args()
+
+bus = Bus(addr_width = args.addr_width)
+ram = bus.add(0, args.ram_size, Ram(args.ram_size))
+with open(args.image, 'rb') as f:
+    ram.load_image(f.read(), args.load_addr)
+uart = bus.add(args.uart_addr, 4, Uart(
+    on_tx = lambda c: sys.stdout.write(chr(c)),
+))
+
+try:
+    timing = (HAPENNY if args.core == 'hapenny' else CHONK).configure(
+        shift_bits_per_cycle = args.shift_bits,
+        early_jal = args.early_jal,
+        predict_branches = args.predict_branches,
+        rf_read_ports = args.rf_read_ports,
+        skip_rs2_reads = args.skip_rs2_reads,
+        muldiv = args.muldiv,
+        multiplier = args.multiplier,
+        compressed = args.compressed,
+        harts = args.harts,
+    )
+except ValueError as e:
+    parser.error(str(e))
+
+hart = Hart(
+    bus,
+    reset_vector = args.load_addr if args.reset_vector is None
+        else args.reset_vector,
+    timing = timing,
+    muldiv = args.muldiv,
+    compressed = args.compressed,
+    hartid = 0 if args.harts > 1 else None,
+)
+hart.x[1] = EXIT_ADDRESS
+
+try:
+    hart.run(max_instructions = args.max_insns, until_pc = EXIT_ADDRESS)
+except ModelError as e:
+    print(f"\nstopped at PC {hart.pc:08x}: {e}")
+sys.stdout.flush()
+
+print()
+if hart.pc != EXIT_ADDRESS:
+    print(f"did not exit after {hart.instret} instructions")
+print(f"instructions: {hart.instret}")
+print(f"cycles ({hart.timing.name}): {hart.cycles}")
+print(f"CPI: {hart.cpi():.3f}")
+
+if args.histogram:
+    total = hart.instret
+    for name, count in sorted(hart.histogram.items(), key = lambda i: -i[1]):
+        print(f"{name:8} {count:10} {100 * count / total:6.2f}%")
@@ -1,4 +1,7 @@
 import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from amaranth import *
 from amaranth.sim import Simulator, Delay, Settle
@@ -10,6 +13,8 @@ from hapenny.chonk.cpu import Cpu
 from hapenny.bus import BusPort, partial_decode, SimpleFabric
 from hapenny import *
 from hapenny.chonk.mem32 import BasicMemory
+from hapenny.trace import Trigger, WindowedCapture, parse_range
+import hapenny.bench
 
 class TestPhase(Enum):
     INIT = 0
@@ -81,6 +86,10 @@ def single_step():
     return (yield cycle_counter) - 2 - start
 
 def write_reg(reg, value):
+    if not args.frontdoor:
+        # Backdoor straight into the register file; takes no cycles.
+        yield from uut.rf.poke(reg, value)
+        return
     yield uut.debug.reg_write.payload.reg.eq(reg)
     yield uut.debug.reg_write.payload.value.eq(value)
     yield uut.debug.reg_write.valid.eq(1)
@@ -88,6 +97,8 @@ def write_reg(reg, value):
     yield uut.debug.reg_write.valid.eq(0)
 
 def read_reg(reg):
+    if not args.frontdoor:
+        return (yield from uut.rf.peek(reg))
     yield uut.debug.reg_read.payload.eq(reg)
     yield uut.debug.reg_read.valid.eq(1)
     yield
@@ -106,6 +117,9 @@ def read_pc():
     return (yield uut.debug.pc)
 
 def write_mem(addr, value):
+    if not args.frontdoor:
+        yield from mem.poke(addr >> 2, value)
+        return
     yield mem.inspect.cmd.payload.addr.eq(addr)
     yield mem.inspect.cmd.payload.data.eq(value)
     yield mem.inspect.cmd.payload.lanes.eq(0b1111)
@@ -115,6 +129,8 @@ def write_mem(addr, value):
     yield mem.inspect.cmd.valid.eq(0)
 
 def read_mem(addr):
+    if not args.frontdoor:
+        return (yield from mem.peek(addr >> 2))
     yield mem.inspect.cmd.payload.addr.eq(addr)
     yield mem.inspect.cmd.payload.lanes.eq(0)
     yield mem.inspect.cmd.valid.eq(1)
@@ -123,13 +139,46 @@ def read_mem(addr):
     yield Settle()
     return (yield mem.inspect.resp)
 
-def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
-    if args.filter is not None and args.filter not in name:
-        return
+class TestCase:
+    """One entry in the instruction test table.
+
+    'before' and 'after' map register numbers, '@addr' memory locations, and
+    'PC' to values to set up before the test and check after it. If
+    'stop_after' is given, the CPU runs freely until the PC reaches that
+    address; otherwise it's single-stepped once per instruction in 'inst'.
+    """
+    def __init__(self, name, inst, *, before = {}, after = {}, stop_after = None):
+        self.name = name
+        self.inst = inst
+        self.before = before
+        self.after = after
+        self.stop_after = stop_after
+
+class TestResult:
+    def __init__(self, name, passed, cycles, error = None, notes = []):
+        self.name = name
+        self.passed = passed
+        self.cycles = cycles
+        self.error = error
+        self.notes = notes
+
+    def report(self):
+        lines = [f"{self.name} ... "] + [n + "\n" for n in self.notes]
+        if self.passed:
+            lines.append(f"({self.cycles} cyc) PASS")
+        else:
+            lines.append(f"({self.cycles} cyc) FAIL: {self.error}")
+        return "".join(lines)
+
+def test_inst(case):
+    name = case.name
+    inst = case.inst
+    before = case.before
+    after = case.after
+    stop_after = case.stop_after
+
     if args.trace:
         print(f"{name} ... ")
-    else:
-        print(f"{name} ... ", end='')
     yield phase.eq(TestPhase.SETUP)
     for r in range(1, 32):
         if r not in before:
@@ -176,9 +225,8 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
             cycle_count += yield from single_step()
     yield
 
-    print(f"({cycle_count} cyc) ", end='')
-
     yield phase.eq(TestPhase.CHECK)
+    notes = []
     try:
         for key, value in after.items():
             if isinstance(key, int):
@@ -187,7 +235,7 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
                     assert actual == value, \
                             f"r{key} should be 0x{value:08x} but is 0x{actual:08x}"
                 else:
-                    print(f"r{key} (unconstrained) is 0x{actual:x}")
+                    notes.append(f"r{key} (unconstrained) is 0x{actual:x}")
             elif isinstance(key, str) and key[0] == '@':
                 addr = int(key[1:], 16)
                 actual = yield from read_mem(addr)
@@ -213,604 +261,634 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
             value = start_address + instruction_count * 4
             assert actual == value, \
                     f"PC should be 0x{value:x} but is 0x{actual:x}"
-
-
-
-
-    except Exception as e:
-        raise Exception(f"test case {name} failed due to above exception") from e
-
-    print("PASS")
-
-parser = argparse.ArgumentParser(
-    prog = "sim-bigcpu",
-    description = "Test bench for 32-bit model",
-)
-parser.add_argument('-f', '--filter', help = 'Filter string for instruction tests', required = False)
-parser.add_argument('-t', '--trace', help = 'Print instruction trace', required = False, action = 'store_true')
-args = parser.parse_args()
-
-if __name__ == "__main__":
-    m = Module()
-    m.submodules.uut = uut = Cpu(counters = True)
-    m.submodules.mem = mem = TestMemory([
-        0b00000000000000000000_00000_1101111, # JAL x0, .
-    ])
-    m.submodules.mem2 = mem2 = TestMemory([
-        0b00000000000000000000_00000_1101111, # JAL x0, .
-    ])
-
-    phase = Signal(TestPhase)
-    cycle_counter = Signal(32)
-    m.d.sync += cycle_counter.eq(cycle_counter + 1)
-
-    m.submodules.bus = fabric = SimpleFabric([
-        partial_decode(m, mem.bus, 30),
-    ])
-
-    connect(m, uut.bus, fabric.bus)
-
-    ports = [
-        phase,
-        uut.halt_request,
-        uut.halted,
-        uut.s.onehot_state,
-        uut.ew.full,
-        uut.rf.read_cmd.valid,
-        uut.rf.read_cmd.payload,
-        uut.rf.write_cmd.valid,
-        uut.rf.write_cmd.payload.reg,
-        uut.rf.write_cmd.payload.value,
-        uut.bus.cmd.valid,
-        uut.bus.cmd.payload.addr,
-        uut.bus.cmd.payload.data,
-        uut.bus.cmd.payload.lanes,
-        uut.bus.resp,
+    except AssertionError as e:
+        return TestResult(name, False, cycle_count, str(e), notes)
+
+    return TestResult(name, True, cycle_count, None, notes)
+
+def build_cases():
+    cases = []
+    cases.append(TestCase(
+        "LUI x1, 0xAAAAA000",
+        0b10101010101010101010_00001_0110111,
+        after={
+            1: 0xAAAAA000,
+            'PC': 4,
+        },
+    ))
+
+    cases.append(TestCase(
+        "AUIPC x1, 0xAAAAA000",
+        0b10101010101010101010_00001_0010111,
+        before={
+            'PC': 0xCAFC,
+        },
+        after={
+            1: (0xAAAAA000 + 0xCAFC) & 0xFFFFFFFF,
+            'PC': 0xCAFC + 4,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JAL x9, .",
+        0b00000000000000000000_01001_1101111,
+        after={
+            9: 4,
+            'PC': 0,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JAL x9, -4",
+        0b1_1111111110_1_11111111_01001_1101111,
+        before={
+            'PC': 12,
+        },
+        after={
+            9: 16,
+            'PC': 8,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JALR x1, x9, 0x456",
+        0b010001010110_01001_000_00001_1100111,
+        before={
+            9: 0xCAFE,
+        },
+        after={
+            9: 0xCAFE,
+            1: 4,
+            'PC': 0xCAFE + 0x456,
+        },
+    ))
+
+    branch_cases = [
+        ("EQ", 0b000, 0xCAFEBABE, 0xCAFEBABE, True),
+        ("EQ", 0b000, 0xCAFEBABE, 0xBAADF00D, False),
+        ("NE", 0b001, 0xCAFEBABE, 0xBAADF00D, True),
+        ("NE", 0b001, 0xCAFEBABE, 0xCAFEBABE, False),
+        ("LT", 0b100, 0xCAFEBABE, 0x12345678, True),
+        ("LT", 0b100, 0x12345678, 0xCAFEBABE, False),
+        ("LT", 0b100, 0, 0xA, True),
+        ("LT", 0b100, 0xA, 0, False),
+        ("GE", 0b101, 0x12345678, 0xCAFEBABE, True),
+        ("GE", 0b101, 0xCAFEBABE, 0x12345678, False),
+        ("LTU", 0b110, 0x12345678, 0xCAFEBABE, True),
+        ("LTU", 0b110, 0xCAFEBABE, 0x12345678, False),
+        ("GEU", 0b111, 0xCAFEBABE, 0x12345678, True),
+        ("GEU", 0b111, 0x12345678, 0xCAFEBABE, False),
     ]
 
-    verilog_src = verilog.convert(m, ports=ports)
-    with open("sim-cpu.v", "w") as v:
-        v.write(verilog_src)
+    for name, opc, x1, x2, taken in branch_cases:
+        desc = f"B{name} x1, x2, 0x400"
+        if not taken:
+            desc += " (not taken)"
 
-    started = False
-    stopping = False
-
-    sim = Simulator(m)
-    sim.add_clock(1e-6)
-
-    def process():
-        global stopping
-        global started
-        yield from halt()
-        started = True
-        yield from test_inst(
-            "LUI x1, 0xAAAAA000",
-            0b10101010101010101010_00001_0110111,
-            after={
-                1: 0xAAAAA000,
-                'PC': 4,
-            },
-        )
-
-        yield from test_inst(
-            "AUIPC x1, 0xAAAAA000",
-            0b10101010101010101010_00001_0010111,
-            before={
-                'PC': 0xCAFC,
-            },
-            after={
-                1: (0xAAAAA000 + 0xCAFC) & 0xFFFFFFFF,
-                'PC': 0xCAFC + 4,
-            },
-        )
-
-        yield from test_inst(
-            "JAL x9, .",
-            0b00000000000000000000_01001_1101111,
-            after={
-                9: 4,
-                'PC': 0,
-            },
-        )
-
-        yield from test_inst(
-            "JAL x9, -4",
-            0b1_1111111110_1_11111111_01001_1101111,
-            before={
-                'PC': 12,
-            },
-            after={
-                9: 16,
-                'PC': 8,
-            },
-        )
-
-        yield from test_inst(
-            "JALR x1, x9, 0x456",
-            0b010001010110_01001_000_00001_1100111,
-            before={
-                9: 0xCAFE,
-            },
-            after={
-                9: 0xCAFE,
-                1: 4,
-                'PC': 0xCAFE + 0x456,
-            },
-        )
-
-        branch_cases = [
-            ("EQ", 0b000, 0xCAFEBABE, 0xCAFEBABE, True),
-            ("EQ", 0b000, 0xCAFEBABE, 0xBAADF00D, False),
-            ("NE", 0b001, 0xCAFEBABE, 0xBAADF00D, True),
-            ("NE", 0b001, 0xCAFEBABE, 0xCAFEBABE, False),
-            ("LT", 0b100, 0xCAFEBABE, 0x12345678, True),
-            ("LT", 0b100, 0x12345678, 0xCAFEBABE, False),
-            ("LT", 0b100, 0, 0xA, True),
-            ("LT", 0b100, 0xA, 0, False),
-            ("GE", 0b101, 0x12345678, 0xCAFEBABE, True),
-            ("GE", 0b101, 0xCAFEBABE, 0x12345678, False),
-            ("LTU", 0b110, 0x12345678, 0xCAFEBABE, True),
-            ("LTU", 0b110, 0xCAFEBABE, 0x12345678, False),
-            ("GEU", 0b111, 0xCAFEBABE, 0x12345678, True),
-            ("GEU", 0b111, 0x12345678, 0xCAFEBABE, False),
-        ]
-
-        for name, opc, x1, x2, taken in branch_cases:
-            desc = f"B{name} x1, x2, 0x400"
-            if not taken:
-                desc += " (not taken)"
-
-            yield from test_inst(
-                desc,
-                0b0_100000_00010_00001_000_0000_0_1100011 | (opc << 12),
-                before={
-                    'PC': 0xF000,
-                    1: x1,
-                    2: x2,
-                },
-                after={
-                    'PC': 0xF000 + (0x400 if taken else 4),
-                },
-            )
-        yield from test_inst(
-            "BNEZ x2, 0x400 (taken)",
-            0b0_100000_00010_00000_001_0000_0_1100011,
+        cases.append(TestCase(
+            desc,
+            0b0_100000_00010_00001_000_0000_0_1100011 | (opc << 12),
             before={
                 'PC': 0xF000,
-                2: 0xA,
+                1: x1,
+                2: x2,
             },
             after={
-                'PC': 0xF400,
+                'PC': 0xF000 + (0x400 if taken else 4),
             },
-        )
-
-        yield from test_inst(
-            "BNEZ x2, 0x400 (not taken)",
-            0b0_100000_00010_00000_001_0000_0_1100011,
-            before={
-                'PC': 0xF000,
-                2: 0,
-            },
-            after={
-                'PC': 0xF004,
-            },
-        )
-
-        yield from test_inst(
-            "blez x2, 0x400",
-            0b0_100000_00010_00000_101_0000_0_1100011,
+        ))
+    cases.append(TestCase(
+        "BNEZ x2, 0x400 (taken)",
+        0b0_100000_00010_00000_001_0000_0_1100011,
+        before={
+            'PC': 0xF000,
+            2: 0xA,
+        },
+        after={
+            'PC': 0xF400,
+        },
+    ))
+
+    cases.append(TestCase(
+        "BNEZ x2, 0x400 (not taken)",
+        0b0_100000_00010_00000_001_0000_0_1100011,
+        before={
+            'PC': 0xF000,
+            2: 0,
+        },
+        after={
+            'PC': 0xF004,
+        },
+    ))
+
+    cases.append(TestCase(
+        "blez x2, 0x400",
+        0b0_100000_00010_00000_101_0000_0_1100011,
+        before={
+            'PC': 0xF000,
+            2: 0xA,
+        },
+        after={
+            'PC': 0xF004,
+        },
+    ))
+
+    load_cases = [
+        ("LW", 0b010, 0x12345678, 0, 0x12345678),
+
+        ("LH", 0b001, 0x12345678, 0, 0x5678),
+        ("LH", 0b001, 0x12345678, 2, 0x1234),
+        ("LH", 0b001, 0x92B4D6F8, 0, 0xFFFF_D6F8),
+        ("LH", 0b001, 0x92B4D6F8, 2, 0xFFFF_92B4),
+
+        ("LHU", 0b101, 0x92B4D6F8, 0, 0xD6F8),
+        ("LHU", 0b101, 0x92B4D6F8, 2, 0x92B4),
+
+        ("LB", 0b000, 0x12345678, 0, 0x78),
+        ("LB", 0b000, 0x12345678, 1, 0x56),
+        ("LB", 0b000, 0x12345678, 2, 0x34),
+        ("LB", 0b000, 0x12345678, 3, 0x12),
+        ("LB", 0b000, 0x92B4D6F8, 0, 0xFFFF_FFF8),
+        ("LB", 0b000, 0x92B4D6F8, 1, 0xFFFF_FFD6),
+        ("LB", 0b000, 0x92B4D6F8, 2, 0xFFFF_FFB4),
+        ("LB", 0b000, 0x92B4D6F8, 3, 0xFFFF_FF92),
+
+        ("LBU", 0b100, 0x92B4D6F8, 0, 0xF8),
+        ("LBU", 0b100, 0x92B4D6F8, 1, 0xD6),
+        ("LBU", 0b100, 0x92B4D6F8, 2, 0xB4),
+        ("LBU", 0b100, 0x92B4D6F8, 3, 0x92),
+    ]
+    for mnem, opc, memword, off, reg in load_cases:
+        desc = f"{mnem} x1, 0xAC(x2)"
+        if off != 0:
+            desc += f" (with x2={off})"
+
+        cases.append(TestCase(
+            desc,
+            0b000010101100_00010_000_00001_0000011 | (opc << 12),
             before={
-                'PC': 0xF000,
-                2: 0xA,
+                1: 0xBAADF00D,
+                2: off,
+                '@AC': memword,
             },
             after={
-                'PC': 0xF004,
+                1: reg,
+                2: off,
+                '@AC': memword,
+                'PC': 4,
             },
-        )
-
-        load_cases = [
-            ("LW", 0b010, 0x12345678, 0, 0x12345678),
-
-            ("LH", 0b001, 0x12345678, 0, 0x5678),
-            ("LH", 0b001, 0x12345678, 2, 0x1234),
-            ("LH", 0b001, 0x92B4D6F8, 0, 0xFFFF_D6F8),
-            ("LH", 0b001, 0x92B4D6F8, 2, 0xFFFF_92B4),
-
-            ("LHU", 0b101, 0x92B4D6F8, 0, 0xD6F8),
-            ("LHU", 0b101, 0x92B4D6F8, 2, 0x92B4),
-
-            ("LB", 0b000, 0x12345678, 0, 0x78),
-            ("LB", 0b000, 0x12345678, 1, 0x56),
-            ("LB", 0b000, 0x12345678, 2, 0x34),
-            ("LB", 0b000, 0x12345678, 3, 0x12),
-            ("LB", 0b000, 0x92B4D6F8, 0, 0xFFFF_FFF8),
-            ("LB", 0b000, 0x92B4D6F8, 1, 0xFFFF_FFD6),
-            ("LB", 0b000, 0x92B4D6F8, 2, 0xFFFF_FFB4),
-            ("LB", 0b000, 0x92B4D6F8, 3, 0xFFFF_FF92),
-
-            ("LBU", 0b100, 0x92B4D6F8, 0, 0xF8),
-            ("LBU", 0b100, 0x92B4D6F8, 1, 0xD6),
-            ("LBU", 0b100, 0x92B4D6F8, 2, 0xB4),
-            ("LBU", 0b100, 0x92B4D6F8, 3, 0x92),
-        ]
-        for mnem, opc, memword, off, reg in load_cases:
-            desc = f"{mnem} x1, 0xAC(x2)"
-            if off != 0:
-                desc += f" (with x2={off})"
-
-            yield from test_inst(
-                desc,
-                0b000010101100_00010_000_00001_0000011 | (opc << 12),
-                before={
-                    1: 0xBAADF00D,
-                    2: off,
-                    '@AC': memword,
-                },
-                after={
-                    1: reg,
-                    2: off,
-                    '@AC': memword,
-                    'PC': 4,
-                },
-            )
+        ))
 
-        store_cases = [
-            ("SW", 0b010, 0xDEADBEEF, 0x12345678, 0, 0x12345678),
+    store_cases = [
+        ("SW", 0b010, 0xDEADBEEF, 0x12345678, 0, 0x12345678),
 
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 0, 0xDEADBE78),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 1, 0xDEAD78EF),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 2, 0xDE78BEEF),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 3, 0x78ADBEEF),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 0, 0xDEADBE78),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 1, 0xDEAD78EF),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 2, 0xDE78BEEF),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 3, 0x78ADBEEF),
 
-            ("SH", 0b001, 0xDEADBEEF, 0x12345678, 0, 0xDEAD5678),
-            ("SH", 0b001, 0xDEADBEEF, 0x12345678, 2, 0x5678BEEF),
-        ]
-        for mnem, opc, prevmem, write, off, expected in store_cases:
-            desc = f"{mnem} x1, 0xAC(x2)"
-            if off != 0:
-                desc += f" (with x2={off})"
-
-            yield from test_inst(
-                desc,
-                0b0000101_00001_00010_000_01100_0100011 | (opc << 12),
-                before={
-                    1: write,
-                    2: off,
-                    '@AC': prevmem,
-                },
-                after={
-                    1: write,
-                    2: off,
-                    '@AC': expected,
-                    'PC': 4,
-                },
-            )
-
-        yield from test_inst(
-            "ADD x1, x2, x3",
-            0b0000000_00011_00010_000_00001_0110011,
+        ("SH", 0b001, 0xDEADBEEF, 0x12345678, 0, 0xDEAD5678),
+        ("SH", 0b001, 0xDEADBEEF, 0x12345678, 2, 0x5678BEEF),
+    ]
+    for mnem, opc, prevmem, write, off, expected in store_cases:
+        desc = f"{mnem} x1, 0xAC(x2)"
+        if off != 0:
+            desc += f" (with x2={off})"
+
+        cases.append(TestCase(
+            desc,
+            0b0000101_00001_00010_000_01100_0100011 | (opc << 12),
             before={
-                2: 0xCAFEBABE,
-                3: 0xBAADF00D,
+                1: write,
+                2: off,
+                '@AC': prevmem,
             },
             after={
-                1: (0xCAFEBABE + 0xBAADF00D) & 0xFFFFFFFF,
+                1: write,
+                2: off,
+                '@AC': expected,
+                'PC': 4,
             },
-        )
-        yield from test_inst(
-            "OR x1, x2, x3",
-            0b0000000_00011_00010_110_00001_0110011,
+        ))
+
+    cases.append(TestCase(
+        "ADD x1, x2, x3",
+        0b0000000_00011_00010_000_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: (0xCAFEBABE + 0xBAADF00D) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "OR x1, x2, x3",
+        0b0000000_00011_00010_110_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: 0xCAFEBABE | 0xBAADF00D,
+        },
+    ))
+
+    cases.append(TestCase(
+        "AND x1, x2, x3",
+        0b0000000_00011_00010_111_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: 0xCAFEBABE & 0xBAADF00D,
+        },
+    ))
+
+    cases.append(TestCase(
+        "ADDI x1, x2, 0x123",
+        0b000100100011_00010_000_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: (0xCAFEBABE + 0x123) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "ADDI x1, x2, -0x123",
+        0b111011011101_00010_000_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: (0xCAFEBABE + -0x123) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "SUB x1, x2, x3",
+        0b0100000_00011_00010_000_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: (0xCAFEBABE - 0xBAADF00D) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "XORI x1, x2, 0x123",
+        0b000100100011_00010_100_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE ^ 0x123,
+        },
+    ))
+    cases.append(TestCase(
+        "ORI x1, x2, 0x123",
+        0b000100100011_00010_110_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE | 0x123,
+        },
+    ))
+    cases.append(TestCase(
+        "ANDI x1, x2, 0x123",
+        0b000100100011_00010_111_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE & 0x123,
+        },
+    ))
+
+    cases.append(TestCase(
+        "SLT x1, x2, x3 (where x2 < x3)",
+        0b0000000_00011_00010_010_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0x12345678,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLT x1, x2, x3 (where x2 >= x3)",
+        0b0000000_00011_00010_010_00001_0110011,
+        before={
+            2: 0x12345678,
+            3: 0xCAFEBABE,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTU x1, x2, x3 (where x2 < x3)",
+        0b0000000_00011_00010_011_00001_0110011,
+        before={
+            2: 0x12345678,
+            3: 0xCAFEBABE,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTU x1, x2, x3 (where x2 >= x3)",
+        0b0000000_00011_00010_011_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0x12345678,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTI x1, x2, 0x123 (where x2 < 0x123)",
+        0b001100100001_00010_010_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTI x1, x2, 0x123 (where x2 >= 0x123)",
+        0b001100100001_00010_010_00001_0010011,
+        before={
+            2: 0x12345678,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTIU x1, x2, 0x123 (where x2 < 0x123)",
+        0b001100100001_00010_011_00001_0010011,
+        before={
+            2: 0x42,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTIU x1, x2, 0x123 (where x2 >= 0x123)",
+        0b001100100001_00010_011_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    for amt in [1, 0, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SLL x1, x2, x3 (with x3={amt})",
+            0b0000000_00011_00010_001_00001_0110011,
             before={
                 2: 0xCAFEBABE,
-                3: 0xBAADF00D,
+                3: amt,
             },
             after={
-                1: 0xCAFEBABE | 0xBAADF00D,
+                1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
             },
-        )
+        ))
 
-        yield from test_inst(
-            "AND x1, x2, x3",
-            0b0000000_00011_00010_111_00001_0110011,
+    for amt in [0, 1, 5, 31]:
+        cases.append(TestCase(
+            f"SLLI x1, x2, {amt}",
+            0b0000000_00000_00010_001_00001_0010011 | amt << 20,
             before={
                 2: 0xCAFEBABE,
-                3: 0xBAADF00D,
             },
             after={
-                1: 0xCAFEBABE & 0xBAADF00D,
+                1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
             },
-        )
+        ))
 
-        yield from test_inst(
-            "ADDI x1, x2, 0x123",
-            0b000100100011_00010_000_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: (0xCAFEBABE + 0x123) & 0xFFFFFFFF,
-            },
-        )
-        yield from test_inst(
-            "ADDI x1, x2, -0x123",
-            0b111011011101_00010_000_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: (0xCAFEBABE + -0x123) & 0xFFFFFFFF,
-            },
-        )
-        yield from test_inst(
-            "SUB x1, x2, x3",
-            0b0100000_00011_00010_000_00001_0110011,
+    for amt in [0, 1, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SRL x1, x2, x3 (with x3={amt})",
+            0b0000000_00011_00010_101_00001_0110011,
             before={
                 2: 0xCAFEBABE,
-                3: 0xBAADF00D,
+                3: amt,
             },
             after={
-                1: (0xCAFEBABE - 0xBAADF00D) & 0xFFFFFFFF,
+                1: 0xCAFEBABE >> (amt & 0x1F),
             },
-        )
-        yield from test_inst(
-            "XORI x1, x2, 0x123",
-            0b000100100011_00010_100_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: 0xCAFEBABE ^ 0x123,
-            },
-        )
-        yield from test_inst(
-            "ORI x1, x2, 0x123",
-            0b000100100011_00010_110_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: 0xCAFEBABE | 0x123,
-            },
-        )
-        yield from test_inst(
-            "ANDI x1, x2, 0x123",
-            0b000100100011_00010_111_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: 0xCAFEBABE & 0x123,
-            },
-        )
+        ))
 
-        yield from test_inst(
-            "SLT x1, x2, x3 (where x2 < x3)",
-            0b0000000_00011_00010_010_00001_0110011,
-            before={
-                2: 0xCAFEBABE,
-                3: 0x12345678,
-            },
-            after={
-                1: 1,
-            },
-        )
-        yield from test_inst(
-            "SLT x1, x2, x3 (where x2 >= x3)",
-            0b0000000_00011_00010_010_00001_0110011,
-            before={
-                2: 0x12345678,
-                3: 0xCAFEBABE,
-            },
-            after={
-                1: 0,
-            },
-        )
-        yield from test_inst(
-            "SLTU x1, x2, x3 (where x2 < x3)",
-            0b0000000_00011_00010_011_00001_0110011,
-            before={
-                2: 0x12345678,
-                3: 0xCAFEBABE,
-            },
-            after={
-                1: 1,
-            },
-        )
-        yield from test_inst(
-            "SLTU x1, x2, x3 (where x2 >= x3)",
-            0b0000000_00011_00010_011_00001_0110011,
+    for amt in [0, 1, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SRLI x1, x2, {amt}",
+            0b0000000_00000_00010_101_00001_0010011 | ((amt & 0x1F) << 20),
             before={
                 2: 0xCAFEBABE,
-                3: 0x12345678,
             },
             after={
-                1: 0,
+                1: 0xCAFEBABE >> (amt & 0x1F),
             },
-        )
-        yield from test_inst(
-            "SLTI x1, x2, 0x123 (where x2 < 0x123)",
-            0b001100100001_00010_010_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: 1,
-            },
-        )
-        yield from test_inst(
-            "SLTI x1, x2, 0x123 (where x2 >= 0x123)",
-            0b001100100001_00010_010_00001_0010011,
-            before={
-                2: 0x12345678,
-            },
-            after={
-                1: 0,
-            },
-        )
-        yield from test_inst(
-            "SLTIU x1, x2, 0x123 (where x2 < 0x123)",
-            0b001100100001_00010_011_00001_0010011,
-            before={
-                2: 0x42,
-            },
-            after={
-                1: 1,
-            },
-        )
-        yield from test_inst(
-            "SLTIU x1, x2, 0x123 (where x2 >= 0x123)",
-            0b001100100001_00010_011_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
-            },
-            after={
-                1: 0,
-            },
-        )
-        for amt in [1, 0, 5, 31, 32]:
-            yield from test_inst(
-                f"SLL x1, x2, x3 (with x3={amt})",
-                0b0000000_00011_00010_001_00001_0110011,
-                before={
-                    2: 0xCAFEBABE,
-                    3: amt,
-                },
-                after={
-                    1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
-                },
-            )
-
-        for amt in [0, 1, 5, 31]:
-            yield from test_inst(
-                f"SLLI x1, x2, {amt}",
-                0b0000000_00000_00010_001_00001_0010011 | amt << 20,
-                before={
-                    2: 0xCAFEBABE,
-                },
-                after={
-                    1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
-                },
-            )
+        ))
 
+    for x2 in [0xCAFEBABE, 0xF00D]: # one negative, one positive
         for amt in [0, 1, 5, 31, 32]:
-            yield from test_inst(
-                f"SRL x1, x2, x3 (with x3={amt})",
-                0b0000000_00011_00010_101_00001_0110011,
+            if x2 & 0x80000000 == 0:
+                result = x2 >> (amt & 0x1F)
+            else:
+                result = ((0xFFFFFFFF_00000000 | x2) >> (amt & 0x1F)) & 0xFFFFFFFF
+            cases.append(TestCase(
+                f"SRA x1, x2, x3 (with x2=0x{x2:x}, x3={amt})",
+                0b0100000_00011_00010_101_00001_0110011,
                 before={
-                    2: 0xCAFEBABE,
+                    2: x2,
                     3: amt,
                 },
                 after={
-                    1: 0xCAFEBABE >> (amt & 0x1F),
+                    1: result,
                 },
-            )
+            ))
+
+    cases.append(TestCase(
+        f"div test",
+        [
+# 8968/0      00058613                mv      a2,a1
+            0x00058613,
+# 896c/4      00050593                mv      a1,a0
+            0x00050593,
+# 8970/8      fff00513                li      a0,-1
+            0xfff00513,
+# 8974/c      02060c63                beqz    a2,89ac <__hidden___udivsi3+0x44>
+            0x02060c63,
+# 8978/10     00100693                li      a3,1
+            0x00100693,
+# 897c/14     00b67a63                bgeu    a2,a1,8990 <__hidden___udivsi3+0x28>
+            0x00b67a63,
+# 8980/18     00c05863                blez    a2,8990 <__hidden___udivsi3+0x28>
+            0x00c05863,
+# 8984/1c     00161613                slli    a2,a2,0x1
+            0x00161613,
+# 8988/20     00169693                slli    a3,a3,0x1
+            0x00169693,
+# 898c/24     feb66ae3                bltu    a2,a1,8980 <__hidden___udivsi3+0x18>
+            0xfeb66ae3,
+# 8990/28     00000513                li      a0,0
+            0x00000513,
+# 8994/2c     00c5e663                bltu    a1,a2,89a0 <__hidden___udivsi3+0x38>
+            0x00c5e663,
+# 8998/30     40c585b3                sub     a1,a1,a2
+            0x40c585b3,
+# 899c/34     00d56533                or      a0,a0,a3
+            0x00d56533,
+# 89a0/38     0016d693                srli    a3,a3,0x1
+            0x0016d693,
+# 89a4/3c     00165613                srli    a2,a2,0x1
+            0x00165613,
+# 89a8/40     fe0696e3                bnez    a3,8994 <__hidden___udivsi3+0x2c>
+            0xfe0696e3,
+# 89ac/44     00008067                ret
+            0x00008067,
+        ],
+        stop_after = 0x44,
+        before={
+            1: 0x1230,
+            10: 100_000,
+            11: 10,
+        },
+        after={
+            10: 10_000,
+            11: 0,
+            12: 5, # empirically
+            13: 0, # empirically
+            'PC': 0x1230,
+        },
+    ))
+    #cases.append(TestCase(
+    #    f"CSRRWI x1, mscratch, 17",
+    #    0b0011_0100_0000_10001_101_00001_1110011,
+    #    after={
+    #        1: 0,
+    #    },
+    #))
+    #cases.append(TestCase(
+    #    f"CSRRS x1, mstatus, x3(=0xFF) / read back",
+    #    [
+    #        0b0011_0000_0000_00011_010_00001_1110011,
+    #        0b0011_0000_0000_00000_010_00010_1110011,
+    #    ],
+    #    before={
+    #        3: 0xFF,
+    #    },
+    #    after={
+    #        1: 0,
+    #        2: 0b1000_1000,
+    #    },
+    #))
+
+    return cases
+
+CASES = build_cases()
+
+def build_design():
+    global uut, mem, mem2, phase, cycle_counter
+    m = Module()
+    m.submodules.uut = uut = Cpu(
+        counters = True,
+        shift_bits_per_cycle = args.shift_bits,
+    )
+    m.submodules.mem = mem = TestMemory([
+        0b00000000000000000000_00000_1101111, # JAL x0, .
+    ])
+    m.submodules.mem2 = mem2 = TestMemory([
+        0b00000000000000000000_00000_1101111, # JAL x0, .
+    ])
 
-        for amt in [0, 1, 5, 31, 32]:
-            yield from test_inst(
-                f"SRLI x1, x2, {amt}",
-                0b0000000_00000_00010_101_00001_0010011 | ((amt & 0x1F) << 20),
-                before={
-                    2: 0xCAFEBABE,
-                },
-                after={
-                    1: 0xCAFEBABE >> (amt & 0x1F),
-                },
-            )
+    phase = Signal(TestPhase, name = "phase")
+    cycle_counter = Signal(32, name = "cycle_counter")
+    m.d.sync += cycle_counter.eq(cycle_counter + 1)
 
-        for x2 in [0xCAFEBABE, 0xF00D]: # one negative, one positive
-            for amt in [0, 1, 5, 31, 32]:
-                if x2 & 0x80000000 == 0:
-                    result = x2 >> (amt & 0x1F)
-                else:
-                    result = ((0xFFFFFFFF_00000000 | x2) >> (amt & 0x1F)) & 0xFFFFFFFF
-                yield from test_inst(
-                    f"SRA x1, x2, x3 (with x2=0x{x2:x}, x3={amt})",
-                    0b0100000_00011_00010_101_00001_0110011,
-                    before={
-                        2: x2,
-                        3: amt,
-                    },
-                    after={
-                        1: result,
-                    },
-                )
-
-        yield from test_inst(
-            f"div test",
-            [
-    # 8968/0      00058613                mv      a2,a1
-                0x00058613,
-    # 896c/4      00050593                mv      a1,a0
-                0x00050593,
-    # 8970/8      fff00513                li      a0,-1
-                0xfff00513,
-    # 8974/c      02060c63                beqz    a2,89ac <__hidden___udivsi3+0x44>
-                0x02060c63,
-    # 8978/10     00100693                li      a3,1
-                0x00100693,
-    # 897c/14     00b67a63                bgeu    a2,a1,8990 <__hidden___udivsi3+0x28>
-                0x00b67a63,
-    # 8980/18     00c05863                blez    a2,8990 <__hidden___udivsi3+0x28>
-                0x00c05863,
-    # 8984/1c     00161613                slli    a2,a2,0x1
-                0x00161613,
-    # 8988/20     00169693                slli    a3,a3,0x1
-                0x00169693,
-    # 898c/24     feb66ae3                bltu    a2,a1,8980 <__hidden___udivsi3+0x18>
-                0xfeb66ae3,
-    # 8990/28     00000513                li      a0,0
-                0x00000513,
-    # 8994/2c     00c5e663                bltu    a1,a2,89a0 <__hidden___udivsi3+0x38>
-                0x00c5e663,
-    # 8998/30     40c585b3                sub     a1,a1,a2
-                0x40c585b3,
-    # 899c/34     00d56533                or      a0,a0,a3
-                0x00d56533,
-    # 89a0/38     0016d693                srli    a3,a3,0x1
-                0x0016d693,
-    # 89a4/3c     00165613                srli    a2,a2,0x1
-                0x00165613,
-    # 89a8/40     fe0696e3                bnez    a3,8994 <__hidden___udivsi3+0x2c>
-                0xfe0696e3,
-    # 89ac/44     00008067                ret
-                0x00008067,
-            ],
-            stop_after = 0x44,
-            before={
-                1: 0x1230,
-                10: 100_000,
-                11: 10,
-            },
-            after={
-                10: 10_000,
-                11: 0,
-                12: 5, # empirically
-                13: 0, # empirically
-                'PC': 0x1230,
-            },
+    m.submodules.bus = fabric = SimpleFabric([
+        partial_decode(m, mem.bus, 30),
+    ])
+
+    connect(m, uut.bus, fabric.bus)
+
+    ports = [
+        phase,
+        uut.halt_request,
+        uut.halted,
+        uut.s.onehot_state,
+        uut.ew.full,
+        uut.rf.read_cmd.valid,
+        uut.rf.read_cmd.payload,
+        uut.rf.write_cmd.valid,
+        uut.rf.write_cmd.payload.reg,
+        uut.rf.write_cmd.payload.value,
+        uut.bus.cmd.valid,
+        uut.bus.cmd.payload.addr,
+        uut.bus.cmd.payload.data,
+        uut.bus.cmd.payload.lanes,
+        uut.bus.resp,
+    ]
+
+    return m, fabric, ports
+
+def run_shard(shard, indices, options):
+    """Runs the cases with the given indices into CASES in a fresh simulator,
+    returning a list of (index, TestResult)."""
+    global args, started, stopping, current_case
+    args = options
+    m, fabric, ports = build_design()
+
+    started = False
+    stopping = False
+    current_case = None
+    results = []
+
+    trigger = Trigger(
+        pcs = args.capture_pc,
+        orders = args.capture_order,
+        tests = args.capture_test,
+        cycles = args.capture_cycles,
+    )
+    if trigger or args.capture_failures:
+        capture = WindowedCapture(
+            ports + [cycle_counter],
+            trigger = trigger,
+            depth = args.capture_depth,
+            rvfi = uut.rvfi,
+            test_name = lambda: current_case,
         )
-        #yield from test_inst(
-        #    f"CSRRWI x1, mscratch, 17",
-        #    0b0011_0100_0000_10001_101_00001_1110011,
-        #    after={
-        #        1: 0,
-        #    },
-        #)
-        #yield from test_inst(
-        #    f"CSRRS x1, mstatus, x3(=0xFF) / read back",
-        #    [
-        #        0b0011_0000_0000_00011_010_00001_1110011,
-        #        0b0011_0000_0000_00000_010_00010_1110011,
-        #    ],
-        #    before={
-        #        3: 0xFF,
-        #    },
-        #    after={
-        #        1: 0,
-        #        2: 0b1000_1000,
-        #    },
-        #)
+    else:
+        capture = None
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
 
+    def process():
+        global stopping
+        global started
+        global current_case
+        yield from halt()
+        started = True
+        for i in indices:
+            current_case = CASES[i].name
+            result = yield from test_inst(CASES[i])
+            results.append((i, result))
+            if not result.passed and args.capture_failures:
+                capture.fire()
+        current_case = None
         yield
         yield
         yield
@@ -876,5 +954,112 @@ if __name__ == "__main__":
 
     if args.trace:
         sim.add_sync_process(rvfi_tracer)
-    with sim.write_vcd(vcd_file="test.vcd", gtkw_file="test.gtkw", traces=ports):
-        sim.run()
+
+    if capture is not None:
+        sim.add_sync_process(capture.process(running = lambda: not stopping))
+
+    if args.jobs == 1:
+        suffix = ""
+    else:
+        suffix = f"-{shard}"
+    try:
+        if args.vcd:
+            with sim.write_vcd(vcd_file=f"test{suffix}.vcd",
+                               gtkw_file=f"test{suffix}.gtkw", traces=ports):
+                sim.run()
+        else:
+            sim.run()
+    except Exception as e:
+        # Something went wrong badly enough to stop the simulation (e.g. the
+        # CPU wouldn't halt). Charge it to the case that was running, and
+        # report the rest of the shard as not run.
+        done = len(results)
+        if done < len(indices):
+            results.append((indices[done], TestResult(
+                CASES[indices[done]].name, False, 0, f"{type(e).__name__}: {e}",
+            )))
+        for i in indices[done + 1:]:
+            results.append((i, TestResult(
+                CASES[i].name, False, 0, "not run, simulation stopped early",
+            )))
+        if capture is not None and args.capture_failures:
+            capture.snapshot()
+
+    if capture is not None:
+        windows = capture.write_vcd(f"capture{suffix}.vcd")
+        if windows:
+            print(f"captured {windows} window(s) to capture{suffix}.vcd")
+
+    return results
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "sim-bigcpu",
+        description = "Test bench for 32-bit model",
+    )
+    parser.add_argument('-f', '--filter', help = 'Filter string for instruction tests', required = False)
+    parser.add_argument('-t', '--trace', help = 'Print instruction trace', required = False, action = 'store_true')
+    parser.add_argument('--frontdoor', help = 'Set up and check registers and memory through the debug and inspect ports instead of the simulation backdoor', required = False, action = 'store_true')
+    parser.add_argument('-j', '--jobs', help = 'Number of simulators to run in parallel (default: one per CPU)', required = False, type = int, default = os.cpu_count())
+    parser.add_argument('--shift-bits', help = 'Bits the shifter moves per cycle: 1, 2, 4, 8 or 16 (default: 1)', required = False, type = int, choices = [1, 2, 4, 8, 16], default = 1)
+    parser.add_argument('--vcd', help = 'Write a waveform of the entire run to test.vcd (slow)', required = False, action = 'store_true')
+    parser.add_argument('--capture-pc', help = 'Capture waveforms around retirement of the instruction at this PC (repeatable)', required = False, type = lambda s: int(s, 0), action = 'append', default = [])
+    parser.add_argument('--capture-order', help = 'Capture waveforms while RVFI order is in the range N, A:B or A:', required = False, type = parse_range)
+    parser.add_argument('--capture-test', help = 'Capture waveforms for test cases whose names contain this string (repeatable)', required = False, action = 'append', default = [])
+    parser.add_argument('--capture-cycles', help = 'Capture waveforms for simulation cycles in the range N, A:B or A:', required = False, type = parse_range)
+    parser.add_argument('--capture-failures', help = 'Capture waveforms leading up to each failing test', required = False, action = 'store_true')
+    parser.add_argument('--capture-depth', help = 'Cycles of lead-up to keep before a capture trigger (default: 64)', required = False, type = int, default = 64)
+    parser.add_argument('--bench', help = 'Write the cycle count of each passing test to this JSON file', required = False)
+    parser.add_argument('--baseline', help = 'Compare cycle counts against this JSON file (e.g. bench/sim-chonk.json) and fail if any got slower', required = False)
+    args = parser.parse_args()
+
+    indices = [
+        i for i, case in enumerate(CASES)
+        if args.filter is None or args.filter in case.name
+    ]
+    if args.trace:
+        # Traces from several simulators at once would be unreadable.
+        args.jobs = 1
+    args.jobs = max(1, min(args.jobs, len(indices)))
+
+    m, fabric, ports = build_design()
+    verilog_src = verilog.convert(m, ports=ports)
+    with open("sim-cpu.v", "w") as v:
+        v.write(verilog_src)
+
+    # Deal the cases out round-robin, so that the slow ones near the end of the
+    # table don't all land in the same shard.
+    shards = [indices[n::args.jobs] for n in range(args.jobs)]
+    if args.jobs == 1:
+        outcomes = [run_shard(0, shards[0], args)]
+    else:
+        with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+            outcomes = list(pool.map(
+                run_shard,
+                range(args.jobs),
+                shards,
+                [args] * args.jobs,
+            ))
+
+    results = sorted((r for outcome in outcomes for r in outcome),
+                     key = lambda r: r[0])
+    failures = 0
+    for _, result in results:
+        print(result.report())
+        if not result.passed:
+            failures += 1
+
+    print(f"{len(results) - failures} passed, {failures} failed")
+
+    keys = hapenny.bench.case_keys([case.name for case in CASES])
+    cycles = {
+        keys[i]: result.cycles for i, result in results if result.passed
+    }
+    if args.bench is not None:
+        hapenny.bench.save(args.bench, "chonk", cycles)
+    if args.baseline is not None:
+        if not hapenny.bench.check(args.baseline, "chonk", cycles):
+            failures += 1
+
+    if failures:
+        sys.exit(1)
@@ -1,4 +1,7 @@
 import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 
 from amaranth import *
 from amaranth.sim import Simulator, Delay, Settle
@@ -7,9 +10,12 @@ from amaranth.lib.wiring import *
 from amaranth.lib.enum import *
 
 from hapenny.cpu import Cpu
-from hapenny.bus import BusPort, partial_decode, SimpleFabric
+from hapenny.bus import BusPort, partial_decode, add_wait_states, SimpleFabric
 from hapenny import *
 from hapenny.mem import BasicMemory
+from hapenny.cosim import RvfiChecker, rvfi_checker_process
+from hapenny.trace import Trigger, WindowedCapture, parse_range
+import hapenny.bench
 
 class TestPhase(Enum):
     INIT = 0
@@ -56,15 +62,25 @@ class TestMemory(BasicMemory):
 
 def halt():
     yield uut.halt_request.eq(1)
+    # Every bus access can take extra cycles when the memory has wait states,
+    # and the instruction cache flushes itself at reset. The CPU also can't
+    # halt in the middle of a multiply or divide.
+    limit = 40 * (1 + args.wait_states) + args.icache
+    if args.muldiv:
+        limit += 40
     attempts = 0
     while (yield uut.halted) == 0:
         attempts += 1
-        if attempts > 40:
-            raise Exception("CPU didn't halt after 40 cycles")
+        if attempts > limit:
+            raise Exception(f"CPU didn't halt after {limit} cycles")
         yield
         yield Settle()
 
 def resume():
+    # The instruction cache flushes itself while the CPU is halted, and would
+    # stall it if we resumed too soon, which would count against the test.
+    while uut.icache is not None and (yield uut.icache.flushing):
+        yield
     yield uut.halt_request.eq(0)
     attempts = 0
     while (yield uut.halted) == 1:
@@ -74,6 +90,30 @@ def resume():
         yield
         yield Settle()
 
+def drain_trace():
+    # The trace port reports an instruction on the cycle after it ends, which
+    # can be after the CPU says it's halted. Wait for a cycle with nothing on
+    # it, so the checker and tracer, which sample it on the same cycles we
+    # do, have seen everything from before the halt.
+    yield
+    while (yield uut.rvfi.valid):
+        yield
+
+# With several harts, cases written for one run on hart 0, while the others
+# go round a JAL x0, . here, out of the way of the cases' code and data.
+PARK = 0x1F8
+
+def select_hart_0():
+    # The debug port reaches whichever hart's turn is next, and single-stepping
+    # moves on to the one after it, so step the others (parking them, if a
+    # case has moved them) until it's hart 0's turn.
+    if args.harts == 1:
+        return
+    yield from write_mem(PARK, 0b00000000000000000000_00000_1101111)
+    while (yield uut.ew.hart) != 0:
+        yield from write_pc(PARK)
+        yield from single_step()
+
 def single_step():
     yield from resume()
     start = yield cycle_counter
@@ -81,7 +121,10 @@ def single_step():
     yield
     yield from halt()
     # Subtract 4 here to not count the fetch cycle to refill the pipeline.
-    return (yield cycle_counter) - 4 - start
+    # (It's a cycle shorter when the FD-Box fetches early, which it does with
+    # a second register file read port, or for bubbles with skip_rs2_reads.)
+    refill = 3 if args.rf_read_ports == 2 or args.skip_rs2_reads else 4
+    return (yield cycle_counter) - refill - start
 
 def write_ureg(reg, value):
     yield uut.debug.reg_write.payload.reg.eq(reg)
@@ -91,6 +134,10 @@ def write_ureg(reg, value):
     yield uut.debug.reg_write.valid.eq(0)
 
 def write_reg(reg, value):
+    if not args.frontdoor:
+        # Backdoor straight into the register file; takes no cycles.
+        yield from uut.rf.poke(reg, value)
+        return
     yield from write_ureg(reg, value & 0xFFFF)
     yield from write_ureg(reg | 0x20, value >> 16)
 
@@ -103,6 +150,8 @@ def read_ureg(reg):
     return (yield uut.debug.reg_value)
 
 def read_reg(reg):
+    if not args.frontdoor:
+        return (yield from uut.rf.peek(reg))
     bottom = yield from read_ureg(reg)
     top = yield from read_ureg(reg | 0x20)
     return bottom | (top << 16)
@@ -117,21 +166,27 @@ def read_pc():
     yield Settle()
     return (yield uut.debug.pc)
 
-def write_mem(addr, value):
+def write_mem_half(addr, value):
+    if not args.frontdoor:
+        yield from mem.poke(addr >> 1, value)
+        return
     yield mem.inspect.cmd.payload.addr.eq(addr)
-    yield mem.inspect.cmd.payload.data.eq(value & 0xFFFF)
-    yield mem.inspect.cmd.payload.lanes.eq(0b11)
-    yield mem.inspect.cmd.valid.eq(1)
-    yield
-    yield mem.inspect.cmd.payload.addr.eq(addr + 2)
-    yield mem.inspect.cmd.payload.data.eq(value >> 16)
+    yield mem.inspect.cmd.payload.data.eq(value)
     yield mem.inspect.cmd.payload.lanes.eq(0b11)
     yield mem.inspect.cmd.valid.eq(1)
     yield
     yield mem.inspect.cmd.payload.lanes.eq(0)
     yield mem.inspect.cmd.valid.eq(0)
 
+def write_mem(addr, value):
+    yield from write_mem_half(addr, value & 0xFFFF)
+    yield from write_mem_half(addr + 2, value >> 16)
+
 def read_mem(addr):
+    if not args.frontdoor:
+        bottom = yield from mem.peek(addr >> 1)
+        top = yield from mem.peek((addr >> 1) + 1)
+        return bottom | (top << 16)
     yield mem.inspect.cmd.payload.addr.eq(addr)
     yield mem.inspect.cmd.payload.lanes.eq(0)
     yield mem.inspect.cmd.valid.eq(1)
@@ -147,15 +202,93 @@ def read_mem(addr):
 
     return bottom | (top << 16)
 
-def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
-    if args.filter is not None:
-        if args.filter not in name:
-            return
+class TestCase:
+    """One entry in the instruction test table.
+
+    'before' and 'after' map register numbers, '@addr' memory locations, and
+    'PC' to values to set up before the test and check after it. If
+    'stop_after' is given, the CPU runs freely until the PC reaches that
+    address; otherwise it's single-stepped once per instruction in 'inst'.
+    Cases marked 'muldiv' only run with --muldiv, and those marked
+    'compressed' only with --compressed. Instructions whose bottom two bits
+    aren't both set are compressed, and take up only a halfword of memory.
+
+    Cases marked 'interrupts' only run with --interrupts, and if 'banked' is
+    True or False, only with or without --banked-interrupts. 'irq' lists
+    (line, cycle) pairs: the bench raises each line that many cycles into the
+    run (which must use 'stop_after'), and drops it when the CPU stores to
+    IRQ_ACK + 4*line.
+
+    Cases are written for the number of harts in 'harts'. Those for one run
+    with any --harts, on hart 0, with the other harts parked in a loop at
+    PARK; the rest only run with that many. With more than one, the CPU is
+    reset to start them all at address 0, so there's no 'PC' in 'before', and
+    they run until they've all reached 'stop_after'. The debug port only
+    reaches one of them, so only memory is checked afterwards.
+
+    'corrupt' is a (step, reg, value) triple for single-stepped cases that
+    only run with --cosim: before that step, the bench changes the register
+    in the register file without telling the checker, as if the CPU had lost
+    or misdirected a write, and the case passes only if the checker then
+    reports the CPU reading the wrong value from it.
+
+    'rdcycle' lists (pc, reg) pairs for RDCYCLE instructions in a
+    'stop_after' program. The bench notes when each one finishes, and checks
+    that the values they left in their registers are as many cycles apart as
+    it counted, wait states and all.
+    """
+    def __init__(self, name, inst, *, before = {}, after = {}, stop_after = None,
+                 muldiv = False, compressed = False, interrupts = False,
+                 banked = None, irq = [], harts = 1, rdcycle = [],
+                 corrupt = None):
+        self.name = name
+        self.inst = inst
+        self.before = before
+        self.after = after
+        self.stop_after = stop_after
+        self.muldiv = muldiv
+        self.compressed = compressed
+        self.interrupts = interrupts
+        self.banked = banked
+        self.irq = irq
+        self.harts = harts
+        self.rdcycle = rdcycle
+        self.corrupt = corrupt
+
+class TestResult:
+    def __init__(self, name, passed, cycles, error = None, notes = []):
+        self.name = name
+        self.passed = passed
+        self.cycles = cycles
+        self.error = error
+        self.notes = notes
+
+    def report(self):
+        lines = [f"{self.name} ... "] + [n + "\n" for n in self.notes]
+        if self.passed:
+            lines.append(f"({self.cycles} cyc) PASS")
+        else:
+            lines.append(f"({self.cycles} cyc) FAIL: {self.error}")
+        return "".join(lines)
+
+def test_inst(case):
+    global divergences
+    name = case.name
+    inst = case.inst
+    before = case.before
+    after = case.after
+    stop_after = case.stop_after
+
     if args.trace:
         print(f"{name} ... ")
-    else:
-        print(f"{name} ... ", end='')
     yield phase.eq(TestPhase.SETUP)
+    if case.harts == 1:
+        yield from select_hart_0()
+    if checker is not None:
+        # We're about to change registers, memory and the PC behind the
+        # checker's back; we tell it what we did below.
+        yield from drain_trace()
+        divergences = [] if case.corrupt is not None else None
     for r in range(1, 32):
         if r not in before:
             yield from write_reg(r, 0xDEADBEEF)
@@ -172,36 +305,99 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
             start_address = value
         else:
             raise Exception(f"unexpected before key: {key}")
+    if checker is not None:
+        # The debug port only reaches one hart's registers, so with several,
+        # the checker learns them as it goes.
+        checker.resync(regs = {
+            r: before.get(r, 0xDEADBEEF) for r in range(1, 32)
+        } if case.harts == 1 else None)
 
     if isinstance(inst, int):
-        instruction_count = 1
-        yield from write_mem(start_address, inst)
-    elif isinstance(inst, list):
-        instruction_count = len(inst)
-        for (i, word) in enumerate(inst):
-            yield from write_mem(start_address + 4 * i, word)
-    else:
+        inst = [inst]
+    elif not isinstance(inst, list):
         raise Exception(f"invalid instruction value: {inst}")
+    instruction_count = len(inst)
+    end_address = start_address
+    for word in inst:
+        if word & 3 == 3:
+            yield from write_mem(end_address, word)
+            end_address += 4
+        else:
+            yield from write_mem_half(end_address, word)
+            end_address += 2
 
     yield from write_pc(start_address)
 
     yield phase.eq(TestPhase.RUN)
     cycle_count = 0
+    # Cycles from the first interrupt request to the first instruction of a
+    # handler, if there are any.
+    raised_at = None
+    latency = None
+    # Harts that have reached stop_after, and instructions retired by all of
+    # them, with several.
+    finished = set()
+    retired = 0
+    # The cycle on which we first saw each PC, for checking RDCYCLE.
+    first_seen = {}
     if stop_after is not None:
-        yield from resume()
+        if case.harts > 1:
+            # Resetting the CPU is the only way to put every hart's PC at the
+            # start. It comes out of reset running, since we're no longer
+            # asking it to halt, with hart 0, which is where the checker we
+            # resynced above expects the next instruction to come from.
+            yield uut.halt_request.eq(0)
+            yield cpu_reset.eq(1)
+            yield
+            yield cpu_reset.eq(0)
+        else:
+            yield from resume()
         while True:
             cycle_count += 1
             pc = yield from read_pc()
-            if pc == stop_after:
+            if case.harts > 1:
+                if pc == stop_after:
+                    finished.add((yield uut.ew.hart))
+                retired += yield uut.rvfi.valid
+                done = len(finished) == case.harts
+            elif args.harts > 1 and (yield uut.ew.hart) != 0:
+                # One of the parked harts.
+                done = False
+            else:
+                first_seen.setdefault(pc, cycle_count)
+                done = pc == stop_after
+            if done:
                 yield from halt()
                 break
+            if case.irq:
+                yield irq_raise.eq(sum(
+                    1 << line for (line, at) in case.irq if at == cycle_count
+                ))
+                if raised_at is None and (yield uut.irq):
+                    raised_at = cycle_count
+                if latency is None and (yield uut.ew.in_handler) \
+                        and (yield uut.ew.full) \
+                        and (yield uut.s.onehot_state[0]):
+                    latency = cycle_count - raised_at
             yield
     else:
         for i in range(instruction_count):
+            if case.corrupt is not None and case.corrupt[0] == i:
+                (_, reg, value) = case.corrupt
+                yield from uut.rf.poke(reg, value)
+            yield from select_hart_0()
             cycle_count += yield from single_step()
+    if case.harts == 1:
+        yield from select_hart_0()
     yield
 
     yield phase.eq(TestPhase.CHECK)
+    notes = []
+    if latency is not None:
+        notes.append(f"interrupt latency: {latency} cycles")
+    if retired:
+        notes.append(f"{case.harts} harts retired {retired} instructions, "
+                     f"{cycle_count / retired:.2f} cycles each")
     try:
         for key, value in after.items():
             if isinstance(key, int):
@@ -210,7 +406,7 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
                     assert actual == value, \
                             f"r{key} should be 0x{value:08x} but is 0x{actual:08x}"
                 else:
-                    print(f"r{key} (unconstrained) is 0x{actual:x}")
+                    notes.append(f"r{key} (unconstrained) is 0x{actual:x}")
             elif isinstance(key, str) and key[0] == '@':
                 addr = int(key[1:], 16)
                 actual = yield from read_mem(addr)
@@ -222,6 +418,25 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
                         f"PC should be 0x{value:x} but is 0x{actual:x}"
             else:
                 raise Exception(f"unexpected after key: {key}")
+        if case.corrupt is not None:
+            yield from drain_trace()
+            reg = case.corrupt[1]
+            assert any(f"x{reg} should hold" in p
+                       for d in divergences for p in d.problems), \
+                    f"cosim didn't notice x{reg} changing behind its back"
+        # An RDCYCLE reads the counter at the same point in every run of it,
+        # so two of them should be as far apart as the instructions after
+        # them started.
+        for ((pc_a, reg_a), (pc_b, reg_b)) in zip(case.rdcycle,
+                                                  case.rdcycle[1:]):
+            counted = first_seen[pc_b + 4] - first_seen[pc_a + 4]
+            read = ((yield from read_reg(reg_b))
+                    - (yield from read_reg(reg_a))) & 0xFFFF_FFFF
+            assert read == counted, \
+                    f"RDCYCLEs at 0x{pc_a:x} and 0x{pc_b:x} read {read} " \
+                    f"cycles apart, but took {counted}"
+        if case.harts > 1:
+            return TestResult(name, True, cycle_count, None, notes)
         for r in range(1, 32):
             if r not in after:
                 if r in before:
@@ -233,604 +448,1370 @@ def test_inst(name, inst, *, before = {}, after = {}, stop_after = None):
                     f"r{r} should not have changed but is now 0x{actual:x}"
         if 'PC' not in after:
             actual = yield from read_pc()
-            value = start_address + instruction_count * 4
+            value = end_address
             assert actual == value, \
                     f"PC should be 0x{value:x} but is 0x{actual:x}"
-
-
-
-
-    except Exception as e:
-        raise Exception(f"test case {name} failed due to above exception") from e
-
-    print(f"({cycle_count} cyc) PASS")
-
-parser = argparse.ArgumentParser(
-    prog = "sim-cpu",
-    description = "Test bench for 16-bit model",
-)
-parser.add_argument('-f', '--filter', help = 'Filter string for instruction tests', required = False)
-parser.add_argument('-t', '--trace', help = 'Print instruction trace', required = False, action = 'store_true')
-args = parser.parse_args()
-
-if __name__ == "__main__":
-    m = Module()
-    m.submodules.uut = uut = Cpu(counters = True)
-    m.submodules.mem = mem = TestMemory([
-        0b00000000000000000000_00000_1101111, # JAL x0, .
-    ])
-    m.submodules.mem2 = mem2 = TestMemory([
-        0b00000000000000000000_00000_1101111, # JAL x0, .
-    ])
-
-    phase = Signal(TestPhase)
-    cycle_counter = Signal(32)
-    m.d.sync += cycle_counter.eq(cycle_counter + 1)
-
-    m.submodules.bus = fabric = SimpleFabric([
-        partial_decode(m, mem.bus, 31),
-    ])
-
-    connect(m, uut.bus, fabric.bus)
-
-    ports = [
-        phase,
-        uut.halt_request,
-        uut.halted,
-        uut.s.onehot_state,
-        uut.ew.full,
-        uut.rf.read_cmd.valid,
-        uut.rf.read_cmd.payload,
-        uut.rf.write_cmd.valid,
-        uut.rf.write_cmd.payload.reg,
-        uut.rf.write_cmd.payload.value,
-        uut.bus.cmd.valid,
-        uut.bus.cmd.payload.addr,
-        uut.bus.cmd.payload.data,
-        uut.bus.cmd.payload.lanes,
-        uut.bus.resp,
+    except AssertionError as e:
+        return TestResult(name, False, cycle_count, str(e), notes)
+
+    return TestResult(name, True, cycle_count, None, notes)
+
+def build_cases():
+    cases = []
+    cases.append(TestCase(
+        "LUI x1, 0xAAAAA000",
+        0b10101010101010101010_00001_0110111,
+        after={
+            1: 0xAAAAA000,
+            'PC': 4,
+        },
+    ))
+
+    cases.append(TestCase(
+        "AUIPC x1, 0xAAAAA000",
+        0b10101010101010101010_00001_0010111,
+        before={
+            'PC': 0xCAFC,
+        },
+        after={
+            1: (0xAAAAA000 + 0xCAFC) & 0xFFFFFFFF,
+            'PC': 0xCAFC + 4,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JAL x9, .",
+        0b00000000000000000000_01001_1101111,
+        after={
+            9: 4,
+            'PC': 0,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JAL x9, -4",
+        0b1_1111111110_1_11111111_01001_1101111,
+        before={
+            'PC': 12,
+        },
+        after={
+            9: 16,
+            'PC': 8,
+        },
+    ))
+
+    cases.append(TestCase(
+        "JALR x1, x9, 0x456",
+        0b010001010110_01001_000_00001_1100111,
+        before={
+            9: 0xCAFE,
+        },
+        after={
+            9: 0xCAFE,
+            1: 4,
+            'PC': 0xCAFE + 0x456,
+        },
+    ))
+
+    branch_cases = [
+        ("EQ", 0b000, 0xCAFEBABE, 0xCAFEBABE, True),
+        ("EQ", 0b000, 0xCAFEBABE, 0xBAADF00D, False),
+        ("NE", 0b001, 0xCAFEBABE, 0xBAADF00D, True),
+        ("NE", 0b001, 0xCAFEBABE, 0xCAFEBABE, False),
+        ("LT", 0b100, 0xCAFEBABE, 0x12345678, True),
+        ("LT", 0b100, 0x12345678, 0xCAFEBABE, False),
+        ("LT", 0b100, 0, 0xA, True),
+        ("LT", 0b100, 0xA, 0, False),
+        ("GE", 0b101, 0x12345678, 0xCAFEBABE, True),
+        ("GE", 0b101, 0xCAFEBABE, 0x12345678, False),
+        ("LTU", 0b110, 0x12345678, 0xCAFEBABE, True),
+        ("LTU", 0b110, 0xCAFEBABE, 0x12345678, False),
+        ("GEU", 0b111, 0xCAFEBABE, 0x12345678, True),
+        ("GEU", 0b111, 0x12345678, 0xCAFEBABE, False),
     ]
 
-    verilog_src = verilog.convert(m, ports=ports)
-    with open("sim-cpu.v", "w") as v:
-        v.write(verilog_src)
-
-    started = False
-    stopping = False
+    for name, opc, x1, x2, taken in branch_cases:
+        desc = f"B{name} x1, x2, 0x400"
+        if not taken:
+            desc += " (not taken)"
 
-    sim = Simulator(m)
-    sim.add_clock(1e-6)
-
-    def process():
-        global stopping
-        global started
-        yield from halt()
-        started = True
-        yield from test_inst(
-            "LUI x1, 0xAAAAA000",
-            0b10101010101010101010_00001_0110111,
-            after={
-                1: 0xAAAAA000,
-                'PC': 4,
-            },
-        )
-
-        yield from test_inst(
-            "AUIPC x1, 0xAAAAA000",
-            0b10101010101010101010_00001_0010111,
+        cases.append(TestCase(
+            desc,
+            0b0_100000_00010_00001_000_0000_0_1100011 | (opc << 12),
             before={
-                'PC': 0xCAFC,
-            },
-            after={
-                1: (0xAAAAA000 + 0xCAFC) & 0xFFFFFFFF,
-                'PC': 0xCAFC + 4,
-            },
-        )
-
-        yield from test_inst(
-            "JAL x9, .",
-            0b00000000000000000000_01001_1101111,
-            after={
-                9: 4,
-                'PC': 0,
-            },
-        )
-
-        yield from test_inst(
-            "JAL x9, -4",
-            0b1_1111111110_1_11111111_01001_1101111,
-            before={
-                'PC': 12,
+                'PC': 0xF000,
+                1: x1,
+                2: x2,
             },
             after={
-                9: 16,
-                'PC': 8,
+                'PC': 0xF000 + (0x400 if taken else 4),
             },
-        )
-
-        yield from test_inst(
-            "JALR x1, x9, 0x456",
-            0b010001010110_01001_000_00001_1100111,
+        ))
+    cases.append(TestCase(
+        "blez x2, 0x400",
+        0b0_100000_00010_00000_101_0000_0_1100011,
+        before={
+            'PC': 0xF000,
+            2: 0xA,
+        },
+        after={
+            'PC': 0xF004,
+        },
+    ))
+
+    load_cases = [
+        ("LW", 0b010, 0x12345678, 0, 0x12345678),
+
+        ("LH", 0b001, 0x12345678, 0, 0x5678),
+        ("LH", 0b001, 0x12345678, 2, 0x1234),
+        ("LH", 0b001, 0x92B4D6F8, 0, 0xFFFF_D6F8),
+        ("LH", 0b001, 0x92B4D6F8, 2, 0xFFFF_92B4),
+
+        ("LHU", 0b101, 0x92B4D6F8, 0, 0xD6F8),
+        ("LHU", 0b101, 0x92B4D6F8, 2, 0x92B4),
+
+        ("LB", 0b000, 0x12345678, 0, 0x78),
+        ("LB", 0b000, 0x12345678, 1, 0x56),
+        ("LB", 0b000, 0x12345678, 2, 0x34),
+        ("LB", 0b000, 0x12345678, 3, 0x12),
+        ("LB", 0b000, 0x92B4D6F8, 0, 0xFFFF_FFF8),
+        ("LB", 0b000, 0x92B4D6F8, 1, 0xFFFF_FFD6),
+        ("LB", 0b000, 0x92B4D6F8, 2, 0xFFFF_FFB4),
+        ("LB", 0b000, 0x92B4D6F8, 3, 0xFFFF_FF92),
+
+        ("LBU", 0b100, 0x92B4D6F8, 0, 0xF8),
+        ("LBU", 0b100, 0x92B4D6F8, 1, 0xD6),
+        ("LBU", 0b100, 0x92B4D6F8, 2, 0xB4),
+        ("LBU", 0b100, 0x92B4D6F8, 3, 0x92),
+    ]
+    for mnem, opc, memword, off, reg in load_cases:
+        desc = f"{mnem} x1, 0xAC(x2)"
+        if off != 0:
+            desc += f" (with x2={off})"
+
+        cases.append(TestCase(
+            desc,
+            0b000010101100_00010_000_00001_0000011 | (opc << 12),
             before={
-                9: 0xCAFE,
+                1: 0xBAADF00D,
+                2: off,
+                '@AC': memword,
             },
             after={
-                9: 0xCAFE,
-                1: 4,
-                'PC': 0xCAFE + 0x456,
+                1: reg,
+                2: off,
+                '@AC': memword,
+                'PC': 4,
             },
-        )
+        ))
 
-        branch_cases = [
-            ("EQ", 0b000, 0xCAFEBABE, 0xCAFEBABE, True),
-            ("EQ", 0b000, 0xCAFEBABE, 0xBAADF00D, False),
-            ("NE", 0b001, 0xCAFEBABE, 0xBAADF00D, True),
-            ("NE", 0b001, 0xCAFEBABE, 0xCAFEBABE, False),
-            ("LT", 0b100, 0xCAFEBABE, 0x12345678, True),
-            ("LT", 0b100, 0x12345678, 0xCAFEBABE, False),
-            ("LT", 0b100, 0, 0xA, True),
-            ("LT", 0b100, 0xA, 0, False),
-            ("GE", 0b101, 0x12345678, 0xCAFEBABE, True),
-            ("GE", 0b101, 0xCAFEBABE, 0x12345678, False),
-            ("LTU", 0b110, 0x12345678, 0xCAFEBABE, True),
-            ("LTU", 0b110, 0xCAFEBABE, 0x12345678, False),
-            ("GEU", 0b111, 0xCAFEBABE, 0x12345678, True),
-            ("GEU", 0b111, 0x12345678, 0xCAFEBABE, False),
-        ]
+    store_cases = [
+        ("SW", 0b010, 0xDEADBEEF, 0x12345678, 0, 0x12345678),
 
-        for name, opc, x1, x2, taken in branch_cases:
-            desc = f"B{name} x1, x2, 0x400"
-            if not taken:
-                desc += " (not taken)"
-
-            yield from test_inst(
-                desc,
-                0b0_100000_00010_00001_000_0000_0_1100011 | (opc << 12),
-                before={
-                    'PC': 0xF000,
-                    1: x1,
-                    2: x2,
-                },
-                after={
-                    'PC': 0xF000 + (0x400 if taken else 4),
-                },
-            )
-        yield from test_inst(
-            "blez x2, 0x400",
-            0b0_100000_00010_00000_101_0000_0_1100011,
-            before={
-                'PC': 0xF000,
-                2: 0xA,
-            },
-            after={
-                'PC': 0xF004,
-            },
-        )
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 0, 0xDEADBE78),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 1, 0xDEAD78EF),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 2, 0xDE78BEEF),
+        ("SB", 0b000, 0xDEADBEEF, 0x12345678, 3, 0x78ADBEEF),
 
-        load_cases = [
-            ("LW", 0b010, 0x12345678, 0, 0x12345678),
-
-            ("LH", 0b001, 0x12345678, 0, 0x5678),
-            ("LH", 0b001, 0x12345678, 2, 0x1234),
-            ("LH", 0b001, 0x92B4D6F8, 0, 0xFFFF_D6F8),
-            ("LH", 0b001, 0x92B4D6F8, 2, 0xFFFF_92B4),
-
-            ("LHU", 0b101, 0x92B4D6F8, 0, 0xD6F8),
-            ("LHU", 0b101, 0x92B4D6F8, 2, 0x92B4),
-
-            ("LB", 0b000, 0x12345678, 0, 0x78),
-            ("LB", 0b000, 0x12345678, 1, 0x56),
-            ("LB", 0b000, 0x12345678, 2, 0x34),
-            ("LB", 0b000, 0x12345678, 3, 0x12),
-            ("LB", 0b000, 0x92B4D6F8, 0, 0xFFFF_FFF8),
-            ("LB", 0b000, 0x92B4D6F8, 1, 0xFFFF_FFD6),
-            ("LB", 0b000, 0x92B4D6F8, 2, 0xFFFF_FFB4),
-            ("LB", 0b000, 0x92B4D6F8, 3, 0xFFFF_FF92),
-
-            ("LBU", 0b100, 0x92B4D6F8, 0, 0xF8),
-            ("LBU", 0b100, 0x92B4D6F8, 1, 0xD6),
-            ("LBU", 0b100, 0x92B4D6F8, 2, 0xB4),
-            ("LBU", 0b100, 0x92B4D6F8, 3, 0x92),
-        ]
-        for mnem, opc, memword, off, reg in load_cases:
-            desc = f"{mnem} x1, 0xAC(x2)"
-            if off != 0:
-                desc += f" (with x2={off})"
-
-            yield from test_inst(
-                desc,
-                0b000010101100_00010_000_00001_0000011 | (opc << 12),
-                before={
-                    1: 0xBAADF00D,
-                    2: off,
-                    '@AC': memword,
-                },
-                after={
-                    1: reg,
-                    2: off,
-                    '@AC': memword,
-                    'PC': 4,
-                },
-            )
-
-        store_cases = [
-            ("SW", 0b010, 0xDEADBEEF, 0x12345678, 0, 0x12345678),
-
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 0, 0xDEADBE78),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 1, 0xDEAD78EF),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 2, 0xDE78BEEF),
-            ("SB", 0b000, 0xDEADBEEF, 0x12345678, 3, 0x78ADBEEF),
-
-            ("SH", 0b001, 0xDEADBEEF, 0x12345678, 0, 0xDEAD5678),
-            ("SH", 0b001, 0xDEADBEEF, 0x12345678, 2, 0x5678BEEF),
-        ]
-        for mnem, opc, prevmem, write, off, expected in store_cases:
-            desc = f"{mnem} x1, 0xAC(x2)"
-            if off != 0:
-                desc += f" (with x2={off})"
-
-            yield from test_inst(
-                desc,
-                0b0000101_00001_00010_000_01100_0100011 | (opc << 12),
-                before={
-                    1: write,
-                    2: off,
-                    '@AC': prevmem,
-                },
-                after={
-                    1: write,
-                    2: off,
-                    '@AC': expected,
-                    'PC': 4,
-                },
-            )
-
-        yield from test_inst(
-            "SW x15, -168(x26)",
-            0xf4fd2c23, # from a failing program
+        ("SH", 0b001, 0xDEADBEEF, 0x12345678, 0, 0xDEAD5678),
+        ("SH", 0b001, 0xDEADBEEF, 0x12345678, 2, 0x5678BEEF),
+    ]
+    for mnem, opc, prevmem, write, off, expected in store_cases:
+        desc = f"{mnem} x1, 0xAC(x2)"
+        if off != 0:
+            desc += f" (with x2={off})"
+
+        cases.append(TestCase(
+            desc,
+            0b0000101_00001_00010_000_01100_0100011 | (opc << 12),
             before={
-                15: 0x12345678,
-                26: 0x4000,
-                '@3f58': 0xDEADBEEF,
+                1: write,
+                2: off,
+                '@AC': prevmem,
             },
             after={
-                '@3f58': 0x12345678,
+                1: write,
+                2: off,
+                '@AC': expected,
                 'PC': 4,
             },
-        )
-
-        yield from test_inst(
-            "ADD x1, x2, x3",
-            0b0000000_00011_00010_000_00001_0110011,
-            before={
-                2: 0xCAFEBABE,
-                3: 0xBAADF00D,
-            },
-            after={
-                1: (0xCAFEBABE + 0xBAADF00D) & 0xFFFFFFFF,
-            },
-        )
-        yield from test_inst(
-            "OR x1, x2, x3",
-            0b0000000_00011_00010_110_00001_0110011,
+        ))
+
+    cases.append(TestCase(
+        "SW x15, -168(x26)",
+        0xf4fd2c23, # from a failing program
+        before={
+            15: 0x12345678,
+            26: 0x4000,
+            '@3f58': 0xDEADBEEF,
+        },
+        after={
+            '@3f58': 0x12345678,
+            'PC': 4,
+        },
+    ))
+
+    cases.append(TestCase(
+        "ADD x1, x2, x3",
+        0b0000000_00011_00010_000_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: (0xCAFEBABE + 0xBAADF00D) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "OR x1, x2, x3",
+        0b0000000_00011_00010_110_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: 0xCAFEBABE | 0xBAADF00D,
+        },
+    ))
+
+    cases.append(TestCase(
+        "AND x1, x2, x3",
+        0b0000000_00011_00010_111_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: 0xCAFEBABE & 0xBAADF00D,
+        },
+    ))
+
+    cases.append(TestCase(
+        "ADDI x1, x2, 0x123",
+        0b000100100011_00010_000_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: (0xCAFEBABE + 0x123) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "ADDI x1, x2, -0x123",
+        0b111011011101_00010_000_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: (0xCAFEBABE + -0x123) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "SUB x1, x2, x3",
+        0b0100000_00011_00010_000_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0xBAADF00D,
+        },
+        after={
+            1: (0xCAFEBABE - 0xBAADF00D) & 0xFFFFFFFF,
+        },
+    ))
+    cases.append(TestCase(
+        "XORI x1, x2, 0x123",
+        0b000100100011_00010_100_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE ^ 0x123,
+        },
+    ))
+    cases.append(TestCase(
+        "ORI x1, x2, 0x123",
+        0b000100100011_00010_110_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE | 0x123,
+        },
+    ))
+    cases.append(TestCase(
+        "ANDI x1, x2, 0x123",
+        0b000100100011_00010_111_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0xCAFEBABE & 0x123,
+        },
+    ))
+
+    cases.append(TestCase(
+        "SLT x1, x2, x3 (where x2 < x3)",
+        0b0000000_00011_00010_010_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0x12345678,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLT x1, x2, x3 (where x2 >= x3)",
+        0b0000000_00011_00010_010_00001_0110011,
+        before={
+            2: 0x12345678,
+            3: 0xCAFEBABE,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTU x1, x2, x3 (where x2 < x3)",
+        0b0000000_00011_00010_011_00001_0110011,
+        before={
+            2: 0x12345678,
+            3: 0xCAFEBABE,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTU x1, x2, x3 (where x2 >= x3)",
+        0b0000000_00011_00010_011_00001_0110011,
+        before={
+            2: 0xCAFEBABE,
+            3: 0x12345678,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTI x1, x2, 0x123 (where x2 < 0x123)",
+        0b001100100001_00010_010_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTI x1, x2, 0x123 (where x2 >= 0x123)",
+        0b001100100001_00010_010_00001_0010011,
+        before={
+            2: 0x12345678,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTIU x1, x2, 0x123 (where x2 < 0x123)",
+        0b001100100001_00010_011_00001_0010011,
+        before={
+            2: 0x42,
+        },
+        after={
+            1: 1,
+        },
+    ))
+    cases.append(TestCase(
+        "SLTIU x1, x2, 0x123 (where x2 >= 0x123)",
+        0b001100100001_00010_011_00001_0010011,
+        before={
+            2: 0xCAFEBABE,
+        },
+        after={
+            1: 0,
+        },
+    ))
+    for amt in [1, 0, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SLL x1, x2, x3 (with x3={amt})",
+            0b0000000_00011_00010_001_00001_0110011,
             before={
                 2: 0xCAFEBABE,
-                3: 0xBAADF00D,
+                3: amt,
             },
             after={
-                1: 0xCAFEBABE | 0xBAADF00D,
+                1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
             },
-        )
+        ))
 
-        yield from test_inst(
-            "AND x1, x2, x3",
-            0b0000000_00011_00010_111_00001_0110011,
+    for amt in [0, 1, 5, 31]:
+        cases.append(TestCase(
+            f"SLLI x1, x2, {amt}",
+            0b0000000_00000_00010_001_00001_0010011 | amt << 20,
             before={
                 2: 0xCAFEBABE,
-                3: 0xBAADF00D,
             },
             after={
-                1: 0xCAFEBABE & 0xBAADF00D,
+                1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
             },
-        )
+        ))
 
-        yield from test_inst(
-            "ADDI x1, x2, 0x123",
-            0b000100100011_00010_000_00001_0010011,
+    for amt in [0, 1, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SRL x1, x2, x3 (with x3={amt})",
+            0b0000000_00011_00010_101_00001_0110011,
             before={
                 2: 0xCAFEBABE,
+                3: amt,
             },
             after={
-                1: (0xCAFEBABE + 0x123) & 0xFFFFFFFF,
+                1: 0xCAFEBABE >> (amt & 0x1F),
             },
-        )
-        yield from test_inst(
-            "ADDI x1, x2, -0x123",
-            0b111011011101_00010_000_00001_0010011,
+        ))
+
+    for amt in [0, 1, 5, 31, 32]:
+        cases.append(TestCase(
+            f"SRLI x1, x2, {amt}",
+            0b0000000_00000_00010_101_00001_0010011 | ((amt & 0x1F) << 20),
             before={
                 2: 0xCAFEBABE,
             },
             after={
-                1: (0xCAFEBABE + -0x123) & 0xFFFFFFFF,
+                1: 0xCAFEBABE >> (amt & 0x1F),
             },
-        )
-        yield from test_inst(
-            "SUB x1, x2, x3",
-            0b0100000_00011_00010_000_00001_0110011,
+        ))
+
+    for x2 in [0xCAFEBABE, 0xF00D]: # one negative, one positive
+        for amt in [0, 1, 5, 31, 32]:
+            if x2 & 0x80000000 == 0:
+                result = x2 >> (amt & 0x1F)
+            else:
+                result = ((0xFFFFFFFF_00000000 | x2) >> (amt & 0x1F)) & 0xFFFFFFFF
+            cases.append(TestCase(
+                f"SRA x1, x2, x3 (with x2=0x{x2:x}, x3={amt})",
+                0b0100000_00011_00010_101_00001_0110011,
+                before={
+                    2: x2,
+                    3: amt,
+                },
+                after={
+                    1: result,
+                },
+            ))
+
+    muldiv_cases = [
+        ("MUL", 0b000, 0xCAFEBABE, 0xBAADF00D, 0x5C679BA6),
+        ("MUL", 0b000, 0x00000007, 0x00000006, 0x0000002A),
+        ("MULH", 0b001, 0xCAFEBABE, 0xBAADF00D, 0x0E5A5560),
+        ("MULH", 0b001, 0xCAFEBABE, 0x12345678, 0xFC3B12F8),
+        ("MULH", 0b001, 0x80000000, 0x80000000, 0x40000000),
+        ("MULHSU", 0b010, 0xCAFEBABE, 0xBAADF00D, 0xD959101E),
+        ("MULHSU", 0b010, 0x12345678, 0xBAADF00D, 0x0D466543),
+        ("MULHU", 0b011, 0xCAFEBABE, 0xBAADF00D, 0x9407002B),
+
+        ("DIV", 0b100, 0xCAFEBABE, 0x00001234, 0xFFFD1691),
+        ("DIV", 0b100, 0xFFFFFC18, 0x00000007, 0xFFFFFF72),
+        ("DIV", 0b100, 0x000003E8, 0xFFFFFFF9, 0xFFFFFF72),
+        ("DIV", 0b100, 0xCAFEBABE, 0xFFFFFFF9, 0x0792779B),
+        ("DIV", 0b100, 0xCAFEBABE, 0x00000000, 0xFFFFFFFF), # by zero
+        ("DIV", 0b100, 0x80000000, 0xFFFFFFFF, 0x80000000), # overflow
+        ("DIVU", 0b101, 0xCAFEBABE, 0x00001234, 0x000B26D3),
+        ("DIVU", 0b101, 0xCAFEBABE, 0x00000000, 0xFFFFFFFF),
+
+        ("REM", 0b110, 0xFFFFFC18, 0x00000007, 0xFFFFFFFA),
+        ("REM", 0b110, 0x000003E8, 0xFFFFFFF9, 0x00000006),
+        ("REM", 0b110, 0xCAFEBABE, 0xFFFFFFF9, 0xFFFFFFFB),
+        ("REM", 0b110, 0xCAFEBABE, 0x00000000, 0xCAFEBABE),
+        ("REM", 0b110, 0x80000000, 0xFFFFFFFF, 0x00000000),
+        ("REMU", 0b111, 0xCAFEBABE, 0x00001234, 0x000001E2),
+        ("REMU", 0b111, 0x00000005, 0xFFFFFFFF, 0x00000005),
+        ("REMU", 0b111, 0xCAFEBABE, 0x00000000, 0xCAFEBABE),
+    ]
+    for mnem, funct3, x2, x3, result in muldiv_cases:
+        cases.append(TestCase(
+            f"{mnem} x1, x2, x3 (with x2=0x{x2:x}, x3=0x{x3:x})",
+            0b0000001_00011_00010_000_00001_0110011 | (funct3 << 12),
             before={
-                2: 0xCAFEBABE,
-                3: 0xBAADF00D,
+                2: x2,
+                3: x3,
             },
             after={
-                1: (0xCAFEBABE - 0xBAADF00D) & 0xFFFFFFFF,
+                1: result,
             },
-        )
-        yield from test_inst(
-            "XORI x1, x2, 0x123",
-            0b000100100011_00010_100_00001_0010011,
+            muldiv = True,
+        ))
+
+    cases.append(TestCase(
+        f"div test",
+        [
+# 8968/0      00058613                mv      a2,a1
+            0x00058613,
+# 896c/4      00050593                mv      a1,a0
+            0x00050593,
+# 8970/8      fff00513                li      a0,-1
+            0xfff00513,
+# 8974/c      02060c63                beqz    a2,89ac <__hidden___udivsi3+0x44>
+            0x02060c63,
+# 8978/10     00100693                li      a3,1
+            0x00100693,
+# 897c/14     00b67a63                bgeu    a2,a1,8990 <__hidden___udivsi3+0x28>
+            0x00b67a63,
+# 8980/18     00c05863                blez    a2,8990 <__hidden___udivsi3+0x28>
+            0x00c05863,
+# 8984/1c     00161613                slli    a2,a2,0x1
+            0x00161613,
+# 8988/20     00169693                slli    a3,a3,0x1
+            0x00169693,
+# 898c/24     feb66ae3                bltu    a2,a1,8980 <__hidden___udivsi3+0x18>
+            0xfeb66ae3,
+# 8990/28     00000513                li      a0,0
+            0x00000513,
+# 8994/2c     00c5e663                bltu    a1,a2,89a0 <__hidden___udivsi3+0x38>
+            0x00c5e663,
+# 8998/30     40c585b3                sub     a1,a1,a2
+            0x40c585b3,
+# 899c/34     00d56533                or      a0,a0,a3
+            0x00d56533,
+# 89a0/38     0016d693                srli    a3,a3,0x1
+            0x0016d693,
+# 89a4/3c     00165613                srli    a2,a2,0x1
+            0x00165613,
+# 89a8/40     fe0696e3                bnez    a3,8994 <__hidden___udivsi3+0x2c>
+            0xfe0696e3,
+# 89ac/44     00008067                ret
+            0x00008067,
+        ],
+        stop_after = 0x44,
+        before={
+            1: 0x1230,
+            10: 100_000,
+            11: 10,
+        },
+        after={
+            10: 10_000,
+            11: 0,
+            12: 5, # empirically
+            13: 0, # empirically
+            'PC': 0x1230,
+        },
+    ))
+    cases.append(TestCase(
+        f"jump chain",
+        [
+# 0       008000ef                jal     ra,8
+            0x008000ef,
+# 4       00100293                li      t0,1
+            0x00100293,
+# 8       00700313                li      t1,7
+            0x00700313,
+# c       0080006f                j       14
+            0x0080006f,
+# 10      00200293                li      t0,2
+            0x00200293,
+# 14      008003ef                jal     t2,1c
+            0x008003ef,
+# 18      00300293                li      t0,3
+            0x00300293,
+# 1c      00300413                li      s0,3
+            0x00300413,
+        ],
+        stop_after = 0x1c,
+        before={
+            5: 0,
+        },
+        after={
+            1: 4,
+            5: 0,
+            6: 7,
+            7: 0x18,
+            8: 3,
+            'PC': 0x20,
+        },
+    ))
+    cases.append(TestCase(
+        f"rdcycle x1",
+        0b1100_0000_0000_00000_011_00001_1110011,
+        after={
+            1: None,
+        },
+    ))
+    cases.append(TestCase(
+        f"rdinstret x1",
+        0b1100_0000_0010_00000_011_00001_1110011,
+        after={
+            1: None,
+        },
+    ))
+    # The cycle counter counts every cycle, including the ones spent waiting
+    # for memory; run with --wait-states to make that interesting.
+    cases.append(TestCase(
+        f"rdcycle across loads and stores",
+        [
+# 0       c00020f3                rdcycle ra
+            0xc00020f3,
+# 4       10002283                lw      t0,256(zero)
+            0x10002283,
+# 8       10502223                sw      t0,260(zero)
+            0x10502223,
+# c       10205303                lhu     t1,258(zero)
+            0x10205303,
+# 10      c0002173                rdcycle sp
+            0xc0002173,
+# 14      401101b3                sub     gp,sp,ra
+            0x401101b3,
+        ],
+        stop_after = 0x14,
+        rdcycle = [(0x0, 1), (0x10, 2)],
+        before={
+            '@100': 0x12345678,
+        },
+        after={
+            1: None,
+            2: None,
+            3: None,
+            5: 0x12345678,
+            6: 0x1234,
+            '@104': 0x12345678,
+        },
+    ))
+    cases.append(TestCase(
+        "C.LI x10, 5",
+        0x4515,
+        after={
+            10: 5,
+            'PC': 2,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.ADDI x10, -1",
+        0x157d,
+        before={
+            10: 5,
+        },
+        after={
+            10: 4,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.ADDI4SPN x8, x2, 16",
+        0x0800,
+        before={
+            2: 0x1000,
+        },
+        after={
+            8: 0x1010,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.ADDI16SP x2, -32",
+        0x713d,
+        before={
+            2: 0x1000,
+        },
+        after={
+            2: 0x0FE0,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.LUI x10, 0xFFFEA000",
+        0x7529,
+        after={
+            10: 0xFFFEA000,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.LW x11, 4(x10)",
+        0x414c,
+        before={
+            10: 0xA8,
+            '@AC': 0x12345678,
+        },
+        after={
+            11: 0x12345678,
+            '@AC': 0x12345678,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.SW x11, 4(x10)",
+        0xc14c,
+        before={
+            10: 0xA8,
+            11: 0x12345678,
+            '@AC': 0xDEADBEEF,
+        },
+        after={
+            '@AC': 0x12345678,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.LWSP x11, 8(x2)",
+        0x45a2,
+        before={
+            2: 0xA4,
+            '@AC': 0x12345678,
+        },
+        after={
+            11: 0x12345678,
+            '@AC': 0x12345678,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.SWSP x11, 8(x2)",
+        0xc42e,
+        before={
+            2: 0xA4,
+            11: 0x12345678,
+            '@AC': 0xDEADBEEF,
+        },
+        after={
+            '@AC': 0x12345678,
+        },
+        compressed = True,
+    ))
+
+    compressed_alu_cases = [
+        ("C.MV", 0x852e, 0xBAADF00D),
+        ("C.ADD", 0x952e, (0xCAFEBABE + 0xBAADF00D) & 0xFFFFFFFF),
+        ("C.SUB", 0x8d0d, (0xCAFEBABE - 0xBAADF00D) & 0xFFFFFFFF),
+        ("C.XOR", 0x8d2d, 0xCAFEBABE ^ 0xBAADF00D),
+        ("C.OR", 0x8d4d, 0xCAFEBABE | 0xBAADF00D),
+        ("C.AND", 0x8d6d, 0xCAFEBABE & 0xBAADF00D),
+    ]
+    for mnem, inst, result in compressed_alu_cases:
+        cases.append(TestCase(
+            f"{mnem} x10, x11",
+            inst,
             before={
-                2: 0xCAFEBABE,
+                10: 0xCAFEBABE,
+                11: 0xBAADF00D,
             },
             after={
-                1: 0xCAFEBABE ^ 0x123,
+                10: result,
             },
-        )
-        yield from test_inst(
-            "ORI x1, x2, 0x123",
-            0b000100100011_00010_110_00001_0010011,
+            compressed = True,
+        ))
+
+    compressed_imm_cases = [
+        ("C.SRLI x10, 4", 0x8111, 0x0CAFEBAB),
+        ("C.SRAI x10, 4", 0x8511, 0xFCAFEBAB),
+        ("C.ANDI x10, -16", 0x9941, 0xCAFEBAB0),
+        ("C.SLLI x10, 4", 0x0512, 0xAFEBABE0),
+    ]
+    for name, inst, result in compressed_imm_cases:
+        cases.append(TestCase(
+            name,
+            inst,
             before={
-                2: 0xCAFEBABE,
+                10: 0xCAFEBABE,
             },
             after={
-                1: 0xCAFEBABE | 0x123,
+                10: result,
             },
-        )
-        yield from test_inst(
-            "ANDI x1, x2, 0x123",
-            0b000100100011_00010_111_00001_0010011,
+            compressed = True,
+        ))
+
+    cases.append(TestCase(
+        "C.J 0x20",
+        0xa005,
+        before={
+            'PC': 0x100,
+        },
+        after={
+            'PC': 0x120,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.JAL 0x20",
+        0x2005,
+        before={
+            'PC': 0x100,
+        },
+        after={
+            1: 0x102,
+            'PC': 0x120,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.JR x10",
+        0x8502,
+        before={
+            10: 0x4002,
+        },
+        after={
+            'PC': 0x4002,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        "C.JALR x10",
+        0x9502,
+        before={
+            'PC': 0x100,
+            10: 0x4002,
+        },
+        after={
+            1: 0x102,
+            'PC': 0x4002,
+        },
+        compressed = True,
+    ))
+    for name, inst, x10, taken in [
+        ("C.BEQZ", 0xc105, 0, True),
+        ("C.BEQZ", 0xc105, 0xCAFEBABE, False),
+        ("C.BNEZ", 0xe105, 0xCAFEBABE, True),
+        ("C.BNEZ", 0xe105, 0, False),
+    ]:
+        desc = f"{name} x10, 0x20"
+        if not taken:
+            desc += " (not taken)"
+        cases.append(TestCase(
+            desc,
+            inst,
             before={
-                2: 0xCAFEBABE,
+                'PC': 0xF000,
+                10: x10,
             },
             after={
-                1: 0xCAFEBABE & 0x123,
-            },
-        )
-
-        yield from test_inst(
-            "SLT x1, x2, x3 (where x2 < x3)",
-            0b0000000_00011_00010_010_00001_0110011,
-            before={
-                2: 0xCAFEBABE,
-                3: 0x12345678,
+                'PC': 0xF000 + (0x20 if taken else 2),
             },
+            compressed = True,
+        ))
+    cases.append(TestCase(
+        "ADDI x1, x2, 0x123 (straddling a word)",
+        0b000100100011_00010_000_00001_0010011,
+        before={
+            'PC': 2,
+            2: 0x1000,
+        },
+        after={
+            1: 0x1123,
+            'PC': 6,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        f"compressed mix",
+        [
+# 0       4515                    c.li    a0,5
+            0x4515,
+# 2       12350593                addi    a1,a0,291
+            0x12350593,
+# 6       952e                    c.add   a0,a1
+            0x952e,
+# 8       006000ef                jal     ra,e
+            0x006000ef,
+# c       4501                    c.li    a0,0
+            0x4501,
+# e       00700613                addi    a2,zero,7
+            0x00700613,
+# 12      e211                    c.bnez  a2,16
+            0xe211,
+# 14      4601                    c.li    a2,0
+            0x4601,
+# 16      8686                    c.mv    a3,ra
+            0x8686,
+# 18      a001                    c.j     18
+            0xa001,
+        ],
+        stop_after = 0x18,
+        after={
+            1: 0xC,
+            10: 0x12D,
+            11: 0x128,
+            12: 7,
+            13: 0xC,
+            'PC': 0x18,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        f"compressed load/store then straddle",
+        [
+# 0       c14c                    c.sw    a1,4(a0)
+            0xc14c,
+# 2       00700613                addi    a2,zero,7
+            0x00700613,
+# 6       0001                    c.nop
+            0x0001,
+# 8       414c                    c.lw    a1,4(a0)
+            0x414c,
+# a       00160713                addi    a4,a2,1
+            0x00160713,
+# e       a001                    c.j     e
+            0xa001,
+        ],
+        stop_after = 0xe,
+        before={
+            10: 0xA8,
+            11: 0x12345678,
+            '@AC': 0xDEADBEEF,
+        },
+        after={
+            11: 0x12345678,
+            12: 7,
+            14: 8,
+            '@AC': 0x12345678,
+            'PC': 0xe,
+        },
+        compressed = True,
+    ))
+    cases.append(TestCase(
+        f"compressed loop",
+        [
+# 0       450d                    c.li    a0,3
+            0x450d,
+# 2       0585                    c.addi  a1,1
+            0x0585,
+# 4       157d                    c.addi  a0,-1
+            0x157d,
+# 6       fd75                    c.bnez  a0,2
+            0xfd75,
+# 8       a001                    c.j     8
+            0xa001,
+        ],
+        stop_after = 0x8,
+        before={
+            11: 0,
+        },
+        after={
+            10: 0,
+            11: 3,
+            'PC': 0x8,
+        },
+        compressed = True,
+    ))
+
+    # Interrupt tests. The handlers for lines 0 and 1 each write a value to
+    # a register and store it to their acknowledgement address, which drops
+    # the line, before returning. With banked interrupts, the register they
+    # write is in the other bank, so it's left alone in the one we check.
+    handlers = {
+# 180     0200006f                j       1a0 <h0>
+        '@180': 0x0200006f,
+# 184     03c0006f                j       1c0 <h1>
+        '@184': 0x03c0006f,
+# 1a0     05500293                li      t0,85
+        '@1A0': 0x05500293,
+# 1a4     1e502823                sw      t0,496(zero)
+        '@1A4': 0x1e502823,
+# 1a8     30200073                mret
+        '@1A8': 0x30200073,
+# 1c0     06600313                li      t1,102
+        '@1C0': 0x06600313,
+# 1c4     1e602a23                sw      t1,500(zero)
+        '@1C4': 0x1e602a23,
+# 1c8     30200073                mret
+        '@1C8': 0x30200073,
+        '@1F0': 0,
+        '@1F4': 0,
+    }
+    main = [
+# 0       30046073                csrsi   mstatus,8
+        0x30046073,
+# 4       00100093                li      ra,1
+        0x00100093,
+# 8       00200113                li      sp,2
+        0x00200113,
+# c       00300193                li      gp,3
+        0x00300193,
+# 10      00400213                li      tp,4
+        0x00400213,
+# 14      0000006f                j       14
+        0x0000006f,
+    ]
+    for banked in [False, True]:
+        suffix = " (banked)" if banked else ""
+        cases.append(TestCase(
+            f"interrupt on line 0{suffix}",
+            main,
+            stop_after = 0x14,
+            before = handlers,
             after={
                 1: 1,
+                2: 2,
+                3: 3,
+                4: 4,
+                **({} if banked else {5: 0x55}),
+                '@1F0': 0x55,
+                '@1F4': 0,
+                'PC': 0x14,
             },
-        )
-        yield from test_inst(
-            "SLT x1, x2, x3 (where x2 >= x3)",
-            0b0000000_00011_00010_010_00001_0110011,
-            before={
-                2: 0x12345678,
-                3: 0xCAFEBABE,
-            },
-            after={
-                1: 0,
-            },
-        )
-        yield from test_inst(
-            "SLTU x1, x2, x3 (where x2 < x3)",
-            0b0000000_00011_00010_011_00001_0110011,
-            before={
-                2: 0x12345678,
-                3: 0xCAFEBABE,
-            },
+            interrupts = True,
+            banked = banked,
+            irq = [(0, 9)],
+        ))
+        cases.append(TestCase(
+            f"interrupts on lines 0 and 1 at once{suffix}",
+            main,
+            stop_after = 0x14,
+            before = handlers,
             after={
                 1: 1,
+                2: 2,
+                3: 3,
+                4: 4,
+                **({} if banked else {5: 0x55, 6: 0x66}),
+                '@1F0': 0x55,
+                '@1F4': 0x66,
+                'PC': 0x14,
             },
-        )
-        yield from test_inst(
-            "SLTU x1, x2, x3 (where x2 >= x3)",
-            0b0000000_00011_00010_011_00001_0110011,
-            before={
-                2: 0xCAFEBABE,
-                3: 0x12345678,
-            },
-            after={
-                1: 0,
-            },
-        )
-        yield from test_inst(
-            "SLTI x1, x2, 0x123 (where x2 < 0x123)",
-            0b001100100001_00010_010_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
+            interrupts = True,
+            banked = banked,
+            irq = [(0, 8), (1, 8)],
+        ))
+        cases.append(TestCase(
+            f"interrupt during SLLI x1, x2, 31{suffix}",
+            [
+# 0       30046073                csrsi   mstatus,8
+                0x30046073,
+# 4       01f11093                slli    ra,sp,0x1f
+                0x01f11093,
+# 8       0000006f                j       8
+                0x0000006f,
+            ],
+            stop_after = 0x8,
+            before = {
+                **handlers,
+                2: 1,
             },
             after={
-                1: 1,
+                1: 0x80000000,
+                **({} if banked else {5: 0x55}),
+                '@1F0': 0x55,
+                'PC': 0x8,
             },
-        )
-        yield from test_inst(
-            "SLTI x1, x2, 0x123 (where x2 >= 0x123)",
-            0b001100100001_00010_010_00001_0010011,
-            before={
-                2: 0x12345678,
+            interrupts = True,
+            banked = banked,
+            irq = [(0, 12)],
+        ))
+    cases.append(TestCase(
+        f"interrupt held off by csrci",
+        [
+# 0       30046073                csrsi   mstatus,8
+            0x30046073,
+# 4       30047073                csrci   mstatus,8
+            0x30047073,
+# 8       00a00193                li      gp,10
+            0x00a00193,
+# c       fff18193                addi    gp,gp,-1
+            0xfff18193,
+# 10      fe019ee3                bnez    gp,c
+            0xfe019ee3,
+# 14      00300193                li      gp,3
+            0x00300193,
+# 18      30046073                csrsi   mstatus,8
+            0x30046073,
+# 1c      00400213                li      tp,4
+            0x00400213,
+# 20      0000006f                j       20
+            0x0000006f,
+        ],
+        stop_after = 0x20,
+        before = {
+            **handlers,
+# 1a0     1e302823                sw      gp,496(zero)
+            '@1A0': 0x1e302823,
+# 1a4     30200073                mret
+            '@1A4': 0x30200073,
+        },
+        after={
+            3: 3,
+            4: 4,
+            # The handler ran after gp was set.
+            '@1F0': 3,
+            'PC': 0x20,
+        },
+        interrupts = True,
+        banked = False,
+        # The countdown loop keeps MIE clear for long enough that the request
+        # lands inside it, however slow the memory is.
+        irq = [(0, 40)],
+    ))
+
+    # A check on the checker: x1 changes between the two instructions without
+    # the CPU writing it, so the second one reads a value that cosim should
+    # know is wrong.
+    cases.append(TestCase(
+        "cosim catches a corrupted register read",
+        [
+# 0       00500093                li      ra,5
+            0x00500093,
+# 4       00008113                mv      sp,ra
+            0x00008113,
+        ],
+        after = {
+            1: 7,
+            2: 7,
+        },
+        corrupt = (1, 1, 7),
+    ))
+
+    # Barrel-threading tests, for two and four harts. Each hart works out
+    # where to store its results from its hart ID.
+    for harts in [2, 4]:
+        cases.append(TestCase(
+            f"{harts} harts read mhartid",
+            [
+# 0       f1402573                csrr    a0,mhartid
+                0xf1402573,
+# 4       00251593                slli    a1,a0,0x2
+                0x00251593,
+# 8       01050613                addi    a2,a0,16
+                0x01050613,
+# c       10c5a023                sw      a2,256(a1)
+                0x10c5a023,
+# 10      0000006f                j       10
+                0x0000006f,
+            ],
+            stop_after = 0x10,
+            before = {
+                f"@{0x100 + 4 * h:X}": 0 for h in range(harts)
             },
-            after={
-                1: 0,
+            after = {
+                f"@{0x100 + 4 * h:X}": 0x10 + h for h in range(harts)
             },
-        )
-        yield from test_inst(
-            "SLTIU x1, x2, 0x123 (where x2 < 0x123)",
-            0b001100100001_00010_011_00001_0010011,
-            before={
-                2: 0x42,
+            harts = harts,
+        ))
+        cases.append(TestCase(
+            f"{harts} harts loop different numbers of times",
+            [
+# 0       f1402573                csrr    a0,mhartid
+                0xf1402573,
+# 4       00150593                addi    a1,a0,1
+                0x00150593,
+# 8       00000613                li      a2,0
+                0x00000613,
+# c       00360613                addi    a2,a2,3
+                0x00360613,
+# 10      fff58593                addi    a1,a1,-1
+                0xfff58593,
+# 14      fe059ce3                bnez    a1,c
+                0xfe059ce3,
+# 18      00251693                slli    a3,a0,0x2
+                0x00251693,
+# 1c      10c6a023                sw      a2,256(a3)
+                0x10c6a023,
+# 20      0000006f                j       20
+                0x0000006f,
+            ],
+            stop_after = 0x20,
+            before = {
+                f"@{0x100 + 4 * h:X}": 0 for h in range(harts)
             },
-            after={
-                1: 1,
+            after = {
+                f"@{0x100 + 4 * h:X}": 3 * (h + 1) for h in range(harts)
             },
-        )
-        yield from test_inst(
-            "SLTIU x1, x2, 0x123 (where x2 >= 0x123)",
-            0b001100100001_00010_011_00001_0010011,
-            before={
-                2: 0xCAFEBABE,
+            harts = harts,
+        ))
+        cases.append(TestCase(
+            f"{harts} harts call a function that loads",
+            [
+# 0       f1402573                csrr    a0,mhartid
+                0xf1402573,
+# 4       00c000ef                jal     10 <f>
+                0x00c000ef,
+# 8       10b6a023                sw      a1,256(a3)
+                0x10b6a023,
+# c       0000006f                j       c
+                0x0000006f,
+# 10      00251693                slli    a3,a0,0x2
+                0x00251693,
+# 14      1206a583                lw      a1,288(a3)
+                0x1206a583,
+# 18      00158593                addi    a1,a1,1
+                0x00158593,
+# 1c      00008067                ret
+                0x00008067,
+            ],
+            stop_after = 0xc,
+            before = {
+                **{f"@{0x100 + 4 * h:X}": 0 for h in range(harts)},
+                **{f"@{0x120 + 4 * h:X}": 0x1000 * (h + 1)
+                   for h in range(harts)},
             },
-            after={
-                1: 0,
+            after = {
+                f"@{0x100 + 4 * h:X}": 0x1000 * (h + 1) + 1
+                for h in range(harts)
             },
-        )
-        for amt in [1, 0, 5, 31, 32]:
-            yield from test_inst(
-                f"SLL x1, x2, x3 (with x3={amt})",
-                0b0000000_00011_00010_001_00001_0110011,
-                before={
-                    2: 0xCAFEBABE,
-                    3: amt,
-                },
-                after={
-                    1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
-                },
-            )
+            harts = harts,
+        ))
+
+    #cases.append(TestCase(
+    #    f"CSRRS x1, mstatus, x3(=0xFF) / read back",
+    #    [
+    #        0b0011_0000_0000_00011_010_00001_1110011,
+    #        0b0011_0000_0000_00000_010_00010_1110011,
+    #    ],
+    #    before={
+    #        3: 0xFF,
+    #    },
+    #    after={
+    #        1: 0,
+    #        2: 0b1000_1000,
+    #    },
+    #))
+
+    return cases
+
+CASES = build_cases()
+
+# Where interrupt handlers go in the test memory: the vector table, and the
+# addresses that acknowledge each line (see build_design).
+IRQ_VECTOR = 0x180
+IRQ_ACK = 0x1F0
+
+def build_design():
+    global uut, mem, mem2, phase, cycle_counter, irq_raise, cpu_reset
+    m = Module()
+    uut = Cpu(
+        counters = True,
+        shift_bits_per_cycle = args.shift_bits,
+        early_jal = args.early_jal,
+        predict_branches = args.predict_branches,
+        wait_states = args.wait_states > 0,
+        icache_halfwords = args.icache,
+        rf_read_ports = args.rf_read_ports,
+        skip_rs2_reads = args.skip_rs2_reads,
+        muldiv = args.muldiv,
+        multiplier = args.multiplier,
+        compressed = args.compressed,
+        interrupts = 2 if args.interrupts else 0,
+        interrupt_vector = IRQ_VECTOR,
+        banked_interrupts = args.banked_interrupts,
+        harts = args.harts,
+    )
+    # Test cases for several harts reset the CPU to start them; see test_inst.
+    cpu_reset = Signal(1, name = "cpu_reset")
+    if args.harts > 1:
+        m.submodules.uut = ResetInserter(cpu_reset)(uut)
+    else:
+        m.submodules.uut = uut
+    m.submodules.mem = mem = TestMemory([
+        0b00000000000000000000_00000_1101111, # JAL x0, .
+    ])
+    m.submodules.mem2 = mem2 = TestMemory([
+        0b00000000000000000000_00000_1101111, # JAL x0, .
+    ])
 
-        for amt in [0, 1, 5, 31]:
-            yield from test_inst(
-                f"SLLI x1, x2, {amt}",
-                0b0000000_00000_00010_001_00001_0010011 | amt << 20,
-                before={
-                    2: 0xCAFEBABE,
-                },
-                after={
-                    1: (0xCAFEBABE << (amt & 0x1F)) & 0xFFFFFFFF,
-                },
-            )
+    phase = Signal(TestPhase, name = "phase")
+    cycle_counter = Signal(32, name = "cycle_counter")
+    m.d.sync += cycle_counter.eq(cycle_counter + 1)
 
-        for amt in [0, 1, 5, 31, 32]:
-            yield from test_inst(
-                f"SRL x1, x2, x3 (with x3={amt})",
-                0b0000000_00011_00010_101_00001_0110011,
-                before={
-                    2: 0xCAFEBABE,
-                    3: amt,
-                },
-                after={
-                    1: 0xCAFEBABE >> (amt & 0x1F),
-                },
-            )
+    m.submodules.bus = fabric = SimpleFabric([
+        partial_decode(
+            m,
+            add_wait_states(m, mem.bus, args.wait_states)
+                if args.wait_states > 0 else mem.bus,
+            31,
+        ),
+    ])
 
-        for amt in [0, 1, 5, 31, 32]:
-            yield from test_inst(
-                f"SRLI x1, x2, {amt}",
-                0b0000000_00000_00010_101_00001_0010011 | ((amt & 0x1F) << 20),
-                before={
-                    2: 0xCAFEBABE,
-                },
-                after={
-                    1: 0xCAFEBABE >> (amt & 0x1F),
-                },
-            )
+    connect(m, uut.bus, fabric.bus)
 
-        for x2 in [0xCAFEBABE, 0xF00D]: # one negative, one positive
-            for amt in [0, 1, 5, 31, 32]:
-                if x2 & 0x80000000 == 0:
-                    result = x2 >> (amt & 0x1F)
-                else:
-                    result = ((0xFFFFFFFF_00000000 | x2) >> (amt & 0x1F)) & 0xFFFFFFFF
-                yield from test_inst(
-                    f"SRA x1, x2, x3 (with x2=0x{x2:x}, x3={amt})",
-                    0b0100000_00011_00010_101_00001_0110011,
-                    before={
-                        2: x2,
-                        3: amt,
-                    },
-                    after={
-                        1: result,
-                    },
-                )
-
-        yield from test_inst(
-            f"div test",
-            [
-    # 8968/0      00058613                mv      a2,a1
-                0x00058613,
-    # 896c/4      00050593                mv      a1,a0
-                0x00050593,
-    # 8970/8      fff00513                li      a0,-1
-                0xfff00513,
-    # 8974/c      02060c63                beqz    a2,89ac <__hidden___udivsi3+0x44>
-                0x02060c63,
-    # 8978/10     00100693                li      a3,1
-                0x00100693,
-    # 897c/14     00b67a63                bgeu    a2,a1,8990 <__hidden___udivsi3+0x28>
-                0x00b67a63,
-    # 8980/18     00c05863                blez    a2,8990 <__hidden___udivsi3+0x28>
-                0x00c05863,
-    # 8984/1c     00161613                slli    a2,a2,0x1
-                0x00161613,
-    # 8988/20     00169693                slli    a3,a3,0x1
-                0x00169693,
-    # 898c/24     feb66ae3                bltu    a2,a1,8980 <__hidden___udivsi3+0x18>
-                0xfeb66ae3,
-    # 8990/28     00000513                li      a0,0
-                0x00000513,
-    # 8994/2c     00c5e663                bltu    a1,a2,89a0 <__hidden___udivsi3+0x38>
-                0x00c5e663,
-    # 8998/30     40c585b3                sub     a1,a1,a2
-                0x40c585b3,
-    # 899c/34     00d56533                or      a0,a0,a3
-                0x00d56533,
-    # 89a0/38     0016d693                srli    a3,a3,0x1
-                0x0016d693,
-    # 89a4/3c     00165613                srli    a2,a2,0x1
-                0x00165613,
-    # 89a8/40     fe0696e3                bnez    a3,8994 <__hidden___udivsi3+0x2c>
-                0xfe0696e3,
-    # 89ac/44     00008067                ret
-                0x00008067,
-            ],
-            stop_after = 0x44,
-            before={
-                1: 0x1230,
-                10: 100_000,
-                11: 10,
-            },
-            after={
-                10: 10_000,
-                11: 0,
-                12: 5, # empirically
-                13: 0, # empirically
-                'PC': 0x1230,
-            },
-        )
-        yield from test_inst(
-            f"rdcycle x1",
-            0b1100_0000_0000_00000_011_00001_1110011,
-            after={
-                1: None,
-            },
-        )
-        yield from test_inst(
-            f"rdinstret x1",
-            0b1100_0000_0010_00000_011_00001_1110011,
-            after={
-                1: None,
-            },
+    # A stand-in for an interrupting device: the test raises lines with
+    # irq_raise, and they stay up until the CPU stores to their
+    # acknowledgement addresses (which also store to memory, as usual), or
+    # the next test starts.
+    irq_raise = Signal(2, name = "irq_raise")
+    if args.interrupts:
+        irq_lines = Signal(2, name = "irq_lines")
+        acks = Cat(*(
+            uut.bus.cmd.valid & uut.bus.cmd.payload.lanes.any()
+                & (uut.bus.cmd.payload.addr == (IRQ_ACK + 4 * line) >> 1)
+            for line in range(2)
+        ))
+        with m.If(phase == TestPhase.SETUP):
+            m.d.sync += irq_lines.eq(0)
+        with m.Else():
+            m.d.sync += irq_lines.eq((irq_lines | irq_raise) & ~acks)
+        m.d.comb += uut.irq.eq(irq_lines)
+
+    ports = [
+        phase,
+        uut.halt_request,
+        uut.halted,
+        uut.s.onehot_state,
+        uut.ew.full,
+        uut.rf.read_cmd.valid,
+        uut.rf.read_cmd.payload,
+        uut.rf.write_cmd.valid,
+        uut.rf.write_cmd.payload.reg,
+        uut.rf.write_cmd.payload.value,
+        uut.bus.cmd.valid,
+        uut.bus.cmd.payload.addr,
+        uut.bus.cmd.payload.data,
+        uut.bus.cmd.payload.lanes,
+        uut.bus.resp,
+    ]
+
+    return m, fabric, ports
+
+def run_shard(shard, indices, options):
+    """Runs the cases with the given indices into CASES in a fresh simulator,
+    returning a list of (index, TestResult)."""
+    global args, checker, divergences, started, stopping, current_case
+    args = options
+    m, fabric, ports = build_design()
+    checker = RvfiChecker(
+        muldiv = args.muldiv,
+        compressed = args.compressed,
+        interrupts = args.interrupts,
+        banked_interrupts = args.banked_interrupts,
+        harts = args.harts,
+    ) if args.cosim else None
+    # Divergences during a case that expects them (see TestCase), or None.
+    divergences = None
+
+    started = False
+    stopping = False
+    current_case = None
+    results = []
+
+    trigger = Trigger(
+        pcs = args.capture_pc,
+        orders = args.capture_order,
+        tests = args.capture_test,
+        cycles = args.capture_cycles,
+    )
+    if trigger or args.capture_failures:
+        capture = WindowedCapture(
+            ports + [cycle_counter],
+            trigger = trigger,
+            depth = args.capture_depth,
+            rvfi = uut.rvfi,
+            test_name = lambda: current_case,
         )
-        #yield from test_inst(
-        #    f"CSRRS x1, mstatus, x3(=0xFF) / read back",
-        #    [
-        #        0b0011_0000_0000_00011_010_00001_1110011,
-        #        0b0011_0000_0000_00000_010_00010_1110011,
-        #    ],
-        #    before={
-        #        3: 0xFF,
-        #    },
-        #    after={
-        #        1: 0,
-        #        2: 0b1000_1000,
-        #    },
-        #)
+    else:
+        capture = None
 
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+
+    def process():
+        global stopping
+        global started
+        global current_case
+        yield from halt()
+        yield from drain_trace()
+        started = True
+        for i in indices:
+            current_case = CASES[i].name
+            result = yield from test_inst(CASES[i])
+            results.append((i, result))
+            if not result.passed and args.capture_failures:
+                capture.fire()
+        current_case = None
         yield
         yield
         yield
@@ -894,8 +1875,149 @@ if __name__ == "__main__":
 
                 print(msg)
 
-        
     if args.trace:
         sim.add_sync_process(rvfi_tracer)
-    with sim.write_vcd(vcd_file="test.vcd", gtkw_file="test.gtkw", traces=ports):
-        sim.run()
+    if checker is not None:
+        def on_divergence(e):
+            if divergences is None:
+                raise e
+            divergences.append(e)
+        sim.add_sync_process(rvfi_checker_process(
+            uut.rvfi,
+            checker,
+            running = lambda: not stopping,
+            on_divergence = on_divergence,
+        ))
+
+    if capture is not None:
+        sim.add_sync_process(capture.process(running = lambda: not stopping))
+
+    if args.jobs == 1:
+        suffix = ""
+    else:
+        suffix = f"-{shard}"
+    try:
+        if args.vcd:
+            with sim.write_vcd(vcd_file=f"test{suffix}.vcd",
+                               gtkw_file=f"test{suffix}.gtkw", traces=ports):
+                sim.run()
+        else:
+            sim.run()
+    except Exception as e:
+        # Something went wrong badly enough to stop the simulation (e.g. the
+        # CPU wouldn't halt). Charge it to the case that was running, and
+        # report the rest of the shard as not run.
+        done = len(results)
+        if done < len(indices):
+            results.append((indices[done], TestResult(
+                CASES[indices[done]].name, False, 0, f"{type(e).__name__}: {e}",
+            )))
+        for i in indices[done + 1:]:
+            results.append((i, TestResult(
+                CASES[i].name, False, 0, "not run, simulation stopped early",
+            )))
+        if capture is not None and args.capture_failures:
+            capture.snapshot()
+
+    if capture is not None:
+        windows = capture.write_vcd(f"capture{suffix}.vcd")
+        if windows:
+            print(f"captured {windows} window(s) to capture{suffix}.vcd")
+
+    checked = checker.checked if checker is not None else None
+    return results, checked
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "sim-cpu",
+        description = "Test bench for 16-bit model",
+    )
+    parser.add_argument('-f', '--filter', help = 'Filter string for instruction tests', required = False)
+    parser.add_argument('-t', '--trace', help = 'Print instruction trace', required = False, action = 'store_true')
+    parser.add_argument('-c', '--cosim', help = 'Check every retired instruction against the Python model', required = False, action = 'store_true')
+    parser.add_argument('--frontdoor', help = 'Set up and check registers and memory through the debug and inspect ports instead of the simulation backdoor', required = False, action = 'store_true')
+    parser.add_argument('-j', '--jobs', help = 'Number of simulators to run in parallel (default: one per CPU)', required = False, type = int, default = os.cpu_count())
+    parser.add_argument('--shift-bits', help = 'Bits the shifter moves per cycle: 1, 2, 4, 8 or 16 (default: 1)', required = False, type = int, choices = [1, 2, 4, 8, 16], default = 1)
+    parser.add_argument('--early-jal', help = 'Configure the CPU to redirect fetch for JAL in the FD-Box', required = False, action = 'store_true')
+    parser.add_argument('--predict-branches', help = 'Configure the CPU to predict backward branches taken', required = False, action = 'store_true')
+    parser.add_argument('--wait-states', help = 'Make the test memory insert this many wait states per access (default: 0)', required = False, type = int, default = 0)
+    parser.add_argument('--icache', help = 'Give the CPU an instruction cache of this many halfwords (default: 0, none)', required = False, type = int, default = 0)
+    parser.add_argument('--rf-read-ports', help = 'Give the register file this many read ports: 1 or 2 (default: 1)', required = False, type = int, choices = [1, 2], default = 1)
+    parser.add_argument('--skip-rs2-reads', help = 'Configure the CPU to run instructions that don\'t need rs2 early on the short schedule', required = False, action = 'store_true')
+    parser.add_argument('--muldiv', help = 'Give the CPU the M extension, and run its tests', required = False, action = 'store_true')
+    parser.add_argument('--multiplier', help = 'Multiplier for the M extension: serial or lut (default: serial)', required = False, choices = ['serial', 'lut'], default = 'serial')
+    parser.add_argument('--compressed', help = 'Give the CPU the C extension, and run its tests', required = False, action = 'store_true')
+    parser.add_argument('--interrupts', help = 'Give the CPU two interrupt lines, and run their tests', required = False, action = 'store_true')
+    parser.add_argument('--banked-interrupts', help = 'Give interrupt handlers their own register bank (implies --interrupts)', required = False, action = 'store_true')
+    parser.add_argument('--harts', help = 'Give the CPU this many barrel-threaded harts, and also run the tests written for that many (default: 1)', required = False, type = int, default = 1)
+    parser.add_argument('--vcd', help = 'Write a waveform of the entire run to test.vcd (slow)', required = False, action = 'store_true')
+    parser.add_argument('--capture-pc', help = 'Capture waveforms around retirement of the instruction at this PC (repeatable)', required = False, type = lambda s: int(s, 0), action = 'append', default = [])
+    parser.add_argument('--capture-order', help = 'Capture waveforms while RVFI order is in the range N, A:B or A:', required = False, type = parse_range)
+    parser.add_argument('--capture-test', help = 'Capture waveforms for test cases whose names contain this string (repeatable)', required = False, action = 'append', default = [])
+    parser.add_argument('--capture-cycles', help = 'Capture waveforms for simulation cycles in the range N, A:B or A:', required = False, type = parse_range)
+    parser.add_argument('--capture-failures', help = 'Capture waveforms leading up to each failing test', required = False, action = 'store_true')
+    parser.add_argument('--capture-depth', help = 'Cycles of lead-up to keep before a capture trigger (default: 64)', required = False, type = int, default = 64)
+    parser.add_argument('--bench', help = 'Write the cycle count of each passing test to this JSON file', required = False)
+    parser.add_argument('--baseline', help = 'Compare cycle counts against this JSON file (e.g. bench/sim-cpu.json) and fail if any got slower', required = False)
+    args = parser.parse_args()
+    args.interrupts |= args.banked_interrupts
+
+    indices = [
+        i for i, case in enumerate(CASES)
+        if (args.filter is None or args.filter in case.name)
+        and (args.muldiv or not case.muldiv)
+        and (args.cosim or case.corrupt is None)
+        and (args.compressed or not case.compressed)
+        and (args.interrupts or not case.interrupts)
+        and case.banked in (None, args.banked_interrupts)
+        and case.harts in (1, args.harts)
+    ]
+    if args.trace:
+        # Traces from several simulators at once would be unreadable.
+        args.jobs = 1
+    args.jobs = max(1, min(args.jobs, len(indices)))
+
+    m, fabric, ports = build_design()
+    verilog_src = verilog.convert(m, ports=ports)
+    with open("sim-cpu.v", "w") as v:
+        v.write(verilog_src)
+
+    # Deal the cases out round-robin, so that the slow ones near the end of the
+    # table don't all land in the same shard.
+    shards = [indices[n::args.jobs] for n in range(args.jobs)]
+    if args.jobs == 1:
+        outcomes = [run_shard(0, shards[0], args)]
+    else:
+        with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+            outcomes = list(pool.map(
+                run_shard,
+                range(args.jobs),
+                shards,
+                [args] * args.jobs,
+            ))
+
+    results = sorted((r for outcome, _ in outcomes for r in outcome),
+                     key = lambda r: r[0])
+    failures = 0
+    for _, result in results:
+        print(result.report())
+        if not result.passed:
+            failures += 1
+
+    if args.cosim:
+        checked = sum(c for _, c in outcomes)
+        print(f"cosim: {checked} retired instructions matched the model")
+    print(f"{len(results) - failures} passed, {failures} failed")
+
+    keys = hapenny.bench.case_keys([case.name for case in CASES])
+    cycles = {
+        keys[i]: result.cycles for i, result in results if result.passed
+    }
+    if args.bench is not None:
+        hapenny.bench.save(args.bench, "hapenny", cycles)
+    if args.baseline is not None:
+        if not hapenny.bench.check(args.baseline, "hapenny", cycles):
+            failures += 1
+
+    if failures:
+        sys.exit(1)
@@ -0,0 +1,137 @@
+import argparse
+import json
+import re
+import runpy
+import sys
+import time
+from pathlib import Path
+
+from hapenny.cxxrtl import Simulation
+from hapenny.serial import SimUart
+
+# Runs Dhrystone (or any other program built for the same memory map) on the
+# upduino-large SoC in a compiled CXXRTL simulation, without a board.
+#
+# The SoC is the one upduino-large.py builds -- CPU, SPRAM (simulated by a
+# generic memory), boot memory, GPIO -- except that the UART is replaced by a
+# SimUart, which hands us each byte as it's written instead of shifting it out
+# at 115200 baud. Rather than feeding the image through the bootloader, we
+# write it straight into SPRAM and replace the bootloader with a jump to it.
+#
+# The run stops when the program prints DONE (as dhrystone/start.S does after
+# main returns). We then report the CPU's own cycle and instret counters, plus
+# the numbers Dhrystone printed, if any:
+#
+#     make -C dhrystone
+#     python sim-dhrystone.py dhrystone/dhry.bin --json dhry.json
+
+BOOT_ADDRESS = 0x8000
+SPRAM = "bulkmem0 U$0"
+BOOTMEM = "bootmem U$0"
+
+parser = argparse.ArgumentParser(
+    prog = "sim-dhrystone",
+    description = "Run Dhrystone on a simulated upduino-large SoC",
+)
+parser.add_argument('image', help = 'raw binary to run (e.g. dhrystone/dhry.bin)')
+parser.add_argument('--load-addr', type = lambda s: int(s, 0), default = 0,
+                    help = 'address to load and start the image at')
+parser.add_argument('--max-cycles', type = int, default = 100_000_000,
+                    help = 'give up after this many cycles')
+parser.add_argument('--until', default = 'DONE',
+                    help = 'stop when the program prints this')
+parser.add_argument('--json', metavar = 'FILE',
+                    help = 'write the results to FILE as JSON')
+parser.add_argument('--muldiv', action = 'store_true',
+                    help = 'give the CPU the M extension')
+parser.add_argument('--compressed', action = 'store_true',
+                    help = 'give the CPU the C extension (build the image '
+                           'with MARCH=rv32ic or rv32imc)')
+args = parser.parse_args()
+
+image = Path(args.image).read_bytes()
+if args.load_addr % 4 or args.load_addr + len(image) > 0x8000:
+    sys.exit(f"image doesn't fit in SPRAM at {args.load_addr:#x}")
+
+board = runpy.run_path("upduino-large.py", run_name = "sim_dhrystone_board")
+design = board["Test"](
+    uart = SimUart(),
+    muldiv = args.muldiv,
+    compressed = args.compressed,
+)
+
+start = time.time()
+sim = Simulation(design)
+print(f"model ready in {time.time() - start:.1f} s", file = sys.stderr)
+
+sim.load_image(SPRAM, image, args.load_addr // 2)
+
+# JAL x0, (load_addr - BOOT_ADDRESS)
+offset = (args.load_addr - BOOT_ADDRESS) & 0x1F_FFFF
+jal = (
+    ((offset >> 20) & 1) << 31
+    | ((offset >> 1) & 0x3FF) << 21
+    | ((offset >> 11) & 1) << 20
+    | ((offset >> 12) & 0xFF) << 12
+    | 0b1101111
+)
+sim.load_memory(BOOTMEM, [jal & 0xFFFF, jal >> 16])
+
+sim.trace_writes("uart tx_valid", "uart tx_data")
+sim.reset()
+
+until = args.until.encode()
+start = time.time()
+output = b""
+while sim.cycle < args.max_cycles:
+    # Short runs so that we stop (and read the counters) soon after the
+    # program finishes.
+    chunk = sim.run(min(10_000, args.max_cycles - sim.cycle))
+    sys.stdout.write(chunk.decode("latin-1"))
+    sys.stdout.flush()
+    output += chunk
+    if until in output:
+        break
+elapsed = time.time() - start
+finished = until in output
+
+cycles = sim["cpu cycle_counter"]
+instret = sim["cpu ew instret_counter"]
+results = {
+    "finished": finished,
+    "cycles": cycles,
+    "instret": instret,
+    "cpi": cycles / instret if instret else None,
+}
+
+# Dhrystone's own measurement covers just the benchmark loop, which makes it
+# the more interesting CPI.
+text = output.decode("latin-1")
+match = re.search(r"User_Time: (\d+) cycles, (\d+) insn", text)
+if match:
+    results["dhrystone_cycles"] = int(match.group(1))
+    results["dhrystone_insns"] = int(match.group(2))
+    results["dhrystone_cpi"] = int(match.group(1)) / int(match.group(2))
+match = re.search(r"DMIPS_Per_MHz: ([\d.]+)", text)
+if match:
+    results["dmips_per_mhz"] = float(match.group(1))
+
+print(file = sys.stderr)
+if not finished:
+    print(f"did not print {args.until} within {args.max_cycles} cycles",
+          file = sys.stderr)
+print(f"simulated {sim.cycle} cycles in {elapsed:.1f} s", file = sys.stderr)
+print(f"instructions retired: {instret}")
+print(f"cycles: {cycles}")
+if instret:
+    print(f"CPI: {cycles / instret:.3f}")
+if "dhrystone_cpi" in results:
+    print(f"Dhrystone CPI: {results['dhrystone_cpi']:.3f}")
+
+if args.json is not None:
+    with open(args.json, "w") as f:
+        json.dump(results, f, indent = 1)
+        f.write("\n")
+
+if not finished:
+    sys.exit(1)
@@ -0,0 +1,255 @@
+import argparse
+import random
+import sys
+
+from amaranth import *
+from amaranth.lib.wiring import *
+from amaranth.sim import Simulator, Settle
+
+from hapenny.bus import SimpleFabric
+from hapenny.cpu import Cpu
+from hapenny.mem import BasicMemory, SpiFlashMemory
+
+# Checks SpiFlashMemory against a model of a 25-series SPI NOR flash: first
+# by reading it straight off its bus (sequentially, at random, and round and
+# round a loop), with and without its cache, and then by running a program
+# out of it on a CPU.
+#
+# The model only knows RELEASE POWER-DOWN (0xAB) and FAST READ (0x0B), starts
+# out powered down, and complains about anything else.
+
+# The window into the flash that the tests use: 2 kiB, 1 MiB in, as if past
+# a bitstream.
+ADDR_BITS = 10
+OFFSET = 0x10_0000
+
+class FlashModel:
+    """Answers FAST READs out of 'contents', a dict of byte address to
+    byte; anywhere else reads as 0xFF. Its process drives flash_cipo, until
+    'running()' returns False, and raises an exception if the flash is used
+    wrongly."""
+    def __init__(self, flash, contents):
+        self.flash = flash
+        self.contents = contents
+
+    def byte(self, addr):
+        return self.contents.get(addr & 0xFF_FFFF, 0xFF)
+
+    def process(self, running):
+        flash = self.flash
+        def process():
+            awake = False
+            clk = 0
+            # Rising clock edges since the flash was selected, and the bits
+            # they brought in (up to the end of the address).
+            rises = 0
+            shift_in = 0
+            while running():
+                yield
+                yield Settle()
+                new_clk = yield flash.flash_clk
+                if not (yield flash.flash_cs):
+                    if rises == 8 and shift_in == 0xAB:
+                        awake = True
+                    rises = 0
+                    shift_in = 0
+                elif new_clk and not clk:
+                    # The flash takes in our bit on the rising edge.
+                    if rises < 32:
+                        shift_in = (shift_in << 1) | (yield flash.flash_copi)
+                    rises += 1
+                    if rises == 8:
+                        if shift_in not in (0xAB, 0x0B):
+                            raise Exception(
+                                f"unknown command 0x{shift_in:02x}")
+                        if shift_in == 0x0B and not awake:
+                            raise Exception("read while powered down")
+                elif clk and not new_clk and rises >= 40:
+                    # After the dummy byte, it puts out a bit of data after
+                    # each falling edge, carrying on into the following bytes
+                    # for as long as we keep clocking.
+                    n = rises - 40
+                    byte = self.byte((shift_in & 0xFF_FFFF) + n // 8)
+                    yield flash.flash_cipo.eq((byte >> (7 - n % 8)) & 1)
+                clk = new_clk
+        return process
+
+def make_contents():
+    rng = random.Random(0xF1A5)
+    return {
+        OFFSET + i: rng.randrange(256) for i in range(2 << ADDR_BITS)
+    }
+
+def expected(contents, addr):
+    a = OFFSET + 2 * addr
+    return contents[a] | (contents[a + 1] << 8)
+
+def bus_read(bus, addr):
+    """Reads a halfword off 'bus', returning it and the cycles it took."""
+    yield bus.cmd.payload.addr.eq(addr)
+    yield bus.cmd.payload.lanes.eq(0)
+    yield bus.cmd.valid.eq(1)
+    cycles = 0
+    while True:
+        yield Settle()
+        ready = yield bus.cmd.ready
+        yield
+        cycles += 1
+        if ready:
+            break
+    yield bus.cmd.valid.eq(0)
+    yield Settle()
+    return ((yield bus.resp), cycles)
+
+def run_reads(addrs, cache_lines):
+    contents = make_contents()
+    m = Module()
+    m.submodules.flash = flash = SpiFlashMemory(
+        addr_bits = ADDR_BITS,
+        offset = OFFSET,
+        cache_lines = cache_lines,
+    )
+    model = FlashModel(flash, contents)
+    result = {}
+
+    def process():
+        total = 0
+        for addr in addrs:
+            (value, cycles) = yield from bus_read(flash.bus, addr)
+            total += cycles
+            if value != expected(contents, addr):
+                result["error"] = (f"halfword 0x{addr:x} should be "
+                                   f"0x{expected(contents, addr):04x} but "
+                                   f"is 0x{value:04x}")
+                break
+        result["cycles"] = total
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(model.process(
+        running = lambda: "cycles" not in result,
+    ))
+    sim.add_sync_process(process)
+    sim.run()
+    return result
+
+# Sums ten words from RAM, adding three to each before storing it back, with
+# the loop running out of flash.
+PROGRAM = [
+# 800     00000513                li      a0,0
+    0x00000513,
+# 804     00a00593                li      a1,10
+    0x00a00593,
+# 808     10002283                lw      t0,256(zero)
+    0x10002283,
+# 80c     00550533                add     a0,a0,t0
+    0x00550533,
+# 810     00328293                addi    t0,t0,3
+    0x00328293,
+# 814     10502023                sw      t0,256(zero)
+    0x10502023,
+# 818     fff58593                addi    a1,a1,-1
+    0xfff58593,
+# 81c     fe0596e3                bnez    a1,808
+    0xfe0596e3,
+# 820     10a02223                sw      a0,260(zero)
+    0x10a02223,
+# 824     0000006f                j       824
+    0x0000006f,
+]
+FLASH_BASE = 0x800
+STOP_AT = 0x824
+
+def run_program(cache_lines, max_cycles):
+    contents = {}
+    for (i, word) in enumerate(PROGRAM):
+        for b in range(4):
+            contents[OFFSET + 4 * i + b] = (word >> (8 * b)) & 0xFF
+
+    m = Module()
+    m.submodules.ram = ram = BasicMemory(depth = 256,
+                                         contents = [0] * 128 + [1])
+    m.submodules.flash = flash = SpiFlashMemory(
+        addr_bits = ADDR_BITS,
+        offset = OFFSET,
+        cache_lines = cache_lines,
+    )
+    m.submodules.fabric = fabric = SimpleFabric([ram.bus, flash.bus])
+    m.submodules.cpu = cpu = Cpu(
+        addr_width = fabric.bus.cmd.payload.addr.shape().width + 1,
+        reset_vector = FLASH_BASE,
+        wait_states = True,
+    )
+    connect(m, cpu.bus, fabric.bus)
+    model = FlashModel(flash, contents)
+    result = {}
+
+    def process():
+        cycles = 0
+        while cycles < max_cycles:
+            yield
+            cycles += 1
+            if (yield cpu.rvfi.valid) and \
+                    (yield cpu.rvfi.payload.pc_rdata) == STOP_AT:
+                break
+        result["cycles"] = cycles
+        if cycles == max_cycles:
+            result["error"] = f"still running after {cycles} cycles"
+            return
+        for (addr, value) in [(0x100, 31), (0x104, 145)]:
+            actual = (yield from ram.peek(addr // 2)) \
+                    | (yield from ram.peek(addr // 2 + 1)) << 16
+            if actual != value:
+                result["error"] = (f"@{addr:X} should be {value} but is "
+                                   f"{actual}")
+                return
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(model.process(
+        running = lambda: "cycles" not in result,
+    ))
+    sim.add_sync_process(process)
+    sim.run()
+    return result
+
+parser = argparse.ArgumentParser(
+    prog = "sim-flash",
+    description = "Test SpiFlashMemory against a model of an SPI flash",
+)
+parser.add_argument('--max-cycles', type = int, default = 200_000,
+                    help = 'give up on the program after this many cycles')
+args = parser.parse_args()
+
+rng = random.Random(1)
+words = 1 << ADDR_BITS
+read_cases = [
+    ("sequential reads", list(range(256))),
+    ("random reads", [rng.randrange(words) for _ in range(64)]),
+    ("looping reads", list(range(0x40, 0x58)) * 8),
+]
+
+passed = 0
+failed = 0
+for cache_lines in (0, 64):
+    cases = [
+        (name, lambda addrs = addrs: run_reads(addrs, cache_lines))
+        for (name, addrs) in read_cases
+    ] + [
+        ("CPU runs a loop from flash",
+         lambda: run_program(cache_lines, args.max_cycles)),
+    ]
+    for (name, run) in cases:
+        result = run()
+        label = f"{name}, cache_lines = {cache_lines}"
+        if "error" in result:
+            print(f"{label} ... ({result['cycles']} cyc) FAIL: "
+                  f"{result['error']}")
+            failed += 1
+        else:
+            print(f"{label} ... ({result['cycles']} cyc) PASS")
+            passed += 1
+
+print(f"{passed} passed, {failed} failed")
+if failed:
+    sys.exit(1)
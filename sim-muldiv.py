@@ -0,0 +1,204 @@
+import argparse
+import sys
+import time
+
+from amaranth import *
+from amaranth.lib.wiring import *
+
+from hapenny.cpu import Cpu
+from hapenny.cxxrtl import Simulation
+from hapenny.mbox import MULTIPLIERS
+from hapenny.mem import BasicMemory
+from hapenny.model import Bus, Hart, Ram, HAPENNY
+
+# Runs every M instruction on a few pairs of operands, on a CPU compiled with
+# CXXRTL, and checks the results and the cycles it took against the Python
+# model. This is mainly for the "dsp" multiplier, which Amaranth's simulator
+# can't run (and so sim-cpu.py can't test): its SB_MAC16 only simulates with
+# Yosys' iCE40 cell models. The first run spends a minute or so compiling.
+#
+#     python sim-muldiv.py --multiplier dsp
+
+# The program reads pairs of operands from TABLE, and writes the results of
+# MUL, MULH, MULHSU, MULHU, DIV, DIVU, REM and REMU for each pair to RESULTS,
+# a word each. Then it writes the cycles that took, by its own count, to
+# ELAPSED.
+PROGRAM = [
+# 0       c00029f3                rdcycle s3
+    0xc00029f3,
+# 4       40000413                li      s0,1024
+    0x40000413,
+# 8       60000493                li      s1,1536
+    0x60000493,
+# c       00c00913                li      s2,12
+    0x00c00913,
+# 10      00042503                lw      a0,0(s0)
+    0x00042503,
+# 14      00442583                lw      a1,4(s0)
+    0x00442583,
+# 18      02b502b3                mul     t0,a0,a1
+    0x02b502b3,
+# 1c      0054a023                sw      t0,0(s1)
+    0x0054a023,
+# 20      02b512b3                mulh    t0,a0,a1
+    0x02b512b3,
+# 24      0054a223                sw      t0,4(s1)
+    0x0054a223,
+# 28      02b522b3                mulhsu  t0,a0,a1
+    0x02b522b3,
+# 2c      0054a423                sw      t0,8(s1)
+    0x0054a423,
+# 30      02b532b3                mulhu   t0,a0,a1
+    0x02b532b3,
+# 34      0054a623                sw      t0,12(s1)
+    0x0054a623,
+# 38      02b542b3                div     t0,a0,a1
+    0x02b542b3,
+# 3c      0054a823                sw      t0,16(s1)
+    0x0054a823,
+# 40      02b552b3                divu    t0,a0,a1
+    0x02b552b3,
+# 44      0054aa23                sw      t0,20(s1)
+    0x0054aa23,
+# 48      02b562b3                rem     t0,a0,a1
+    0x02b562b3,
+# 4c      0054ac23                sw      t0,24(s1)
+    0x0054ac23,
+# 50      02b572b3                remu    t0,a0,a1
+    0x02b572b3,
+# 54      0054ae23                sw      t0,28(s1)
+    0x0054ae23,
+# 58      00840413                addi    s0,s0,8
+    0x00840413,
+# 5c      02048493                addi    s1,s1,32
+    0x02048493,
+# 60      fff90913                addi    s2,s2,-1
+    0xfff90913,
+# 64      fa0916e3                bnez    s2,10
+    0xfa0916e3,
+# 68      c0002a73                rdcycle s4
+    0xc0002a73,
+# 6c      413a0ab3                sub     s5,s4,s3
+    0x413a0ab3,
+# 70      7f502e23                sw      s5,2044(zero)
+    0x7f502e23,
+# 74      0000006f                j       74
+    0x0000006f,
+]
+TABLE = 0x400
+RESULTS = 0x600
+ELAPSED = 0x7FC
+FIRST_RDCYCLE = 0x0
+LAST_RDCYCLE = 0x68
+DONE = 0x74
+
+# Must be as many as the program's loop count.
+OPERANDS = [
+    (7, 6),
+    (0xCAFEBABE, 0xBAADF00D),
+    (0x80000000, 0x80000000),
+    (0xCAFEBABE, 0x12345678),
+    (0x12345678, 0xBAADF00D),
+    (0x000003E8, 0xFFFFFFF9),
+    (0x80000000, 0xFFFFFFFF),
+    (0xCAFEBABE, 0),
+    (0xFFFFFC18, 7),
+    (5, 0xFFFFFFFF),
+    (0xFFFFFFFF, 0xFFFFFFFF),
+    (0x0000FFFF, 0x0000FFFF),
+]
+NAMES = ["MUL", "MULH", "MULHSU", "MULHU", "DIV", "DIVU", "REM", "REMU"]
+
+MEMORY_WORDS = 1024
+MEMORY = "mem U$0"
+
+def halfwords(words):
+    return [h for w in words for h in (w & 0xFFFF, w >> 16)]
+
+def image():
+    contents = [0] * MEMORY_WORDS
+    program = halfwords(PROGRAM)
+    contents[:len(program)] = program
+    table = halfwords([x for pair in OPERANDS for x in pair])
+    contents[TABLE // 2:TABLE // 2 + len(table)] = table
+    return contents
+
+class Test(Elaboratable):
+    def __init__(self, multiplier):
+        self.multiplier = multiplier
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.mem = mem = BasicMemory(depth = MEMORY_WORDS,
+                                             contents = image())
+        m.submodules.cpu = cpu = Cpu(
+            addr_width = mem.addr_bits + 1,
+            counters = True,
+            muldiv = True,
+            multiplier = self.multiplier,
+        )
+        connect(m, cpu.bus, mem.bus)
+        return m
+
+def read_word(read, addr):
+    return read(addr // 2) | (read(addr // 2 + 1) << 16)
+
+parser = argparse.ArgumentParser(
+    prog = "sim-muldiv",
+    description = "Test the M extension on a CPU compiled with CXXRTL",
+)
+parser.add_argument('--multiplier', choices = MULTIPLIERS, default = 'dsp',
+                    help = 'multiplier to build the CPU with (default: dsp)')
+parser.add_argument('--max-cycles', type = int, default = 100_000,
+                    help = 'give up after this many cycles')
+args = parser.parse_args()
+
+# What the model makes of the same program.
+ram = Ram(2 * MEMORY_WORDS)
+ram.load_halfwords(image())
+bus = Bus(addr_width = 11)
+bus.add(0, 2 * MEMORY_WORDS, ram)
+hart = Hart(
+    bus,
+    timing = HAPENNY.configure(muldiv = True, multiplier = args.multiplier),
+    muldiv = True,
+)
+hart.run(until_pc = FIRST_RDCYCLE)
+start = hart.cycles
+hart.run(until_pc = LAST_RDCYCLE)
+model_cycles = hart.cycles - start
+hart.run(until_pc = DONE)
+
+start = time.time()
+sim = Simulation(Test(args.multiplier),
+                 cell_models = args.multiplier == "dsp")
+print(f"model ready in {time.time() - start:.1f} s", file = sys.stderr)
+sim.reset()
+read = lambda i: sim.read_memory(MEMORY, i)
+while sim.cycle < args.max_cycles and read_word(read, ELAPSED) == 0:
+    sim.run(1000)
+
+failures = 0
+for (n, (a, b)) in enumerate(OPERANDS):
+    for (i, name) in enumerate(NAMES):
+        addr = RESULTS + 32 * n + 4 * i
+        actual = read_word(read, addr)
+        expected = ram.read(addr, 4)
+        if actual != expected:
+            print(f"{name} 0x{a:08x}, 0x{b:08x} should be 0x{expected:08x} "
+                  f"but is 0x{actual:08x}")
+            failures += 1
+
+elapsed = read_word(read, ELAPSED)
+if elapsed == 0:
+    print(f"program didn't finish in {sim.cycle} cycles")
+    failures += 1
+elif elapsed != model_cycles:
+    print(f"program took {elapsed} cycles, but the model says "
+          f"{model_cycles}")
+    failures += 1
+
+print(f"{args.multiplier}: {len(OPERANDS) * len(NAMES)} results, "
+      f"{elapsed} cycles, {failures} problems")
+if failures:
+    sys.exit(1)
@@ -0,0 +1,266 @@
+import argparse
+import sys
+
+from amaranth import *
+from amaranth.sim import Simulator
+
+from hapenny.bus import add_wait_states
+from hapenny.mem import BasicMemory
+from hapenny.multicore import MultiCore
+
+# Runs a few programs on a simulated MultiCore SoC, checking that the cores
+# can tell themselves apart, that the Mailbox's locks and inboxes work when
+# several cores lean on them at once, and how long a trivially parallel
+# batch job takes. Every core runs the same program out of its own
+# scratchpad, and the cases check what they leave in shared memory once they
+# all reach 'stop_after'.
+#
+# Try it with different --cores to see how the batch job scales.
+
+# Where the test SoC (a 256-halfword scratchpad per core, and a 256-halfword
+# shared RAM followed by the mailbox) puts things.
+SHARED_RAM = 0x400
+MAILBOX = 0x600
+
+class TestCase:
+    """One program to run on all the cores.
+
+    'before' and 'after' map byte addresses in shared RAM to the 32-bit
+    words that should be there before and after running.
+    """
+    def __init__(self, name, inst, *, stop_after, before = {}, after = {}):
+        self.name = name
+        self.inst = inst
+        self.stop_after = stop_after
+        self.before = before
+        self.after = after
+
+def build_cases(cores):
+    cases = []
+    cases.append(TestCase(
+        "cores read their IDs",
+        [
+# 0       60000493                li      s1,1536
+            0x60000493,
+# 4       0004d503                lhu     a0,0(s1)
+            0x0004d503,
+# 8       00251593                slli    a1,a0,2
+            0x00251593,
+# c       01050613                addi    a2,a0,16
+            0x01050613,
+# 10      40c5a023                sw      a2,1024(a1)
+            0x40c5a023,
+# 14      0000006f                j       14
+            0x0000006f,
+        ],
+        stop_after = 0x14,
+        after = {SHARED_RAM + 4 * n: 0x10 + n for n in range(cores)},
+    ))
+    cases.append(TestCase(
+        "lock guards a shared counter",
+        [
+# 0       60000493                li      s1,1536
+            0x60000493,
+# 4       00a00513                li      a0,10
+            0x00a00513,
+# 8       0404d283                lhu     t0,64(s1)
+            0x0404d283,
+# c       fe029ee3                bnez    t0,8
+            0xfe029ee3,
+# 10      40002303                lw      t1,1024(zero)
+            0x40002303,
+# 14      00130313                addi    t1,t1,1
+            0x00130313,
+# 18      40602023                sw      t1,1024(zero)
+            0x40602023,
+# 1c      04049023                sh      zero,64(s1)
+            0x04049023,
+# 20      fff50513                addi    a0,a0,-1
+            0xfff50513,
+# 24      fe0512e3                bnez    a0,8
+            0xfe0512e3,
+# 28      0000006f                j       28
+            0x0000006f,
+        ],
+        stop_after = 0x28,
+        before = {SHARED_RAM: 0},
+        after = {SHARED_RAM: 10 * cores},
+    ))
+    cases.append(TestCase(
+        "messages go around a ring",
+        [
+# 0       60000493                li      s1,1536
+            0x60000493,
+# 4       0004d503                lhu     a0,0(s1)
+            0x0004d503,
+# 8       00150593                addi    a1,a0,1
+            0x00150593,
+# c       0064d283                lhu     t0,6(s1)
+            0x0064d283,
+# 10      00559463                bne     a1,t0,18
+            0x00559463,
+# 14      00000593                li      a1,0
+            0x00000593,
+# 18      00159313                slli    t1,a1,1
+            0x00159313,
+# 1c      00930333                add     t1,t1,s1
+            0x00930333,
+# 20      10050613                addi    a2,a0,256
+            0x10050613,
+# 24      02c31023                sh      a2,32(t1)
+            0x02c31023,
+# 28      00100393                li      t2,1
+            0x00100393,
+# 2c      00a393b3                sll     t2,t2,a0
+            0x00a393b3,
+# 30      0024d283                lhu     t0,2(s1)
+            0x0024d283,
+# 34      0072f2b3                and     t0,t0,t2
+            0x0072f2b3,
+# 38      fe028ce3                beqz    t0,30
+            0xfe028ce3,
+# 3c      0044d683                lhu     a3,4(s1)
+            0x0044d683,
+# 40      00049223                sh      zero,4(s1)
+            0x00049223,
+# 44      00251313                slli    t1,a0,2
+            0x00251313,
+# 48      40d32023                sw      a3,1024(t1)
+            0x40d32023,
+# 4c      0000006f                j       4c
+            0x0000006f,
+        ],
+        stop_after = 0x4c,
+        after = {
+            SHARED_RAM + 4 * n: 0x100 + (n - 1) % cores for n in range(cores)
+        },
+    ))
+    # Each core sums every CORES'th element of a 64-word array, starting
+    # with its own number.
+    array = [3 * i + 1 for i in range(64)]
+    cases.append(TestCase(
+        "cores sum an array between them",
+        [
+# 0       60000493                li      s1,1536
+            0x60000493,
+# 4       0004d503                lhu     a0,0(s1)
+            0x0004d503,
+# 8       00251293                slli    t0,a0,2
+            0x00251293,
+# c       0064d303                lhu     t1,6(s1)
+            0x0064d303,
+# 10      00231313                slli    t1,t1,2
+            0x00231313,
+# 14      10000393                li      t2,256
+            0x10000393,
+# 18      00000593                li      a1,0
+            0x00000593,
+# 1c      5002ae03                lw      t3,1280(t0)
+            0x5002ae03,
+# 20      01c585b3                add     a1,a1,t3
+            0x01c585b3,
+# 24      006282b3                add     t0,t0,t1
+            0x006282b3,
+# 28      fe72cae3                blt     t0,t2,1c
+            0xfe72cae3,
+# 2c      00251e93                slli    t4,a0,2
+            0x00251e93,
+# 30      40bea023                sw      a1,1024(t4)
+            0x40bea023,
+# 34      0000006f                j       34
+            0x0000006f,
+        ],
+        stop_after = 0x34,
+        before = {
+            SHARED_RAM + 0x100 + 4 * i: x for (i, x) in enumerate(array)
+        },
+        after = {
+            SHARED_RAM + 4 * n: sum(array[n::cores]) for n in range(cores)
+        },
+    ))
+    return cases
+
+def halfwords(words):
+    return [h for w in words for h in (w & 0xFFFF, w >> 16)]
+
+def run_case(case, cores, max_cycles, wait_states):
+    ram_contents = [0] * 256
+    for (addr, value) in case.before.items():
+        i = (addr - SHARED_RAM) // 2
+        ram_contents[i:i + 2] = halfwords([value])
+
+    m = Module()
+    m.submodules.ram = ram = BasicMemory(depth = 256,
+                                         contents = ram_contents)
+    shared_ram = ram.bus
+    if wait_states:
+        shared_ram = add_wait_states(m, shared_ram, wait_states)
+    m.submodules.soc = soc = MultiCore(
+        cores = cores,
+        shared = [shared_ram],
+        image = halfwords(case.inst),
+        scratchpad_words = 256,
+    )
+    assert soc.addresses == [SHARED_RAM, MAILBOX], \
+            "the test programs have the SoC's address map baked in"
+
+    result = {}
+
+    def process():
+        finished = set()
+        cycles = 0
+        while len(finished) < cores and cycles < max_cycles:
+            yield
+            cycles += 1
+            for (n, cpu) in enumerate(soc.cpus):
+                if (yield cpu.rvfi.valid) and \
+                        (yield cpu.rvfi.payload.pc_rdata) == case.stop_after:
+                    finished.add(n)
+        result["cycles"] = cycles
+        if len(finished) < cores:
+            result["error"] = (f"cores {sorted(set(range(cores)) - finished)}"
+                               f" still running after {cycles} cycles")
+            return
+        for (addr, value) in case.after.items():
+            i = (addr - SHARED_RAM) // 2
+            actual = (yield from ram.peek(i)) \
+                    | (yield from ram.peek(i + 1)) << 16
+            if actual != value:
+                result["error"] = (f"@{addr:X} should be 0x{value:08x} but "
+                                   f"is 0x{actual:08x}")
+                return
+
+    sim = Simulator(m)
+    sim.add_clock(1e-6)
+    sim.add_sync_process(process)
+    sim.run()
+    return result
+
+parser = argparse.ArgumentParser(
+    prog = "sim-multicore",
+    description = "Test a multi-core hapenny SoC in simulation",
+)
+parser.add_argument('--cores', type = int, default = 4,
+                    help = 'number of cores to build (default: 4)')
+parser.add_argument('--wait-states', type = int, default = 0,
+                    help = 'give the shared RAM this many wait states')
+parser.add_argument('--max-cycles', type = int, default = 20_000,
+                    help = 'give up on a case after this many cycles')
+args = parser.parse_args()
+
+passed = 0
+failed = 0
+for case in build_cases(args.cores):
+    result = run_case(case, args.cores, args.max_cycles,
+                      args.wait_states)
+    if "error" in result:
+        print(f"{case.name} ... ({result['cycles']} cyc) FAIL: "
+              f"{result['error']}")
+        failed += 1
+    else:
+        print(f"{case.name} ... ({result['cycles']} cyc) PASS")
+        passed += 1
+
+print(f"{passed} passed, {failed} failed")
+if failed:
+    sys.exit(1)
@@ -0,0 +1,98 @@
+import argparse
+import runpy
+import sys
+import time
+from pathlib import Path
+
+from hapenny.cxxrtl import Simulation
+
+# Runs a whole SoC from one of the board scripts (its Test class) in a
+# compiled CXXRTL simulation, printing whatever the firmware sends out the
+# UART. The first run of a given design spends a minute or so compiling it;
+# later runs reuse the compiled model from build/cxxrtl.
+#
+# For example, to run the UPduino SoC's bootloader for a second of simulated
+# time:
+#
+#     python sim-soc.py upduino-large.py --cycles 24000000
+#
+# Use --load to preload memories (by their CXXRTL names, which --list prints)
+# with firmware, e.g. to skip the bootloader by overwriting boot memory:
+#
+#     python sim-soc.py upduino-large.py --load 'bootmem U$0=payload.bin'
+
+parser = argparse.ArgumentParser(
+    prog = "sim-soc",
+    description = "Simulate a board script's SoC using CXXRTL",
+)
+parser.add_argument('script', help = 'board script defining a Test class')
+parser.add_argument('--clock-freq', type = float, default = 24e6,
+                    help = 'simulated clock frequency, for the UART')
+parser.add_argument('--baud', type = int, default = 115200,
+                    help = 'UART baud rate used by the design')
+parser.add_argument('--uart', default = 'uart tx',
+                    help = 'name of the UART TX signal to decode')
+parser.add_argument('--cycles', type = int, default = 10_000_000,
+                    help = 'number of cycles to simulate')
+parser.add_argument('--until', metavar = 'SIGNAL',
+                    help = 'stop early when this signal goes high '
+                           '(e.g. "cpu halted")')
+parser.add_argument('--load', action = 'append', default = [],
+                    metavar = 'MEMORY=FILE[@ROW]',
+                    help = 'preload a memory with a binary image')
+parser.add_argument('--list', action = 'store_true',
+                    help = 'list signal and memory names and exit')
+args = parser.parse_args()
+
+# Board scripts do their building under a __name__ == "__main__" guard, so we
+# can borrow their Test class without synthesizing anything.
+board = runpy.run_path(args.script, run_name = "sim_soc_board")
+design = board["Test"](clock_freq = args.clock_freq)
+
+start = time.time()
+sim = Simulation(design)
+print(f"model ready in {time.time() - start:.1f} s", file = sys.stderr)
+
+if args.list:
+    for name in sorted(sim.names()):
+        print(name)
+    sys.exit(0)
+
+for spec in args.load:
+    memory, _, path = spec.partition("=")
+    path, _, row = path.partition("@")
+    sim.load_image(memory, Path(path).read_bytes(), int(row, 0) if row else 0)
+
+# This mirrors OversampleClock's rounding, so that we sample the bits where
+# the UART actually puts them.
+oversample = 16
+divisor = int(round(args.clock_freq / (args.baud * oversample)))
+sim.trace_uart(args.uart, divisor * oversample)
+
+sim.reset()
+start = time.time()
+remaining = args.cycles
+while remaining > 0:
+    chunk = min(remaining, 1_000_000)
+    before = sim.cycle
+    sys.stdout.write(sim.run(chunk, until = args.until)
+                     .decode("latin-1"))
+    sys.stdout.flush()
+    remaining -= sim.cycle - before
+    if sim.cycle - before < chunk:
+        break
+elapsed = time.time() - start
+
+print(file = sys.stderr)
+print(f"ran {sim.cycle} cycles in {elapsed:.1f} s "
+      f"({sim.cycle / elapsed / 1e6:.2f} MHz)", file = sys.stderr)
+try:
+    cycles = sim["cpu cycle_counter"]
+    instret = sim["cpu ew instret_counter"]
+except KeyError:
+    # Built without counters.
+    pass
+else:
+    print(f"CPU counters: {cycles} cycles, {instret} instructions retired"
+          + (f", CPI {cycles / instret:.3f}" if instret else ""),
+          file = sys.stderr)
@@ -0,0 +1,140 @@
+import argparse
+import ast
+import csv
+import itertools
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from pathlib import Path
+
+from hapenny.build import build_script
+
+# Builds a board script's SoC once for every combination of parameters in a
+# grid, several builds at a time, and reports what each one cost in logic
+# cells and what Fmax it reached. This is the sort of thing the notes
+# directory is full of, minus the afternoon of running synthesis by hand.
+#
+# The board script needs a Test class whose constructor takes the parameters
+# being swept, and a PLATFORM naming the board's platform class;
+# icestick-smallest.py has both. For example:
+#
+#     python sweep.py icestick-smallest.py -p ram_words=256,512,1024 \
+#         -p narrow_pc=True,False -p counters=False,True
+#
+# Every point is written to a CSV file (sweep.csv by default), and the points
+# on the Pareto front -- the ones that no other point beats on both size and
+# speed -- are printed at the end. Timing failures don't stop a build here,
+# since the achieved Fmax is the interesting part, so a point that misses the
+# board's PLL frequency is still reported (with timing_met = False).
+#
+# The toolchain is found the way Amaranth's build always finds it, so you may
+# need to set YOSYS, NEXTPNR_ICE40 and ICEPACK.
+#
+# Placement luck moves Fmax around by several MHz, which can swamp the effect
+# of a parameter. --seeds N places each point N times and keeps the best,
+# which costs N times as much place-and-route time.
+
+def parse_param(text):
+    "Parses NAME=V1,V2,... into (NAME, [values])."
+    name, sep, values = text.partition("=")
+    if not sep or not name or not values:
+        raise argparse.ArgumentTypeError(f"expected NAME=V1,V2,...: {text}")
+    return name, [parse_value(v) for v in values.split(",")]
+
+def parse_value(text):
+    # Python literals (numbers, True/False, None) as themselves; anything
+    # else is a string.
+    try:
+        return ast.literal_eval(text)
+    except (ValueError, SyntaxError):
+        return text
+
+def pareto_front(rows):
+    """Returns the rows that no other row beats on both LCs (smaller is
+    better) and Fmax (larger is better), in order of size."""
+    front = []
+    for row in sorted(rows, key = lambda r: (r["lcs"], -r["fmax"])):
+        if not front or row["fmax"] > front[-1]["fmax"]:
+            front.append(row)
+    return front
+
+def describe(params):
+    return " ".join(f"{k}={v}" for k, v in params.items()) or "(defaults)"
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "sweep",
+        description = "Build a board script's SoC over a grid of parameters",
+    )
+    parser.add_argument('script',
+                        help = 'board script defining Test and PLATFORM')
+    parser.add_argument('-p', '--param', action = 'append', default = [],
+                        type = parse_param, metavar = 'NAME=V1,V2,...',
+                        help = 'a Test parameter and the values to try '
+                               '(repeat for more parameters)')
+    parser.add_argument('-j', '--jobs', type = int, default = os.cpu_count(),
+                        help = 'number of builds to run at once')
+    parser.add_argument('--seeds', type = int,
+                        help = 'place each point with this many nextpnr '
+                               'seeds and keep the fastest')
+    parser.add_argument('--csv', default = 'sweep.csv',
+                        help = 'where to write the results')
+    parser.add_argument('--build-dir', default = 'build/sweep',
+                        help = 'directory to hold each point\'s build')
+    args = parser.parse_args()
+
+    names = [name for name, _ in args.param]
+    if len(set(names)) != len(names):
+        sys.exit("each parameter can only be given once")
+    grid = [dict(zip(names, values))
+            for values in itertools.product(*(v for _, v in args.param))]
+    print(f"sweeping {len(grid)} points, {args.jobs} at a time")
+
+    rows = [None] * len(grid)
+    with ProcessPoolExecutor(max_workers = args.jobs) as pool:
+        futures = {}
+        for i, params in enumerate(grid):
+            build_dir = Path(args.build_dir) / f"{i:03}"
+            futures[pool.submit(
+                build_script, args.script, params,
+                build_dir = build_dir,
+                seeds = args.seeds,
+                jobs = 1,
+                nextpnr_opts = "--timing-allow-fail",
+            )] = (i, params, build_dir)
+
+        for future in as_completed(futures):
+            i, params, build_dir = futures[future]
+            row = dict(params, build_dir = str(build_dir))
+            try:
+                report = future.result()
+            except Exception as e:
+                print(f"{describe(params)}: FAILED ({e}); see {build_dir}")
+                row.update(lcs = None, brams = None, fmax = None,
+                           timing_met = None)
+            else:
+                row.update(lcs = report.lcs, brams = report.brams,
+                           fmax = report.fmax,
+                           timing_met = report.timing_met)
+                print(f"{describe(params)}: {report.lcs} LCs, "
+                      f"{report.fmax} MHz")
+            rows[i] = row
+
+    with open(args.csv, "w", newline = "") as f:
+        writer = csv.DictWriter(f, fieldnames = names + [
+            "lcs", "brams", "fmax", "timing_met", "build_dir",
+        ])
+        writer.writeheader()
+        writer.writerows(rows)
+    print(f"wrote {args.csv}")
+
+    built = [r for r in rows if r["lcs"] is not None and r["fmax"] is not None]
+    print()
+    print("Pareto front (fewest LCs for a given Fmax):")
+    for row in pareto_front(built):
+        params = {k: row[k] for k in names}
+        print(f"  {row['lcs']:5} LCs  {row['fmax']:7.2f} MHz  "
+              f"{describe(params)}")
+
+    if len(built) < len(rows):
+        sys.exit(1)
@@ -0,0 +1,124 @@
+import argparse
+import filecmp
+import shutil
+import sys
+import tempfile
+from pathlib import Path
+
+from amaranth import *
+from amaranth.lib.memory import Memory
+from amaranth_boards.icestick import ICEStickPlatform
+
+import hapenny.build
+from hapenny.build import BuildError
+from hapenny.mem import BasicMemory
+
+# Checks that the build cache and update_memories notice when a memory that
+# yosys turned into logic changes. Both work by patching new contents into
+# the block RAMs of an old bitstream, which can't help with a memory that
+# isn't in block RAM, so a change to one has to mean a full build (for the
+# cache) or an error (for update_memories), never the old bitstream with the
+# old contents.
+#
+# This runs the real tools on a small design for the Icestick, so set YOSYS,
+# NEXTPNR_ICE40 and ICEPACK as for the board scripts, e.g.
+#
+#     YOSYS=yowasp-yosys NEXTPNR_ICE40=yowasp-nextpnr-ice40 \
+#         ICEPACK=yowasp-icepack python test-build.py
+
+class Top(Elaboratable):
+    """Counts through a block RAM and a tiny ROM, which is small enough for
+    yosys to build out of LUTs, and shows the two XORed together on the
+    LEDs."""
+    def __init__(self, ram, rom):
+        self.ram = ram
+        self.rom = rom
+
+    def elaborate(self, platform):
+        m = Module()
+        m.submodules.ram = ram = BasicMemory(depth = 256, contents = self.ram)
+        m.submodules.rom = rom = Memory(shape = 4, depth = 4, init = self.rom)
+        rom_read = rom.read_port(domain = "comb")
+
+        counter = Signal(24)
+        m.d.sync += counter.eq(counter + 1)
+        m.d.comb += [
+            ram.bus.cmd.valid.eq(1),
+            ram.bus.cmd.payload.addr.eq(counter[16:]),
+            rom_read.addr.eq(counter[22:]),
+        ]
+
+        data = ram.bus.resp
+        leds = Cat(*(platform.request("led", i).o for i in range(4)))
+        m.d.comb += leds.eq(data[:4] ^ data[4:8] ^ data[8:12] ^ data[12:]
+                            ^ rom_read.data)
+        return m
+
+RAM = [(i * 0x9E37) & 0xFFFF for i in range(256)]
+NEW_RAM = [(i * 0x7F4A + 1) & 0xFFFF for i in range(256)]
+ROM = [0x3, 0x5, 0x9, 0xE]
+NEW_ROM = [0x3, 0x5, 0x9, 0x6]
+
+def build(top, build_dir, cache = None):
+    return hapenny.build.build(ICEStickPlatform(), top, build_dir = build_dir,
+                               cache = cache)
+
+def case_firmware_update(work):
+    # A block RAM change goes through; a change to the ROM doesn't.
+    build_dir = work / "update"
+    build(Top(RAM, ROM), build_dir)
+    hapenny.build.update_memories(ICEStickPlatform(), Top(NEW_RAM, ROM),
+                                  build_dir = build_dir)
+    try:
+        hapenny.build.update_memories(ICEStickPlatform(),
+                                      Top(NEW_RAM, NEW_ROM),
+                                      build_dir = build_dir)
+    except BuildError as e:
+        if "rom" not in str(e):
+            return f"BuildError doesn't name the ROM: {e}"
+        return None
+    return "update_memories accepted a change to a ROM in logic"
+
+def case_cache(work):
+    # After a change to the ROM, the cache has to give us what a build from
+    # scratch would.
+    cache = work / "cache"
+    build(Top(RAM, ROM), work / "cached", cache = cache)
+    build(Top(RAM, NEW_ROM), work / "cached", cache = cache)
+    build(Top(RAM, NEW_ROM), work / "fresh")
+    if not filecmp.cmp(work / "cached" / "top.asc", work / "fresh" / "top.asc",
+                       shallow = False):
+        return "cached build of the new ROM differs from a fresh build"
+    return None
+
+parser = argparse.ArgumentParser(
+    prog = "test-build",
+    description = "Test the build cache and update_memories against "
+                  "memories that yosys puts in logic",
+)
+parser.add_argument('--keep', action = 'store_true',
+                    help = 'leave the build directories behind in build/')
+args = parser.parse_args()
+
+if args.keep:
+    work = Path("build/test-build")
+    shutil.rmtree(work, ignore_errors = True)
+else:
+    work = Path(tempfile.mkdtemp(prefix = "test-build-"))
+
+failures = 0
+for (name, case) in [
+    ("update_memories refuses a changed ROM in logic", case_firmware_update),
+    ("build cache rebuilds for a changed ROM in logic", case_cache),
+]:
+    error = case(work)
+    if error is None:
+        print(f"{name} ... PASS")
+    else:
+        print(f"{name} ... FAIL: {error}")
+        failures += 1
+
+if not args.keep:
+    shutil.rmtree(work)
+if failures:
+    sys.exit(1)
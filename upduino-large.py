@@ -9,6 +9,7 @@ from amaranth.build import ResourceError, Resource, Pins, Attrs
 from amaranth_boards.upduino_v3 import UpduinoV3Platform
 
 from hapenny import StreamSig
+import hapenny.build
 import hapenny.cpu
 from hapenny.bus import BusPort, SimpleFabric, partial_decode
 from hapenny.gpio import OutputPort
@@ -18,12 +19,31 @@ from hapenny.mem import BasicMemory, SpramMemory
 RAM_WORDS = 256 * 1
 RAM_ADDR_BITS = (RAM_WORDS - 1).bit_length()
 
-print(f"boot memory will use {RAM_ADDR_BITS}-bit addressing")
-
 bootloader = Path("upduino-bootloader.bin").read_bytes()
 boot_image = struct.unpack("<" + "h" * (len(bootloader) // 2), bootloader)
 
 class Test(Elaboratable):
+    """The SoC. With no platform (as when simulating it with hapenny.cxxrtl)
+    the pins aren't wired up, RX idles high, and the UART needs to be told the
+    clock frequency.
+
+    Parameters
+    ----------
+    clock_freq (float): clock frequency for the UART, if there's no platform
+        to ask.
+    uart: a component to use in place of the BidiUart, such as a SimUart.
+    muldiv (bool): give the CPU the M extension, with its multiplier in one
+        of the UP5K's DSPs.
+    compressed (bool): give the CPU the C extension.
+    """
+
+    def __init__(self, clock_freq = None, uart = None, muldiv = False,
+                 compressed = False):
+        self.clock_freq = clock_freq
+        self.uart = uart
+        self.muldiv = muldiv
+        self.compressed = compressed
+
     def elaborate(self, platform):
         m = Module()
 
@@ -38,12 +58,18 @@ class Test(Elaboratable):
             # parameter is in bytes.)
             prog_addr_width = 1 + 14 + 1,
             counters = True,
+            muldiv = self.muldiv,
+            compressed = self.compressed,
         )
         m.submodules.bootmem = bootmem = BasicMemory(depth = RAM_WORDS,
                                                      contents = boot_image)
         m.submodules.bulkmem0 = bulkmem0 = SpramMemory()
         m.submodules.port = port = OutputPort(1)
-        m.submodules.uart = uart = BidiUart(baud_rate = 115200)
+        if self.uart is not None:
+            uart = self.uart
+        else:
+            uart = BidiUart(baud_rate = 115200, clock_freq = self.clock_freq)
+        m.submodules.uart = uart
         m.submodules.fabric = fabric = SimpleFabric([
             # Put all the potentially executable RAM in the bottom portion of
             # the address space, to allow PC and fetch circuitry to be slightly
@@ -55,6 +81,11 @@ class Test(Elaboratable):
         ])
 
         connect(m, cpu.bus, fabric.bus)
+
+        if platform is None:
+            m.d.comb += uart.rx.eq(1)
+            return m
+
         platform.add_resources([
             Resource("tx", 0, Pins("7", dir="o", conn=("j", 0))),
             Resource("rx", 0, Pins("8", dir="i", conn=("j", 0))),
@@ -81,13 +112,33 @@ class Test(Elaboratable):
 
         return m
 
-parser = argparse.ArgumentParser(
-    prog = "upduino-large",
-    description = "Script for synthesizing a larger UPduino SoC",
-)
-args = parser.parse_args()
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "upduino-large",
+        description = "Script for synthesizing a larger UPduino SoC",
+    )
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'rebuild from scratch instead of reusing '
+                               'results from build/cache')
+    parser.add_argument('--firmware-only', action = 'store_true',
+                        help = 'just put new memory contents into the last '
+                               'build\'s bitstream, skipping synthesis and '
+                               'place and route')
+    parser.add_argument('--muldiv', action = 'store_true',
+                        help = 'give the CPU the M extension')
+    parser.add_argument('--compressed', action = 'store_true',
+                        help = 'give the CPU the C extension')
+    args = parser.parse_args()
 
+    print(f"boot memory will use {RAM_ADDR_BITS}-bit addressing")
 
-p = UpduinoV3Platform()
-p.hfosc_div = 1 # divide 48MHz by 2**1 = 24 MHz
-p.build(Test(), do_program = True)
+    p = UpduinoV3Platform()
+    p.hfosc_div = 1 # divide 48MHz by 2**1 = 24 MHz
+    soc = Test(muldiv = args.muldiv, compressed = args.compressed)
+    if args.firmware_only:
+        hapenny.build.update_memories(p, soc, build_dir = "build",
+                                      do_program = True)
+    else:
+        hapenny.build.build(p, soc, build_dir = "build",
+                            cache = None if args.no_cache else "build/cache",
+                            do_program = True)
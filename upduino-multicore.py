@@ -0,0 +1,130 @@
+import argparse
+import struct
+from pathlib import Path
+
+from amaranth import *
+from amaranth.lib.wiring import *
+from amaranth_boards.resources.interface import UARTResource
+from amaranth_boards.upduino_v3 import UpduinoV3Platform
+
+import hapenny.build
+from hapenny.gpio import OutputPort
+from hapenny.serial import BidiUart
+from hapenny.mem import SpramMemory
+from hapenny.multicore import MultiCore
+
+# Several cores on a UP5K, each running out of its own block RAM scratchpad,
+# sharing an SPRAM, an output port (the green LED) and the UART. The address
+# map, as every core sees it:
+#
+#     0x0_0000  the core's own scratchpad
+#     0x2_0000  SPRAM
+#     0x2_8000  output port
+#     0x3_0000  UART
+#     0x3_8000  mailbox
+#
+# The firmware (multicore/hello.bin by default) is loaded into every
+# scratchpad, and has to fit.
+
+# Used by sweep.py to build this design for the right board.
+PLATFORM = UpduinoV3Platform
+
+class Test(Elaboratable):
+    """The SoC. With no platform (as when simulating it with hapenny.cxxrtl)
+    the pins aren't wired up, RX idles high, and the UART needs to be told the
+    clock frequency.
+
+    Parameters
+    ----------
+    clock_freq (float): clock frequency for the UART, if there's no platform
+        to ask.
+    uart: a component to use in place of the BidiUart, such as a SimUart.
+    cores (int): number of cores. Each one's scratchpad and register file
+        take five of the UP5K's 30 block RAMs.
+    scratchpad_words (int): size of each core's scratchpad in halfwords.
+    firmware (path): image to load into the scratchpads.
+    """
+
+    def __init__(self, clock_freq = None, uart = None, cores = 4,
+                 scratchpad_words = 1024, firmware = "multicore/hello.bin"):
+        self.clock_freq = clock_freq
+        self.uart = uart
+        self.cores = cores
+        self.scratchpad_words = scratchpad_words
+        self.firmware = firmware
+
+    def elaborate(self, platform):
+        m = Module()
+
+        image = Path(self.firmware).read_bytes()
+        image = struct.unpack("<" + "H" * (len(image) // 2), image)
+        assert len(image) <= self.scratchpad_words, \
+                f"{self.firmware} doesn't fit in a scratchpad"
+
+        m.submodules.bulkmem0 = bulkmem0 = SpramMemory()
+        m.submodules.port = port = OutputPort(1)
+        if self.uart is not None:
+            uart = self.uart
+        else:
+            uart = BidiUart(baud_rate = 115200, clock_freq = self.clock_freq)
+        m.submodules.uart = uart
+        m.submodules.soc = soc = MultiCore(
+            cores = self.cores,
+            shared = [
+                bulkmem0.bus,
+                port.bus,
+                uart.bus,
+            ],
+            image = image,
+            scratchpad_words = self.scratchpad_words,
+        )
+        assert soc.addresses == [0x2_0000, 0x2_8000, 0x3_0000, 0x3_8000], \
+                "address map has moved; update the comment and firmware"
+
+        if platform is None:
+            m.d.comb += uart.rx.eq(1)
+            return m
+
+        platform.add_resources([
+            UARTResource(0, rx = "8", tx = "7", conn = ("j", 0)),
+        ])
+        uart.bind(m, platform.request("uart", 0))
+
+        rgb_led = platform.request("rgb_led", 0)
+        m.d.comb += [
+            rgb_led.r.o.eq(Cat(cpu.halted for cpu in soc.cpus).any()),
+            rgb_led.g.o.eq(port.pins[0]),
+        ]
+
+        return m
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(
+        prog = "upduino-multicore",
+        description = "Script for synthesizing a multi-core UPduino SoC",
+    )
+    parser.add_argument('--no-cache', action = 'store_true',
+                        help = 'rebuild from scratch instead of reusing '
+                               'results from build/cache')
+    parser.add_argument('--firmware-only', action = 'store_true',
+                        help = 'just put new memory contents into the last '
+                               'build\'s bitstream, skipping synthesis and '
+                               'place and route')
+    parser.add_argument('--cores', type = int, default = 4,
+                        help = 'number of cores (default: 4)')
+    parser.add_argument('--firmware', default = "multicore/hello.bin",
+                        help = 'image to load into every core\'s scratchpad')
+    args = parser.parse_args()
+
+    p = UpduinoV3Platform()
+    # A core with wait states only just makes 24 MHz on the UP5K, and several
+    # of them don't quite.
+    p.hfosc_div = 2 # divide 48MHz by 2**2 = 12 MHz
+    soc = Test(cores = args.cores, firmware = args.firmware)
+    if args.firmware_only:
+        hapenny.build.update_memories(p, soc, build_dir = "build",
+                                      do_program = True)
+    else:
+        hapenny.build.build(p, soc, build_dir = "build",
+                            cache = None if args.no_cache else "build/cache",
+                            do_program = True)